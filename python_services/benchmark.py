@@ -0,0 +1,905 @@
+"""
+Benchmark hors ligne du microservice d'images
+L'application FastAPI est pilotée en process (client ASGI, sans réseau ni serveur) avec
+des modèles de remplacement, pour mesurer le service lui-même sur une machine CPU:
+  - stub: pipeline factice au coût par step configurable (sleep ou calcul)
+  - tiny: vrai pipeline diffusers SDXL aux poids aléatoires minuscules
+Real-ESRGAN est remplacé par un petit réseau x4 (convolution + PixelShuffle), ou par un vrai RRDBNet
+(architecture anime_6B, poids aléatoires) avec --esrgan rrdb.
+Avec --compile, les modèles désignés passent par l'exécution compilée du service (IMAGE_API_COMPILE), et la phase
+compile mesure chaque bucket de formes de --compile-buckets: latence par appel en eager, compilation, puis compilé.
+
+Mesures: temps de démarrage jusqu'à "prêt", latence de bout en bout (percentiles), débit sous charge concurrente,
+brouillon et refine contre rendu complet, coût d'encodage / décodage des images, latence d'annulation, pic de mémoire
+par phase. Les résultats sont écrits en JSON pour comparer deux exécutions:
+
+    python benchmark.py --output bench.json
+    python benchmark.py --pipeline tiny --output bench_tiny.json
+    python benchmark.py --output new.json --baseline bench.json
+    python benchmark.py --workers 2 --work compute --output bench_2workers.json
+    python benchmark.py --pipeline tiny --esrgan rrdb --cpu-precision float32 --output fp32.json
+    python benchmark.py --pipeline tiny --esrgan rrdb --cpu-precision bfloat16 --baseline fp32.json
+    python benchmark.py --pipeline tiny --esrgan rrdb --compile all --phases compile --output compiled.json
+
+Nécessite httpx (client ASGI), en plus des dépendances du service.
+"""
+
+import argparse
+import asyncio
+import base64
+import functools
+import io
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import numpy as np
+import torch
+from PIL import Image
+
+from image_encoding import OUTPUT_FORMATS, encode_image, output_encoding
+
+SCRIPT_DIR = Path(__file__).parent
+STUB_MODEL_BYTES = 64 * 1024 ** 2  # Empreinte déclarée au registre pour les modèles de remplacement
+STUB_REFERENCE_PIXELS = 512 * 512  # Les coûts du pipeline factice sont donnés pour une image de cette taille
+
+
+# ==================== MODÈLES DE REMPLACEMENT ====================
+
+def spend(seconds: float, work: str):
+    """Consomme seconds secondes: en dormant ("sleep") ou en calculant sur le CPU ("compute")"""
+    if seconds <= 0:
+        return
+    if work == "sleep":
+        time.sleep(seconds)
+        return
+    deadline = time.perf_counter() + seconds
+    matrix = torch.rand(128, 128)
+    while time.perf_counter() < deadline:
+        torch.mm(matrix, matrix)
+
+
+class StubVAE:
+    """
+    VAE factice: ce que vae_decode utilise (dtype, config, post_quant_conv, decode)
+    decode_seconds par image 512x512, proportionnel aux pixels
+    """
+
+    def __init__(self, pipeline: "StubPipeline"):
+        self.pipeline = pipeline
+        self.dtype = torch.float32
+        self.config = SimpleNamespace(scaling_factor=1.0, force_upcast=False)
+        self.post_quant_conv = torch.nn.Conv2d(4, 4, 1)
+
+    def to(self, **kwargs):
+        return self
+
+    def decode(self, latents: torch.Tensor, return_dict: bool = True):
+        height, width = latents.shape[-2] * 8, latents.shape[-1] * 8
+        spend(self.pipeline.decode_seconds * latents.shape[0] * height * width / STUB_REFERENCE_PIXELS,
+              self.pipeline.work)
+        return (StubPipeline._decode(latents, width, height) * 2 - 1,)
+
+
+class StubPipeline:
+    """
+    Pipeline SDXL factice: la partie de l'interface diffusers utilisée par l'API
+    (encode_prompt, __call__ avec callback_on_step_end, num_timesteps, vae, ...)
+    Chaque step coûte step_seconds par image 512x512 du lot, le décodage decode_seconds par image
+    (proportionnels aux pixels: un brouillon en demi-résolution coûte quatre fois moins par step).
+    """
+    step_seconds = 0.02
+    decode_seconds = 0.01
+    work = "sleep"
+
+    def __init__(self, **components):
+        self.components = components
+        self.config = SimpleNamespace(force_zeros_for_empty_prompt=True)
+        self.num_timesteps = 0
+        self.vae = StubVAE(self)
+        self.watermark = None
+
+    def enable_attention_slicing(self):
+        pass
+
+    def upcast_vae(self):
+        pass
+
+    def set_progress_bar_config(self, **kwargs):
+        pass
+
+    def encode_prompt(self, prompt: str, device: str, num_images_per_prompt: int = 1, **kwargs):
+        # Embeddings déterministes par texte, aux dimensions SDXL
+        generator = torch.Generator().manual_seed(zlib.crc32(prompt.encode("utf8")))
+        embeds = torch.randn(1, 77, 2048, generator=generator)
+        pooled = torch.randn(1, 1280, generator=generator)
+        return embeds, None, pooled, None
+
+    def __call__(self, prompt_embeds: torch.Tensor, num_inference_steps: int, generator: List[torch.Generator],
+                 callback_on_step_end: Optional[Callable] = None, width: int = 1024, height: int = 1024,
+                 image: Optional[List[Any]] = None, strength: float = 1.0, output_type: str = "pil",
+                 **kwargs):
+        batch_size = prompt_embeds.shape[0]
+        if image is not None:
+            if isinstance(image[0], torch.Tensor):  # Latents (refine d'un brouillon)
+                height, width = image[0].shape[-2] * 8, image[0].shape[-1] * 8
+            else:
+                width, height = image[0].size
+            num_inference_steps = max(1, int(num_inference_steps * strength))
+        self.num_timesteps = num_inference_steps
+        latents = torch.stack([torch.randn(4, height // 8, width // 8, generator=g) for g in generator])
+
+        for step_index in range(num_inference_steps):
+            spend(self.step_seconds * batch_size * width * height / STUB_REFERENCE_PIXELS, self.work)
+            latents = latents * 0.98
+            if callback_on_step_end is not None:
+                latents = callback_on_step_end(self, step_index, step_index, {"latents": latents})["latents"]
+
+        if output_type == "latent":
+            return SimpleNamespace(images=latents)
+        images = (self.vae.decode(latents)[0] + 1) / 2
+        if output_type == "pt":
+            return SimpleNamespace(images=images)
+        return SimpleNamespace(images=[self.to_pil(image) for image in images])
+
+    @staticmethod
+    def _decode(latents: torch.Tensor, width: int, height: int) -> torch.Tensor:
+        # Image lisse (latent agrandi), plus réaliste à compresser que du bruit pur; N x 3 x H x W dans [0, 1]
+        rgb = ((latents[:, :3] + 2) / 4).clamp(0, 1)
+        return torch.nn.functional.interpolate(rgb, size=(height, width), mode="bicubic").clamp(0, 1)
+
+    @staticmethod
+    def to_pil(image: torch.Tensor) -> Image.Image:
+        return Image.fromarray(image.mul(255).round().to(torch.uint8).permute(1, 2, 0).numpy())
+
+
+def tiny_sdxl_components() -> Dict[str, Any]:
+    """Composants SDXL minuscules aux poids aléatoires (mêmes classes que le vrai modèle, sans téléchargement)"""
+    import tempfile
+
+    from diffusers import AutoencoderKL, EulerDiscreteScheduler, UNet2DConditionModel
+    from transformers import CLIPTextConfig, CLIPTextModel, CLIPTextModelWithProjection, CLIPTokenizer
+    from transformers.models.clip.tokenization_clip import bytes_to_unicode
+
+    torch.manual_seed(0)
+    unet = UNet2DConditionModel(
+        block_out_channels=(32, 64), layers_per_block=2, sample_size=32, in_channels=4, out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"), up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        attention_head_dim=(2, 4), use_linear_projection=True, addition_embed_type="text_time",
+        addition_time_embed_dim=8, transformer_layers_per_block=(1, 2),
+        projection_class_embeddings_input_dim=80, cross_attention_dim=64
+    )
+    vae = AutoencoderKL(
+        block_out_channels=[32, 64], in_channels=3, out_channels=3,
+        down_block_types=["DownEncoderBlock2D", "DownEncoderBlock2D"],
+        up_block_types=["UpDecoderBlock2D", "UpDecoderBlock2D"], latent_channels=4, sample_size=128
+    )
+    scheduler = EulerDiscreteScheduler(beta_start=0.00085, beta_end=0.012, steps_offset=1,
+                                       beta_schedule="scaled_linear", timestep_spacing="leading")
+    text_config = CLIPTextConfig(
+        bos_token_id=0, eos_token_id=2, hidden_size=32, intermediate_size=37, layer_norm_eps=1e-05,
+        num_attention_heads=4, num_hidden_layers=5, pad_token_id=1, vocab_size=1000, hidden_act="gelu",
+        projection_dim=32
+    )
+
+    # Tokenizer CLIP au niveau caractère, écrit dans un dossier temporaire (pas de hub)
+    vocab_dir = tempfile.mkdtemp(prefix="bench_tokenizer_")
+    chars = list(bytes_to_unicode().values())
+    vocab = {char: index for index, char in enumerate(chars)}
+    for char in chars:
+        vocab[char + "</w>"] = len(vocab)
+    vocab["<|startoftext|>"] = len(vocab)
+    vocab["<|endoftext|>"] = len(vocab)
+    with open(os.path.join(vocab_dir, "vocab.json"), "w", encoding="utf8") as vocab_file:
+        json.dump(vocab, vocab_file)
+    with open(os.path.join(vocab_dir, "merges.txt"), "w", encoding="utf8") as merges_file:
+        merges_file.write("#version: 0.2\n")
+    tokenizer = CLIPTokenizer(os.path.join(vocab_dir, "vocab.json"), os.path.join(vocab_dir, "merges.txt"),
+                              model_max_length=77)
+
+    return {
+        "vae": vae, "text_encoder": CLIPTextModel(text_config),
+        "text_encoder_2": CLIPTextModelWithProjection(text_config),
+        "tokenizer": tokenizer, "tokenizer_2": tokenizer, "unet": unet, "scheduler": scheduler,
+    }
+
+
+def stub_esrgan(network: str = "conv") -> SimpleNamespace:
+    """
+    Remplaçant de RealESRGANer: même attributs (model, scale, half)
+    network: "conv" (réseau x4 minuscule) ou "rrdb" (RRDBNet anime_6B aux poids aléatoires: coût réel du réseau)
+    """
+    torch.manual_seed(0)
+    if network == "rrdb":
+        from basicsr.archs.rrdbnet_arch import RRDBNet
+        model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=6, num_grow_ch=32, scale=4).eval()
+    else:
+        model = torch.nn.Sequential(torch.nn.Conv2d(3, 3 * 16, 3, padding=1), torch.nn.PixelShuffle(4)).eval()
+    return SimpleNamespace(model=model, scale=4, half=False)
+
+
+def install_stand_ins(api, pipeline: str, esrgan: str = "conv"):
+    """
+    Remplace les modèles du registre (et les classes de pipeline en mode stub)
+    Les modèles passent par le backend CPU du service et par son exécution compilée, comme les vrais au chargement
+    """
+    if pipeline == "stub":
+        api.StableDiffusionXLPipeline = StubPipeline
+        api.StableDiffusionXLImg2ImgPipeline = StubPipeline
+        api.model_registry.register("sdxl", dict, STUB_MODEL_BYTES, on_drop=api.forget_sdxl_pipelines)
+    else:
+        def load_tiny_sdxl() -> Dict[str, Any]:
+            components = tiny_sdxl_components()
+            api.cpu_backend.prepare(components["unet"])
+            api.cpu_backend.prepare(components["vae"])
+            api.model_compiler.wrap("unet", components["unet"])
+            api.model_compiler.wrap("vae_decoder", components["vae"].decoder)
+            return components
+
+        api.model_registry.register("sdxl", load_tiny_sdxl, STUB_MODEL_BYTES, on_drop=api.forget_sdxl_pipelines)
+
+    def load_esrgan(name: str) -> SimpleNamespace:
+        upsampler = stub_esrgan(esrgan)
+        api.cpu_backend.prepare(upsampler.model)
+        api.model_compiler.wrap(name, upsampler.model)
+        return upsampler
+
+    for name in ("esrgan_general", "esrgan_anime"):
+        api.model_registry.register(name, functools.partial(load_esrgan, name), STUB_MODEL_BYTES,
+                                    on_drop=functools.partial(api.model_compiler.release, name))
+
+
+def configure_worker(pipeline: str, esrgan: str, step_seconds: float, decode_seconds: float, work: str,
+                     quiet: bool, api):
+    """Initialisation d'un processus worker (--workers): mêmes modèles de remplacement que le processus principal"""
+    if quiet:
+        logging.getLogger().setLevel(logging.WARNING)
+    StubPipeline.step_seconds = step_seconds
+    StubPipeline.decode_seconds = decode_seconds
+    StubPipeline.work = work
+    install_stand_ins(api, pipeline, esrgan)
+
+
+# ==================== MESURES ====================
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    """Percentiles d'une série de durées (secondes)"""
+    if not values:
+        return {"count": 0, "mean": None, "p50": None, "p90": None, "p99": None, "max": None}
+    array = np.asarray(values)
+    return {
+        "count": len(values),
+        "mean": round(float(array.mean()), 4),
+        "p50": round(float(np.percentile(array, 50)), 4),
+        "p90": round(float(np.percentile(array, 90)), 4),
+        "p99": round(float(np.percentile(array, 99)), 4),
+        "max": round(float(array.max()), 4),
+    }
+
+
+class MemorySampler:
+    """Relève la mémoire résidente du processus en tâche de fond pour connaître le pic de chaque phase"""
+
+    def __init__(self, read_rss: Callable[[], Optional[int]], interval_s: float = 0.01):
+        self.read_rss = read_rss
+        self.interval_s = interval_s
+        self.peak: Optional[int] = None
+
+    def _sample(self, stop: threading.Event):
+        while not stop.is_set():
+            rss = self.read_rss()
+            if rss is not None and (self.peak is None or rss > self.peak):
+                self.peak = rss
+            stop.wait(self.interval_s)
+
+    @contextmanager
+    def phase(self, report: Dict[str, Any]) -> Iterator[None]:
+        """Ajoute rss_start_mb et rss_peak_mb à report"""
+        start = self.read_rss()
+        self.peak = start
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        stop = threading.Event()
+        sampler = threading.Thread(target=self._sample, args=(stop,), daemon=True)
+        sampler.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            sampler.join()
+            report["rss_start_mb"] = round(start / 1024 ** 2, 1) if start is not None else None
+            report["rss_peak_mb"] = round(self.peak / 1024 ** 2, 1) if self.peak is not None else None
+            if torch.cuda.is_available():
+                report["cuda_peak_mb"] = round(torch.cuda.max_memory_allocated() / 1024 ** 2, 1)
+
+
+def stage_breakdown(api, before: Dict[str, tuple]) -> Dict[str, Optional[float]]:
+    """Durée moyenne de chaque étape côté serveur depuis before (histogrammes de /metrics)"""
+    breakdown = {}
+    for name, (count, total) in stage_snapshot(api).items():
+        count_delta, total_delta = count - before[name][0], total - before[name][1]
+        breakdown[f"{name}_mean_s"] = round(total_delta / count_delta, 4) if count_delta else None
+    return breakdown
+
+
+def stage_snapshot(api) -> Dict[str, tuple]:
+    return {
+        "queue_wait": api.QUEUE_WAIT_SECONDS.snapshot(job_type="generate"),
+        "text_encode": api.TEXT_ENCODE_SECONDS.snapshot(),
+        "denoise_step": api.DENOISE_STEP_SECONDS.snapshot(mode="txt2img"),
+        "vae_decode": api.VAE_DECODE_SECONDS.snapshot(mode="txt2img"),
+        "image_encode": api.IMAGE_ENCODE_SECONDS.snapshot(format="png"),
+    }
+
+
+class Benchmark:
+    def __init__(self, api, client, args: argparse.Namespace):
+        self.api = api
+        self.client = client
+        self.args = args
+        self.sampler = MemorySampler(api.process_rss_bytes)
+        self.request_index = 0
+
+    def generate_body(self, steps: Optional[int] = None) -> Dict[str, Any]:
+        # Prompt variable: chaque requête encode son prompt (le negative prompt, lui, reste en cache)
+        self.request_index += 1
+        return {
+            "prompt": f"benchmark prompt {self.request_index}",
+            "width": self.args.width,
+            "height": self.args.height,
+            "steps": steps or self.args.steps,
+            "seed": self.request_index,
+        }
+
+    async def post_generate(self, body: Dict[str, Any], headers: Optional[Dict[str, str]] = None):
+        headers = {"accept": "image/png", **(headers or {})}
+        start_time = time.perf_counter()
+        response = await self.client.post("/generate", json=body, headers=headers)
+        return response, time.perf_counter() - start_time
+
+    async def warmup(self):
+        """Premier appel: chargement des modèles, hors mesures"""
+        report = {}
+        start_time = time.perf_counter()
+        response, _ = await self.post_generate(self.generate_body(steps=2))
+        response.raise_for_status()
+        report["first_generate_s"] = round(time.perf_counter() - start_time, 3)
+        upscale = await self.client.post("/upscale", json=self.upscale_body(), headers={"accept": "image/png"})
+        upscale.raise_for_status()
+        return report
+
+    async def latency(self) -> Dict[str, Any]:
+        """Requêtes /generate une par une: latence de bout en bout et répartition par étape"""
+        report: Dict[str, Any] = {}
+        before = stage_snapshot(self.api)
+        latencies = []
+        with self.sampler.phase(report):
+            for _ in range(self.args.requests):
+                response, elapsed = await self.post_generate(self.generate_body())
+                response.raise_for_status()
+                latencies.append(elapsed)
+        report["latency_s"] = summarize(latencies)
+        report["stages"] = stage_breakdown(self.api, before)
+        return report
+
+    async def throughput(self) -> Dict[str, Any]:
+        """--concurrency clients simultanés pour --load-requests requêtes au total"""
+        report: Dict[str, Any] = {"concurrency": self.args.concurrency}
+        remaining = [self.args.load_requests]
+        latencies, statuses = [], {}
+        stats_before = self.api.inference_worker.stats()
+
+        async def client_loop():
+            while remaining[0] > 0:
+                remaining[0] -= 1
+                response, elapsed = await self.post_generate(self.generate_body())
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+                if response.status_code == 200:
+                    latencies.append(elapsed)
+                elif response.status_code == 429:
+                    await asyncio.sleep(0.05)
+
+        with self.sampler.phase(report):
+            start_time = time.perf_counter()
+            await asyncio.gather(*(client_loop() for _ in range(self.args.concurrency)))
+            wall_time = time.perf_counter() - start_time
+
+        stats_after = self.api.inference_worker.stats()
+        report.update({
+            "wall_s": round(wall_time, 3),
+            "images_per_s": round(len(latencies) / wall_time, 3),
+            "latency_s": summarize(latencies),
+            "status_codes": {str(code): count for code, count in sorted(statuses.items())},
+            "batches": stats_after["batches"] - stats_before["batches"],
+            "batched_jobs": stats_after["batched_jobs"] - stats_before["batched_jobs"],
+        })
+        return report
+
+    async def draft_refine(self) -> Dict[str, Any]:
+        """
+        Rendu complet (--full-steps steps à la taille demandée) contre brouillon (/generate avec draft=true)
+        puis refine de ce brouillon (/refine, avec chaque agrandisseur)
+        """
+        report: Dict[str, Any] = {"full_steps": self.args.full_steps}
+        single, drafts = [], []
+        refines = {upscaler: [] for upscaler in self.api.REFINE_UPSCALERS}
+        with self.sampler.phase(report):
+            for _ in range(max(1, self.args.requests // 2)):
+                response, elapsed = await self.post_generate(self.generate_body(steps=self.args.full_steps))
+                response.raise_for_status()
+                single.append(elapsed)
+
+                body = {**self.generate_body(steps=self.args.full_steps), "draft": True}
+                response, elapsed = await self.post_generate(body)
+                response.raise_for_status()
+                drafts.append(elapsed)
+                draft_info = json.loads(response.headers["x-image-info"])
+                for upscaler, latencies in refines.items():
+                    start_time = time.perf_counter()
+                    response = await self.client.post(
+                        "/refine", json={"draft_id": draft_info["draft"]["draft_id"], "upscaler": upscaler},
+                        headers={"accept": "image/png"}
+                    )
+                    response.raise_for_status()
+                    latencies.append(time.perf_counter() - start_time)
+
+        def mean(values: List[float]) -> float:
+            return sum(values) / len(values)
+
+        report.update({
+            "draft_size": f"{draft_info['width']}x{draft_info['height']}",
+            "draft_steps": draft_info["steps"],
+            "single_s": summarize(single),
+            "draft_s": summarize(drafts),
+            "refine_s": {upscaler: summarize(latencies) for upscaler, latencies in refines.items()},
+            # Brouillons pour le prix d'un rendu complet, et coût du parcours brouillon + refine
+            "drafts_per_single": round(mean(single) / mean(drafts), 2),
+            "draft_plus_refine_over_single": {
+                upscaler: round((mean(drafts) + mean(latencies)) / mean(single), 3)
+                for upscaler, latencies in refines.items()
+            },
+        })
+        return report
+
+    def upscale_body(self, width: Optional[int] = None, height: Optional[int] = None) -> Dict[str, Any]:
+        width = width or self.args.upscale_size
+        height = height or width
+        pixels = np.random.default_rng(0).integers(0, 256, (height // 8, width // 8, 3), dtype=np.uint8)
+        image = Image.fromarray(pixels).resize((width, height), Image.BICUBIC)
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        return {"image": base64.b64encode(buffer.getvalue()).decode(), "scale": 4, "model": "general"}
+
+    async def upscale(self) -> Dict[str, Any]:
+        """Upscales successifs d'une image --upscale-size (le remplaçant ESRGAN coûte peu: mesure surtout le service)"""
+        report: Dict[str, Any] = {"input_size": self.args.upscale_size}
+        body = self.upscale_body()
+        latencies = []
+        with self.sampler.phase(report):
+            for _ in range(max(1, self.args.requests // 2)):
+                start_time = time.perf_counter()
+                response = await self.client.post("/upscale", json=body, headers={"accept": "image/png"})
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - start_time)
+        report["latency_s"] = summarize(latencies)
+        report["tiling"] = json.loads(response.headers["x-image-info"]).get("tiling")
+        return report
+
+    async def upscale_batch(self) -> Dict[str, Any]:
+        """
+        Les mêmes N images upscalées par N appels successifs à /upscale, puis par un seul /upscale/batch
+        (réponses JSON base64 des deux côtés, comme le NDJSON du lot)
+        """
+        count = max(2, self.args.requests // 2)
+        body = self.upscale_body()
+        report: Dict[str, Any] = {"images": count, "input_size": self.args.upscale_size}
+        with self.sampler.phase(report):
+            start_time = time.perf_counter()
+            for _ in range(count):
+                response = await self.client.post("/upscale", json=body)
+                response.raise_for_status()
+            sequential_s = time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            batch_body = {"images": [body["image"]] * count, "scale": body["scale"], "model": body["model"]}
+            response = await self.client.post("/upscale/batch", json=batch_body)
+            response.raise_for_status()
+            batch_s = time.perf_counter() - start_time
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        report.update({
+            "sequential_s": round(sequential_s, 3),
+            "batch_s": round(batch_s, 3),
+            "speedup": round(sequential_s / batch_s, 2) if batch_s > 0 else None,
+            "succeeded": lines[-1]["succeeded"],
+            "max_images_per_pass": max(line["info"]["batch_size"] for line in lines[:-1] if line.get("success")),
+        })
+        return report
+
+    def codec(self) -> Dict[str, Any]:
+        """Coût d'encodage (service, réglages par défaut) et de décodage (client) par format, plus le base64 du JSON"""
+        size = self.args.codec_size
+        latent = torch.randn(4, size // 8, size // 8, generator=torch.Generator().manual_seed(0))
+        image = StubPipeline.to_pil(StubPipeline._decode(latent[None], size, size)[0])
+        report: Dict[str, Any] = {"image_size": size}
+        repeats = self.args.codec_repeats
+        for image_format in OUTPUT_FORMATS:
+            encoding = output_encoding(image_format)
+            encode_times, decode_times = [], []
+            for _ in range(repeats):
+                start_time = time.perf_counter()
+                encoded = encode_image(image, encoding)
+                encode_times.append(time.perf_counter() - start_time)
+                start_time = time.perf_counter()
+                Image.open(io.BytesIO(encoded.data)).load()
+                decode_times.append(time.perf_counter() - start_time)
+            base64_times = []
+            for _ in range(repeats):
+                start_time = time.perf_counter()
+                base64.b64decode(base64.b64encode(encoded.data))
+                base64_times.append(time.perf_counter() - start_time)
+            report[image_format] = {
+                "encoding": encoding.describe(),
+                "bytes": len(encoded.data),
+                "encode_s": summarize(encode_times),
+                "decode_s": summarize(decode_times),
+                "base64_roundtrip_s": summarize(base64_times),
+            }
+        return report
+
+    async def admission(self) -> Dict[str, Any]:
+        """
+        ETA annoncées: --concurrency générations soumises d'un coup (POST /jobs), ETA de la soumission
+        comparée à la fin réelle; durée prédite de chaque job comparée à sa part du lot mesurée
+        """
+        report: Dict[str, Any] = {"concurrency": self.args.concurrency}
+
+        async def wait_done(job_id: str, start_time: float) -> tuple:
+            while True:
+                status = (await self.client.get(f"/jobs/{job_id}")).json()
+                if status["status"] not in ("queued", "running"):
+                    return status, time.perf_counter() - start_time
+                await asyncio.sleep(0.005)
+
+        with self.sampler.phase(report):
+            submitted = []
+            for _ in range(self.args.concurrency):
+                start_time = time.perf_counter()
+                response = await self.client.post("/jobs?type=generate", json=self.generate_body())
+                response.raise_for_status()
+                status = response.json()
+                submitted.append((status["eta_s"], asyncio.create_task(wait_done(status["job_id"], start_time))))
+            eta_errors, cost_ratios = [], []
+            for eta_s, task in submitted:
+                status, elapsed = await task
+                info = status["info"] or {}
+                if eta_s is not None:
+                    eta_errors.append(abs(eta_s - elapsed))
+                if "admission" in info:
+                    share = info["generation_time_s"] * info["num_images"] / info["batch_size"]
+                    cost_ratios.append(info["admission"]["predicted_s"] / share if share else 0.0)
+        report["eta_error_s"] = summarize(eta_errors)
+        report["predicted_over_measured"] = summarize(cost_ratios)
+        report["admissions"] = {
+            action: int(self.api.ADMISSIONS.value(job_type="generate", action=action))
+            for action in ("accepted", "downscaled", "deferred", "rejected")
+        }
+        return report
+
+    async def cancellation(self) -> Dict[str, Any]:
+        """Délai entre POST /cancel et la réponse 499 d'une génération en cours"""
+        report: Dict[str, Any] = {}
+        latencies, statuses = [], {}
+        with self.sampler.phase(report):
+            for trial in range(self.args.cancel_trials):
+                job_id = f"bench_cancel_{trial}_{time.monotonic_ns()}"
+                body = self.generate_body(steps=self.args.steps * 10)
+                request = asyncio.create_task(self.post_generate(body, {"x-job-id": job_id}))
+                # Attendre que la génération ait vraiment commencé
+                while True:
+                    event = self.api.progress_hub.last_event(job_id)
+                    if event is not None and event["event"] == "progress":
+                        break
+                    if request.done():
+                        break
+                    await asyncio.sleep(0.002)
+                start_time = time.perf_counter()
+                await self.client.post(f"/cancel/{job_id}")
+                response, _ = await request
+                latencies.append(time.perf_counter() - start_time)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        report["latency_s"] = summarize(latencies)
+        report["status_codes"] = {str(code): count for code, count in sorted(statuses.items())}
+        return report
+
+    async def compile_bucket(self, width: int, height: int, count: int) -> float:
+        """Une génération de count images width x height (et leur upscale si ESRGAN est compilé), en secondes"""
+        start_time = time.perf_counter()
+        body = {**self.generate_body(), "width": width, "height": height, "num_images": count}
+        response = await self.client.post("/generate", json=body)
+        response.raise_for_status()
+        if any(model.startswith("esrgan") for model in self.api.model_compiler.models):
+            upscale = self.upscale_body(width, height)
+            batch_body = {"images": [upscale["image"]] * count, "scale": upscale["scale"], "model": upscale["model"]}
+            response = await self.client.post("/upscale/batch", json=batch_body)
+            response.raise_for_status()
+        return time.perf_counter() - start_time
+
+    async def compile(self) -> Dict[str, Any]:
+        """
+        Exécution compilée, par bucket de --compile-buckets (largeur x hauteur x images): les mêmes requêtes
+        en eager, puis compilées (la première compile le bucket, sauf s'il l'a été au warmup). Latence par appel
+        de chaque modèle et par bucket de formes du modèle: pour l'UNet, un appel est un step de débruitage
+        """
+        compiler = self.api.model_compiler
+        if not compiler.enabled or self.args.workers:
+            return {"skipped": "needs --compile and --workers 0"}
+        calls = []
+        forward = compiler.on_call
+
+        def collect(model: str, bucket: str, mode: str, seconds: float):
+            calls.append((model, bucket, mode, seconds))
+            forward(model, bucket, mode, seconds)
+
+        repeats = max(1, self.args.requests // 2)
+        report: Dict[str, Any] = {"models": list(compiler.models), "mode": compiler.mode, "buckets": {}}
+        compiler.on_call = collect
+        try:
+            with self.sampler.phase(report):
+                for width, height, count in self.args.compile_buckets:
+                    calls.clear()
+                    with compiler.eager():
+                        eager = [await self.compile_bucket(width, height, count) for _ in range(repeats)]
+                    first_s = await self.compile_bucket(width, height, count)
+                    compiled = [await self.compile_bucket(width, height, count) for _ in range(repeats)]
+                    report["buckets"][f"{width}x{height}x{count}"] = {
+                        "eager_s": summarize(eager),
+                        "first_compiled_s": round(first_s, 3),
+                        "compiled_s": summarize(compiled),
+                        "calls": call_breakdown(calls, compiler.stats()["buckets"]),
+                    }
+        finally:
+            compiler.on_call = forward
+        return report
+
+
+def call_breakdown(calls: List[tuple], known: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """
+    Latence moyenne par appel, par modèle et par bucket de formes: eager, compilé, et durée de la compilation
+    (mesurée dans la phase, sinon la dernière connue du service: warmup ou exécution précédente)
+    """
+    grouped: Dict[str, Dict[str, Dict[str, List[float]]]] = {}
+    for model, bucket, mode, seconds in calls:
+        grouped.setdefault(model, {}).setdefault(bucket, {}).setdefault(mode, []).append(seconds)
+    breakdown: Dict[str, Dict[str, Any]] = {}
+    for model, buckets in grouped.items():
+        for bucket, modes in buckets.items():
+            eager, compiled = summarize(modes.get("eager", []))["mean"], summarize(modes.get("compiled", []))["mean"]
+            compile_s = modes["compile"][0] if "compile" in modes else known.get(model, {}).get(bucket, {}).get(
+                "compile_s")
+            breakdown.setdefault(model, {})[bucket] = {
+                "eager_call_s": eager,
+                "compiled_call_s": compiled,
+                "compile_s": round(compile_s, 2) if compile_s is not None else None,
+                "speedup": round(eager / compiled, 2) if eager and compiled else None,
+            }
+    return breakdown
+
+
+def environment_info(api, args: argparse.Namespace) -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SCRIPT_DIR, capture_output=True,
+                                text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "torch_threads": torch.get_num_threads(),
+        "device": api.device,
+        "cpu_backend": api.cpu_backend.describe() if api.device == "cpu" else None,
+        "compile": {"models": list(api.model_compiler.models), "mode": api.model_compiler.mode,
+                    "cache_dir": os.environ.get("TORCHINDUCTOR_CACHE_DIR")} if api.model_compiler.enabled else None,
+    }
+
+
+PHASES = ("latency", "throughput", "draft_refine", "upscale", "upscale_batch", "codec", "admission", "cancellation",
+          "compile")
+
+
+async def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    # La configuration du service est lue à l'import: on la fixe avant
+    os.environ.setdefault("HF_HUB_OFFLINE", "1")
+    os.environ["IMAGE_API_RESULT_CACHE_MB"] = "0"  # Chaque requête doit passer par le worker
+    os.environ["IMAGE_API_CANCEL_BACKEND"] = "memory"
+    os.environ["IMAGE_API_COST_MODEL_PATH"] = ""  # Calibration sur les stand-ins: à ne pas garder
+    # Brouillons en demi-résolution même aux petites tailles du benchmark
+    os.environ.setdefault("IMAGE_API_DRAFT_MIN_SIDE", str(min(args.width, args.height) // 2))
+    os.environ.setdefault("IMAGE_API_MAX_QUEUE_DEPTH", str(max(8, args.concurrency)))
+    os.environ["IMAGE_API_WORKER_PROCESSES"] = str(args.workers)
+    if args.cpu_precision:
+        os.environ["IMAGE_API_CPU_PRECISION"] = args.cpu_precision
+    if args.compile:
+        os.environ["IMAGE_API_COMPILE"] = args.compile
+        # Mesures par bucket des modèles de remplacement: pas dans le manifeste du vrai service
+        os.environ["IMAGE_API_COMPILE_CACHE_DIR"] = args.compile_cache
+    try:
+        import httpx
+    except ImportError:
+        raise SystemExit("benchmark.py needs httpx (pip install httpx)")
+    import image_generation_api as api
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    StubPipeline.step_seconds = args.step_ms / 1000
+    StubPipeline.decode_seconds = args.decode_ms / 1000
+    StubPipeline.work = args.work
+    install_stand_ins(api, args.pipeline, args.esrgan)
+    api.worker_process_initializer = functools.partial(
+        configure_worker, args.pipeline, args.esrgan, StubPipeline.step_seconds, StubPipeline.decode_seconds, args.work,
+        not args.verbose
+    )
+
+    results: Dict[str, Any] = {}
+    await api.startup_event()
+    try:
+        # Démarrage à froid: import du service, préchargement et warmup (IMAGE_API_PRELOAD, IMAGE_API_WARMUP_STEPS)
+        if api.startup_task is not None:
+            await api.startup_task
+        startup = api.startup_state.as_dict()
+        results["startup"] = {"phases_s": startup["phases_s"], "startup_to_ready_s": startup["startup_to_ready_s"]}
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=600) as client:
+            bench = Benchmark(api, client, args)
+            results["warmup"] = await bench.warmup()
+            for phase in args.phases:
+                print(f"⏱️ {phase}...", file=sys.stderr)
+                result = getattr(bench, phase)()
+                results[phase] = await result if asyncio.iscoroutine(result) else result
+    finally:
+        await api.shutdown_event()
+
+    config = {key: value for key, value in vars(args).items() if key not in ("output", "baseline", "verbose")}
+    return {"config": config, "environment": environment_info(api, args), "results": results}
+
+
+# ==================== COMPARAISON ====================
+
+MEMORY_AND_SIZE_METRICS = ("rss_peak_mb", "cuda_peak_mb", "bytes")
+
+
+def flatten(tree: Dict[str, Any], prefix: str = "") -> Dict[str, float]:
+    values = {}
+    for key, value in tree.items():
+        path = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            values.update(flatten(value, path))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[path] = float(value)
+    return values
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], tolerance: float) -> List[Dict[str, Any]]:
+    """
+    Écarts relatifs au-delà de tolerance entre deux exécutions
+    Une durée ou une mémoire qui augmente, ou un débit qui baisse, est une régression
+    """
+    before, after = flatten(baseline["results"]), flatten(current["results"])
+    changes = []
+    for path in sorted(before.keys() & after.keys()):
+        parts = path.split(".")
+        measured = any(part.endswith("_s") for part in parts) or parts[-1] in MEMORY_AND_SIZE_METRICS
+        old, new = before[path], after[path]
+        if not measured or old == 0 or parts[-1] == "count":
+            continue
+        ratio = new / old
+        if abs(ratio - 1) <= tolerance:
+            continue
+        higher_is_better = path.endswith("per_s")
+        changes.append({
+            "metric": path, "baseline": old, "current": new, "ratio": round(ratio, 3),
+            "regression": ratio < 1 if higher_is_better else ratio > 1,
+        })
+    if baseline.get("config") != current.get("config"):
+        print("⚠️ Baseline was run with a different configuration", file=sys.stderr)
+    return changes
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark hors ligne du microservice d'images (CPU, sans réseau)")
+    parser.add_argument("--pipeline", choices=["stub", "tiny"], default="stub",
+                        help="stub: coût par step configurable; tiny: vrai pipeline SDXL minuscule")
+    parser.add_argument("--work", choices=["sleep", "compute"], default="sleep",
+                        help="(stub) le coût d'un step est du sommeil ou du calcul CPU")
+    parser.add_argument("--step-ms", type=float, default=20.0,
+                        help="(stub) coût d'un step par image 512x512 (proportionnel aux pixels)")
+    parser.add_argument("--decode-ms", type=float, default=10.0,
+                        help="(stub) coût du décodage VAE par image 512x512")
+    parser.add_argument("--width", type=int, default=None, help="défaut: 512 (stub), 64 (tiny)")
+    parser.add_argument("--height", type=int, default=None)
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=8, help="requêtes de la phase latency")
+    parser.add_argument("--full-steps", type=int, default=40,
+                        help="steps d'un rendu complet (phase draft_refine; défaut du service)")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=0,
+                        help="processus workers (mode coordinateur, IMAGE_API_WORKER_PROCESSES); 0 = tout en process")
+    parser.add_argument("--load-requests", type=int, default=16, help="requêtes de la phase throughput")
+    parser.add_argument("--esrgan", choices=["conv", "rrdb"], default="conv",
+                        help="remplaçant de Real-ESRGAN: convolution minuscule, ou RRDBNet anime_6B (coût réel)")
+    parser.add_argument("--cpu-precision", choices=["auto", "bfloat16", "float32"], default=None,
+                        help="IMAGE_API_CPU_PRECISION du service (défaut: celle de l'environnement)")
+    parser.add_argument("--compile", default=None,
+                        help="IMAGE_API_COMPILE du service: unet, vae, esrgan ou all (défaut: exécution eager)")
+    parser.add_argument("--compile-cache", default=str(SCRIPT_DIR / "compile_cache" / "benchmark"),
+                        help="cache des noyaux compilés, gardé d'une exécution à l'autre (redémarrage à chaud)")
+    parser.add_argument("--compile-buckets", default=None,
+                        help="buckets de la phase compile, largeur x hauteur x images (défaut: WxHx1,WxHx2)")
+    parser.add_argument("--upscale-size", type=int, default=128)
+    parser.add_argument("--codec-size", type=int, default=1024)
+    parser.add_argument("--codec-repeats", type=int, default=5)
+    parser.add_argument("--cancel-trials", type=int, default=5)
+    parser.add_argument("--phases", default=",".join(PHASES), help=f"sous-ensemble de {','.join(PHASES)}")
+    parser.add_argument("--output", help="fichier JSON des résultats (défaut: sortie standard)")
+    parser.add_argument("--baseline", help="JSON d'une exécution précédente à comparer")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="écart relatif ignoré à la comparaison")
+    parser.add_argument("--verbose", action="store_true", help="garder les logs du service")
+    args = parser.parse_args(argv)
+
+    default_size = 512 if args.pipeline == "stub" else 64
+    args.width = args.width or default_size
+    args.height = args.height or args.width
+    args.phases = [phase.strip() for phase in args.phases.split(",") if phase.strip()]
+    unknown = set(args.phases) - set(PHASES)
+    if unknown:
+        parser.error(f"unknown phases: {', '.join(sorted(unknown))}")
+    buckets = args.compile_buckets or f"{args.width}x{args.height}x1,{args.width}x{args.height}x2"
+    try:
+        args.compile_buckets = [tuple(int(size) for size in bucket.strip().split("x")) for bucket in buckets.split(",")]
+    except ValueError:
+        parser.error(f"invalid --compile-buckets: {buckets} (expected WxHxN,...)")
+    if any(len(bucket) != 3 for bucket in args.compile_buckets):
+        parser.error(f"invalid --compile-buckets: {buckets} (expected WxHxN,...)")
+    return args
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    sys.path.insert(0, str(SCRIPT_DIR))
+    report = asyncio.run(run_benchmark(args))
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + "\n", encoding="utf8")
+        print(f"✅ Results written to {args.output}", file=sys.stderr)
+    else:
+        print(output)
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf8"))
+        changes = compare(baseline, report, args.tolerance)
+        for change in changes:
+            marker = "❌" if change["regression"] else "✅"
+            print(f"{marker} {change['metric']}: {change['baseline']:g} -> {change['current']:g} "
+                  f"(x{change['ratio']})", file=sys.stderr)
+        if not changes:
+            print(f"✅ No change beyond {args.tolerance:.0%} against {args.baseline}", file=sys.stderr)
+        return 1 if any(change["regression"] for change in changes) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
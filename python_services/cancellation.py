@@ -0,0 +1,275 @@
+"""
+Système d'annulation des jobs par jetons en mémoire
+Chaque job reçoit un CancellationToken dont la vérification (appelée à chaque step
+de débruitage) est une simple lecture d'attribut, sans appel système.
+Un jeton de groupe par type de job ("generate", "upscale", ...) permet d'annuler
+tous les jobs d'un type en O(1), y compris ceux qui attendent encore dans la file.
+
+Un backend fichier optionnel assure la compatibilité avec le bot Node (qui peut
+écrire cancel_all_generate.flag directement) et la diffusion des annulations
+entre plusieurs processus: un seul thread scrute le dossier à intervalle fixe,
+au lieu d'un stat() par step et par job.
+"""
+
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class _GroupToken:
+    """Jeton partagé par tous les jobs d'un type enregistrés avant la prochaine annulation groupée"""
+    __slots__ = ("cancelled",)
+
+    def __init__(self):
+        self.cancelled = False
+
+
+class CancellationToken:
+    """Jeton d'annulation d'un job: is_cancelled() ne fait que lire deux booléens"""
+    __slots__ = ("job_id", "job_type", "created_at", "_cancelled", "_group")
+
+    def __init__(self, job_id: str, job_type: str, group: _GroupToken):
+        self.job_id = job_id
+        self.job_type = job_type
+        self.created_at = time.monotonic()
+        self._cancelled = False
+        self._group = group
+
+    def cancel(self):
+        self._cancelled = True
+
+    def is_cancelled(self) -> bool:
+        return self._cancelled or self._group.cancelled
+
+    def raise_if_cancelled(self, where: str = ""):
+        """Lève InterruptedError si le job a été annulé (utilisé dans les callbacks de step)"""
+        if self._cancelled or self._group.cancelled:
+            suffix = f" {where}" if where else ""
+            raise InterruptedError(f"Job {self.job_id} was cancelled{suffix}")
+
+
+class CancellationRegistry:
+    """
+    Registre des jobs annulables (en cours ou en attente dans la file)
+
+    Args:
+        on_cancel: appelé avec le job_id à chaque annulation (ex: retirer le job de la file)
+    """
+
+    def __init__(self, on_cancel: Optional[Callable[[str], None]] = None):
+        self.on_cancel = on_cancel
+        self.backend: Optional["FileCancellationBackend"] = None
+        self._tokens: Dict[str, CancellationToken] = {}
+        self._groups: Dict[str, _GroupToken] = {}
+        # Annulations groupées "armées" pour les jobs qui arrivent juste après (type -> échéance)
+        self._armed_until: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self.cancelled_count = 0
+
+    def register(self, job_id: str, job_type: str) -> CancellationToken:
+        """Crée le jeton d'un nouveau job"""
+        with self._lock:
+            group = self._groups.get(job_type)
+            if group is None:
+                group = self._groups[job_type] = _GroupToken()
+            token = CancellationToken(job_id, job_type, group)
+            armed_until = self._armed_until.get(job_type)
+            if armed_until is not None:
+                if time.monotonic() < armed_until:
+                    token.cancel()
+                    logger.info(f"🛑 Job {job_id} cancelled on arrival (pending cancel-all for {job_type})")
+                else:
+                    del self._armed_until[job_type]
+            self._tokens[job_id] = token
+        return token
+
+    def release(self, job_id: str):
+        """Oublie un job terminé (succès, erreur ou annulation)"""
+        with self._lock:
+            self._tokens.pop(job_id, None)
+
+    def get(self, job_id: str) -> Optional[CancellationToken]:
+        return self._tokens.get(job_id)
+
+    def is_cancelled(self, job_id: str) -> bool:
+        token = self._tokens.get(job_id)
+        return token is not None and token.is_cancelled()
+
+    def active_jobs(self) -> Dict[str, str]:
+        """job_id -> type pour tous les jobs enregistrés"""
+        with self._lock:
+            return {job_id: token.job_type for job_id, token in self._tokens.items()}
+
+    def cancel(self, job_id: str, broadcast: bool = True) -> bool:
+        """
+        Annule un job local; s'il est inconnu ici et qu'un backend partagé est
+        configuré, l'annulation est diffusée aux autres processus
+
+        Returns:
+            True si le job était connu localement
+        """
+        token = self._tokens.get(job_id)
+        if token is None:
+            if broadcast and self.backend is not None and self.backend.broadcast:
+                self.backend.publish_job(job_id)
+            return False
+        if not token.is_cancelled():
+            token.cancel()
+            self.cancelled_count += 1
+            logger.info(f"🛑 Job {job_id} cancelled")
+            if self.on_cancel is not None:
+                self.on_cancel(job_id)
+        return True
+
+    def cancel_type(self, job_type: str, arm_for_s: float = 0.0, broadcast: bool = True) -> int:
+        """
+        Annule tous les jobs d'un type ("all" pour tous les types)
+
+        Args:
+            arm_for_s: annule aussi les jobs de ce type enregistrés pendant ce délai
+            broadcast: diffuse l'annulation aux autres processus si le backend est partagé
+
+        Returns:
+            Nombre de jobs locaux annulés
+        """
+        with self._lock:
+            job_types = list(self._groups) if job_type == "all" else [job_type]
+            victims = [token.job_id for token in self._tokens.values()
+                       if token.job_type in job_types and not token.is_cancelled()]
+            for name in job_types:
+                group = self._groups.get(name)
+                if group is not None:
+                    group.cancelled = True
+                # Les prochains jobs de ce type repartent avec un jeton de groupe neuf
+                self._groups[name] = _GroupToken()
+                if arm_for_s > 0:
+                    self._armed_until[name] = time.monotonic() + arm_for_s
+
+        self.cancelled_count += len(victims)
+        logger.info(f"🛑 Cancelled {len(victims)} {job_type} job(s)")
+        if self.on_cancel is not None:
+            for job_id in victims:
+                self.on_cancel(job_id)
+        if broadcast and self.backend is not None and self.backend.broadcast:
+            self.backend.publish_type(job_type)
+        return len(victims)
+
+
+class FileCancellationBackend:
+    """
+    Pont entre le dossier cancel_flags/ et le registre en mémoire
+
+    Un thread unique scrute le dossier toutes les poll_interval secondes:
+      - <job_id>.cancel annule le job s'il tourne dans ce processus
+      - cancel_all_<type>.flag annule tous les jobs du type (et ceux qui arrivent
+        dans les arm_for_s secondes, le bot Node l'écrit avant d'avoir un job_id)
+    Les fichiers ne sont traités qu'une fois par processus et supprimés après file_ttl_s,
+    ce qui laisse le temps aux autres processus de les voir.
+
+    Args:
+        broadcast: écrit aussi des fichiers de flag pour les annulations locales,
+            afin que les autres workers (uvicorn --workers N) les reçoivent
+    """
+
+    def __init__(self, registry: CancellationRegistry, directory: Path, poll_interval: float = 0.5,
+                 broadcast: bool = False, arm_for_s: float = 10.0, file_ttl_s: float = 30.0):
+        self.registry = registry
+        self.directory = Path(directory)
+        self.poll_interval = poll_interval
+        self.broadcast = broadcast
+        self.arm_for_s = arm_for_s
+        self.file_ttl_s = file_ttl_s
+        self._seen: Dict[str, float] = {}  # nom de fichier -> mtime déjà traité
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        registry.backend = self
+
+    def start(self):
+        self.directory.mkdir(exist_ok=True)
+        self.clear()
+        self._thread = threading.Thread(target=self._run, name="cancel-flags-poller", daemon=True)
+        self._thread.start()
+        logger.info(f"📁 Watching cancel flags in {self.directory.absolute()} every {self.poll_interval}s")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.poll_interval * 2)
+            self._thread = None
+
+    def clear(self):
+        """Supprime les flags laissés par une exécution précédente"""
+        for name in self._list():
+            self._unlink(name)
+
+    # ---------- Publication (multi-processus) ----------
+
+    def publish_job(self, job_id: str):
+        self._write(f"{job_id}.cancel")
+
+    def publish_type(self, job_type: str):
+        self._write(f"cancel_all_{job_type}.flag")
+
+    def _write(self, name: str):
+        path = self.directory / name
+        try:
+            path.write_text("cancelled", encoding="utf8")
+            # Ne pas retraiter notre propre flag au prochain passage
+            self._seen[name] = path.stat().st_mtime
+        except OSError as e:
+            logger.warning(f"Failed to write cancel flag {name}: {e}")
+
+    # ---------- Scrutation ----------
+
+    def _list(self) -> List[str]:
+        try:
+            return [entry.name for entry in os.scandir(self.directory)
+                    if entry.name.endswith((".cancel", ".flag"))]
+        except OSError:
+            return []
+
+    def _unlink(self, name: str):
+        try:
+            (self.directory / name).unlink()
+        except OSError:
+            pass
+        self._seen.pop(name, None)
+
+    def poll_once(self):
+        """Un passage de scrutation: un scandir et un stat par flag présent"""
+        now = time.time()
+        for name in self._list():
+            try:
+                mtime = (self.directory / name).stat().st_mtime
+            except OSError:
+                continue
+
+            if now - mtime > self.file_ttl_s:
+                self._unlink(name)
+                continue
+            if self._seen.get(name) == mtime:
+                continue
+            self._seen[name] = mtime
+
+            if name.endswith(".cancel"):
+                job_id = name[:-len(".cancel")]
+                if self.registry.cancel(job_id, broadcast=False):
+                    logger.info(f"🛑 Job {job_id} cancelled via flag file")
+                    self._unlink(name)
+            elif name.startswith("cancel_all_"):
+                job_type = name[len("cancel_all_"):-len(".flag")]
+                remaining_arm = max(self.arm_for_s - (now - mtime), 0.0)
+                logger.info(f"🛑 Found {name}, cancelling {job_type} jobs")
+                self.registry.cancel_type(job_type, arm_for_s=remaining_arm, broadcast=False)
+
+    def _run(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.poll_once()
+            except Exception as e:
+                logger.warning(f"Cancel flag poller error: {e}")
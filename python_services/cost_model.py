@@ -0,0 +1,267 @@
+"""
+Modèle de coût des jobs du microservice d'images: durée et mémoire prédites avant
+qu'un job ne touche un modèle (contrôle d'admission, ETA de la file)
+  - génération: débruitage (steps x images x mégapixels, plus un terme d'attention qui croît
+    avec la résolution), décodage VAE (mégapixels de sortie) et activations du UNet
+  - upscale: passes Real-ESRGAN par mégapixel d'entrée (un coefficient par modèle) et RAM
+    des sorties (l'accumulation des tuiles se fait en float32 sur CPU)
+Chaque coefficient part d'une valeur a priori selon le device, puis suit une moyenne glissante
+des jobs mesurés (durées partout, pic mémoire en CUDA). Les coefficients calibrés sont gardés
+dans un fichier JSON entre deux démarrages, par profil (device et précision).
+Ce module n'importe pas torch.
+"""
+
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MEGAPIXEL = 1024 * 1024
+LATENT_SCALE = 8
+# Résolution (mégapixels) à laquelle l'attention pèse autant que le reste d'un step
+ATTENTION_MEGAPIXELS = 4.0
+# Activations du UNet par pixel de latent et par image du lot CFG (fp16, attention par tranches)
+UNET_BYTES_PER_LATENT_PIXEL_FP16 = 48 * 1024
+# RAM d'un upscale par pixel de sortie du réseau (accumulateur et poids float32, uint8, PIL), puis
+# par pixel de l'image finale redimensionnée au facteur demandé
+UPSCALE_NATIVE_BYTES_PER_PIXEL = 22
+UPSCALE_OUTPUT_BYTES_PER_PIXEL = 3
+SIZE_ALIGN = 64  # Les tailles réduites restent des multiples de 64 px
+
+# Coefficients a priori: secondes par unité (RTX 3060 en fp16 / CPU récent en fp32), multiplicateur
+# pour la mémoire; remplacés par les mesures dès les premiers jobs
+CUDA_PRIORS = {"denoise_s": 0.6, "vae_decode_s": 0.5, "esrgan_general_s": 4.0, "esrgan_anime_s": 1.5,
+               "unet_memory": 1.0}
+CPU_PRIORS = {"denoise_s": 30.0, "vae_decode_s": 20.0, "esrgan_general_s": 120.0, "esrgan_anime_s": 40.0,
+              "unet_memory": 1.0}
+
+
+@dataclass
+class JobCost:
+    """Coût prédit d'un job: calcul sur le device et pic mémoire"""
+    seconds: float
+    memory_bytes: int
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {"predicted_s": round(self.seconds, 1), "predicted_memory_mb": round(self.memory_bytes / MEGAPIXEL)}
+
+
+def denoise_units(width: int, height: int, steps: int, images: int) -> float:
+    """Travail de débruitage: steps x images x mégapixels, majoré par l'attention aux grandes résolutions"""
+    megapixels = width * height / MEGAPIXEL
+    return steps * images * megapixels * (1 + megapixels / ATTENTION_MEGAPIXELS)
+
+
+def unet_activation_bytes(width: int, height: int, images: int, element_size: int) -> int:
+    """
+    Activations du UNet au pic, a priori: linéaires en pixels de latent, plus la matrice
+    d'attention du niveau le plus fin qui en a (latent sous-échantillonné 2x)
+    Le guidage (CFG) double le lot
+    """
+    tokens = (width // LATENT_SCALE) * (height // LATENT_SCALE)
+    attention_tokens = tokens // 4
+    per_image = tokens * UNET_BYTES_PER_LATENT_PIXEL_FP16 * element_size // 2 + attention_tokens ** 2 * element_size
+    return 2 * images * per_image
+
+
+def upscale_host_bytes(width: int, height: int, scale: int, native_scale: int = 4) -> int:
+    """RAM des sorties d'un upscale (les activations du réseau sont bornées par le découpage en tuiles)"""
+    return width * height * (native_scale ** 2 * UPSCALE_NATIVE_BYTES_PER_PIXEL
+                             + scale ** 2 * UPSCALE_OUTPUT_BYTES_PER_PIXEL)
+
+
+def align_down(value: float, minimum: int) -> int:
+    return max(minimum, int(value) // SIZE_ALIGN * SIZE_ALIGN)
+
+
+class CostModel:
+    """
+    Prédictions de durée et de mémoire, recalibrées sur les jobs mesurés
+
+    observe() remplace d'abord l'a priori par la moyenne des premières mesures, puis suit
+    une moyenne glissante (poids smoothing) pour s'adapter au matériel et aux réglages
+
+    Args:
+        priors: coefficient a priori par clé (secondes par unité, multiplicateur mémoire)
+        path: fichier JSON des coefficients calibrés (None = pas de persistance)
+        profile: identifiant du matériel; les mesures d'un autre profil sont ignorées au chargement
+        smoothing: poids d'une nouvelle mesure une fois la moyenne établie
+        save_interval_s: intervalle minimal entre deux écritures du fichier
+    """
+
+    def __init__(self, priors: Dict[str, float], path: Optional[Path] = None, profile: str = "",
+                 smoothing: float = 0.2, save_interval_s: float = 60.0):
+        self.priors = dict(priors)
+        self.path = path
+        self.profile = profile
+        self.smoothing = smoothing
+        self.save_interval_s = save_interval_s
+        self._coefficients = dict(priors)
+        self._samples = {key: 0 for key in priors}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._saved_at = time.monotonic()
+
+    # ---------- Calibration ----------
+
+    def coefficient(self, key: str) -> float:
+        with self._lock:
+            return self._coefficients[key]
+
+    def observe(self, key: str, units: float, measured: float):
+        """Recale un coefficient sur une mesure (measured pour units unités de travail)"""
+        if units <= 0 or measured <= 0 or not math.isfinite(measured):
+            return
+        with self._lock:
+            samples = self._samples[key] + 1
+            weight = max(self.smoothing, 1 / samples)
+            self._coefficients[key] += weight * (measured / units - self._coefficients[key])
+            self._samples[key] = samples
+            self._dirty = True
+            due = time.monotonic() - self._saved_at >= self.save_interval_s
+        if due:
+            self.save()
+
+    def observe_generation(self, width: int, height: int, steps: int, images: int, element_size: int,
+                           generation_s: float, decode_s: float, peak_memory_bytes: Optional[int] = None):
+        """Génération terminée: durées du débruitage et du décodage, pic du débruitage s'il a été mesuré"""
+        self.observe("vae_decode_s", width * height * images / MEGAPIXEL, decode_s)
+        self.observe("denoise_s", denoise_units(width, height, steps, images), generation_s - decode_s)
+        if peak_memory_bytes:
+            self.observe("unet_memory", unet_activation_bytes(width, height, images, element_size), peak_memory_bytes)
+
+    def observe_upscale(self, model: str, width: int, height: int, seconds: float):
+        """Upscale terminé (model: esrgan_general ou esrgan_anime): durée des passes pour une image width x height"""
+        self.observe(f"{model}_s", width * height / MEGAPIXEL, seconds)
+
+    # ---------- Prédictions ----------
+
+    def generation(self, width: int, height: int, steps: int, images: int, element_size: int) -> JobCost:
+        """Coût prédit d'une génération (steps: steps de débruitage réellement exécutés)"""
+        seconds = (self.coefficient("denoise_s") * denoise_units(width, height, steps, images)
+                   + self.coefficient("vae_decode_s") * width * height * images / MEGAPIXEL)
+        memory = self.coefficient("unet_memory") * unet_activation_bytes(width, height, images, element_size)
+        return JobCost(seconds, int(memory))
+
+    def upscale(self, model: str, width: int, height: int, scale: int) -> JobCost:
+        """Coût prédit d'un upscale d'une image d'entrée width x height (model: esrgan_general ou esrgan_anime)"""
+        seconds = self.coefficient(f"{model}_s") * width * height / MEGAPIXEL
+        return JobCost(seconds, upscale_host_bytes(width, height, scale))
+
+    def fit_generation(self, width: int, height: int, steps: int, images: int, element_size: int,
+                       max_seconds: float, max_memory_bytes: int, min_side: int = 512,
+                       min_steps: int = 20) -> Optional[Tuple[int, int, int]]:
+        """
+        Plus grande génération qui tient dans le budget (0 = pas de limite), ou None
+        La résolution est d'abord réduite jusqu'à ce que la mémoire tienne (proportions gardées),
+        puis les steps jusqu'à min_steps pour la durée (au-delà d'une trentaine de steps SDXL gagne
+        peu, la résolution se voit), puis de nouveau la résolution jusqu'à min_side
+
+        Returns:
+            (width, height, steps)
+        """
+        def fits(candidate_width: int, candidate_height: int, candidate_steps: int, check_time: bool) -> bool:
+            cost = self.generation(candidate_width, candidate_height, candidate_steps, images, element_size)
+            return ((not max_memory_bytes or cost.memory_bytes <= max_memory_bytes)
+                    and (not check_time or not max_seconds or cost.seconds <= max_seconds))
+
+        def shrink(candidate_steps: int, check_time: bool) -> Optional[Tuple[int, int]]:
+            factor = 1.0
+            while True:
+                candidate_width = align_down(width * factor, min(min_side, width))
+                candidate_height = align_down(height * factor, min(min_side, height))
+                if fits(candidate_width, candidate_height, candidate_steps, check_time):
+                    return candidate_width, candidate_height
+                if candidate_width <= min(min_side, width) and candidate_height <= min(min_side, height):
+                    return None
+                factor *= 0.9
+
+        size = shrink(steps, check_time=False)
+        if size is None:
+            return None
+        width, height = size
+        if fits(width, height, steps, check_time=True):
+            return width, height, steps
+        if max_seconds:
+            decode = self.generation(width, height, 0, images, element_size).seconds
+            per_step = self.generation(width, height, 1, images, element_size).seconds - decode
+            if per_step > 0:
+                steps = min(steps, max(min(min_steps, steps), int((max_seconds - decode) / per_step)))
+        size = shrink(steps, check_time=True)
+        return (*size, steps) if size is not None else None
+
+    def fit_upscale(self, model: str, width: int, height: int, scale: int, max_seconds: float,
+                    max_memory_bytes: int, min_side: int = 64) -> Optional[Tuple[int, int]]:
+        """Plus grande image d'entrée (proportions gardées) dont l'upscale tient dans le budget, ou None"""
+        cost = self.upscale(model, width, height, scale)
+        ratio = 1.0
+        if max_seconds and cost.seconds > max_seconds:
+            ratio = min(ratio, max_seconds / cost.seconds)
+        if max_memory_bytes and cost.memory_bytes > max_memory_bytes:
+            ratio = min(ratio, max_memory_bytes / cost.memory_bytes)
+        factor = math.sqrt(ratio)
+        fitted = int(width * factor), int(height * factor)
+        return fitted if min(fitted) >= min_side else None
+
+    # ---------- Persistance ----------
+
+    def load(self):
+        """Reprend les coefficients calibrés du fichier (même profil uniquement)"""
+        if self.path is None or not self.path.exists():
+            return
+        try:
+            saved = json.loads(self.path.read_text(encoding="utf8")).get(self.profile, {})
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️ Could not read cost model {self.path}: {e}")
+            return
+        with self._lock:
+            for key, entry in saved.items():
+                if key in self._coefficients and entry.get("samples", 0) > 0:
+                    self._coefficients[key] = float(entry["value"])
+                    self._samples[key] = int(entry["samples"])
+        if saved:
+            logger.info(f"📐 Cost model calibration loaded ({self.profile})")
+
+    def save(self):
+        """Écrit les coefficients calibrés (remplacement atomique, les autres profils sont gardés)"""
+        if self.path is None:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            calibrated = {key: {"value": self._coefficients[key], "samples": samples}
+                          for key, samples in self._samples.items() if samples > 0}
+            self._dirty = False
+            self._saved_at = time.monotonic()
+        try:
+            profiles = json.loads(self.path.read_text(encoding="utf8")) if self.path.exists() else {}
+        except (OSError, ValueError):
+            profiles = {}
+        profiles[self.profile] = calibrated
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            descriptor, temporary = tempfile.mkstemp(dir=self.path.parent, suffix=".tmp")
+            with os.fdopen(descriptor, "w", encoding="utf8") as file:
+                json.dump(profiles, file, indent=2)
+            os.replace(temporary, self.path)
+        except OSError as e:
+            logger.warning(f"⚠️ Could not save cost model {self.path}: {e}")
+
+    def status(self) -> Dict[str, Any]:
+        """Coefficients actuels exposés sur le health check"""
+        with self._lock:
+            return {
+                "profile": self.profile,
+                "coefficients": {
+                    key: {"value": round(value, 4), "prior": self.priors[key], "samples": self._samples[key]}
+                    for key, value in self._coefficients.items()
+                },
+            }
@@ -0,0 +1,181 @@
+"""
+Backend d'inférence CPU: précision réduite, format mémoire et threads
+Sur CPU, SDXL et Real-ESRGAN tournaient en float32, avec le nombre de threads par défaut de torch:
+  - bfloat16 par autocast là où le CPU le permet (oneDNN: AVX512-BF16/AMX natifs, AVX512 émulé):
+    les poids restent en float32, les convolutions et matmuls passent en bfloat16.
+    Pas de débordement comme en float16 (même plage que float32), y compris pour le VAE
+  - channels_last pour l'UNet, le VAE et RRDBNet: format attendu par les convolutions oneDNN
+  - pas d'attention slicing: le noyau flash CPU de scaled_dot_product_attention est plus rapide et
+    moins gourmand que l'attention découpée
+  - pools de threads explicites: threads intra-op et inter-op du processus, et plafond par
+    modèle (ex: ESRGAN sur 4 threads, SDXL sur tous) appliqué pendant ses appels
+
+L'épinglage des cœurs par modèle passe par les processus workers (IMAGE_API_WORKER_DEVICES,
+ex: "cpu:0-11=sdxl,cpu:12-15=esrgan"): chaque processus fixe son affinité avant d'importer torch.
+"""
+
+import logging
+import os
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+import torch
+
+from model_registry import model_matches
+
+logger = logging.getLogger(__name__)
+
+PRECISIONS = ("auto", "bfloat16", "float32")
+
+
+def bf16_supported() -> bool:
+    """oneDNN sait calculer en bfloat16 sur ce CPU (natif ou émulé en AVX512)"""
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def resolve_precision(requested: str) -> torch.dtype:
+    """
+    Précision de calcul pour une valeur de IMAGE_API_CPU_PRECISION
+
+    Raises:
+        ValueError: précision inconnue
+    """
+    if requested not in PRECISIONS:
+        raise ValueError(f"Invalid CPU precision: {requested!r} (expected {', '.join(PRECISIONS)})")
+    if requested == "float32":
+        return torch.float32
+    if bf16_supported():
+        return torch.bfloat16
+    if requested == "bfloat16":
+        logger.warning("⚠️ bfloat16 not supported by this CPU (oneDNN), falling back to float32")
+    return torch.float32
+
+
+def available_cpus() -> int:
+    """Cœurs utilisables par ce processus (affinité comprise)"""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def parse_model_threads(text: str) -> Dict[str, int]:
+    """
+    "sdxl=12,esrgan=4" -> {"sdxl": 12, "esrgan": 4}
+
+    Raises:
+        ValueError: entrée mal formée
+    """
+    threads = {}
+    for entry in (entry.strip() for entry in text.split(",")):
+        if not entry:
+            continue
+        name, separator, count = entry.partition("=")
+        if not separator or not count.strip().isdigit() or int(count) <= 0:
+            raise ValueError(f"Invalid IMAGE_API_CPU_MODEL_THREADS entry: {entry!r} (expected model=threads)")
+        threads[name.strip()] = int(count)
+    return threads
+
+
+@contextmanager
+def thread_limit(count: Optional[int]) -> Iterator[None]:
+    """Threads intra-op de torch limités à count pendant le bloc (réglage du processus, thread worker unique)"""
+    previous = torch.get_num_threads()
+    if not count or count == previous:
+        yield
+        return
+    torch.set_num_threads(count)
+    try:
+        yield
+    finally:
+        torch.set_num_threads(previous)
+
+
+class CpuBackend:
+    """
+    Réglages d'inférence CPU d'un processus
+
+    Args:
+        enabled: False sur GPU (inference() et prepare() ne font rien)
+        precision: "auto" (bfloat16 si supporté), "bfloat16" ou "float32"
+        threads: threads intra-op du processus (0 = défaut de torch, un par cœur utilisable)
+        interop_threads: threads inter-op (0 = défaut de torch); l'UNet n'exécute pas de branches
+            en parallèle, 1 évite des threads inactifs qui se disputent les cœurs
+        model_threads: plafond de threads par modèle ("esrgan" couvre esrgan_general et esrgan_anime)
+        channels_last: convertit les modèles convolutifs au format channels_last
+    """
+
+    def __init__(self, enabled: bool, precision: str = "auto", threads: int = 0, interop_threads: int = 0,
+                 model_threads: Optional[Dict[str, int]] = None, channels_last: bool = True):
+        self.enabled = enabled
+        self.requested_precision = precision
+        self.compute_dtype = resolve_precision(precision) if enabled else torch.float32
+        self.model_threads = dict(model_threads or {})
+        self.channels_last = channels_last and enabled
+        if enabled:
+            self._configure_threads(threads, interop_threads)
+
+    @property
+    def autocast(self) -> bool:
+        return self.enabled and self.compute_dtype != torch.float32
+
+    @property
+    def precision(self) -> str:
+        return str(self.compute_dtype).replace("torch.", "")
+
+    def _configure_threads(self, threads: int, interop_threads: int):
+        cpus = available_cpus()
+        if threads:
+            torch.set_num_threads(min(threads, cpus))
+        if interop_threads:
+            try:
+                torch.set_num_interop_threads(interop_threads)
+            except RuntimeError as e:  # Déjà fixé (travail inter-op déjà lancé dans ce processus)
+                logger.warning(f"⚠️ Could not set inter-op threads: {e}")
+        for name, count in self.model_threads.items():
+            if count > cpus:
+                logger.warning(f"⚠️ IMAGE_API_CPU_MODEL_THREADS: {name}={count} capped to {cpus} usable cores")
+                self.model_threads[name] = cpus
+        logger.info(f"🧮 CPU backend: {self.precision}, {torch.get_num_threads()} threads "
+                    f"({torch.get_num_interop_threads()} inter-op), channels_last "
+                    f"{'on' if self.channels_last else 'off'}"
+                    + (f", per model {self.model_threads}" if self.model_threads else ""))
+
+    def threads_for(self, model: str) -> Optional[int]:
+        """Plafond de threads d'un modèle (None = tous les threads du processus)"""
+        return next((count for name, count in self.model_threads.items() if model_matches(model, (name,))), None)
+
+    @contextmanager
+    def inference(self, model: str) -> Iterator[None]:
+        """Contexte des appels à un modèle: autocast bfloat16 et plafond de threads"""
+        if not self.enabled:
+            yield
+            return
+        with thread_limit(self.threads_for(model)):
+            if self.autocast:
+                # Sans cache des poids convertis: il garderait une copie bfloat16 de l'UNet (~5 Go) pendant tout
+                # le débruitage; reconvertir à chaque appel coûte quelques % d'un step SDXL sur CPU
+                with torch.autocast("cpu", dtype=self.compute_dtype, cache_enabled=False):
+                    yield
+            else:
+                yield
+
+    def prepare(self, module: Any) -> Any:
+        """Modèle convolutif (UNet, VAE, RRDBNet) passé en channels_last"""
+        if self.channels_last and isinstance(module, torch.nn.Module):
+            module.to(memory_format=torch.channels_last)
+        return module
+
+    def describe(self) -> Dict[str, Any]:
+        """Réglages exposés sur le health check"""
+        return {
+            "precision": self.precision,
+            "requested_precision": self.requested_precision,
+            "bf16_supported": bf16_supported(),
+            "threads": torch.get_num_threads(),
+            "interop_threads": torch.get_num_interop_threads(),
+            "model_threads": self.model_threads,
+            "channels_last": self.channels_last,
+        }
@@ -0,0 +1,110 @@
+"""
+Brouillons de génération, gardés pour POST /refine
+Une génération en mode brouillon (draft=true) tourne à résolution et steps réduits: l'utilisateur
+explore plusieurs prompts pour le prix d'un rendu complet. Les latents débruités du brouillon et
+ses images décodées sont gardés ici pour qu'un refine reparte du brouillon (img2img à la taille
+demandée) au lieu de tout redébruiter:
+  - en RAM CPU: ne consomme pas le budget du device, survit au déchargement de SDXL
+  - borné en octets (LRU) et en durée de vie (TTL)
+
+Ce module n'importe pas torch: les latents sont des tableaux numpy (ils traversent aussi les
+processus workers du mode coordinateur).
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Draft:
+    """Un brouillon: une entrée par image du job"""
+    latents: np.ndarray  # N x 4 x h x w, latents débruités avant décodage VAE
+    images: List[Any]  # Images PIL décodées du brouillon
+    seeds: List[int]
+    request: Any  # GenerateRequest d'origine (taille et steps demandés, prompt, cfg)
+    created_at: float = field(default_factory=time.monotonic)
+
+    @property
+    def nbytes(self) -> int:
+        return self.latents.nbytes + sum(image.width * image.height * len(image.getbands()) for image in self.images)
+
+
+class DraftStore:
+    """
+    LRU borné en octets et en âge: draft_id -> Draft
+
+    Args:
+        max_bytes: taille maximale des brouillons gardés (0 = mode brouillon sans refine possible)
+        ttl_s: durée de vie d'un brouillon après sa création
+    """
+
+    def __init__(self, max_bytes: int, ttl_s: float):
+        self.max_bytes = max_bytes
+        self.ttl_s = ttl_s
+        self._entries: "OrderedDict[str, Draft]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.used_bytes = 0
+        self.stored = 0
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def put(self, draft_id: str, draft: Draft):
+        size = draft.nbytes
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._drop_expired()
+            if draft_id in self._entries:
+                self.used_bytes -= self._entries.pop(draft_id).nbytes
+            while self.used_bytes + size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.used_bytes -= evicted.nbytes
+                self.evictions += 1
+            self._entries[draft_id] = draft
+            self.used_bytes += size
+            self.stored += 1
+
+    def get(self, draft_id: str) -> Optional[Draft]:
+        """Brouillon encore disponible, sinon None (inconnu, expiré ou évincé)"""
+        with self._lock:
+            self._drop_expired()
+            draft = self._entries.get(draft_id)
+            if draft is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(draft_id)
+            self.hits += 1
+            return draft
+
+    def _drop_expired(self):
+        # Les entrées sont rangées par dernier usage, pas par création: on parcourt tout (peu d'entrées)
+        deadline = time.monotonic() - self.ttl_s
+        for draft_id in [draft_id for draft_id, draft in self._entries.items() if draft.created_at < deadline]:
+            self.used_bytes -= self._entries.pop(draft_id).nbytes
+            self.expired += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Compteurs exposés sur le health check"""
+        with self._lock:
+            self._drop_expired()
+            return {
+                "entries": len(self._entries),
+                "used_mb": round(self.used_bytes / 1024 ** 2, 2),
+                "max_mb": round(self.max_bytes / 1024 ** 2, 2),
+                "ttl_s": self.ttl_s,
+                "stored": self.stored,
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "evictions": self.evictions,
+            }
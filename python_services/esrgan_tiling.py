@@ -0,0 +1,343 @@
+"""
+Upscaling Real-ESRGAN par tuiles, à mémoire bornée
+Le RRDBNet est appliqué directement (sans RealESRGANer.enhance) pour:
+  - choisir la taille des tuiles d'après la mémoire disponible et la résolution d'entrée
+  - faire chevaucher les tuiles et fondre les coutures (pondération linéaire),
+    au lieu du simple recadrage de RealESRGANer qui laisse des coutures visibles
+  - traiter plusieurs tuiles de même taille en un seul appel (batch), y compris des
+    tuiles (ou des images entières) de plusieurs images upscalées ensemble
+  - vérifier l'annulation entre deux lots de tuiles
+Le pic mémoire sur le device ne dépend plus que de la taille de tuile; la sortie
+pleine résolution est assemblée en RAM CPU.
+
+Vérification de qualité contre la sortie sans tuiles:
+    python esrgan_tiling.py image.png [--model general|anime] [--tile 256]
+"""
+
+import logging
+import math
+import os
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+logger = logging.getLogger(__name__)
+
+# Mémoire d'activation par pixel d'entrée au pic du RRDBNet x4 (fp32, mesurée sur CPU);
+# la moitié en fp16. Inclut les cartes 64 canaux à 4x la résolution de l'upsampling final.
+BYTES_PER_INPUT_PIXEL_FP32 = 16 * 1024
+# Part de la mémoire libre qu'on s'autorise à utiliser (fragmentation, autres allocations)
+MEMORY_SAFETY_FACTOR = 0.5
+TILE_ALIGN = 32
+MIN_TILE = 128
+PRE_PAD = 10  # Marge réfléchie autour de l'image, comme RealESRGANer (moins d'artefacts aux bords)
+
+
+@dataclass
+class TilePlan:
+    """Découpage retenu pour un upscale (tile en pixels d'entrée)"""
+    tile: int
+    overlap: int
+    batch_size: int
+
+    def as_dict(self) -> Dict[str, int]:
+        return {"tile": self.tile, "overlap": self.overlap, "batch_size": self.batch_size}
+
+
+def bytes_per_input_pixel(half: bool) -> int:
+    return BYTES_PER_INPUT_PIXEL_FP32 // 2 if half else BYTES_PER_INPUT_PIXEL_FP32
+
+
+def available_memory_bytes(device: str) -> int:
+    """Mémoire libre sur le device (VRAM libre en CUDA, MemAvailable sur CPU)"""
+    if device == "cuda" and torch.cuda.is_available():
+        free_bytes, _ = torch.cuda.mem_get_info()
+        return free_bytes
+    try:
+        with open("/proc/meminfo", encoding="utf8") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 4 * 1024 ** 3
+
+
+def plan_tiles(width: int, height: int, available_bytes: int, half: bool, max_tile: int = 512,
+               overlap: int = 32, max_batch: int = 4, untiled_max_pixels: int = 512 * 512,
+               tile: Optional[int] = None) -> Optional[TilePlan]:
+    """
+    Choisit la taille de tuile pour une image d'entrée width x height
+
+    Args:
+        available_bytes: mémoire libre sur le device
+        max_tile: côté maximal d'une tuile (pixels d'entrée)
+        overlap: chevauchement entre tuiles voisines (pixels d'entrée)
+        max_batch: nombre maximal de tuiles par appel au modèle
+        untiled_max_pixels: au-delà, on découpe même si l'image tiendrait en mémoire
+        tile: taille de tuile imposée (pixels d'entrée; 0 = jamais de tuiles), sinon d'après la mémoire
+
+    Returns:
+        None si l'image passe en un seul morceau, sinon le TilePlan
+    """
+    per_pixel = bytes_per_input_pixel(half)
+    usable = available_bytes * MEMORY_SAFETY_FACTOR
+    padded_pixels = (width + 2 * PRE_PAD) * (height + 2 * PRE_PAD)
+    if tile == 0 or (tile is None and width * height <= untiled_max_pixels and padded_pixels * per_pixel <= usable):
+        return None
+
+    if tile is None:
+        tile = int(math.sqrt(usable / per_pixel)) // TILE_ALIGN * TILE_ALIGN
+        tile = max(MIN_TILE, min(tile, max_tile))
+    if tile >= max(width, height) + 2 * PRE_PAD:
+        # Une seule tuile couvrirait toute l'image
+        return None
+    overlap = min(overlap, tile // 4)
+    batch_size = max(1, min(max_batch, int(usable // (tile * tile * per_pixel))))
+    return TilePlan(tile, overlap, batch_size)
+
+
+def batch_limit(height: int, width: int, available_bytes: int, half: bool, max_batch: int) -> int:
+    """Nombre de morceaux height x width (pixels d'entrée, marge comprise) par appel au modèle"""
+    usable = available_bytes * MEMORY_SAFETY_FACTOR
+    return max(1, min(max_batch, int(usable // (height * width * bytes_per_input_pixel(half)))))
+
+
+def tile_starts(length: int, tile: int, overlap: int) -> List[int]:
+    """Origines des tuiles sur un axe; la dernière est calée sur le bord"""
+    if length <= tile:
+        return [0]
+    starts = list(range(0, length - tile, tile - overlap))
+    starts.append(length - tile)
+    return starts
+
+
+def blend_ramp(size: int, fade: int, fade_start: bool, fade_end: bool) -> torch.Tensor:
+    """Poids 1D: rampe linéaire sur les bords partagés avec une tuile voisine, 1 ailleurs"""
+    ramp = torch.ones(size)
+    fade = min(fade, size // 2)
+    if fade > 0:
+        edge = torch.arange(1, fade + 1, dtype=torch.float32) / (fade + 1)
+        if fade_start:
+            ramp[:fade] = edge
+        if fade_end:
+            ramp[-fade:] = edge.flip(0)
+    return ramp
+
+
+def _run_model(model: torch.nn.Module, batch: torch.Tensor, device: str, half: bool) -> torch.Tensor:
+    with torch.no_grad():
+        inputs = batch.to(device)
+        if half:
+            inputs = inputs.half()
+        return model(inputs).float().cpu()
+
+
+@dataclass
+class _Upscale:
+    """Une image en cours d'upscale: morceaux restants et sortie accumulée (sur CPU)"""
+    image: torch.Tensor  # 1x3xHxW avec la marge PRE_PAD
+    height: int  # Taille sans la marge
+    width: int
+    pending: List[Tuple[int, int, int, int]]  # (y, x, h, w) des morceaux restant à passer
+    batch_size: int  # Morceaux de cette image par appel au modèle
+    fade: int = 0
+    output: Optional[torch.Tensor] = None
+    weights: Optional[torch.Tensor] = None
+    error: Optional[BaseException] = None
+    done: bool = False
+
+
+def _prepare(image: np.ndarray, scale: int, plan: Optional[TilePlan], half: bool,
+             available_bytes: Optional[int], max_batch: int) -> _Upscale:
+    height, width = image.shape[:2]
+    tensor = torch.from_numpy(np.ascontiguousarray(image)).permute(2, 0, 1).unsqueeze(0).float().div_(255)
+    # "reflect" exige une marge plus petite que l'image
+    pad_mode = "reflect" if min(height, width) > PRE_PAD else "replicate"
+    tensor = F.pad(tensor, (PRE_PAD, PRE_PAD, PRE_PAD, PRE_PAD), mode=pad_mode)
+    _, channels, padded_h, padded_w = tensor.shape
+
+    if plan is None:
+        batch_size = batch_limit(padded_h, padded_w, available_bytes, half, max_batch) if available_bytes else 1
+        return _Upscale(tensor, height, width, [(0, 0, padded_h, padded_w)], batch_size)
+    tile_h, tile_w = min(plan.tile, padded_h), min(plan.tile, padded_w)
+    pending = [(y, x, tile_h, tile_w) for y in tile_starts(padded_h, tile_h, plan.overlap)
+               for x in tile_starts(padded_w, tile_w, plan.overlap)]
+    return _Upscale(tensor, height, width, pending, plan.batch_size, fade=plan.overlap * scale,
+                    output=torch.zeros(channels, padded_h * scale, padded_w * scale),
+                    weights=torch.zeros(1, padded_h * scale, padded_w * scale))
+
+
+def _accumulate(job: _Upscale, piece: Tuple[int, int, int, int], result: torch.Tensor, scale: int):
+    """Ajoute la sortie d'un morceau, pondérée sur les bords partagés avec ses voisins"""
+    y, x, h, w = piece
+    if job.output is None:
+        job.output = result.unsqueeze(0)
+        return
+    _, _, padded_h, padded_w = job.image.shape
+    weight_y = blend_ramp(h * scale, job.fade, y > 0, y + h < padded_h)
+    weight_x = blend_ramp(w * scale, job.fade, x > 0, x + w < padded_w)
+    weight = weight_y[:, None] * weight_x[None, :]
+    region = (slice(None), slice(y * scale, (y + h) * scale), slice(x * scale, (x + w) * scale))
+    job.output[region] += result * weight
+    job.weights[region] += weight
+
+
+def _finish(job: _Upscale, scale: int) -> np.ndarray:
+    output = job.output if job.weights is None else job.output.div_(job.weights).unsqueeze(0)
+    margin = PRE_PAD * scale
+    output = output[0, :, margin:margin + job.height * scale, margin:margin + job.width * scale]
+    return output.clamp_(0, 1).mul_(255).round_().to(torch.uint8).permute(1, 2, 0).contiguous().numpy()
+
+
+def upscale_arrays(model: torch.nn.Module, images: Sequence[np.ndarray], scale: int, device: str, half: bool,
+                   plans: Sequence[Optional[TilePlan]], available_bytes: Optional[int] = None,
+                   max_batch: int = 1, check_cancelled: Optional[Sequence[Optional[Callable[[], None]]]] = None
+                   ) -> Iterator[Tuple[int, Union[np.ndarray, BaseException]]]:
+    """
+    Upscale plusieurs images RGB uint8 ensemble: les morceaux de même taille (tuiles, ou images
+    entières non découpées) de différentes images partagent les appels au modèle
+
+    Les images sont terminées dans l'ordre: chaque appel part des morceaux de la première image
+    inachevée et se complète avec des morceaux de même taille des suivantes. Chaque image est
+    produite dès que son dernier morceau est passé.
+
+    Args:
+        plans: découpage de chaque image (None = un seul passage)
+        available_bytes, max_batch: bornent le nombre d'images entières de même taille par appel
+            (batch_limit); sans available_bytes, une image non découpée passe seule
+        check_cancelled: par image, appelé avant chaque appel qui la concerne (lève pour l'interrompre)
+
+    Yields:
+        (index de l'image, image H*scale x W*scale x 3) ou (index, exception propre à cette image)
+    """
+    jobs = [_prepare(image, scale, plan, half, available_bytes, max_batch) for image, plan in zip(images, plans)]
+    checks = list(check_cancelled) if check_cancelled is not None else [None] * len(jobs)
+
+    for index, job in enumerate(jobs):
+        while job.pending and job.error is None:
+            shape = job.pending[0][2:]
+            limit = job.batch_size
+            chunk: List[Tuple[int, Tuple[int, int, int, int]]] = []
+            for other_index in range(index, len(jobs)):
+                other = jobs[other_index]
+                if other.error is not None:
+                    continue
+                matching = [piece for piece in other.pending if piece[2:] == shape]
+                if not matching:
+                    continue
+                if checks[other_index] is not None:
+                    try:
+                        checks[other_index]()
+                    except Exception as e:
+                        other.error = e
+                        continue
+                # La mémoire d'un appel ne dépend que de la taille des morceaux: même limite pour toutes les images
+                chunk.extend((other_index, piece) for piece in matching[:limit - len(chunk)])
+                if len(chunk) >= limit:
+                    break
+            if job.error is not None:
+                break
+
+            height, width = shape
+            batch = torch.cat([jobs[owner].image[:, :, y:y + height, x:x + width] for owner, (y, x, _, _) in chunk])
+            upscaled = _run_model(model, batch, device, half)
+            for (owner, piece), result in zip(chunk, upscaled):
+                jobs[owner].pending.remove(piece)
+                _accumulate(jobs[owner], piece, result, scale)
+
+            # Les images suivantes terminées au passage sont produites tout de suite
+            for other_index in range(index + 1, len(jobs)):
+                other = jobs[other_index]
+                if not other.pending and not other.done and other.error is None:
+                    other.done = True
+                    yield other_index, _finish(other, scale)
+
+        if job.error is not None:
+            yield index, job.error
+        elif not job.done:
+            job.done = True
+            yield index, _finish(job, scale)
+
+
+def upscale_array(model: torch.nn.Module, image: np.ndarray, scale: int, device: str, half: bool,
+                  plan: Optional[TilePlan] = None,
+                  check_cancelled: Optional[Callable[[], None]] = None) -> np.ndarray:
+    """
+    Upscale une image RGB uint8 (HxWx3) par le facteur natif du modèle
+
+    Args:
+        model: RRDBNet déjà placé sur le device (upsampler.model)
+        scale: facteur natif du modèle (4 pour x4plus)
+        plan: découpage en tuiles, None pour un seul passage
+        check_cancelled: appelé entre deux lots de tuiles (lève pour interrompre)
+
+    Returns:
+        Image RGB uint8 (H*scale x W*scale x 3)
+    """
+    _, output = next(upscale_arrays(model, [image], scale, device, half, [plan], check_cancelled=[check_cancelled]))
+    if isinstance(output, BaseException):
+        raise output
+    return output
+
+
+def psnr(reference: np.ndarray, candidate: np.ndarray) -> float:
+    """PSNR en dB entre deux images uint8 (inf si identiques)"""
+    mse = np.mean((reference.astype(np.float32) - candidate.astype(np.float32)) ** 2)
+    if mse == 0:
+        return float("inf")
+    return float(10 * np.log10(255.0 ** 2 / mse))
+
+
+def compare_with_untiled(model: torch.nn.Module, image: np.ndarray, scale: int, device: str, half: bool,
+                         plan: TilePlan) -> Dict[str, float]:
+    """Écart entre la sortie par tuiles et la sortie en un seul passage (petites images uniquement)"""
+    start_time = time.monotonic()
+    reference = upscale_array(model, image, scale, device, half, None)
+    untiled_s = time.monotonic() - start_time
+    start_time = time.monotonic()
+    tiled = upscale_array(model, image, scale, device, half, plan)
+    tiled_s = time.monotonic() - start_time
+    diff = np.abs(reference.astype(np.int16) - tiled.astype(np.int16))
+    return {
+        "psnr_db": round(psnr(reference, tiled), 2),
+        "max_abs_diff": int(diff.max()),
+        "mean_abs_diff": round(float(diff.mean()), 4),
+        "untiled_s": round(untiled_s, 3),
+        "tiled_s": round(tiled_s, 3),
+    }
+
+
+def _main():
+    import argparse
+    import json
+
+    from PIL import Image
+
+    parser = argparse.ArgumentParser(description="Compare l'upscale Real-ESRGAN par tuiles à la sortie sans tuiles")
+    parser.add_argument("image", help="image d'entrée (garder petite: la référence est calculée sans tuiles)")
+    parser.add_argument("--model", choices=["general", "anime"], default="general")
+    parser.add_argument("--tile", type=int, default=128)
+    parser.add_argument("--overlap", type=int, default=32)
+    parser.add_argument("--batch", type=int, default=4)
+    args = parser.parse_args()
+
+    from image_generation_api import device, load_esrgan
+
+    upsampler = load_esrgan(args.model)
+    if upsampler is None:
+        raise SystemExit(f"Real-ESRGAN ({args.model}) not available")
+    image = np.array(Image.open(args.image).convert("RGB"))
+    plan = TilePlan(args.tile, args.overlap, args.batch)
+    report = compare_with_untiled(upsampler.model, image, upsampler.scale, device, upsampler.half, plan)
+    report.update({"image": os.path.basename(args.image), "size": f"{image.shape[1]}x{image.shape[0]}",
+                   "plan": plan.as_dict()})
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    _main()
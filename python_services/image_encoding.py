@@ -0,0 +1,96 @@
+"""
+Encodage des images de sortie (PNG, WebP, JPEG) pour le microservice d'images
+Le format et la qualité se choisissent par requête (champs output_format, quality,
+lossless, png_compress_level), sinon d'après l'en-tête Accept et les défauts ci-dessous.
+
+L'encodage ne tourne ni sur la boucle asyncio ni sur le thread worker: l'API le confie
+à un pool de threads (Pillow relâche le GIL pendant la compression), ce qui le fait
+chevaucher le débruitage du job suivant. Ce module n'importe pas torch.
+"""
+
+import io
+import os
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+from PIL import Image
+
+from image_responses import EncodedImage
+
+OUTPUT_FORMATS = ("png", "webp", "jpeg")
+
+# Qualité des formats avec perte (WebP / JPEG), 1-100
+DEFAULT_QUALITY = int(os.environ.get("IMAGE_API_OUTPUT_QUALITY", "95"))
+# Niveau zlib des PNG: générations (défaut Pillow) et upscales (grosses images: compression rapide)
+DEFAULT_PNG_LEVEL = int(os.environ.get("IMAGE_API_PNG_COMPRESS_LEVEL", "6"))
+DEFAULT_UPSCALE_PNG_LEVEL = int(os.environ.get("IMAGE_API_UPSCALE_PNG_COMPRESS_LEVEL", "1"))
+
+
+@dataclass(frozen=True)
+class OutputEncoding:
+    """Réglages d'encodage d'un job"""
+    image_format: str = "png"
+    quality: int = DEFAULT_QUALITY  # WebP / JPEG avec perte
+    lossless: bool = False  # WebP uniquement
+    png_compress_level: int = DEFAULT_PNG_LEVEL
+
+    def describe(self) -> Dict[str, Any]:
+        """Réglages effectivement utilisés (clé de cache et info de la réponse)"""
+        if self.image_format == "png":
+            return {"format": "png", "png_compress_level": self.png_compress_level}
+        if self.image_format == "webp" and self.lossless:
+            return {"format": "webp", "lossless": True}
+        return {"format": self.image_format, "quality": self.quality}
+
+
+def output_encoding(negotiated_format: str, output_format: Optional[str] = None, quality: Optional[int] = None,
+                    lossless: Optional[bool] = None, png_compress_level: Optional[int] = None,
+                    high_quality: bool = False) -> OutputEncoding:
+    """
+    Réglages d'un job: champs de la requête, sinon format négocié (Accept) et défauts
+
+    Args:
+        high_quality: défauts des upscales (WebP sans perte, PNG compressé rapidement)
+
+    Raises:
+        ValueError: format ou valeur hors limites
+    """
+    image_format = (output_format or negotiated_format).lower()
+    if image_format == "jpg":
+        image_format = "jpeg"
+    if image_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported output_format: {image_format} (expected {', '.join(OUTPUT_FORMATS)})")
+    if quality is not None and not 1 <= quality <= 100:
+        raise ValueError("quality must be between 1 and 100")
+    if png_compress_level is not None and not 0 <= png_compress_level <= 9:
+        raise ValueError("png_compress_level must be between 0 and 9")
+    if lossless and image_format != "webp":
+        raise ValueError("lossless is only supported for webp")
+
+    return OutputEncoding(
+        image_format=image_format,
+        quality=quality if quality is not None else DEFAULT_QUALITY,
+        # Un upscale sans qualité explicite reste sans perte, comme avant
+        lossless=lossless if lossless is not None else (high_quality and quality is None),
+        png_compress_level=(png_compress_level if png_compress_level is not None
+                            else DEFAULT_UPSCALE_PNG_LEVEL if high_quality else DEFAULT_PNG_LEVEL),
+    )
+
+
+def encode_image(image: Image.Image, encoding: OutputEncoding) -> EncodedImage:
+    """Encode une image PIL (bloquant: à appeler depuis le pool d'encodage)"""
+    buffered = io.BytesIO()
+    if encoding.image_format == "webp":
+        if encoding.lossless:
+            image.save(buffered, format="WEBP", lossless=True)
+        else:
+            image.save(buffered, format="WEBP", quality=encoding.quality)
+    elif encoding.image_format == "jpeg":
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        # Pas de sous-échantillonnage de la chroma en haute qualité (contours nets des textes et traits)
+        image.save(buffered, format="JPEG", quality=encoding.quality,
+                   subsampling=0 if encoding.quality >= 90 else 2)
+    else:
+        image.save(buffered, format="PNG", compress_level=encoding.png_compress_level)
+    return EncodedImage(buffered.getvalue(), encoding.image_format, image.width, image.height)
@@ -4,27 +4,58 @@ Utilise Diffusers (HuggingFace) pour Stable Diffusion
 Et Real-ESRGAN pour l'upscaling fidèle
 """
 
+import time
+
+# Référence du temps de démarrage, prise avant les imports lourds (torch seul coûte plusieurs secondes)
+IMPORT_STARTED_AT = time.monotonic()
+
 import asyncio
 import base64
+import gc
 import io
 import json
 import logging
+import math
 import numpy as np
 import os
-import time
+import random
+import re
 import torch
+import uuid
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
-from diffusers import (
-    StableDiffusionXLPipeline,
-    StableDiffusionXLImg2ImgPipeline,
-    DPMSolverMultistepScheduler
-)
-from fastapi import FastAPI, HTTPException, BackgroundTasks
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from dataclasses import dataclass, field
 from pathlib import Path
-from pydantic import BaseModel
-from typing import Optional, Literal
+from pydantic import BaseModel, ValidationError, field_validator
+from typing import BinaryIO, Dict, Iterator, List, Optional, Literal, Tuple
+
+from cancellation import CancellationRegistry, CancellationToken, FileCancellationBackend
+from cpu_backend import CpuBackend, parse_model_threads
+from cost_model import CPU_PRIORS, CUDA_PRIORS, SIZE_ALIGN, CostModel, JobCost
+from draft_store import Draft, DraftStore
+from esrgan_tiling import available_memory_bytes, plan_tiles, TilePlan, upscale_arrays
+from image_encoding import OutputEncoding, encode_image, output_encoding
+from image_responses import (BatchItemResult, EncodedImage, MEDIA_TYPE_BY_FORMAT, batch_stream_response, image_response,
+                             negotiate_response_format)
+from inference_worker import InferenceWorker, QueueFullError, current_lane
+from job_store import JobRecord, JobStore, STATUS_CANCELLED, STATUS_DONE, STATUS_ERROR, STATUS_QUEUED, STATUS_RUNNING
+from job_progress import (EVENT_CANCELLED, EVENT_DONE, EVENT_ERROR, EVENT_PREVIEW, EVENT_PROGRESS, EVENT_QUEUED,
+                          EVENT_STARTED, ProgressHub)
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, MetricsRegistry
+from model_compiler import ModelCompiler, parse_compile_models
+from model_registry import GB, TIER_DEVICE, TIER_OFFLOADED, TIER_UNLOADED, ModelRegistry, model_matches
+from prompt_cache import PromptEmbeddingCache
+from residency_policy import KeepAlivePolicy, parse_keep_alive_overrides
+from result_cache import ResultCache, bytes_digest, file_digest, request_key
+from startup_state import PHASE_IMPORTS, PHASE_WARMUP, PHASE_WEIGHTS, StartupState
+from uploads import UPLOAD_JSON, UPLOAD_RAW, parse_image_upload, read_limited_body, upload_kind
+from vae_decode import LATENT_SCALE, MIN_TILE as VAE_MIN_TILE, DecodePlan, decode_latents, plan_decode
+from worker_process import WorkerProcess, portable_outcomes, rebuild_outcomes, worker_specs
 
 # Désactiver les warnings NumPy pour les conversions d'images
 warnings.filterwarnings('ignore', category=RuntimeWarning, message='invalid value encountered in cast')
@@ -41,110 +72,328 @@ dtype = torch.float16 if device == "cuda" else torch.float32
 
 logger.info(f"🚀 Starting API with device: {device}, dtype: {dtype}")
 
+# Démarrage à froid: le port s'ouvre tout de suite ("warming"), les poids se chargent ensuite sur le worker
+startup_state = StartupState(IMPORT_STARTED_AT)
+startup_state.mark(PHASE_IMPORTS)
+
+# Classes diffusers importées au premier chargement de SDXL (import_diffusers): diffusers et
+# transformers ajoutent ~2 s d'import qui retarderaient l'ouverture du port
+StableDiffusionXLPipeline = None
+StableDiffusionXLImg2ImgPipeline = None
+DPMSolverMultistepScheduler = None
+
 # Activer TensorFloat32 pour meilleure performance sur GPU Ampere (RTX 30xx)
 if device == "cuda":
     torch.set_float32_matmul_precision('high')
     logger.info("✅ TensorFloat32 activé pour matmul (meilleure performance)")
 
+# Backend CPU (cpu_backend.py): précision de calcul "auto" (bfloat16 par autocast si le CPU le permet),
+# "bfloat16" ou "float32" (les poids restent en float32 dans tous les cas)
+CPU_PRECISION = os.environ.get("IMAGE_API_CPU_PRECISION", "auto")
+# Threads intra-op et inter-op du processus (0 = défaut de torch: un thread par cœur utilisable)
+CPU_THREADS = int(os.environ.get("IMAGE_API_CPU_THREADS", "0"))
+CPU_INTEROP_THREADS = int(os.environ.get("IMAGE_API_CPU_INTEROP_THREADS", "1"))
+# Plafond de threads par modèle pendant ses appels, ex: "esrgan=4" ("" = tous les threads pour chaque modèle)
+CPU_MODEL_THREADS = parse_model_threads(os.environ.get("IMAGE_API_CPU_MODEL_THREADS", ""))
+# UNet, VAE et RRDBNet en channels_last (format des convolutions oneDNN)
+CPU_CHANNELS_LAST = os.environ.get("IMAGE_API_CPU_CHANNELS_LAST", "1") == "1"
+cpu_backend = CpuBackend(device == "cpu", CPU_PRECISION, CPU_THREADS, CPU_INTEROP_THREADS, CPU_MODEL_THREADS,
+                         CPU_CHANNELS_LAST)
+
 # Chargement des modèles au démarrage (lazy loading)
+# La résidence (device / RAM CPU / déchargé) est gérée par model_registry, défini plus bas.
+# txt2img et img2img sont deux vues construites sur le même jeu de poids SDXL.
 txt2img_pipeline = None
 img2img_pipeline = None
-esrgan_models = {}  # Dictionnaire pour stocker différents modèles ESRGAN
 
-# Système d'auto-unload après inactivité
-last_model_usage = time.time()  # Timestamp du dernier usage
-AUTO_UNLOAD_DELAY = 120  # 2 minutes en secondes
+# Cache des embeddings de prompts (RAM CPU), partagé par txt2img et img2img
+PROMPT_CACHE_MB = float(os.environ.get("IMAGE_API_PROMPT_CACHE_MB", "64"))
+prompt_cache = PromptEmbeddingCache(int(PROMPT_CACHE_MB * 1024 * 1024))
+
+# Budget mémoire des modèles résidents: on n'évince que si un chargement le dépasserait
+# (par défaut 90% de la VRAM sur GPU, 75% de la RAM sur CPU)
+MEMORY_BUDGET_GB = os.environ.get("IMAGE_API_MEMORY_BUDGET_GB")
+# Empreintes estimées sur le device (poids + activations au pic), utilisées pour le budget;
+# une fois offloadé en RAM CPU, un modèle n'occupe que ses poids
+SDXL_WEIGHTS_BYTES = int((7.0 if dtype == torch.float16 else 14.0) * GB)
+SDXL_ESTIMATED_BYTES = SDXL_WEIGHTS_BYTES + int(1.5 * GB)
+ESRGAN_WEIGHTS_BYTES = int(0.1 * GB)  # RRDBNet x4plus: ~65 Mo en float32
+ESRGAN_ESTIMATED_BYTES = int(1.5 * GB)  # Poids légers, activations bornées par la taille de tuile
+
+# RAM CPU utilisée comme palier intermédiaire avant de décharger complètement un modèle
+# (sur GPU, par défaut de quoi garder les poids SDXL et les deux Real-ESRGAN)
+OFFLOAD_BUDGET_GB = float(os.environ.get(
+    "IMAGE_API_OFFLOAD_BUDGET_GB",
+    str(max(8.0, (SDXL_WEIGHTS_BYTES + 2 * ESRGAN_WEIGHTS_BYTES) / GB)) if device == "cuda" else "0"))
+
+# Upscale par tuiles: "auto" choisit la taille d'après la mémoire libre et la résolution,
+# "0" désactive le découpage, un entier impose la taille de tuile (pixels d'entrée)
+ESRGAN_TILE = os.environ.get("IMAGE_API_ESRGAN_TILE", "auto")
+ESRGAN_TILE_OVERLAP = int(os.environ.get("IMAGE_API_ESRGAN_TILE_OVERLAP", "32"))
+ESRGAN_TILE_BATCH = int(os.environ.get("IMAGE_API_ESRGAN_TILE_BATCH", "4"))
+if ESRGAN_TILE != "auto" and not ESRGAN_TILE.isdigit():
+    raise ValueError(f"Invalid IMAGE_API_ESRGAN_TILE: {ESRGAN_TILE} (expected auto, 0 or a tile size in pixels)")
+if ESRGAN_TILE_OVERLAP < 0:
+    raise ValueError(f"Invalid IMAGE_API_ESRGAN_TILE_OVERLAP: {ESRGAN_TILE_OVERLAP} (expected >= 0)")
+# Au-delà de ce nombre de pixels d'entrée, on découpe même si l'image tiendrait en mémoire
+ESRGAN_UNTILED_MAX_PIXELS = int(os.environ.get("IMAGE_API_ESRGAN_UNTILED_MAX_PIXELS", str(512 * 512)))
+
+# Décodage VAE par tuiles (vae_decode.py): "auto" découpe au-delà de VAE_TILED_MIN_PIXELS pixels par image
+# ou si l'image ne tiendrait pas dans la mémoire libre, "0" désactive le découpage, un entier impose la
+# taille de tuile (pixels de sortie, multiple de 8)
+VAE_TILE = os.environ.get("IMAGE_API_VAE_TILE", "auto")
+VAE_TILE_OVERLAP = int(os.environ.get("IMAGE_API_VAE_TILE_OVERLAP", "128"))
+VAE_TILED_MIN_PIXELS = int(os.environ.get("IMAGE_API_VAE_TILED_MIN_PIXELS", str(1024 * 1024)))
+VAE_DECODE_BATCH = int(os.environ.get("IMAGE_API_VAE_DECODE_BATCH", "4"))  # Images (ou tuiles) par appel au VAE
+
+# Encodage des sorties (PNG/WebP/JPEG) dans un pool de threads, hors de la boucle et du worker
+ENCODER_THREADS = int(os.environ.get("IMAGE_API_ENCODER_THREADS", str(min(4, os.cpu_count() or 1))))
+encoder_pool = ThreadPoolExecutor(max_workers=ENCODER_THREADS, thread_name_prefix="image-encoder")
+
+# Taille maximale d'une requête (image envoyée en JSON base64, multipart ou corps brut)
+MAX_UPLOAD_BYTES = int(float(os.environ.get("IMAGE_API_MAX_UPLOAD_MB", "32")) * 1024 * 1024)
+
+# Système d'auto-unload après inactivité (par modèle): délai calculé par residency_policy à partir
+# des écarts observés entre requêtes et du temps de rechargement mesuré, borné par KEEP_ALIVE_MIN_S/MAX_S
+KEEP_ALIVE_MIN_S = float(os.environ.get("IMAGE_API_KEEP_ALIVE_MIN_S", "120"))
+KEEP_ALIVE_MAX_S = float(os.environ.get("IMAGE_API_KEEP_ALIVE_MAX_S", "1800"))
+# Délais fixes par modèle, ex: "sdxl=900,esrgan_anime=60" (remplacent le calcul)
+KEEP_ALIVE_OVERRIDES = parse_keep_alive_overrides(os.environ.get("IMAGE_API_KEEP_ALIVE", ""))
+AUTO_UNLOAD_CHECK_INTERVAL_S = 30
+keep_alive_policy = KeepAlivePolicy(KEEP_ALIVE_MIN_S, KEEP_ALIVE_MAX_S, overrides=KEEP_ALIVE_OVERRIDES)
 auto_unload_task = None  # Task asyncio pour l'auto-unload
 
-# Système d'annulation des jobs
-active_jobs = {}  # job_id -> {"cancelled": bool, "type": str}
-job_results = {}  # job_id -> {"status": str, "result": dict or error}
-job_counter = 0
+# Métriques Prometheus (GET /metrics): durées par étape, relevées avec des horloges monotones
+# sans log par step; les compteurs des caches et du registre sont lus au moment du scrape
+metrics = MetricsRegistry(prefix="netricsa_image_")
+STEP_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+QUEUE_WAIT_SECONDS = metrics.histogram(
+    "queue_wait_seconds", "Time spent in the worker queue before starting", ["job_type"])
+MODEL_LOAD_SECONDS = metrics.histogram(
+    "model_load_seconds", "Model load from disk (load) or move back from CPU RAM (restore)", ["model", "kind"])
+TEXT_ENCODE_SECONDS = metrics.histogram(
+    "text_encode_seconds", "SDXL text encoders on one prompt (prompt cache misses only)", buckets=STEP_BUCKETS)
+DENOISE_STEP_SECONDS = metrics.histogram(
+    "denoise_step_seconds", "One denoising step for a whole batch", ["mode"], buckets=STEP_BUCKETS)
+VAE_DECODE_SECONDS = metrics.histogram(
+    "vae_decode_seconds", "VAE decode and post-processing after the last step", ["mode"])
+IMAGE_ENCODE_SECONDS = metrics.histogram(
+    "image_encode_seconds", "Encoding one output image", ["format"], buckets=STEP_BUCKETS)
+ESRGAN_SECONDS = metrics.histogram(
+    "esrgan_seconds", "Real-ESRGAN forward passes for one image (all tiles)", ["model"])
+JOB_DURATION_SECONDS = metrics.histogram(
+    "job_duration_seconds", "Job duration from submission to result, queue wait included", ["job_type", "outcome"])
+JOB_CANCELLATIONS = metrics.counter("cancellations_total", "Jobs cancelled (queued or running)", ["job_type"])
+JOB_OOMS = metrics.counter("oom_total", "Jobs failed with an out-of-memory error", ["job_type"])
+ADMISSIONS = metrics.counter(
+    "admissions_total", "Admission control decisions (accepted, downscaled, deferred, rejected)",
+    ["job_type", "action"])
+MODEL_CALL_SECONDS = metrics.histogram(
+    "model_call_seconds", "One call to a compiled model (one UNet step) per shape bucket", ["model", "bucket", "mode"],
+    buckets=STEP_BUCKETS)
+
+# Worker d'inférence: un seul thread possède le device, précédé d'une file de priorité bornée
+# Au-delà de MAX_QUEUE_DEPTH jobs en attente, l'API répond 429 immédiatement
+MAX_QUEUE_DEPTH = int(os.environ.get("IMAGE_API_MAX_QUEUE_DEPTH", "8"))
+PRIORITY_MAINTENANCE = -1  # Déchargements: passent avant tout le reste
+PRIORITY_UPSCALE = 0  # Upscales: courts, on ne les fait pas attendre derrière une génération
+PRIORITY_GENERATE = 1
+PRIORITY_DEFERRED = 2  # Jobs acceptés malgré une file trop longue (over_budget="defer"): après les autres
+PRIORITY_PREPARE = 3  # Préchargements annoncés par le bot: seulement quand rien d'autre n'attend
+# Mode coordinateur: N processus workers, chacun avec son device (ou ses cœurs CPU) et ses propres
+# modèles résidents; ce processus garde la file, les jobs, les caches et l'encodage (0 = tout ici)
+WORKER_PROCESSES = int(os.environ.get("IMAGE_API_WORKER_PROCESSES", "0"))
+# Un device par worker, ex: "cuda:0,cuda:1" ou "cpu:0-7,cpu:8-15" (défaut: GPU en tourniquet, sinon
+# cœurs CPU découpés en blocs égaux)
+WORKER_DEVICES = os.environ.get("IMAGE_API_WORKER_DEVICES", "")
+# Un job attend au plus ce délai un worker qui a déjà son modèle avant de partir sur un autre
+AFFINITY_WAIT_S = float(os.environ.get("IMAGE_API_AFFINITY_WAIT_S", "10"))
+inference_worker = InferenceWorker(
+    max_queue_depth=MAX_QUEUE_DEPTH,
+    on_job_start=lambda job_type, wait_s: QUEUE_WAIT_SECONDS.observe(wait_s, job_type=job_type),
+    lanes=max(1, WORKER_PROCESSES),
+    affinity_wait_s=AFFINITY_WAIT_S
+)
+worker_processes: List[WorkerProcess] = []  # Un par voie de inference_worker en mode coordinateur
+# Appelé avec ce module dans chaque processus worker après son import (benchmark: modèles de remplacement)
+worker_process_initializer = None
+# Images par appel au pipeline: les générations compatibles en attente sont regroupées
+# (même mode, taille, steps, cfg) jusqu'à ce nombre d'images; c'est aussi le max de num_images
+MAX_BATCH_IMAGES = int(os.environ.get("IMAGE_API_MAX_BATCH_IMAGES", "4"))
+# Upscales en attente du même modèle regroupés jusqu'à ce nombre d'images: les tuiles (ou images
+# entières) de même taille partagent les passes de Real-ESRGAN
+UPSCALE_BATCH_IMAGES = int(os.environ.get("IMAGE_API_UPSCALE_BATCH_IMAGES", "4"))
+# /upscale/batch: images par requête, images d'une requête soumises à la file en même temps,
+# taille maximale du corps (toutes images comprises)
+UPSCALE_BATCH_MAX_IMAGES = int(os.environ.get("IMAGE_API_UPSCALE_BATCH_MAX_IMAGES", "32"))
+UPSCALE_BATCH_WINDOW = int(os.environ.get("IMAGE_API_UPSCALE_BATCH_WINDOW", str(UPSCALE_BATCH_IMAGES)))
+UPSCALE_BATCH_MAX_UPLOAD_BYTES = int(float(os.environ.get("IMAGE_API_UPSCALE_BATCH_MAX_UPLOAD_MB", "128")) * 1024**2)
+
+# Système d'annulation des jobs: un jeton en mémoire par job (vérification O(1) à chaque step)
+
+# Backend d'annulation
+#   "memory": jetons en mémoire uniquement
+#   "file" (défaut): scrute aussi cancel_flags/, où le bot Node écrit cancel_all_generate.flag
+#   "shared": diffuse en plus les annulations aux autres workers via cancel_flags/ (uvicorn --workers N)
+CANCEL_BACKEND = os.environ.get("IMAGE_API_CANCEL_BACKEND", "file")
+CANCEL_POLL_INTERVAL = float(os.environ.get("IMAGE_API_CANCEL_POLL_INTERVAL", "0.5"))
 
 # Dossier pour les fichiers de flag d'annulation
 # Utiliser le chemin absolu basé sur l'emplacement de ce script
 SCRIPT_DIR = Path(__file__).parent
 CANCEL_FLAGS_DIR = SCRIPT_DIR / "cancel_flags"
-CANCEL_FLAGS_DIR.mkdir(exist_ok=True)
 
-logger.info(f"📁 Cancel flags directory: {CANCEL_FLAGS_DIR.absolute()}")
+# Cache disque des résultats déterministes (generate avec seed fixé, upscale)
+RESULT_CACHE_DIR = Path(os.environ.get("IMAGE_API_RESULT_CACHE_DIR", str(SCRIPT_DIR / "result_cache")))
+RESULT_CACHE_MB = float(os.environ.get("IMAGE_API_RESULT_CACHE_MB", "1024"))
+result_cache = ResultCache(RESULT_CACHE_DIR, int(RESULT_CACHE_MB * 1024 * 1024))
+
+# Résultats des jobs asynchrones (POST /jobs), gardés JOB_RESULT_TTL_S secondes après la fin
+# Au-delà de JOB_RESULT_MEMORY_MB en RAM (ou JOB_RESULT_SPILL_MB pour un seul résultat),
+# les images sont déversées dans job_results/; au-delà de JOB_RESULT_DISK_MB, les plus anciennes sont oubliées
+JOB_RESULT_TTL_S = float(os.environ.get("IMAGE_API_JOB_RESULT_TTL_S", "3600"))
+JOB_RESULT_MEMORY_MB = float(os.environ.get("IMAGE_API_JOB_RESULT_MEMORY_MB", "256"))
+JOB_RESULT_SPILL_MB = float(os.environ.get("IMAGE_API_JOB_RESULT_SPILL_MB", "4"))
+JOB_RESULT_DISK_MB = float(os.environ.get("IMAGE_API_JOB_RESULT_DISK_MB", "2048"))
+job_results = JobStore(
+    SCRIPT_DIR / "job_results",
+    ttl_s=JOB_RESULT_TTL_S,
+    max_memory_bytes=int(JOB_RESULT_MEMORY_MB * 1024 * 1024),
+    spill_threshold_bytes=int(JOB_RESULT_SPILL_MB * 1024 * 1024),
+    max_disk_bytes=int(JOB_RESULT_DISK_MB * 1024 * 1024)
+)
 
+# Exécution compilée (model_compiler.py, torch.compile): "unet", "vae" (décodeur), "esrgan", "all",
+# ou "" (désactivée, par défaut)
+# Chaque forme d'entrée (lot x résolution) est un bucket compilé une fois; au-delà de COMPILE_MAX_BUCKETS par
+# modèle, les nouvelles formes restent en eager. Les noyaux compilés sont gardés sur disque (COMPILE_CACHE_DIR):
+# un redémarrage ou un rechargement ne les recompile pas
+COMPILE_MODELS = parse_compile_models(os.environ.get("IMAGE_API_COMPILE", ""))
+COMPILE_CACHE_DIR = Path(os.environ.get("IMAGE_API_COMPILE_CACHE_DIR", str(SCRIPT_DIR / "compile_cache")))
+COMPILE_MODE = os.environ.get("IMAGE_API_COMPILE_MODE", "default")  # "reduce-overhead" (CUDA graphs), "max-autotune"
+COMPILE_MAX_BUCKETS = int(os.environ.get("IMAGE_API_COMPILE_MAX_BUCKETS", "8"))
+model_compiler = ModelCompiler(
+    COMPILE_MODELS, COMPILE_CACHE_DIR, COMPILE_MODE, COMPILE_MAX_BUCKETS, freezing=device == "cpu",
+    on_call=lambda model, bucket, mode, seconds: MODEL_CALL_SECONDS.observe(
+        seconds, model=model, bucket=bucket, mode=mode),
+    is_out_of_memory=lambda error: is_out_of_memory(error)  # Défini plus bas
+)
 
-def create_job_id() -> str:
-    """Crée un ID unique pour un job"""
-    global job_counter
-    job_counter += 1
-    return f"job_{job_counter}_{int(time.time() * 1000)}"
+# Contrôle d'admission (cost_model.py): durée et mémoire de chaque job prédites avant la mise en file,
+# d'après la résolution, les steps, le mode et le modèle ESRGAN, recalibrées sur les jobs mesurés
+# Un job trop gros (plus de MAX_JOB_SECONDS de calcul, ou plus de mémoire que le budget) est refusé
+# (422) ou réduit; une file de plus de MAX_QUEUE_WAIT_S d'attente prédite est refusée (429, Retry-After
+# honnête) ou le job passe après les autres. 0 = pas de limite
+MAX_JOB_SECONDS = float(os.environ.get("IMAGE_API_MAX_JOB_SECONDS", "600" if device == "cuda" else "3600"))
+MAX_QUEUE_WAIT_S = float(os.environ.get("IMAGE_API_MAX_QUEUE_WAIT_S", "600"))
+# Politique par défaut (champ over_budget des requêtes): "reject", "downscale" ou "defer"
+OVER_BUDGET_POLICY = os.environ.get("IMAGE_API_OVER_BUDGET", "reject")
+OVER_BUDGET_POLICIES = ("reject", "downscale", "defer")
+# Génération réduite au plus à cette taille (côté) et à ce nombre de steps
+DOWNSCALE_MIN_SIDE = int(os.environ.get("IMAGE_API_DOWNSCALE_MIN_SIDE", "512"))
+DOWNSCALE_MIN_STEPS = int(os.environ.get("IMAGE_API_DOWNSCALE_MIN_STEPS", "20"))
+# Coefficients calibrés gardés entre deux démarrages ("" = pas de fichier)
+COST_MODEL_PATH = os.environ.get("IMAGE_API_COST_MODEL_PATH", str(SCRIPT_DIR / "cost_model.json"))
+ELEMENT_SIZE = 2 if dtype == torch.float16 else 4  # Octets par valeur des activations
+# Coefficients calibrés propres au matériel et à l'exécution compilée: un fichier copié d'une autre machine,
+# ou calibré avant IMAGE_API_COMPILE, est ignoré
+COST_PROFILE = ((f"{torch.cuda.get_device_name(0)}, {dtype}" if device == "cuda"
+                 else f"cpu x{os.cpu_count()}, {cpu_backend.precision}")
+                + (f", compiled {'+'.join(COMPILE_MODELS)}" if COMPILE_MODELS else ""))
+cost_model = CostModel(CUDA_PRIORS if device == "cuda" else CPU_PRIORS,
+                       path=Path(COST_MODEL_PATH) if COST_MODEL_PATH else None, profile=COST_PROFILE)
+
+# Mode brouillon (draft=true sur /generate): taille x DRAFT_SCALE (petit côté d'au moins DRAFT_MIN_SIDE,
+# multiple de 64) et au plus DRAFT_STEPS steps. Latents et images gardés DRAFT_TTL_S secondes (au plus
+# DRAFT_STORE_MB en RAM) pour POST /refine, qui les reprend en img2img à la taille demandée
+DRAFT_SCALE = float(os.environ.get("IMAGE_API_DRAFT_SCALE", "0.5"))
+DRAFT_MIN_SIDE = int(os.environ.get("IMAGE_API_DRAFT_MIN_SIDE", "512"))
+DRAFT_STEPS = int(os.environ.get("IMAGE_API_DRAFT_STEPS", "12"))
+DRAFT_TTL_S = float(os.environ.get("IMAGE_API_DRAFT_TTL_S", "1800"))
+DRAFT_STORE_MB = float(os.environ.get("IMAGE_API_DRAFT_STORE_MB", "256"))
+draft_store = DraftStore(int(DRAFT_STORE_MB * 1024 * 1024), DRAFT_TTL_S)
+# Agrandissement du brouillon avant le refine: "latent" (latents interpolés, sans VAE encode) ou "esrgan"
+# (image du brouillon upscalée par Real-ESRGAN puis réencodée); force img2img par défaut de chacun
+# (les latents interpolés sont flous: il faut débruiter davantage)
+REFINE_UPSCALER = os.environ.get("IMAGE_API_REFINE_UPSCALER", "latent")
+REFINE_UPSCALERS = ("latent", "esrgan")
+REFINE_STRENGTH = {"latent": 0.55, "esrgan": 0.35}
+
+
+def discard_queued_job(job_id: str):
+    """
+    Un job annulé encore dans la file en sort immédiatement (son handler répond 499)
+    Déjà parti sur un processus worker: l'annulation lui est transmise
+    """
+    if inference_worker.discard(job_id, InterruptedError(f"Job {job_id} was cancelled while queued")):
+        return
+    for worker in worker_processes:
+        worker.cancel(job_id)
 
 
-def is_job_cancelled(job_id: str) -> bool:
-    """Vérifie si un job a été annulé en checkant le fichier de flag"""
-    # Vérifier d'abord dans active_jobs (méthode HTTP)
-    if active_jobs.get(job_id, {}).get("cancelled", False):
-        logger.info(f"🛑 Job {job_id} cancelled via active_jobs dict")
-        return True
+cancellation = CancellationRegistry(on_cancel=discard_queued_job)
+cancel_flags_backend = None
+if CANCEL_BACKEND in ("file", "shared"):
+    cancel_flags_backend = FileCancellationBackend(
+        cancellation, CANCEL_FLAGS_DIR,
+        poll_interval=CANCEL_POLL_INTERVAL,
+        broadcast=CANCEL_BACKEND == "shared"
+    )
 
-    # Vérifier aussi le fichier de flag (méthode fichier - plus fiable)
-    cancel_flag_file = CANCEL_FLAGS_DIR / f"{job_id}.cancel"
-    if cancel_flag_file.exists():
-        logger.info(f"🛑 Found cancel flag file for job {job_id}: {cancel_flag_file}")
-        return True
 
-    # Vérifier aussi un flag global "cancel_all_generate"
-    cancel_all_file = CANCEL_FLAGS_DIR / "cancel_all_generate.flag"
-    if cancel_all_file.exists():
-        job_info = active_jobs.get(job_id, {})
-        if job_info.get("type") == "generate":
-            logger.info(f"🛑 Found cancel_all_generate flag at {cancel_all_file}, cancelling job {job_id}")
-            return True
-
-    return False
-
-
-def cancel_job(job_id: str) -> bool:
-    """Annule un job en cours en créant un fichier de flag"""
-    if job_id in active_jobs:
-        active_jobs[job_id]["cancelled"] = True
-        # Créer aussi un fichier de flag
-        cancel_flag_file = CANCEL_FLAGS_DIR / f"{job_id}.cancel"
-        cancel_flag_file.touch()
-        logger.info(f"🛑 Job {job_id} cancelled (flag file created)")
-        return True
-    return False
+def create_job_id() -> str:
+    """Crée un ID unique pour un job (aléatoire: pas de collision entre redémarrages ni entre workers)"""
+    return f"job_{uuid.uuid4().hex}"
 
 
-def cancel_all_jobs_of_type(job_type: str) -> int:
-    """Annule tous les jobs d'un certain type via un fichier de flag"""
-    # Créer un fichier de flag global
-    if job_type == "generate" or job_type == "all":
-        cancel_all_file = CANCEL_FLAGS_DIR / "cancel_all_generate.flag"
-        cancel_all_file.touch()
-        logger.info(f"🛑 Created cancel_all_generate flag file")
+# Un client peut choisir l'ID de son job (en-tête X-Job-Id) pour suivre /jobs/{id}/events
+# pendant que sa requête /generate ou /upscale est en cours
+JOB_ID_PATTERN = re.compile(r"^[A-Za-z0-9_.-]{1,64}$")
 
-    # Compter combien de jobs seront annulés
-    count = 0
-    for job_id, job_info in active_jobs.items():
-        if job_info.get("type") == job_type or job_type == "all":
-            cancel_job(job_id)
-            count += 1
 
-    return count
+def requested_job_id(http_request: Request) -> str:
+    """ID fourni par le client via X-Job-Id, sinon un nouvel ID"""
+    job_id = http_request.headers.get("x-job-id")
+    if job_id is None:
+        return create_job_id()
+    if not JOB_ID_PATTERN.match(job_id):
+        raise HTTPException(status_code=400, detail="Invalid X-Job-Id (expected 1-64 chars among A-Z a-z 0-9 _ . -)")
+    if cancellation.get(job_id) is not None:
+        raise HTTPException(status_code=409, detail=f"Job {job_id} already exists")
+    return job_id
 
 
-def cleanup_cancel_flags():
-    """Nettoie les anciens fichiers de flag"""
-    try:
-        for flag_file in CANCEL_FLAGS_DIR.glob("*.cancel"):
-            flag_file.unlink()
-        for flag_file in CANCEL_FLAGS_DIR.glob("*.flag"):
-            flag_file.unlink()
-    except Exception as e:
-        logger.warning(f"Failed to cleanup cancel flags: {e}")
+# Progression des jobs (Server-Sent Events sur /jobs/{id}/events)
+progress_hub = ProgressHub()
+# Un aperçu basse résolution toutes les N steps, seulement si un client écoute (0 = désactivé)
+PREVIEW_EVERY_STEPS = int(os.environ.get("IMAGE_API_PREVIEW_EVERY", "5"))
+# Projection linéaire approximative latents SDXL -> RGB: un aperçu sans décodage VAE
+SDXL_LATENT_RGB_FACTORS = [
+    [0.3651, 0.4232, 0.4341],
+    [-0.2533, -0.0042, 0.1068],
+    [0.1076, 0.1111, -0.0362],
+    [-0.3165, -0.2492, -0.2188],
+]
+SDXL_LATENT_RGB_BIAS = [0.1084, -0.0175, -0.0011]
 
 
 # Modèle par défaut - Stable Diffusion XL pour qualité maximale
 # SDXL produit des images de bien meilleure qualité mais nécessite plus de VRAM (8-10GB)
 DEFAULT_MODEL = "stabilityai/stable-diffusion-xl-base-1.0"
+# Identité des encodeurs de texte pour prompt_cache: mêmes poids et même précision = mêmes embeddings
+PROMPT_ENCODER_ID = f"{DEFAULT_MODEL}@{dtype}"
+# Copie locale de DEFAULT_MODEL (dossier au format diffusers): chargée sans aucune requête au hub HF
+SDXL_MODEL_PATH = os.environ.get("IMAGE_API_SDXL_PATH")
+# Safetensors mappés en mémoire et copiés tenseur par tenseur sur le device (pas de copie complète en RAM)
+MMAP_WEIGHTS = os.environ.get("IMAGE_API_MMAP_WEIGHTS", "0") == "1"
+
+# Préchargement au démarrage, en tâche de fond: pipelines parmi txt2img, img2img, esrgan_general,
+# esrgan_anime ("none" = rien), puis WARMUP_STEPS steps factices à WARMUP_SIZE px (0 = pas de warmup)
+PRELOAD_PIPELINES = [name.strip() for name in os.environ.get("IMAGE_API_PRELOAD", "txt2img").split(",")
+                     if name.strip() and name.strip() != "none"]
+WARMUP_STEPS = int(os.environ.get("IMAGE_API_WARMUP_STEPS", "2" if device == "cuda" else "0"))
+WARMUP_SIZE = int(os.environ.get("IMAGE_API_WARMUP_SIZE", "1024"))
+startup_task = None  # Task asyncio du préchargement
 
 
 # ==================== MODELS PYDANTIC ====================
@@ -157,330 +406,726 @@ class GenerateRequest(BaseModel):
     steps: Optional[int] = 40  # SDXL converge plus vite (40 steps suffisent)
     cfg_scale: Optional[float] = 8.0  # SDXL optimal
     seed: Optional[int] = -1
-    reference_image: Optional[str] = None  # Base64, pour img2img
+    reference_image: Optional[str] = None  # Base64, pour img2img (ou fichier en multipart/corps brut)
     strength: Optional[float] = 0.75  # Force de transformation (0-1)
+    num_images: Optional[int] = 1  # Variations générées en un seul appel
+    seeds: Optional[List[int]] = None  # Un seed par image (prioritaire sur seed et num_images)
+    output_format: Optional[str] = None  # "png", "webp" ou "jpeg" (défaut: d'après Accept)
+    quality: Optional[int] = None  # WebP / JPEG avec perte, 1-100
+    lossless: Optional[bool] = None  # WebP sans perte
+    png_compress_level: Optional[int] = None  # 0-9
+    over_budget: Optional[str] = None  # "reject", "downscale" ou "defer" (défaut: IMAGE_API_OVER_BUDGET)
+    draft: Optional[bool] = False  # Brouillon rapide (taille et steps réduits), à reprendre avec /refine
+
+    @field_validator("seeds", mode="before")
+    @classmethod
+    def split_seeds(cls, value):
+        # En multipart, les seeds arrivent en texte: "1,2,3"
+        if isinstance(value, str):
+            return [part.strip() for part in value.split(",") if part.strip()]
+        return value
+
+    def image_seeds(self) -> List[int]:
+        """Seed de chaque image: seeds explicites, sinon seed, seed+1, ..., sinon aléatoires"""
+        if self.seeds:
+            return list(self.seeds)
+        if self.seed != -1:
+            return [self.seed + index for index in range(self.num_images)]
+        return [random.randrange(2 ** 32) for _ in range(self.num_images)]
+
+
+class RefineRequest(BaseModel):
+    draft_id: str  # ID du job brouillon (info.draft.draft_id)
+    image_index: Optional[int] = 0  # Image du brouillon à reprendre
+    upscaler: Optional[str] = None  # "latent" ou "esrgan" (défaut: IMAGE_API_REFINE_UPSCALER)
+    strength: Optional[float] = None  # Force img2img (défaut: selon upscaler)
+    width: Optional[int] = None  # Taille et steps du rendu (défaut: ceux demandés au brouillon)
+    height: Optional[int] = None
+    steps: Optional[int] = None
+    output_format: Optional[str] = None  # Comme GenerateRequest
+    quality: Optional[int] = None
+    lossless: Optional[bool] = None
+    png_compress_level: Optional[int] = None
+    over_budget: Optional[str] = None
 
 
 class UpscaleRequest(BaseModel):
-    image: str  # Base64
+    image: Optional[str] = None  # Base64 (absent si l'image arrive en multipart ou en corps brut)
     scale: Optional[int] = 4  # x4 par défaut avec le modèle x4plus
     model: Optional[str] = "general"  # "general" ou "anime"
+    output_format: Optional[str] = None  # Comme GenerateRequest (défaut: WebP sans perte / PNG rapide)
+    quality: Optional[int] = None
+    lossless: Optional[bool] = None
+    png_compress_level: Optional[int] = None
+    over_budget: Optional[str] = None  # Comme GenerateRequest ("downscale" réduit l'image d'entrée)
+
+
+class UpscaleBatchRequest(BaseModel):
+    images: List[str] = []  # Base64 (vide si les images arrivent en parties fichier "images")
+    scale: Optional[int] = 4  # Réglages communs à toutes les images, comme UpscaleRequest
+    model: Optional[str] = "general"
+    output_format: Optional[str] = None
+    quality: Optional[int] = None
+    lossless: Optional[bool] = None
+    png_compress_level: Optional[int] = None
+    over_budget: Optional[str] = None
 
 
 # ==================== HELPER FUNCTIONS ====================
 
-def unload_pipeline(pipeline_type: str):
-    """Décharge un pipeline spécifique pour libérer la VRAM"""
-    global txt2img_pipeline, img2img_pipeline, esrgan_models
+def default_memory_budget_bytes() -> int:
+    """Budget par défaut: 90% de la VRAM sur GPU, 75% de la RAM physique sur CPU"""
+    if MEMORY_BUDGET_GB is not None:
+        return int(float(MEMORY_BUDGET_GB) * GB)
+    if device == "cuda":
+        return int(torch.cuda.get_device_properties(0).total_memory * 0.9)
+    try:
+        return int(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") * 0.75)
+    except (AttributeError, ValueError, OSError):
+        return 16 * GB  # Windows: pas de sysconf
 
-    if pipeline_type == "txt2img" and txt2img_pipeline is not None:
-        logger.info("🗑️ Unloading txt2img pipeline to free VRAM...")
-        del txt2img_pipeline
-        txt2img_pipeline = None
-        if device == "cuda":
-            torch.cuda.empty_cache()
-        logger.info("✅ txt2img pipeline unloaded")
 
-    elif pipeline_type == "img2img" and img2img_pipeline is not None:
-        logger.info("🗑️ Unloading img2img pipeline to free VRAM...")
-        del img2img_pipeline
-        img2img_pipeline = None
-        if device == "cuda":
-            torch.cuda.empty_cache()
-        logger.info("✅ img2img pipeline unloaded")
+def release_device_memory():
+    """Rend la mémoire libérée au driver après une éviction"""
+    gc.collect()
+    if device == "cuda":
+        torch.cuda.empty_cache()
 
-    elif pipeline_type == "esrgan" and len(esrgan_models) > 0:
-        logger.info("🗑️ Unloading ESRGAN models to free VRAM...")
-        esrgan_models.clear()
-        if device == "cuda":
-            torch.cuda.empty_cache()
-        logger.info("✅ ESRGAN models unloaded")
-
-    elif pipeline_type == "generation":
-        # Décharge tous les pipelines de génération (txt2img ET img2img)
-        if txt2img_pipeline is not None or img2img_pipeline is not None:
-            logger.info("🗑️ Unloading generation pipelines to free VRAM...")
-            if txt2img_pipeline is not None:
-                del txt2img_pipeline
-                txt2img_pipeline = None
-            if img2img_pipeline is not None:
-                del img2img_pipeline
-                img2img_pipeline = None
-            if device == "cuda":
-                torch.cuda.empty_cache()
-            logger.info("✅ Generation pipelines unloaded")
 
+def configure_sdxl_pipeline(pipeline):
+    """Applique les optimisations mémoire à un pipeline construit sur les poids partagés"""
+    if not cpu_backend.enabled:
+        pipeline.enable_attention_slicing()
+    # Sur CPU, le scaled_dot_product_attention de torch (noyau flash CPU) est plus rapide que l'attention
+    # découpée et son pic mémoire est plus bas: pas de slicing
+    # Pas de barre tqdm: une ligne par step dans les logs (la progression passe par /jobs/{id}/events)
+    pipeline.set_progress_bar_config(disable=True)
+    # Pas de enable_vae_slicing(): le décodage est fait par decode_generated_latents, en tranches
+    # et en tuiles dimensionnées d'après la mémoire libre
 
-def load_txt2img_pipeline():
-    """Charge le pipeline txt2img (lazy loading) et décharge img2img et ESRGAN si nécessaire"""
-    global txt2img_pipeline
-    if txt2img_pipeline is None:
-        # Décharger img2img et ESRGAN s'ils sont chargés pour économiser la VRAM
-        unload_pipeline("img2img")
-        unload_pipeline("esrgan")
-
-        logger.info("📥 Loading SDXL txt2img pipeline...")
-        txt2img_pipeline = StableDiffusionXLPipeline.from_pretrained(
-            DEFAULT_MODEL,
-            torch_dtype=dtype,
-            use_safetensors=True,
-            variant="fp16",
-            safety_checker=None,
-            requires_safety_checker=False
-        ).to(device)
-
-        txt2img_pipeline.scheduler = DPMSolverMultistepScheduler.from_config(
-            txt2img_pipeline.scheduler.config,
-            use_karras_sigmas=True
-        )
-        logger.info("✅ Scheduler: DPM++ 2M Karras")
+    if device == "cuda":
+        try:
+            pipeline.enable_xformers_memory_efficient_attention()
+            logger.info("✅ xformers activé (memory efficient attention)")
+        except Exception as e:
+            logger.warning(f"⚠️ xformers indisponible: {e}")
 
-        txt2img_pipeline.enable_attention_slicing()
-        logger.info("✅ VAE kept in FP16 (same as pipeline)")
 
-        if device == "cuda":
-            try:
-                txt2img_pipeline.enable_xformers_memory_efficient_attention()
-                logger.info("✅ xformers activé (memory efficient attention)")
-            except Exception as e:
-                logger.warning(f"⚠️ xformers indisponible: {e}")
+def import_diffusers():
+    """Importe les classes diffusers au premier usage (les remplaçants du benchmark sont conservés)"""
+    global StableDiffusionXLPipeline, StableDiffusionXLImg2ImgPipeline, DPMSolverMultistepScheduler
+    if None not in (StableDiffusionXLPipeline, StableDiffusionXLImg2ImgPipeline, DPMSolverMultistepScheduler):
+        return
+    start_time = time.monotonic()
+    import diffusers
+    StableDiffusionXLPipeline = StableDiffusionXLPipeline or diffusers.StableDiffusionXLPipeline
+    StableDiffusionXLImg2ImgPipeline = StableDiffusionXLImg2ImgPipeline or diffusers.StableDiffusionXLImg2ImgPipeline
+    DPMSolverMultistepScheduler = DPMSolverMultistepScheduler or diffusers.DPMSolverMultistepScheduler
+    logger.info(f"📦 diffusers imported in {time.monotonic() - start_time:.1f}s")
 
-            logger.info("ℹ️  torch.compile() désactivé (Windows/Triton non disponible)")
 
-        logger.info("✅ SDXL txt2img pipeline loaded")
+def load_sdxl_weights() -> dict:
+    """
+    Charge les poids SDXL (UNet, VAE, text encoders, scheduler) depuis le disque
+    Appelé uniquement par model_registry: utiliser load_sdxl_components()
+    """
+    import_diffusers()
+    source = SDXL_MODEL_PATH or DEFAULT_MODEL
+    logger.info(f"📥 Loading SDXL weights from {source} (shared by txt2img and img2img)...")
+    load_options = {}
+    if SDXL_MODEL_PATH:
+        load_options["local_files_only"] = True
+    if MMAP_WEIGHTS:
+        # accelerate lit chaque tenseur du fichier mappé directement vers le device
+        load_options.update(low_cpu_mem_usage=True, device_map={"": device})
+    base_pipeline = StableDiffusionXLPipeline.from_pretrained(
+        source,
+        torch_dtype=dtype,
+        use_safetensors=True,
+        variant="fp16",
+        safety_checker=None,
+        requires_safety_checker=False,
+        **load_options
+    ).to(device)
+
+    base_pipeline.scheduler = DPMSolverMultistepScheduler.from_config(
+        base_pipeline.scheduler.config,
+        use_karras_sigmas=True
+    )
+    logger.info("✅ Scheduler: DPM++ 2M Karras")
+    logger.info("✅ VAE kept in FP16 (same as pipeline)")
+    cpu_backend.prepare(base_pipeline.unet)
+    cpu_backend.prepare(base_pipeline.vae)
+    model_compiler.wrap("unet", base_pipeline.unet)
+    model_compiler.wrap("vae_decoder", base_pipeline.vae.decoder)
+
+    return base_pipeline.components
+
+
+def move_sdxl_components(components: dict, target_device: str):
+    """Déplace tous les modules SDXL partagés (txt2img et img2img suivent automatiquement)"""
+    for component in components.values():
+        if isinstance(component, torch.nn.Module):
+            component.to(target_device)
+
+
+def forget_sdxl_pipelines():
+    """Les pipelines référencent les poids libérés: ils seront reconstruits au prochain usage"""
+    global txt2img_pipeline, img2img_pipeline
+    txt2img_pipeline = None
+    img2img_pipeline = None
+    model_compiler.release("unet", "vae_decoder")
+
+
+def load_sdxl_components() -> dict:
+    """
+    Retourne les poids SDXL partagés par txt2img et img2img, résidents sur le device
+    Changer de mode ne recharge rien
+    """
+    return model_registry.get("sdxl")
+
+
+def load_txt2img_pipeline():
+    """Construit le pipeline txt2img sur les poids SDXL partagés (lazy loading)"""
+    global txt2img_pipeline
+    components = load_sdxl_components()
+    import_diffusers()
+    if txt2img_pipeline is None:
+        txt2img_pipeline = StableDiffusionXLPipeline(**components)
+        configure_sdxl_pipeline(txt2img_pipeline)
+        logger.info("✅ SDXL txt2img pipeline ready (shared weights)")
     return txt2img_pipeline
 
 
 def load_img2img_pipeline():
-    """Charge le pipeline img2img (lazy loading) et décharge txt2img et ESRGAN si nécessaire"""
+    """Construit le pipeline img2img sur les poids SDXL partagés (lazy loading)"""
     global img2img_pipeline
+    components = load_sdxl_components()
+    import_diffusers()
     if img2img_pipeline is None:
-        # Décharger txt2img et ESRGAN s'ils sont chargés pour économiser la VRAM
-        unload_pipeline("txt2img")
-        unload_pipeline("esrgan")
-
-        logger.info("📥 Loading SDXL img2img pipeline...")
-        img2img_pipeline = StableDiffusionXLImg2ImgPipeline.from_pretrained(
-            DEFAULT_MODEL,
-            torch_dtype=dtype,
-            use_safetensors=True,
-            variant="fp16",
-            safety_checker=None,
-            requires_safety_checker=False
-        ).to(device)
-
-        img2img_pipeline.scheduler = DPMSolverMultistepScheduler.from_config(
-            img2img_pipeline.scheduler.config,
-            use_karras_sigmas=True
-        )
-        logger.info("✅ Scheduler: DPM++ 2M Karras")
-
-        img2img_pipeline.enable_attention_slicing()
-        logger.info("✅ VAE kept in FP16 (same as pipeline)")
+        img2img_pipeline = StableDiffusionXLImg2ImgPipeline(**components)
+        configure_sdxl_pipeline(img2img_pipeline)
+        logger.info("✅ SDXL img2img pipeline ready (shared weights)")
+    return img2img_pipeline
 
-        if device == "cuda":
-            try:
-                img2img_pipeline.enable_xformers_memory_efficient_attention()
-                logger.info("✅ xformers activé (memory efficient attention)")
-            except Exception as e:
-                logger.warning(f"⚠️ xformers indisponible: {e}")
 
-            logger.info("ℹ️  torch.compile() désactivé (Windows/Triton non disponible)")
+def create_esrgan(model_type: str):
+    """
+    Instancie Real-ESRGAN sur le device
+    Appelé uniquement par model_registry: utiliser load_esrgan()
 
-        logger.info("✅ SDXL img2img pipeline loaded")
-    return img2img_pipeline
+    Args:
+        model_type: "general" pour x4plus standard, "anime" pour x4plus_anime_6B
+    """
+    logger.info(f"📥 Loading Real-ESRGAN ({model_type})...")
+    logger.info("Importing basicsr.archs.rrdbnet_arch...")
+    from basicsr.archs.rrdbnet_arch import RRDBNet
+    logger.info("Importing realesrgan...")
+    from realesrgan import RealESRGANer
+    logger.info("Imports successful!")
+
+    if model_type == "anime":
+        # Configuration pour anime_6B (6 blocks, optimisé pour illustrations/anime)
+        model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=6, num_grow_ch=32, scale=4)
+        model_path = 'https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.2.4/RealESRGAN_x4plus_anime_6B.pth'
+        model_name = "x4plus_anime_6B"
+    else:  # general
+        # Configuration pour x4plus (modèle standard)
+        model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=4)
+        model_path = 'https://github.com/xinntao/Real-ESRGAN/releases/download/v0.1.0/RealESRGAN_x4plus.pth'
+        model_name = "x4plus"
+
+    # Utiliser le modèle avec paramètres optimisés pour la qualité
+    upsampler = RealESRGANer(
+        scale=4,  # x4 scale
+        model_path=model_path,
+        model=model,
+        tile=0,  # Le découpage en tuiles est fait par esrgan_tiling (coutures fondues)
+        tile_pad=10,
+        pre_pad=10,  # Augmenté pour réduire les artefacts aux bords
+        half=True if device == "cuda" else False,
+        device=device
+    )
+    cpu_backend.prepare(upsampler.model)
+    model_compiler.wrap(esrgan_model_name(model_type), upsampler.model)
+    logger.info(f"✅ Real-ESRGAN {model_name} loaded successfully (optimized for quality)")
+    return upsampler
+
+
+def esrgan_model_name(model_type: str) -> str:
+    """Nom du modèle Real-ESRGAN dans model_registry ("general" par défaut)"""
+    return "esrgan_anime" if model_type == "anime" else "esrgan_general"
 
 
 def load_esrgan(model_type: str = "general"):
     """
-    Charge Real-ESRGAN (lazy loading) et décharge les pipelines de génération si nécessaire
+    Retourne Real-ESRGAN résident sur le device (lazy loading)
+    Les poids SDXL ne sont évincés que si les deux ne tiennent pas dans le budget
 
     Args:
         model_type: "general" pour x4plus standard, "anime" pour x4plus_anime_6B
     """
-    global esrgan_models
+    try:
+        return model_registry.get(esrgan_model_name(model_type))
+    except ImportError as e:
+        logger.error(f"⚠️ ImportError loading Real-ESRGAN: {e}")
+        logger.error(f"Python path: {__file__}")
+        import sys
+        logger.error(f"sys.path: {sys.path}")
+    except Exception as e:
+        logger.error(f"❌ Error loading Real-ESRGAN: {e}")
+        import traceback
+        logger.error(traceback.format_exc())
+    return None
 
-    if model_type not in esrgan_models:
-        # Décharger les pipelines de génération pour économiser la VRAM
-        unload_pipeline("generation")
 
-        logger.info(f"📥 Loading Real-ESRGAN ({model_type})...")
-        try:
-            logger.info("Importing basicsr.archs.rrdbnet_arch...")
-            from basicsr.archs.rrdbnet_arch import RRDBNet
-            logger.info("Importing realesrgan...")
-            from realesrgan import RealESRGANer
-            logger.info("Imports successful!")
-
-            if model_type == "anime":
-                # Configuration pour anime_6B (6 blocks, optimisé pour illustrations/anime)
-                model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=6, num_grow_ch=32, scale=4)
-                model_path = 'https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.2.4/RealESRGAN_x4plus_anime_6B.pth'
-                model_name = "x4plus_anime_6B"
-            else:  # general
-                # Configuration pour x4plus (modèle standard)
-                model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=4)
-                model_path = 'https://github.com/xinntao/Real-ESRGAN/releases/download/v0.1.0/RealESRGAN_x4plus.pth'
-                model_name = "x4plus"
-
-            # Utiliser le modèle avec paramètres optimisés pour la qualité
-            esrgan_models[model_type] = RealESRGANer(
-                scale=4,  # x4 scale
-                model_path=model_path,
-                model=model,
-                tile=0,  # Pas de tiling = meilleure qualité (utilise plus de VRAM)
-                tile_pad=10,
-                pre_pad=10,  # Augmenté pour réduire les artefacts aux bords
-                half=True if device == "cuda" else False,
-                device=device
-            )
-            logger.info(f"✅ Real-ESRGAN {model_name} loaded successfully (optimized for quality)")
-        except ImportError as e:
-            logger.error(f"⚠️ ImportError loading Real-ESRGAN: {e}")
-            logger.error(f"Python path: {__file__}")
-            import sys
-            logger.error(f"sys.path: {sys.path}")
-            esrgan_models[model_type] = None
-        except Exception as e:
-            logger.error(f"❌ Error loading Real-ESRGAN: {e}")
-            import traceback
-            logger.error(traceback.format_exc())
-            esrgan_models[model_type] = None
+model_registry = ModelRegistry(
+    device_budget_bytes=default_memory_budget_bytes(),
+    offload_budget_bytes=int(OFFLOAD_BUDGET_GB * GB),
+    on_release=release_device_memory,
+    on_load=lambda name, seconds, kind: MODEL_LOAD_SECONDS.observe(seconds, model=name, kind=kind)
+)
+model_registry.register(
+    "sdxl", load_sdxl_weights, SDXL_ESTIMATED_BYTES,
+    offload=lambda components: move_sdxl_components(components, "cpu"),
+    restore=lambda components: move_sdxl_components(components, device),
+    on_drop=forget_sdxl_pipelines,
+    offload_size_bytes=SDXL_WEIGHTS_BYTES
+)
+for _esrgan_type in ("general", "anime"):
+    model_registry.register(
+        f"esrgan_{_esrgan_type}",
+        lambda model_type=_esrgan_type: create_esrgan(model_type),
+        ESRGAN_ESTIMATED_BYTES,
+        offload=lambda upsampler: upsampler.model.to("cpu"),
+        restore=lambda upsampler: upsampler.model.to(device),
+        on_drop=lambda model_type=_esrgan_type: model_compiler.release(esrgan_model_name(model_type)),
+        offload_size_bytes=ESRGAN_WEIGHTS_BYTES
+    )
+for _name in list(keep_alive_policy.overrides):
+    if _name not in model_registry.status()["models"]:
+        logger.warning(f"⚠️ IMAGE_API_KEEP_ALIVE: unknown model {_name} (ignored)")
+        keep_alive_policy.overrides.pop(_name)
+logger.info(f"📊 Model memory budget: {model_registry.device_budget_bytes / GB:.1f} GB "
+            f"(+{OFFLOAD_BUDGET_GB:.1f} GB CPU offload)")
+
+
+def vae_decode_plan(latents: torch.Tensor, element_size: int) -> DecodePlan:
+    """Découpage du décodage VAE d'un lot, selon IMAGE_API_VAE_TILE et la mémoire libre"""
+    count, _, height, width = latents.shape
+    available = available_memory_bytes(device)
+    if device == "cuda":
+        # Mémoire gardée en cache par l'allocateur: libre pour nous, pas pour mem_get_info
+        available += torch.cuda.memory_reserved() - torch.cuda.memory_allocated()
+    tile = None if VAE_TILE == "auto" else int(VAE_TILE) // LATENT_SCALE
+    return plan_decode(height, width, count, available, element_size, VAE_TILED_MIN_PIXELS, tile=tile,
+                       overlap=VAE_TILE_OVERLAP // LATENT_SCALE, max_slice=VAE_DECODE_BATCH)
 
-    return esrgan_models.get(model_type)
 
+def decode_generated_latents(pipeline, latents: torch.Tensor,
+                             check_cancelled=None) -> Tuple[torch.Tensor, dict]:
+    """
+    Étape de décodage VAE après le dernier step (vae_decode.decode_latents)
+    Si l'estimation mémoire s'est trompée (OOM), on recommence une fois avec de petites tuiles, une par appel
 
-def clean_generated_image(image: Image.Image) -> Image.Image:
+    Returns:
+        (images N x 3 x H x W dans [0, 1], info: découpage, durée et pic mémoire du décodage)
     """
-    Nettoie une image générée pour éviter les valeurs invalides (NaN, Inf)
-    qui peuvent causer des warnings lors de la conversion
+    try:
+        return decode_latents(pipeline, latents, vae_decode_plan, check_cancelled)
+    except Exception as e:
+        if not is_out_of_memory(e):
+            raise
+        logger.warning(f"⚠️ VAE decode ran out of memory ({e}), "
+                       f"retrying with {VAE_MIN_TILE * LATENT_SCALE}px tiles")
+    release_device_memory()
+    overlap = min(VAE_TILE_OVERLAP // LATENT_SCALE, VAE_MIN_TILE // 4)
+    images, info = decode_latents(pipeline, latents, lambda _latents, _size: DecodePlan(VAE_MIN_TILE, overlap, 1),
+                                  check_cancelled)
+    return images, {**info, "oom_retry": True}
+
+
+def tensors_to_images(images: torch.Tensor) -> Tuple[List[Image.Image], List[dict]]:
     """
-    # Convertir en numpy array
-    img_array = np.array(image)
+    Convertit la sortie du pipeline (N x 3 x H x W, flottants dans [0, 1]) en images PIL
+    La validation se fait sur le tenseur, en une seule passe (aminmax par image, sur le device):
+    NaN/Inf et image toute noire deviennent des drapeaux, les pixels ne sont pas relus en numpy
 
-    # Debug: Afficher les stats de l'image
-    logger.info(f"Image array - shape: {img_array.shape}, dtype: {img_array.dtype}, min: {img_array.min()}, max: {img_array.max()}")
+    Returns:
+        (images PIL, drapeaux {"nan_values", "black_image"} de chaque image)
+    """
+    low, high = torch.aminmax(images.flatten(1), dim=1)  # NaN se propage dans min et max
+    invalid = ~(torch.isfinite(low) & torch.isfinite(high))
+    black = high <= 0
+    if bool(invalid.any()):
+        images = torch.nan_to_num(images, nan=0.0, posinf=1.0, neginf=0.0)
+    pixels = images.mul(255).round_().clamp_(0, 255).to(torch.uint8).permute(0, 2, 3, 1).cpu().numpy()
+
+    flags = [{"nan_values": nan_values, "black_image": is_black}
+             for nan_values, is_black in zip(invalid.tolist(), black.tolist())]
+    for index, image_flags in enumerate(flags):
+        if image_flags["nan_values"]:
+            logger.warning(f"⚠️ Image {index} of the batch had NaN/Inf values (replaced)")
+        if image_flags["black_image"]:
+            logger.error(f"⚠️ Image {index} of the batch is completely black!")
+    return [Image.fromarray(array) for array in pixels], flags
+
+
+def timed_encode(image: Image.Image, encoding: OutputEncoding) -> Tuple[EncodedImage, float]:
+    start_time = time.perf_counter()
+    encoded = encode_image(image, encoding)
+    elapsed = time.perf_counter() - start_time
+    IMAGE_ENCODE_SECONDS.observe(elapsed, format=encoding.image_format)
+    return encoded, elapsed
+
+
+async def encode_images(images: List[Image.Image], encoding: OutputEncoding) -> Tuple[List[EncodedImage], dict]:
+    """
+    Encode les images d'un job dans le pool d'encodage, en parallèle
+    Le thread worker est déjà passé au job suivant: l'encodage chevauche son débruitage
 
-    # Vérifier si l'image est vide (toute noire)
-    if img_array.max() == 0:
-        logger.error("⚠️ Generated image is completely black!")
-        return image  # Retourner l'image originale sans modification
+    Returns:
+        (images encodées, champs ajoutés à l'info: réglages, durée, taille)
+    """
+    loop = asyncio.get_running_loop()
+    start_time = time.perf_counter()
+    results = await asyncio.gather(*(
+        loop.run_in_executor(encoder_pool, timed_encode, image, encoding) for image in images
+    ))
+    encoded = [image for image, _ in results]
+    return encoded, {
+        "encoding": encoding.describe(),
+        "encode_time_s": round(time.perf_counter() - start_time, 3),
+        "output_bytes": sum(len(image.data) for image in encoded),
+    }
 
-    # Si l'image est déjà en uint8, pas besoin de conversion
-    if img_array.dtype == np.uint8:
-        logger.info("Image already in uint8 format")
-        return image
 
-    # Remplacer les NaN et Inf par des valeurs valides
-    if np.any(np.isnan(img_array)) or np.any(np.isinf(img_array)):
-        logger.warning("⚠️ Detected NaN/Inf values in generated image, cleaning...")
-        img_array = np.nan_to_num(img_array, nan=0.0, posinf=255.0, neginf=0.0)
+def base64_to_image(base64_str: str) -> Image.Image:
+    """Convertit une string base64 en image PIL"""
+    image_data = base64.b64decode(base64_str)
+    return Image.open(io.BytesIO(image_data))
 
-    # Si les valeurs sont entre 0 et 1 (float), convertir en 0-255
-    if img_array.max() <= 1.0:
-        logger.info("Converting float [0,1] to uint8 [0,255]")
-        img_array = (img_array * 255).astype(np.uint8)
-    else:
-        # S'assurer que les valeurs sont dans la plage [0, 255]
-        img_array = np.clip(img_array, 0, 255).astype(np.uint8)
 
-    # Reconvertir en PIL Image
-    return Image.fromarray(img_array)
+def open_input_image(base64_str: Optional[str], file: Optional[BinaryIO]) -> Image.Image:
+    """Ouvre l'image envoyée, depuis un fichier uploadé si présent, sinon depuis le base64"""
+    if file is not None:
+        image = Image.open(file)
+        image.load()  # Décoder tant que le fichier est ouvert
+        return image
+    return base64_to_image(base64_str)
 
 
-def image_to_base64(image: Image.Image, high_quality: bool = False) -> str:
+async def read_image_request(http_request: Request, model_cls, file_field: str, max_files: int = 1,
+                             max_bytes: int = MAX_UPLOAD_BYTES):
     """
-    Convertit une image PIL en base64
+    Décode le corps d'une requête image: JSON (base64), multipart/form-data ou corps brut
+    Retourne le modèle pydantic validé et l'envoi (None en JSON), à fermer par l'appelant
+    """
+    if upload_kind(http_request) == UPLOAD_JSON:
+        body = await read_limited_body(http_request, max_bytes)
+        try:
+            return model_cls.model_validate_json(body), None
+        except ValidationError as e:
+            raise RequestValidationError(e.errors())
 
-    Args:
-        image: Image PIL à convertir
-        high_quality: Si True, utilise une compression PNG optimale pour la qualité
+    upload = await parse_image_upload(http_request, file_field, max_bytes, max_files)
+    try:
+        return model_cls.model_validate(upload.fields), upload
+    except ValidationError as e:
+        upload.close()
+        raise RequestValidationError(e.errors())
+
+
+def unload_all_models():
+    """
+    Décharge tous les modèles de la mémoire (libère la VRAM)
+    Doit tourner sur le thread worker pour ne jamais décharger sous une génération en cours
     """
-    # Nettoyer l'image avant la conversion
-    image = clean_generated_image(image)
+    unloaded = model_registry.unload_all()
+    if unloaded:
+        logger.info(f"✅ Unloaded: {', '.join(unloaded)}")
 
-    buffered = io.BytesIO()
-    if high_quality:
-        # PNG avec compression minimale pour qualité maximale
-        image.save(buffered, format="PNG", compress_level=1, optimize=False)
-    else:
-        # PNG standard
-        image.save(buffered, format="PNG")
-    return base64.b64encode(buffered.getvalue()).decode()
 
+def unload_idle_models(keep_alive: dict) -> List[str]:
+    """Décharge les modèles inactifs depuis leur délai (table nom -> secondes calculée par keep_alive_table)"""
+    return model_registry.unload_idle(lambda name, _reload_cost_s: keep_alive.get(name, KEEP_ALIVE_MIN_S))
 
-def base64_to_image(base64_str: str) -> Image.Image:
-    """Convertit une string base64 en image PIL"""
-    image_data = base64.b64decode(base64_str)
-    return Image.open(io.BytesIO(image_data))
+
+def model_keep_alive_s(name: str, reload_cost_s: float) -> float:
+    return keep_alive_policy.keep_alive_s(name, reload_cost_s)
 
 
-def update_last_usage():
-    """Met à jour le timestamp du dernier usage des modèles"""
-    global last_model_usage
-    last_model_usage = time.time()
-    logger.debug(f"Model usage updated: {last_model_usage}")
+def keep_alive_table(status: dict) -> dict:
+    """Délai de chaque modèle d'un worker, d'après la demande observée ici et son coût de rechargement"""
+    return {name: model_keep_alive_s(name, model["reload_cost_s"]) for name, model in status["models"].items()}
 
 
 async def check_and_unload_models():
     """
-    Vérifie périodiquement l'inactivité et décharge les modèles si nécessaire
+    Vérifie périodiquement l'inactivité et décharge les modèles inutilisés depuis leur délai
+    de keep-alive (keep_alive_policy); un modèle en cours d'utilisation n'est jamais déchargé
+    En mode coordinateur, chaque processus worker libre est vérifié séparément
+    Purge aussi les résultats de jobs expirés (suppression des fichiers hors de la boucle)
     Cette fonction tourne en background
     """
-    global txt2img_pipeline, img2img_pipeline, esrgan_models, last_model_usage
-
     while True:
-        await asyncio.sleep(60)  # Vérifier toutes les minutes
+        await asyncio.sleep(AUTO_UNLOAD_CHECK_INTERVAL_S)
+        await asyncio.to_thread(job_results.purge_expired)
+
+        for lane in range(inference_worker.lanes):
+            if not inference_worker.is_lane_idle(lane) or inference_worker.queue_depth > 0:
+                continue
+            status = lane_status(lane)
+            if not status:
+                continue  # Worker pas encore démarré
+            keep_alive = keep_alive_table(status)
+            try:
+                unloaded = await inference_worker.submit(
+                    lane_job_id("auto_unload", lane), "maintenance",
+                    lambda: run_on_lane("unload_idle", keep_alive),
+                    priority=PRIORITY_MAINTENANCE, lane=lane
+                )
+            except QueueFullError:
+                break
+            except Exception as e:
+                logger.warning(f"⚠️ Auto-unload failed: {e}")
+                continue
+            if unloaded:
+                logger.info(f"🗑️ Auto-unload completed ({', '.join(unloaded)}) - VRAM freed after inactivity")
 
-        # Calculer le temps d'inactivité
-        inactive_time = time.time() - last_model_usage
 
-        # Si inactif depuis plus de 5 minutes ET qu'il y a des modèles chargés
-        if inactive_time > AUTO_UNLOAD_DELAY:
-            models_loaded = (txt2img_pipeline is not None) or (img2img_pipeline is not None) or (len(esrgan_models) > 0)
+def start_auto_unload_task():
+    """Démarre la tâche d'auto-unload en background"""
+    global auto_unload_task
+    if auto_unload_task is None:
+        auto_unload_task = asyncio.create_task(check_and_unload_models())
+        logger.info(f"✅ Auto-unload task started (keep-alive {KEEP_ALIVE_MIN_S:.0f}-{KEEP_ALIVE_MAX_S:.0f}s "
+                    f"per model, from observed demand)")
 
-            if models_loaded:
-                logger.info(f"⏰ Models inactive for {inactive_time:.0f}s, auto-unloading...")
 
-                # Décharger txt2img pipeline
-                if txt2img_pipeline is not None:
-                    del txt2img_pipeline
-                    txt2img_pipeline = None
-                    logger.info("✅ txt2img_pipeline unloaded")
+def run_warmup():
+    """
+    Génération factice de WARMUP_STEPS steps puis décodage VAE: contexte CUDA, choix des kernels (cuDNN,
+    xformers) et allocateur prêts avant la première vraie requête. Ne passe ni par les caches ni par les métriques
+    """
+    pipeline = load_txt2img_pipeline()
+    with torch.inference_mode(), cpu_backend.inference("sdxl"):
+        embeds, _, pooled, _ = pipeline.encode_prompt(
+            prompt="warmup", device=device, num_images_per_prompt=1, do_classifier_free_guidance=False
+        )
+        result = pipeline(
+            prompt_embeds=embeds,
+            pooled_prompt_embeds=pooled,
+            negative_prompt_embeds=torch.zeros_like(embeds),
+            negative_pooled_prompt_embeds=torch.zeros_like(pooled),
+            width=WARMUP_SIZE,
+            height=WARMUP_SIZE,
+            num_inference_steps=WARMUP_STEPS,
+            generator=[torch.Generator(device=device).manual_seed(0)],
+            output_type="latent"
+        )
+        decode_generated_latents(pipeline, result.images)
+    if device == "cuda":
+        torch.cuda.synchronize()
 
-                # Décharger img2img pipeline
-                if img2img_pipeline is not None:
-                    del img2img_pipeline
-                    img2img_pipeline = None
-                    logger.info("✅ img2img_pipeline unloaded")
 
-                # Décharger ESRGAN models
-                if esrgan_models:
-                    esrgan_models.clear()
-                    logger.info("✅ esrgan_models unloaded")
+PRELOADERS = {
+    "txt2img": load_txt2img_pipeline,
+    "img2img": load_img2img_pipeline,
+    "esrgan_general": lambda: load_esrgan("general"),
+    "esrgan_anime": lambda: load_esrgan("anime"),
+}
+# Modèle de model_registry derrière chaque pipeline préchargeable
+PIPELINE_MODELS = {"txt2img": "sdxl", "img2img": "sdxl", "esrgan_general": "esrgan_general",
+                   "esrgan_anime": "esrgan_anime"}
+pending_prepares = set()  # Pipelines dont un préchargement annoncé attend dans la file
 
-                # Libérer la VRAM
-                if device == "cuda":
-                    torch.cuda.empty_cache()
-                    logger.info("✅ VRAM freed")
 
-                logger.info("🗑️ Auto-unload completed - VRAM freed after inactivity")
+def preload_pipeline(pipeline: str):
+    """Charge (ou garde chargé) le modèle d'un pipeline de PRELOADERS"""
+    PRELOADERS[pipeline]()
 
 
-def start_auto_unload_task():
-    """Démarre la tâche d'auto-unload en background"""
-    global auto_unload_task
-    if auto_unload_task is None:
-        auto_unload_task = asyncio.create_task(check_and_unload_models())
-        logger.info("✅ Auto-unload task started (5 min inactivity)")
+def preload_models():
+    """Préchargement au démarrage, sur le thread worker: PRELOAD_PIPELINES puis warmup"""
+    for name in PRELOAD_PIPELINES:
+        loader = PRELOADERS.get(name)
+        if loader is None:
+            logger.warning(f"⚠️ Unknown IMAGE_API_PRELOAD entry: {name} (expected {', '.join(PRELOADERS)})")
+            continue
+        loader()
+    startup_state.mark(PHASE_WEIGHTS)
+
+    if WARMUP_STEPS > 0:
+        logger.info(f"🔥 Warmup: {WARMUP_STEPS} step(s) at {WARMUP_SIZE}x{WARMUP_SIZE}...")
+        run_warmup()
+        startup_state.mark(PHASE_WARMUP)
+
+
+async def warm_up_models():
+    """
+    Passe le préchargement dans la file: les requêtes arrivées entre-temps attendent derrière lui
+    En mode coordinateur, chaque processus worker précharge ses modèles; prêt quand tous ont fini
+    """
+    error = None
+    try:
+        await asyncio.gather(*submit_to_each_lane("startup_preload", "startup_preload"))
+    except Exception as e:
+        error = str(e)
+    startup_state.ready(error)
+
+
+def start_warmup_task():
+    """Ouvre le service en état "warming" et lance le préchargement en background"""
+    global startup_task
+    startup_state.warming()
+    if not PRELOAD_PIPELINES and WARMUP_STEPS <= 0:
+        startup_state.ready()
+        return
+    if startup_task is None:
+        startup_task = asyncio.create_task(warm_up_models())
+
+
+# ==================== PROCESSUS WORKERS ====================
+
+def share_device_memory(device_share: int, process_count: int):
+    """
+    Processus worker: les budgets mémoire par défaut sont partagés entre les workers
+    (device_share workers sur le même device, process_count workers dans la même RAM)
+    """
+    if MEMORY_BUDGET_GB is None and device_share > 1:
+        model_registry.device_budget_bytes //= device_share
+    if "IMAGE_API_OFFLOAD_BUDGET_GB" not in os.environ and process_count > 1:
+        model_registry.offload_budget_bytes //= process_count
+
+
+def serve_models(models: Tuple[str, ...]):
+    """
+    Processus worker réservé à des modèles (IMAGE_API_WORKER_DEVICES "cpu:0-11=sdxl"): ne précharge
+    que ceux-là, et pas de warmup SDXL s'il ne le sert pas. Il reste capable de charger les autres
+    (refine par Real-ESRGAN sur le worker SDXL)
+    """
+    global WARMUP_STEPS
+    if not models:
+        return
+    PRELOAD_PIPELINES[:] = [name for name in PRELOAD_PIPELINES
+                            if name not in PIPELINE_MODELS or model_matches(PIPELINE_MODELS[name], models)]
+    if not model_matches("sdxl", models):
+        WARMUP_STEPS = 0
+
+
+def start_worker_processes():
+    """Mode coordinateur: un processus worker par voie de inference_worker (import du service en parallèle)"""
+    if WORKER_PROCESSES <= 0 or worker_processes:
+        return
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    cuda_count = torch.cuda.device_count() if device == "cuda" else 0
+    known_models = model_registry.status()["models"]
+    for spec in worker_specs(WORKER_PROCESSES, WORKER_DEVICES, cuda_count, cpus):
+        for pattern in spec.models:
+            if not any(model_matches(name, (pattern,)) for name in known_models):
+                logger.warning(f"⚠️ IMAGE_API_WORKER_DEVICES: unknown model {pattern} for worker {spec.index}")
+        inference_worker.set_lane_served(spec.index, spec.models)
+        worker = WorkerProcess(
+            spec, worker_process_initializer,
+            on_event=lambda job_id, event_type, data: progress_hub.publish(job_id, event_type, data),
+            on_metric=metrics.replay
+        )
+        worker.start()
+        worker_processes.append(worker)
+
+
+def stop_worker_processes():
+    for worker in worker_processes:
+        worker.stop()
+    worker_processes.clear()
+
+
+def lane_status(lane: int) -> dict:
+    """Résidence des modèles d'une voie: ce processus, ou dernier état rapporté par son worker ({} si inconnu)"""
+    if not worker_processes:
+        return model_registry.status()
+    return worker_processes[lane].status
+
+
+def lane_statuses() -> List[dict]:
+    return [status for status in (lane_status(lane) for lane in range(inference_worker.lanes)) if status]
+
+
+def resident_models(status: dict) -> set:
+    return {name for name, model in status.get("models", {}).items() if model["tier"] == TIER_DEVICE}
+
+
+def lane_job_id(job_id: str, lane: int) -> str:
+    """ID d'un job de maintenance propre à une voie (inchangé avec une seule voie)"""
+    return job_id if inference_worker.lanes == 1 else f"{job_id}_{lane}"
+
+
+def run_on_lane(method: str, *args, jobs: tuple = ()):
+    """
+    Exécute une fonction de WORKER_METHODS pour le job courant: ici sans processus workers,
+    sinon sur le processus worker de la voie (résultat et exceptions reconstruits)
+    Appelé sur un thread de inference_worker
+    """
+    if not worker_processes:
+        return WORKER_METHODS[method](*args)
+    lane = current_lane()
+    worker = worker_processes[lane]
+    try:
+        return worker.call(method, args, jobs)
+    finally:
+        inference_worker.set_lane_models(lane, resident_models(worker.status))
+
+
+def submit_to_each_lane(job_id: str, method: str, *args) -> List[asyncio.Future]:
+    """Un job de maintenance par voie (chaque processus worker a ses propres modèles)"""
+    return [
+        inference_worker.submit(lane_job_id(job_id, lane), "maintenance",
+                                lambda: run_on_lane(method, *args),
+                                priority=PRIORITY_MAINTENANCE, lane=lane)
+        for lane in range(inference_worker.lanes)
+    ]
+
+
+def remote_job(token: CancellationToken, job_type: str) -> tuple:
+    """Description d'un job envoyé à un processus worker: aperçus demandés, annulation déjà reçue"""
+    return token.job_id, job_type, progress_hub.has_subscribers(token.job_id), token.is_cancelled()
+
+
+def read_upload_bytes(file: Optional[BinaryIO]) -> Optional[bytes]:
+    """Contenu d'un fichier uploadé, pour l'envoyer à un processus worker"""
+    if file is None:
+        return None
+    file.seek(0)
+    return file.read()
 
 
 # ==================== API ENDPOINTS ====================
 
 @app.on_event("startup")
 async def startup_event():
-    """Événement de démarrage - lance les tâches background"""
+    """Événement de démarrage - lance le worker d'inférence et les tâches background"""
+    start_worker_processes()
+    inference_worker.start()
+    if cancel_flags_backend is not None:
+        cancel_flags_backend.start()
+    result_cache.load_index()
+    job_results.reset_directory()
+    cost_model.load()
     start_auto_unload_task()
+    start_warmup_task()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Événement d'arrêt - termine le worker après le job en cours"""
+    if cancel_flags_backend is not None:
+        cancel_flags_backend.stop()
+    inference_worker.stop(timeout=5)
+    stop_worker_processes()
+    encoder_pool.shutdown(wait=False)
+    cost_model.save()
+    model_compiler.save()
 
 
 @app.get("/")
@@ -488,320 +1133,1662 @@ async def root():
     """Health check endpoint"""
     return {
         "service": "Netricsa Image Generation API",
-        "status": "online",
+        "status": startup_state.status,
         "device": device,
-        "models_loaded": {
+        "models_loaded": models_loaded(),
+        "residency": model_registry.status() if not worker_processes else {"workers": worker_residency()},
+        "keep_alive": keep_alive_policy.stats(model_reload_cost_s),
+        "model_loads": model_registry.load_stats() if not worker_processes else None,
+        "queue": inference_worker.stats(),
+        "prompt_cache": prompt_cache.stats(),
+        "result_cache": result_cache.stats(),
+        "job_results": job_results.stats(),
+        "drafts": draft_store.stats(),
+        "cost_model": cost_model.status(),
+        "cpu_backend": cpu_backend.describe() if device == "cpu" else None,
+        "compile": model_compiler.stats() if model_compiler.enabled else None,
+        "startup": startup_state.as_dict()
+    }
+
+
+def models_loaded() -> dict:
+    """Modèles chargés (en mode coordinateur: chargés sur au moins un processus worker)"""
+    if not worker_processes:
+        return {
+            "sdxl_weights": model_registry.is_loaded("sdxl"),
             "txt2img": txt2img_pipeline is not None,
             "img2img": img2img_pipeline is not None,
-            "esrgan_general": "general" in esrgan_models,
-            "esrgan_anime": "anime" in esrgan_models
+            "esrgan_general": model_registry.is_loaded("esrgan_general"),
+            "esrgan_anime": model_registry.is_loaded("esrgan_anime")
         }
+    loaded = {name for status in lane_statuses() for name, model in status["models"].items()
+              if model["tier"] != TIER_UNLOADED}
+    return {
+        "sdxl_weights": "sdxl" in loaded,
+        "txt2img": "sdxl" in loaded,
+        "img2img": "sdxl" in loaded,
+        "esrgan_general": "esrgan_general" in loaded,
+        "esrgan_anime": "esrgan_anime" in loaded
     }
 
 
-@app.post("/generate")
-async def generate_image(request: GenerateRequest):
+def worker_residency() -> List[dict]:
+    """Résidence des modèles de chaque processus worker (dernier état rapporté)"""
+    return [
+        {"worker": worker.spec.index, "device": worker.spec.describe(),
+         "pid": worker.process.pid if worker.alive else None, "restarts": worker.restarts, **worker.status}
+        for worker in worker_processes
+    ]
+
+
+def model_reload_cost_s(name: str) -> float:
+    """Coût de rechargement mesuré (en mode coordinateur: le plus élevé parmi les workers)"""
+    costs = [status["models"][name]["reload_cost_s"] for status in lane_statuses() if name in status["models"]]
+    return max(costs) if costs else model_registry.reload_cost_s(name)
+
+
+@app.get("/ready")
+async def readiness():
+    """Prêt à servir sans chargement à froid: 200 une fois le préchargement terminé, 503 avant"""
+    return JSONResponse(status_code=200 if startup_state.is_ready else 503, content=startup_state.as_dict())
+
+
+def process_rss_bytes() -> Optional[int]:
+    """Mémoire résidente du processus (Linux; None ailleurs)"""
+    try:
+        with open("/proc/self/statm", encoding="utf8") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def memory_usage_bytes() -> dict:
+    """Jauge memory_bytes: empreintes estimées des modèles, caches en RAM, allocateur CUDA, processus"""
+    if worker_processes:
+        statuses = lane_statuses()
+        models_device = int(sum(status["device_used_gb"] for status in statuses) * GB)
+        models_offloaded = int(sum(status["offload_used_gb"] for status in statuses) * GB)
+    else:
+        models_device, models_offloaded = model_registry.device_used_bytes, model_registry.offload_used_bytes
+    usage = {
+        ("models_device",): models_device,
+        ("models_offloaded",): models_offloaded,
+        ("prompt_cache",): prompt_cache.used_bytes,
+        ("job_results",): job_results.memory_bytes,
+        ("drafts",): draft_store.used_bytes,
+    }
+    if device == "cuda":
+        usage[("cuda_allocated",)] = torch.cuda.memory_allocated()
+        usage[("cuda_reserved",)] = torch.cuda.memory_reserved()
+    rss = process_rss_bytes()
+    if rss is not None:
+        usage[("process_rss",)] = rss
+    return usage
+
+
+def model_tiers() -> dict:
     """
-    Génère une image avec Stable Diffusion (txt2img ou img2img)
+    Jauge model_resident: 1 pour le palier actuel de chaque modèle, 0 pour les autres
+    (en mode coordinateur: nombre de processus workers où le modèle est dans ce palier)
+    """
+    tiers = {(name, tier): 0 for name in model_registry.status()["models"]
+             for tier in (TIER_DEVICE, TIER_OFFLOADED, TIER_UNLOADED)}
+    for status in lane_statuses():
+        for name, model in status["models"].items():
+            tiers[(name, model["tier"])] = tiers.get((name, model["tier"]), 0) + 1
+    return tiers
+
+
+metrics.counter("result_cache_hits_total", "Requests served from the disk result cache",
+                callback=lambda: result_cache.hits)
+metrics.counter("result_cache_misses_total", "Result cache lookups without a stored result",
+                callback=lambda: result_cache.misses)
+metrics.counter("result_cache_evictions_total", "Result cache entries removed to stay under the size limit",
+                callback=lambda: result_cache.evictions)
+metrics.counter("prompt_cache_hits_total", "Prompt embeddings served from the cache",
+                callback=lambda: prompt_cache.hits)
+metrics.counter("prompt_cache_misses_total", "Prompts run through the text encoders",
+                callback=lambda: prompt_cache.misses)
+metrics.counter("prompt_cache_evictions_total", "Prompt embeddings evicted from the cache",
+                callback=lambda: prompt_cache.evictions)
+metrics.counter("model_evictions_total", "Models evicted from the device to make room",
+                callback=lambda: model_registry.eviction_count)
+metrics.counter("worker_jobs_total", "Jobs handled by the inference worker", ["outcome"],
+                callback=lambda: {("completed",): inference_worker.completed_count,
+                                  ("failed",): inference_worker.failed_count,
+                                  ("rejected",): inference_worker.rejected_count})
+metrics.gauge("queue_depth", "Jobs waiting in the worker queue", callback=lambda: inference_worker.queue_depth)
+metrics.gauge("model_resident", "1 for the tier each model currently sits in (summed over worker processes)",
+              ["model", "tier"],
+              callback=model_tiers)
+metrics.gauge("memory_bytes", "Memory use by kind (model sizes are registry estimates)", ["kind"],
+              callback=memory_usage_bytes)
+metrics.gauge("model_keep_alive_seconds", "Idle time after which each model is unloaded", ["model"],
+              callback=lambda: {(name,): model_keep_alive_s(name, model_reload_cost_s(name))
+                                for name in model_registry.status()["models"]})
+metrics.gauge("result_cache_bytes", "Disk used by the result cache", callback=lambda: result_cache.used_bytes)
+metrics.gauge("startup_seconds", "Time from the start of the service import to the end of each startup phase",
+              ["phase"], callback=lambda: {(phase,): seconds for phase, seconds in startup_state.phases().items()})
+metrics.gauge("ready", "1 once the startup preload and warmup are done", callback=lambda: int(startup_state.is_ready))
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Métriques au format texte Prometheus (histogrammes de durée par étape, compteurs, jauges)"""
+    return PlainTextResponse(metrics.render(), media_type=METRICS_CONTENT_TYPE)
+
+
+def input_image_digest(base64_str: Optional[str], file: Optional[BinaryIO]) -> Optional[str]:
+    """Empreinte de l'image envoyée (même valeur en base64, multipart ou corps brut)"""
+    if file is not None:
+        return file_digest(file)
+    if base64_str:
+        return bytes_digest(base64.b64decode(base64_str))
+    return None
+
+
+def request_encoding(request, negotiated_format: str, high_quality: bool = False) -> OutputEncoding:
+    """Réglages d'encodage d'une requête (champs output_format, quality, ... sinon Accept)"""
+    try:
+        return output_encoding(negotiated_format, request.output_format, request.quality, request.lossless,
+                               request.png_compress_level, high_quality=high_quality)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def generation_cache_key(request: GenerateRequest, seeds: List[int], encoding: OutputEncoding,
+                         reference_file: Optional[BinaryIO]) -> str:
+    """Clé du cache de résultats pour une génération à seeds fixés"""
+    reference = input_image_digest(request.reference_image, reference_file)
+    return request_key({
+        "kind": "generate",
+        "model": PROMPT_ENCODER_ID,
+        "device": device,
+        "prompt": request.prompt,
+        "negative_prompt": request.negative_prompt,
+        "width": request.width,
+        "height": request.height,
+        "steps": request.steps,
+        "cfg_scale": request.cfg_scale,
+        "seeds": seeds,
+        "reference": reference,
+        "strength": request.strength if reference is not None else None,
+        "encoding": encoding.describe(),
+    })
+
+
+def upscale_cache_key(request: UpscaleRequest, encoding: OutputEncoding, image_file: Optional[BinaryIO]) -> str:
+    """Clé du cache de résultats pour un upscale (image, modèle, facteur)"""
+    return request_key({
+        "kind": "upscale",
+        "image": input_image_digest(request.image, image_file),
+        "model": "anime" if request.model == "anime" else "general",
+        "scale": request.scale,
+        "encoding": encoding.describe(),
+    })
+
+
+async def lookup_result_cache(key_func, *args):
     """
-    # Mettre à jour le timestamp d'utilisation
-    update_last_usage()
+    Calcule la clé du cache (hash de l'image compris, hors de la boucle) et cherche le résultat
+    Returns:
+        (clé, (images, info) ou None); clé None si l'entrée est illisible (l'erreur sortira du job)
+    """
+    try:
+        cache_key = await asyncio.to_thread(key_func, *args)
+    except ValueError:  # base64 invalide
+        return None, None
+    return cache_key, await asyncio.to_thread(result_cache.get, cache_key)
+
+
+def queue_full_exception(error: QueueFullError) -> HTTPException:
+    """Réponse 429 immédiate quand la file du worker est pleine"""
+    logger.warning(f"⚠️ Rejecting job: {error}")
+    return HTTPException(status_code=429, detail=str(error), headers={"Retry-After": "30"})
+
+
+@dataclass
+class Admission:
+    """Décision du contrôle d'admission pour un job (rapportée dans info.admission)"""
+    action: str  # "accepted", "downscaled" ou "deferred"
+    cost: JobCost
+    priority: int
+    queue_eta_s: float  # Attente prédite avant le début du job
+    queue_cost_s: float  # Durée prédite comptée dans les ETA de la file (chargement du modèle compris)
+    requested: Optional[dict] = None  # Paramètres demandés, quand le job a été réduit
 
-    # Créer un job ID pour cette génération
-    job_id = create_job_id()
-    active_jobs[job_id] = {"cancelled": False, "type": "generate"}
+    def as_dict(self) -> dict:
+        admission = {"action": self.action, **self.cost.as_dict(), "queue_eta_s": round(self.queue_eta_s, 1)}
+        if self.requested is not None:
+            admission["requested"] = self.requested
+        return admission
 
+
+def over_budget_policy(request) -> str:
+    """Politique d'un job qui dépasse le budget: champ over_budget, sinon IMAGE_API_OVER_BUDGET"""
+    policy = request.over_budget or OVER_BUDGET_POLICY
+    if policy not in OVER_BUDGET_POLICIES:
+        raise HTTPException(status_code=400, detail=f"Invalid over_budget: {policy} "
+                                                    f"(expected {', '.join(OVER_BUDGET_POLICIES)})")
+    return policy
+
+
+def job_memory_budget_bytes(model: str) -> int:
+    """
+    Mémoire du device laissée aux activations d'un job une fois les poids de son modèle chargés
+    (en mode coordinateur: le plus petit budget parmi les processus workers)
+    0 si les poids seuls dépassent déjà le budget: le registre les charge quand même, on ne
+    refuse pas pour autant tous les jobs
+    """
+    statuses = [status for status in lane_statuses() if "device_budget_gb" in status] or [model_registry.status()]
+    remaining = min(int((status["device_budget_gb"] - status["models"][model]["size_gb"]) * GB)
+                    for status in statuses)
+    return max(0, remaining)
+
+
+def model_queue_cost_s(model: str) -> float:
+    """Temps de chargement à compter dans l'ETA si aucun worker n'a le modèle sur son device"""
+    if any(model in resident_models(status) for status in lane_statuses()):
+        return 0.0
+    return model_reload_cost_s(model)
+
+
+def is_over_budget(cost: JobCost, max_memory_bytes: int) -> bool:
+    return bool((MAX_JOB_SECONDS and cost.seconds > MAX_JOB_SECONDS)
+                or (max_memory_bytes and cost.memory_bytes > max_memory_bytes))
+
+
+def reject_over_budget(job_type: str, cost: JobCost, max_memory_bytes: int, hint: str):
+    """Refus d'un job trop gros (422): coût prédit et limites dans le détail"""
+    ADMISSIONS.inc(job_type=job_type, action="rejected")
+    detail = (f"Job over budget: predicted {cost.seconds:.0f}s of compute (max {MAX_JOB_SECONDS:.0f}s), "
+              f"{cost.memory_bytes / GB:.1f} GB of memory (budget {max_memory_bytes / GB:.1f} GB); {hint}")
+    logger.warning(f"⚠️ Rejecting {job_type} job: {detail}")
+    raise HTTPException(status_code=422, detail=detail)
+
+
+def admit_to_queue(job_type: str, policy: str, priority: int, cost: JobCost, queue_cost_s: float,
+                   requested: Optional[dict] = None) -> Admission:
+    """
+    Attente prédite dans la file (durées prédites des jobs devant et reste des lots en cours)
+    Au-delà de MAX_QUEUE_WAIT_S: 429 avec un Retry-After égal à cette attente, ou job différé
+    (PRIORITY_DEFERRED) avec over_budget="defer"
+    """
+    wait_s = inference_worker.estimated_start_s(priority)
+    action = "downscaled" if requested is not None else "accepted"
+    if MAX_QUEUE_WAIT_S and wait_s > MAX_QUEUE_WAIT_S:
+        if policy != "defer":
+            ADMISSIONS.inc(job_type=job_type, action="rejected")
+            logger.warning(f"⚠️ Rejecting {job_type} job: predicted queue wait {wait_s:.0f}s")
+            raise HTTPException(status_code=429, headers={"Retry-After": str(math.ceil(wait_s))},
+                                detail=f"Queue too long: predicted wait {wait_s:.0f}s (max {MAX_QUEUE_WAIT_S:.0f}s); "
+                                       f"retry later or use over_budget=defer")
+        priority, action = PRIORITY_DEFERRED, "deferred"
+        wait_s = inference_worker.estimated_start_s(priority)
+    ADMISSIONS.inc(job_type=job_type, action=action)
+    return Admission(action, cost, priority, wait_s, queue_cost_s, requested)
+
+
+def denoise_steps(request: GenerateRequest, is_img2img: bool) -> int:
+    """Steps de débruitage réellement exécutés (img2img: steps x strength, comme diffusers)"""
+    return max(1, int(request.steps * request.strength)) if is_img2img else request.steps
+
+
+def admit_generation(request: GenerateRequest, images: int, is_img2img: bool) -> Tuple[GenerateRequest, Admission]:
+    """
+    Contrôle d'admission d'une génération, avant qu'elle ne touche un modèle
+    over_budget="downscale": steps puis résolution réduits jusqu'à tenir dans le budget
+
+    Returns:
+        (requête, réduite si besoin; décision)
+    Raises:
+        HTTPException: 422 si le job est trop gros, 429 si la file est trop longue
+    """
+    policy = over_budget_policy(request)
+    max_memory = job_memory_budget_bytes("sdxl")
+    steps = denoise_steps(request, is_img2img)
+    cost = cost_model.generation(request.width, request.height, steps, images, ELEMENT_SIZE)
+    requested = None
+    if is_over_budget(cost, max_memory):
+        fitted = None
+        if policy == "downscale":
+            fitted = cost_model.fit_generation(request.width, request.height, steps, images, ELEMENT_SIZE,
+                                               MAX_JOB_SECONDS, max_memory, DOWNSCALE_MIN_SIDE, DOWNSCALE_MIN_STEPS)
+        if fitted is None:
+            reject_over_budget("generate", cost, max_memory,
+                               "lower width, height, steps or num_images, or use over_budget=downscale")
+        width, height, fitted_steps = fitted
+        requested = {"width": request.width, "height": request.height, "steps": request.steps}
+        if is_img2img and fitted_steps != steps:
+            # img2img: steps demandés tels que steps x strength donne les steps retenus
+            fitted_steps = min(request.steps, math.ceil(fitted_steps / request.strength))
+        request = request.model_copy(update={"width": width, "height": height, "steps": fitted_steps})
+        cost = cost_model.generation(width, height, denoise_steps(request, is_img2img), images, ELEMENT_SIZE)
+        logger.info(f"📐 Generation downscaled to {width}x{height}, {request.steps} steps "
+                    f"(requested {requested['width']}x{requested['height']}, {requested['steps']} steps)")
+    return request, admit_to_queue("generate", policy, PRIORITY_GENERATE, cost,
+                                   cost.seconds + model_queue_cost_s("sdxl"), requested)
+
+
+def input_image_size(base64_str: Optional[str], file: Optional[BinaryIO]) -> Optional[Tuple[int, int]]:
+    """Dimensions de l'image envoyée, lues dans son en-tête (None si illisible: l'erreur sortira du job)"""
     try:
-        logger.info(f"🎨 Generating image (job {job_id}): '{request.prompt[:50]}...'")
-
-        # Callback pour vérifier l'annulation à chaque step
-        def callback_on_step_end(pipe, step_index, timestep, callback_kwargs):
-            if is_job_cancelled(job_id):
-                logger.info(f"🛑 Generation cancelled at step {step_index}")
-                raise InterruptedError(f"Job {job_id} was cancelled")
-            return callback_kwargs
-
-        # Préparer le seed
-        generator = None
-        if request.seed != -1:
-            generator = torch.Generator(device=device).manual_seed(request.seed)
-
-        # Si image de référence fournie, utiliser img2img
-        if request.reference_image:
+        source = file if file is not None else io.BytesIO(base64.b64decode(base64_str))
+        with Image.open(source) as image:
+            return image.size
+    except Exception:
+        return None
+    finally:
+        if file is not None:
+            file.seek(0)
+
+
+def admit_upscale(request: UpscaleRequest,
+                  size: Optional[Tuple[int, int]]) -> Tuple[Optional[Tuple[int, int]], Admission]:
+    """
+    Contrôle d'admission d'un upscale: durée des passes Real-ESRGAN et RAM des sorties
+    (face à la RAM libre). over_budget="downscale": image d'entrée réduite avant l'upscale
+
+    Returns:
+        (taille d'entrée à utiliser, None = image telle quelle; décision)
+    Raises:
+        HTTPException: 422 si le job est trop gros, 429 si la file est trop longue
+    """
+    policy = over_budget_policy(request)
+    model = esrgan_model_name(request.model)
+    if size is None:
+        cost = JobCost(0.0, 0)
+        return None, admit_to_queue("upscale", policy, PRIORITY_UPSCALE, cost, model_queue_cost_s(model))
+    max_memory = available_memory_bytes("cpu")
+    cost = cost_model.upscale(model, *size, request.scale)
+    input_size, requested = None, None
+    if is_over_budget(cost, max_memory):
+        if policy == "downscale":
+            input_size = cost_model.fit_upscale(model, *size, request.scale, MAX_JOB_SECONDS, max_memory)
+        if input_size is None:
+            reject_over_budget("upscale", cost, max_memory,
+                               "send a smaller image or lower scale, or use over_budget=downscale")
+        requested = {"width": size[0], "height": size[1]}
+        cost = cost_model.upscale(model, *input_size, request.scale)
+        logger.info(f"📐 Upscale input downscaled to {input_size[0]}x{input_size[1]} (sent {size[0]}x{size[1]})")
+    return input_size, admit_to_queue("upscale", policy, PRIORITY_UPSCALE, cost,
+                                      cost.seconds + model_queue_cost_s(model), requested)
+
+
+def calibrate_cost_model(job_type: str, info: dict):
+    """Recale le modèle de coût sur les durées (et en CUDA le pic mémoire) mesurées d'un job terminé"""
+    if job_type == "generate":
+        peak_mb = info.get("denoise_peak_memory_mb")
+        cost_model.observe_generation(
+            info["width"], info["height"], info["denoise_steps"], info["batch_size"], ELEMENT_SIZE,
+            info["generation_time_s"], info["vae_decode"]["decode_time_s"],
+            int(peak_mb * 1024 * 1024) if peak_mb else None
+        )
+    elif job_type == "upscale":
+        # Lot d'images: les passes sont partagées, chaque image compte pour sa part du temps
+        width, height = (int(value) for value in info["original_size"].split("x"))
+        cost_model.observe_upscale(esrgan_model_name(info["model"]), width, height,
+                                   info["upscale_time_s"] / info["batch_size"])
+
+
+def publish_queued(job_id: str):
+    """Événement queued d'un job qui vient d'entrer dans la file: position et ETA prédite"""
+    eta_s = inference_worker.job_eta_s(job_id)
+    progress_hub.publish(job_id, EVENT_QUEUED, {"position": inference_worker.queue_position(job_id),
+                                                "eta_s": round(eta_s, 1) if eta_s is not None else None})
+
+
+def cached_result(job_id: str, cached) -> asyncio.Future:
+    """Future déjà résolu pour une requête servie depuis le cache de résultats"""
+    logger.info(f"💾 Job {job_id} served from result cache")
+    images, info = cached
+    future = asyncio.get_running_loop().create_future()
+    future.set_result((images, {**info, "cached": True}))
+    return future
+
+
+def is_out_of_memory(error: BaseException) -> bool:
+    """OOM CUDA, ou allocation refusée sur CPU"""
+    if isinstance(error, (torch.cuda.OutOfMemoryError, MemoryError)):
+        return True
+    message = str(error)
+    return isinstance(error, RuntimeError) and ("out of memory" in message or "can't allocate memory" in message)
+
+
+async def finish_job(job_id: str, job_type: str, future: asyncio.Future, encoding: OutputEncoding,
+                     cache_key: Optional[str], upload, admission: Optional[Admission] = None):
+    """
+    Attend les images du worker, les encode dans le pool d'encodage puis libère ce qui est
+    attaché au job: jeton d'annulation, canal de progression (événement final) et fichier
+    uploadé; recale le modèle de coût et met le résultat en cache
+    Tourne en tâche: le nettoyage a lieu même si le client qui attendait s'est déconnecté
+    """
+    start_time = time.monotonic()
+    final_event, final_data = EVENT_ERROR, None
+    try:
+        raw_images, info = await future
+        calibrate_cost_model(job_type, info)
+        images, encode_info = await encode_images(raw_images, encoding)
+        info = {**info, **encode_info}
+        if admission is not None:
+            info["admission"] = admission.as_dict()
+        final_event, final_data = EVENT_DONE, {"info": info}
+        if cache_key is not None:
+            asyncio.get_running_loop().run_in_executor(None, result_cache.put, cache_key, images, info)
+        return images, info
+    except InterruptedError:
+        final_event = EVENT_CANCELLED
+        raise
+    except HTTPException as e:
+        final_data = {"detail": e.detail}
+        raise
+    except Exception as e:
+        final_data = {"detail": str(e)}
+        if is_out_of_memory(e):
+            JOB_OOMS.inc(job_type=job_type)
+        raise
+    finally:
+        if final_event == EVENT_CANCELLED:
+            JOB_CANCELLATIONS.inc(job_type=job_type)
+        JOB_DURATION_SECONDS.observe(time.monotonic() - start_time, job_type=job_type, outcome=final_event)
+        # Oublier le jeton de ce job uniquement (les autres jobs ne sont pas touchés)
+        cancellation.release(job_id)
+        progress_hub.close(job_id, final_event, final_data)
+        if upload is not None:
+            upload.close()
+
+
+def job_http_exception(job_id: str, job_type: str, error: Exception) -> HTTPException:
+    """Traduit l'erreur d'un job en réponse HTTP (499 si annulé, 500 si inattendue)"""
+    if isinstance(error, HTTPException):
+        return error
+    label = "Upscale" if job_type == "upscale" else "Generation"
+    if isinstance(error, InterruptedError):
+        logger.info(f"🛑 Job {job_id} was cancelled")
+        return HTTPException(status_code=499, detail=f"{label} cancelled: {str(error)}")
+    logger.error(f"❌ Error {'upscaling' if job_type == 'upscale' else 'generating'} image: {error}")
+    return HTTPException(status_code=500, detail=str(error))
+
+
+@dataclass
+class RefineSource:
+    """Image d'un brouillon reprise par /refine: ses latents (1 x 4 x h x w) et son image décodée"""
+    draft_id: str
+    image_index: int
+    latents: np.ndarray
+    image: Image.Image
+    upscaler: str  # "latent" ou "esrgan"
+
+
+@dataclass
+class GenerationItem:
+    """Une requête /generate (ou /refine) telle que l'exécute le worker (seule ou dans un lot)"""
+    token: CancellationToken
+    request: GenerateRequest
+    reference_file: Optional[BinaryIO] = None
+    seeds: List[int] = field(default_factory=list)
+    refine: Optional[RefineSource] = None  # Refine: img2img à partir d'un brouillon
+
+    @property
+    def is_img2img(self) -> bool:
+        return self.reference_file is not None or bool(self.request.reference_image) or self.refine is not None
+
+    def batch_key(self) -> tuple:
+        """Deux générations ne partagent un appel au pipeline que si ces paramètres sont identiques"""
+        request = self.request
+        strength = request.strength if self.is_img2img else None
+        upscaler = self.refine.upscaler if self.refine is not None else None
+        return ("img2img" if self.is_img2img else "txt2img", request.width, request.height,
+                request.steps, request.cfg_scale, strength, upscaler)
+
+
+def load_reference_image(item: GenerationItem) -> Image.Image:
+    """Décode et prépare l'image de référence d'un img2img"""
+    request = item.request
+    try:
+        # Décoder l'image de référence (fichier uploadé ou base64)
+        logger.info("Decoding reference image...")
+        ref_image = open_input_image(request.reference_image, item.reference_file)
+        logger.info(f"Reference image decoded - mode: {ref_image.mode}, size: {ref_image.size}")
+
+        # IMPORTANT: Convertir en RGB pour éviter les problèmes avec les PNG (canal alpha)
+        if ref_image.mode != "RGB":
+            logger.info(f"Converting image from {ref_image.mode} to RGB")
+            ref_image = ref_image.convert("RGB")
+            logger.info("Conversion to RGB successful")
+
+        # Redimensionner à la taille demandée
+        logger.info(f"Resizing image to {request.width}x{request.height}")
+        ref_image = ref_image.resize((request.width, request.height))
+        logger.info("Resize successful")
+        return ref_image
+
+    except Exception as e:
+        logger.error(f"❌ Error processing reference image: {e}")
+        raise HTTPException(status_code=400, detail=f"Invalid reference image: {str(e)}")
+
+
+def esrgan_enlarge(images: List[Image.Image], width: int, height: int, check_cancelled) -> List[Image.Image]:
+    """Agrandit des images à width x height: Real-ESRGAN general (x4), puis Lanczos jusqu'à la taille exacte"""
+    with model_registry.pinned(esrgan_model_name("general")), cpu_backend.inference(esrgan_model_name("general")):
+        esrgan = load_esrgan("general")
+        if esrgan is None:
+            raise HTTPException(status_code=503, detail="Real-ESRGAN (general) not available")
+        start_time = time.monotonic()
+        outputs = upscale_arrays(
+            esrgan.model, [np.array(image) for image in images], esrgan.scale, device, esrgan.half,
+            [esrgan_tile_plan(image.width, image.height, esrgan.half) for image in images],
+            available_bytes=available_memory_bytes(device), max_batch=ESRGAN_TILE_BATCH,
+            check_cancelled=[check_cancelled] * len(images)
+        )
+        enlarged = [None] * len(images)
+        for index, output_np in outputs:
+            if isinstance(output_np, BaseException):
+                raise output_np
+            enlarged[index] = Image.fromarray(output_np, mode="RGB").resize((width, height), Image.LANCZOS)
+        ESRGAN_SECONDS.observe(time.monotonic() - start_time, model="general")
+    return enlarged
+
+
+def refine_references(batch: List["GenerationItem"], check_cancelled) -> list:
+    """
+    Entrées img2img d'un lot de refines, à la taille demandée: latents du brouillon interpolés
+    (passés tels quels au pipeline, sans VAE encode), ou image du brouillon upscalée par Real-ESRGAN
+    """
+    request = batch[0].request
+    if batch[0].refine.upscaler == "esrgan":
+        return esrgan_enlarge([item.refine.image for item in batch], request.width, request.height, check_cancelled)
+    references = []
+    for item in batch:
+        source = item.refine
+        latents = torch.from_numpy(source.latents).to(device, torch.float32)
+        # Facteur pixels / latents lu sur le brouillon (8 pour SDXL)
+        scale = source.image.height // latents.shape[-2]
+        size = (request.height // scale, request.width // scale)
+        references.append(torch.nn.functional.interpolate(latents, size=size, mode="bicubic", align_corners=False))
+    return references
+
+
+def encode_text(pipeline, text: str) -> tuple:
+    """Embeddings (séquence, pooled) d'un texte, calculés par les deux encodeurs SDXL"""
+    with TEXT_ENCODE_SECONDS.time(), torch.inference_mode():
+        embeds, _, pooled, _ = pipeline.encode_prompt(
+            prompt=text, device=device, num_images_per_prompt=1, do_classifier_free_guidance=False
+        )
+    # Gardés en RAM CPU: le cache ne consomme pas le budget du device et survit au déchargement de SDXL
+    return embeds.cpu(), pooled.cpu()
+
+
+def cached_text_embedding(pipeline, text: str) -> tuple:
+    return prompt_cache.get_or_compute(PROMPT_ENCODER_ID, text, lambda: encode_text(pipeline, text))
+
+
+def prompt_embedding_args(pipeline, prompts: List[str], negative_prompts: List[Optional[str]]) -> dict:
+    """
+    Arguments prompt_embeds/pooled_prompt_embeds (et négatifs) pour un lot, une entrée par image
+    Chaque texte distinct n'est encodé qu'une fois, puis servi par prompt_cache
+    """
+    positives = [cached_text_embedding(pipeline, prompt) for prompt in prompts]
+    negatives = []
+    for negative_prompt, (embeds, pooled) in zip(negative_prompts, positives):
+        if not negative_prompt and pipeline.config.force_zeros_for_empty_prompt:
+            # Même convention que diffusers: negative prompt vide = embeddings nuls
+            negatives.append((torch.zeros_like(embeds), torch.zeros_like(pooled)))
+        else:
+            negatives.append(cached_text_embedding(pipeline, negative_prompt or ""))
+
+    def stack(pairs, index):
+        return torch.cat([pair[index] for pair in pairs]).to(device, non_blocking=True)
+
+    return {
+        "prompt_embeds": stack(positives, 0),
+        "pooled_prompt_embeds": stack(positives, 1),
+        "negative_prompt_embeds": stack(negatives, 0),
+        "negative_pooled_prompt_embeds": stack(negatives, 1),
+    }
+
+
+def latents_to_preview(latents: torch.Tensor) -> str:
+    """Aperçu JPEG (base64) d'un latent 4 x h/8 x w/8, à la résolution du latent"""
+    factors = torch.tensor(SDXL_LATENT_RGB_FACTORS, dtype=latents.dtype, device=latents.device)
+    bias = torch.tensor(SDXL_LATENT_RGB_BIAS, dtype=latents.dtype, device=latents.device)
+    rgb = torch.einsum("chw,cr->hwr", latents, factors) + bias
+    rgb = ((rgb + 1) / 2).clamp(0, 1).mul(255).to(torch.uint8).cpu().numpy()
+    buffer = io.BytesIO()
+    Image.fromarray(rgb).save(buffer, format="JPEG", quality=70)
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+def publish_generation_progress(batch: List["GenerationItem"], step: int, total_steps: int, latents: torch.Tensor):
+    """Avancement de chaque job du lot; aperçus toutes les PREVIEW_EVERY_STEPS steps pour les jobs écoutés"""
+    want_preview = PREVIEW_EVERY_STEPS > 0 and step % PREVIEW_EVERY_STEPS == 0 and step < total_steps
+    offset = 0
+    for item in batch:
+        job_id = item.token.job_id
+        count = len(item.seeds)
+        progress_hub.publish(job_id, EVENT_PROGRESS, {"step": step, "total_steps": total_steps})
+        if want_preview and progress_hub.has_subscribers(job_id):
+            previews = [latents_to_preview(latent) for latent in latents[offset:offset + count]]
+            progress_hub.publish(job_id, EVENT_PREVIEW, {"step": step, "format": "jpeg", "images": previews})
+        offset += count
+
+
+def run_generation_batch(items: List[GenerationItem]) -> list:
+    """
+    Exécute une ou plusieurs générations compatibles (même batch_key) en un seul appel au pipeline
+    Bloquant: ne jamais appeler depuis la boucle asyncio
+
+    Returns:
+        Pour chaque item, ([Image PIL], info) ou l'exception propre à ce job (encodage: finish_job)
+    """
+    outcomes = [None] * len(items)
+    active = []
+    references = []
+    for index, item in enumerate(items):
+        try:
+            # Le job a pu être annulé pendant qu'il attendait dans la file
+            item.token.raise_if_cancelled("while queued")
+            if item.is_img2img and item.refine is None:
+                references.append(load_reference_image(item))
+        except (InterruptedError, HTTPException) as e:
+            outcomes[index] = e
+            continue
+        active.append(index)
+    if not active:
+        return outcomes
+
+    batch = [items[index] for index in active]
+    first = batch[0].request
+    is_img2img = batch[0].is_img2img
+    job_ids = ", ".join(item.token.job_id for item in batch)
+    total_images = sum(len(item.seeds) for item in batch)
+    logger.info(f"🎨 Generating {total_images} image(s) (job {job_ids}): '{first.prompt[:50]}...'")
+
+    for item in batch:
+        progress_hub.publish(item.token.job_id, EVENT_STARTED, {"batch_size": total_images})
+
+    # Callback à chaque step: durée du step, annulation (simple lecture des jetons; un lot ne
+    # s'arrête que si tous ses jobs sont annulés) puis progression et aperçus pour les clients abonnés
+    mode = "img2img" if is_img2img else "txt2img"
+    step_clock = [0.0]
+
+    def check_batch_cancelled(stage: str):
+        if all(item.token.is_cancelled() for item in batch):
+            logger.info(f"🛑 Generation cancelled {stage}")
+            raise InterruptedError(f"Job {job_ids} was cancelled")
+
+    def callback_on_step_end(pipe, step_index, timestep, callback_kwargs):
+        now = time.perf_counter()
+        DENOISE_STEP_SECONDS.observe(now - step_clock[0], mode=mode)
+        check_batch_cancelled(f"at step {step_index}")
+        publish_generation_progress(batch, step_index + 1, pipe.num_timesteps, callback_kwargs["latents"])
+        # Le temps de publication (aperçus compris) n'est pas compté dans le step suivant
+        step_clock[0] = time.perf_counter()
+        return callback_kwargs
+
+    # Un générateur par image: chaque requête garde ses seeds, qu'elle soit seule ou dans un lot
+    generators = [torch.Generator(device=device).manual_seed(seed) for item in batch for seed in item.seeds]
+
+    # Refine: le brouillon est agrandi avant d'épingler SDXL (Real-ESRGAN n'a pas à cohabiter avec lui)
+    refine_time = None
+    if batch[0].refine is not None:
+        start_time = time.monotonic()
+        references = refine_references(batch, lambda: check_batch_cancelled("during draft upscale"))
+        refine_time = time.monotonic() - start_time
+
+    # SDXL reste épinglé jusqu'au décodage: ni évincé ni compté inactif pendant la génération
+    with model_registry.pinned("sdxl"), cpu_backend.inference("sdxl"):
+        if is_img2img:
             logger.info("Using img2img mode with reference image")
             pipeline = load_img2img_pipeline()
+        else:
+            logger.info("Using txt2img mode")
+            pipeline = load_txt2img_pipeline()
 
-            try:
-                # Décoder l'image de référence
-                logger.info("Decoding reference image from base64...")
-                ref_image = base64_to_image(request.reference_image)
-                logger.info(f"Reference image decoded - mode: {ref_image.mode}, size: {ref_image.size}")
-
-                # IMPORTANT: Convertir en RGB pour éviter les problèmes avec les PNG (canal alpha)
-                if ref_image.mode != "RGB":
-                    logger.info(f"Converting image from {ref_image.mode} to RGB")
-                    ref_image = ref_image.convert("RGB")
-                    logger.info("Conversion to RGB successful")
-
-                # Redimensionner à la taille demandée
-                logger.info(f"Resizing image to {request.width}x{request.height}")
-                ref_image = ref_image.resize((request.width, request.height))
-                logger.info("Resize successful")
-
-            except Exception as e:
-                logger.error(f"❌ Error processing reference image: {e}")
-                raise HTTPException(status_code=400, detail=f"Invalid reference image: {str(e)}")
+        # Embeddings pris dans le cache quand le prompt (ou le negative prompt) a déjà été encodé
+        start_time = time.monotonic()
+        prompt_args = prompt_embedding_args(
+            pipeline,
+            [item.request.prompt for item in batch for _ in item.seeds],
+            [item.request.negative_prompt for item in batch for _ in item.seeds]
+        )
+        logger.info(f"Prompt embeddings ready in {time.monotonic() - start_time:.2f}s")
 
-            # Générer avec img2img
+        start_time = time.monotonic()
+        step_clock[0] = time.perf_counter()
+        if device == "cuda":
+            # Pic des activations du débruitage (calibration du modèle de coût)
+            memory_baseline = torch.cuda.memory_allocated()
+            torch.cuda.reset_peak_memory_stats()
+        if is_img2img:
+            # Générer avec img2img (une image de référence par image produite)
             logger.info("Starting img2img generation...")
             with torch.inference_mode():
                 result = pipeline(
-                    prompt=request.prompt,
-                    negative_prompt=request.negative_prompt,
-                    image=ref_image,
-                    strength=request.strength,
-                    num_inference_steps=request.steps,
-                    guidance_scale=request.cfg_scale,
-                    generator=generator,
-                    callback_on_step_end=callback_on_step_end
+                    **prompt_args,
+                    image=[reference for item, reference in zip(batch, references) for _ in item.seeds],
+                    strength=first.strength,
+                    num_inference_steps=first.steps,
+                    guidance_scale=first.cfg_scale,
+                    generator=generators,
+                    callback_on_step_end=callback_on_step_end,
+                    output_type="latent"  # Décodage VAE: étape séparée (decode_generated_latents)
                 )
             logger.info("img2img generation completed")
         else:
-            # Mode txt2img classique
-            logger.info("Using txt2img mode")
-            pipeline = load_txt2img_pipeline()
-
-            # Générer l'image
-            logger.info(f"Generating with params - width:{request.width}, height:{request.height}, steps:{request.steps}, cfg:{request.cfg_scale}")
+            # Mode txt2img classique: générer l'image
+            logger.info(f"Generating with params - width:{first.width}, height:{first.height}, steps:{first.steps}, cfg:{first.cfg_scale}")
             with torch.inference_mode():
                 result = pipeline(
-                    prompt=request.prompt,
-                    negative_prompt=request.negative_prompt,
-                    width=request.width,
-                    height=request.height,
-                    num_inference_steps=request.steps,
-                    guidance_scale=request.cfg_scale,
-                    generator=generator,
-                    callback_on_step_end=callback_on_step_end
+                    **prompt_args,
+                    width=first.width,
+                    height=first.height,
+                    num_inference_steps=first.steps,
+                    guidance_scale=first.cfg_scale,
+                    generator=generators,
+                    callback_on_step_end=callback_on_step_end,
+                    output_type="latent"  # Décodage VAE: étape séparée (decode_generated_latents)
                 )
             logger.info("txt2img generation completed")
+        denoise_peak_mb = None
+        if device == "cuda":
+            denoise_peak_mb = round((torch.cuda.max_memory_allocated() - memory_baseline) / 1024 ** 2, 1)
+        # Décodage VAE (en tranches ou en tuiles d'après la résolution et la mémoire libre), puis
+        # tenseurs validés et convertis en une passe par tensors_to_images
+        latents = result.images
+        decoded, decode_info = decode_generated_latents(
+            pipeline, latents, check_cancelled=lambda: check_batch_cancelled("during VAE decode")
+        )
+        images, image_flags = tensors_to_images(decoded)
+    generation_time = time.monotonic() - start_time
+    # Après le dernier step: décodage VAE et conversion en PIL
+    VAE_DECODE_SECONDS.observe(time.perf_counter() - step_clock[0], mode=mode)
+
+    logger.info(f"Pipeline returned {len(images)} image(s) in {generation_time:.1f}s")
+
+    # Redistribuer les images à chaque job, encodées dans son format négocié
+    offset = 0
+    for index, item in zip(active, batch):
+        count = len(item.seeds)
+        generated_images = images[offset:offset + count]
+        flags = image_flags[offset:offset + count]
+        item_latents = latents[offset:offset + count]
+        offset += count
+        if item.token.is_cancelled():
+            outcomes[index] = InterruptedError(f"Job {item.token.job_id} was cancelled")
+            continue
+        info = {
+            "width": generated_images[0].width,
+            "height": generated_images[0].height,
+            "steps": item.request.steps,
+            "seed": item.seeds[0] if item.request.seed != -1 or item.request.seeds else "random",
+            "seeds": item.seeds,
+            "num_images": count,
+            "batch_size": total_images,
+            "mode": "img2img" if is_img2img else "txt2img",
+            "nan_values": any(image["nan_values"] for image in flags),
+            "black_image": any(image["black_image"] for image in flags),
+            "vae_decode": decode_info,
+            "denoise_steps": pipeline.num_timesteps,
+            "generation_time_s": round(generation_time, 2),  # Lot entier, décodage compris
+            "denoise_peak_memory_mb": denoise_peak_mb
+        }
+        if item.request.draft:
+            # Latents gardés par keep_draft (retirés de l'info avant la réponse)
+            info["draft_latents"] = item_latents.float().cpu().numpy()
+        if item.refine is not None:
+            info["refine"] = {
+                "draft_id": item.refine.draft_id,
+                "image_index": item.refine.image_index,
+                "upscaler": item.refine.upscaler,
+                "strength": item.request.strength,
+                "upscale_time_s": round(refine_time, 2)
+            }
+        outcomes[index] = (generated_images, info)
 
-        # Vérifier le résultat
-        logger.info(f"Pipeline returned {len(result.images)} image(s)")
-        generated_image = result.images[0]
-        logger.info(f"Generated image - mode: {generated_image.mode}, size: {generated_image.size}")
+    logger.info(f"✅ {total_images} image(s) generated successfully")
+    return outcomes
 
-        # Convertir en base64
-        image_base64 = image_to_base64(generated_image)
 
-        logger.info(f"✅ Image generated successfully")
+def worker_generation_batch(requests: list) -> list:
+    """Processus worker: run_generation_batch sur des (job_id, requête, image de référence, seeds, brouillon)"""
+    items = [GenerationItem(cancellation.get(job_id), request, io.BytesIO(reference) if reference is not None else None,
+                            seeds, refine)
+             for job_id, request, reference, seeds, refine in requests]
+    return portable_outcomes(run_generation_batch(items))
 
-        # Nettoyer le job de la liste active et les fichiers de flag
-        if job_id in active_jobs:
-            del active_jobs[job_id]
 
-        # Nettoyer le fichier de flag spécifique
-        cancel_flag_file = CANCEL_FLAGS_DIR / f"{job_id}.cancel"
-        if cancel_flag_file.exists():
-            cancel_flag_file.unlink()
+def dispatch_generation_batch(items: List[GenerationItem]) -> list:
+    """Batcher des générations: exécuté ici, ou sur le processus worker de la voie (mode coordinateur)"""
+    if not worker_processes:
+        return run_generation_batch(items)
+    requests = [(item.token.job_id, item.request, read_upload_bytes(item.reference_file), item.seeds, item.refine)
+                for item in items]
+    outcomes = run_on_lane("generate_batch", requests, jobs=tuple(remote_job(item.token, "generate") for item in items))
+    return rebuild_outcomes(outcomes)
 
-        # Nettoyer le flag global si plus de jobs actifs
-        if not any(j.get("type") == "generate" for j in active_jobs.values()):
-            cancel_all_file = CANCEL_FLAGS_DIR / "cancel_all_generate.flag"
-            if cancel_all_file.exists():
-                cancel_all_file.unlink()
 
-        return {
-            "success": True,
-            "image": image_base64,
-            "job_id": job_id,
-            "info": {
-                "width": result.images[0].width,
-                "height": result.images[0].height,
-                "steps": request.steps,
-                "seed": request.seed if request.seed != -1 else "random",
-                "mode": "img2img" if request.reference_image else "txt2img"
-            }
-        }
+def run_generation(item: GenerationItem):
+    """Exécute une génération seule (job non regroupé)"""
+    outcome = dispatch_generation_batch([item])[0]
+    if isinstance(outcome, BaseException):
+        raise outcome
+    return outcome
 
-    except InterruptedError as e:
-        # Job annulé
-        logger.info(f"🛑 Job {job_id} was cancelled")
-        if job_id in active_jobs:
-            del active_jobs[job_id]
-        cleanup_cancel_flags()
-        raise HTTPException(status_code=499, detail=f"Generation cancelled: {str(e)}")
+
+inference_worker.register_batcher("generate", dispatch_generation_batch, MAX_BATCH_IMAGES)
+
+
+async def submit_generate(http_request: Request, job_id: str, image_format: str) -> asyncio.Future:
+    """
+    Lit et valide une requête de génération puis la place dans la file du worker
+    Retourne un future résolu avec (images, info): tâche finish_job, ou résultat déjà
+    calculé si la requête est servie depuis le cache disque
+    """
+    request, upload = await read_image_request(http_request, GenerateRequest, "reference_image")
+    reference_file = upload.file if upload is not None else None
+
+    try:
+        num_images = len(request.seeds) if request.seeds else request.num_images
+        if not 1 <= num_images <= MAX_BATCH_IMAGES:
+            raise HTTPException(status_code=400,
+                                detail=f"num_images must be between 1 and {MAX_BATCH_IMAGES} (got {num_images})")
+        encoding = request_encoding(request, image_format)
+    except HTTPException:
+        if upload is not None:
+            upload.close()
+        raise
+    seeds = request.image_seeds()
+    requested = request
+    if request.draft:
+        request = draft_request(request)
+
+    # Seeds fixés: résultat entièrement déterminé par la requête, on tente le cache disque
+    # (sauf brouillon: ses latents doivent être gardés pour /refine)
+    cache_key, cached = None, None
+    if result_cache.enabled and not request.draft and (request.seed != -1 or request.seeds):
+        cache_key, cached = await lookup_result_cache(
+            generation_cache_key, request, seeds, encoding, reference_file
+        )
+    if cached is not None:
+        if upload is not None:
+            upload.close()
+        return cached_result(job_id, cached)
+
+    # Coût prédit avant de toucher au modèle: refus, réduction ou report si le budget est dépassé
+    try:
+        admitted, admission = admit_generation(request, len(seeds), reference_file is not None
+                                               or bool(request.reference_image))
+    except HTTPException:
+        if upload is not None:
+            upload.close()
+        raise
+    if admitted is not request:
+        request, cache_key = admitted, None  # Résultat réduit: pas celui que la requête désigne
+
+    keep_alive_policy.record_request("sdxl")
+    return enqueue_generation(job_id, request, reference_file, seeds, encoding, cache_key, upload, admission,
+                              draft_of=requested if request.draft else None)
+
+
+def enqueue_generation(job_id: str, request: GenerateRequest, reference_file: Optional[BinaryIO], seeds: List[int],
+                       encoding: OutputEncoding, cache_key: Optional[str], upload, admission: Admission,
+                       refine: Optional[RefineSource] = None,
+                       draft_of: Optional[GenerateRequest] = None) -> asyncio.Future:
+    """
+    Place une génération admise dans la file du worker (regroupable avec les générations compatibles)
+    draft_of: requête d'origine d'un brouillon, dont les latents sont gardés pour /refine
+    """
+    # Jeton d'annulation et canal de progression de cette génération
+    token = cancellation.register(job_id, "generate")
+    progress_hub.open(job_id, "generate")
+    item = GenerationItem(token, request, reference_file, seeds, refine)
+
+    try:
+        future = inference_worker.submit(
+            job_id, "generate",
+            lambda: run_generation(item),
+            priority=admission.priority,
+            batch_key=item.batch_key(), batch_item=item, batch_weight=len(seeds), model="sdxl",
+            cost_s=admission.queue_cost_s
+        )
+    except QueueFullError as e:
+        cancellation.release(job_id)
+        progress_hub.close(job_id, EVENT_ERROR, {"detail": str(e)})
+        if upload is not None:
+            upload.close()
+        raise queue_full_exception(e)
+    publish_queued(job_id)
+    if draft_of is not None:
+        future = asyncio.ensure_future(keep_draft(job_id, draft_of, seeds, future))
+    return asyncio.ensure_future(finish_job(job_id, "generate", future, encoding, cache_key, upload, admission))
+
+
+def draft_request(request: GenerateRequest) -> GenerateRequest:
+    """
+    Paramètres d'un brouillon: taille réduite de DRAFT_SCALE (même facteur pour les deux côtés, petit côté
+    d'au moins DRAFT_MIN_SIDE, multiples de 64) et au plus DRAFT_STEPS steps
+    """
+    factor = min(1.0, max(DRAFT_SCALE, DRAFT_MIN_SIDE / min(request.width, request.height)))
+
+    def side(value: int) -> int:
+        return value if factor == 1.0 else max(SIZE_ALIGN, round(value * factor / SIZE_ALIGN) * SIZE_ALIGN)
+
+    return request.model_copy(update={
+        "width": side(request.width), "height": side(request.height), "steps": min(request.steps, DRAFT_STEPS)
+    })
+
+
+async def keep_draft(job_id: str, requested: GenerateRequest, seeds: List[int], future: asyncio.Future) -> tuple:
+    """Garde les latents et les images d'un brouillon terminé; info.draft indique comment le reprendre"""
+    images, info = await future
+    latents = info.pop("draft_latents")
+    draft_store.put(job_id, Draft(latents, images, seeds, requested))
+    info["draft"] = {
+        "draft_id": job_id,
+        "requested": {"width": requested.width, "height": requested.height, "steps": requested.steps},
+        "expires_in_s": DRAFT_TTL_S
+    }
+    return images, info
+
+
+@app.post("/generate")
+async def generate_image(http_request: Request):
+    """
+    Génère une image avec Stable Diffusion (txt2img ou img2img)
+    Le calcul tourne sur le worker d'inférence, la boucle reste disponible pendant ce temps
+    Corps: JSON (GenerateRequest), ou multipart/form-data avec l'image de référence
+    en partie fichier "reference_image"
+    num_images (ou une liste seeds) produit plusieurs variations en un seul appel; les requêtes
+    compatibles qui attendent dans la file sont regroupées dans le même appel au pipeline
+    Avec des seeds fixés, le résultat est mis en cache sur disque et resservi sans GPU
+    Réponse selon Accept: image/png ou image/webp brut, multipart/mixed, ou JSON base64 (défaut)
+    Pour ne pas garder la connexion ouverte pendant le calcul: POST /jobs?type=generate
+    """
+    job_id = requested_job_id(http_request)
+    response_format = negotiate_response_format(http_request.headers.get("accept"))
+    job = await submit_generate(http_request, job_id, response_format.image_format)
+    try:
+        images, info = await job
+    except Exception as e:
+        raise job_http_exception(job_id, "generate", e)
+    return image_response(job_id, images, info, response_format)
+
+
+async def submit_refine(http_request: Request, job_id: str, image_format: str) -> asyncio.Future:
+    """
+    Lit une requête de refine et place dans la file un img2img qui reprend le brouillon à la taille demandée
+    Même seed que l'image du brouillon: la composition est conservée, les détails sont recalculés
+    """
+    body = await read_limited_body(http_request, MAX_UPLOAD_BYTES)
+    try:
+        request = RefineRequest.model_validate_json(body)
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+
+    draft = draft_store.get(request.draft_id)
+    if draft is None:
+        raise HTTPException(status_code=404, detail=f"Draft {request.draft_id} not found or expired")
+    if not 0 <= request.image_index < len(draft.seeds):
+        raise HTTPException(status_code=400, detail=f"image_index must be between 0 and {len(draft.seeds) - 1}")
+    upscaler = request.upscaler or REFINE_UPSCALER
+    if upscaler not in REFINE_UPSCALERS:
+        raise HTTPException(status_code=400,
+                            detail=f"Unknown upscaler: {upscaler} (expected {' or '.join(REFINE_UPSCALERS)})")
+    strength = request.strength if request.strength is not None else REFINE_STRENGTH[upscaler]
+    if not 0 < strength <= 1:
+        raise HTTPException(status_code=400, detail=f"strength must be in ]0, 1] (got {strength})")
+
+    # Génération img2img équivalente: prompt et cfg du brouillon, seed de l'image reprise
+    index = request.image_index
+    original = draft.request
+    generate = original.model_copy(update={
+        "width": request.width or original.width,
+        "height": request.height or original.height,
+        "steps": request.steps or original.steps,
+        "strength": strength,
+        "seeds": [draft.seeds[index]],
+        "num_images": 1,
+        "reference_image": None,
+        "draft": False,
+        **{name: getattr(request, name)
+           for name in ("output_format", "quality", "lossless", "png_compress_level", "over_budget")}
+    })
+    encoding = request_encoding(generate, image_format)
+    generate, admission = admit_generation(generate, 1, True)
+
+    keep_alive_policy.record_request("sdxl")
+    if upscaler == "esrgan":
+        keep_alive_policy.record_request(esrgan_model_name("general"))
+    source = RefineSource(request.draft_id, index, draft.latents[index:index + 1], draft.images[index], upscaler)
+    logger.info(f"🖌️ Refining draft {request.draft_id} (image {index}) to {generate.width}x{generate.height} "
+                f"with {upscaler} upscale, strength {strength}")
+    return enqueue_generation(job_id, generate, None, generate.seeds, encoding, None, None, admission, refine=source)
+
+
+@app.post("/refine")
+async def refine_draft(http_request: Request):
+    """
+    Reprend une image d'un brouillon (/generate avec draft=true) à la taille demandée
+    Le brouillon est agrandi (latents interpolés, ou image upscalée par Real-ESRGAN) puis passe dans
+    img2img avec son seed: strength x steps steps de débruitage au lieu d'un rendu complet
+    Corps: JSON (RefineRequest); réponse négociée comme /generate
+    """
+    job_id = requested_job_id(http_request)
+    response_format = negotiate_response_format(http_request.headers.get("accept"))
+    job = await submit_refine(http_request, job_id, response_format.image_format)
+    try:
+        images, info = await job
     except Exception as e:
-        logger.error(f"❌ Error generating image: {e}")
-        if job_id in active_jobs:
-            del active_jobs[job_id]
-        cleanup_cancel_flags()
-        raise HTTPException(status_code=500, detail=str(e))
+        raise job_http_exception(job_id, "generate", e)
+    return image_response(job_id, images, info, response_format)
 
 
 @app.post("/cancel/{job_id}")
 async def cancel_generation(job_id: str):
     """
-    Annule une génération en cours
+    Annule un job en cours ou encore en attente dans la file
+    (ou toutes les images d'un lot /upscale/batch)
     """
-    if cancel_job(job_id):
+    if cancellation.cancel(job_id):
         return {"success": True, "message": f"Job {job_id} cancelled"}
-    else:
-        raise HTTPException(status_code=404, detail=f"Job {job_id} not found or already completed")
+    if job_id in upscale_batches:
+        batch = upscale_batches[job_id]
+        batch.cancelled = True
+        cancelled_count = sum(cancellation.cancel(image_job_id) for image_job_id in batch.job_ids)
+        return {"success": True, "message": f"Batch {job_id} cancelled", "cancelled_count": cancelled_count}
+    if cancel_flags_backend is not None and cancel_flags_backend.broadcast:
+        # Le job tourne peut-être dans un autre worker: l'annulation lui a été diffusée
+        return JSONResponse(status_code=202, content={
+            "success": True, "message": f"Job {job_id} not found here, cancel broadcast to other workers"
+        })
+    raise HTTPException(status_code=404, detail=f"Job {job_id} not found or already completed")
 
 
 @app.post("/cancel-all/{job_type}")
 async def cancel_all_jobs(job_type: str):
     """
-    Annule tous les jobs d'un certain type via fichiers de flag
+    Annule tous les jobs d'un certain type ("all" pour tous), en cours ou en attente
     """
     logger.info(f"🛑 Received cancel-all request for type: {job_type}")
-    logger.info(f"🛑 Active jobs before cancel: {list(active_jobs.keys())}")
-
-    # Utiliser le système de fichiers de flag
-    cancelled_count = cancel_all_jobs_of_type(job_type)
 
-    logger.info(f"🛑 Cancelled {cancelled_count} job(s) via flag files")
+    cancelled_count = cancellation.cancel_type(job_type)
 
-    return {"success": True, "cancelled_count": cancelled_count, "method": "flag_file"}
+    return {"success": True, "cancelled_count": cancelled_count, "method": "token"}
 
 
 @app.get("/jobs")
 async def list_active_jobs():
     """
-    Liste les jobs actifs
+    Liste les jobs actifs (en cours et en attente dans la file)
     """
+    jobs = cancellation.active_jobs()
+    running = [job.job_id for job in inference_worker.current_batch]
     return {
-        "active_jobs": list(active_jobs.keys()),
-        "count": len(active_jobs)
+        "active_jobs": list(jobs.keys()),
+        "count": len(jobs),
+        "running": running[0] if running else None,
+        "running_jobs": running,  # Tous les jobs en cours (lot, ou un par processus worker)
+        "queued": inference_worker.pending_jobs()
     }
 
 
-@app.post("/upscale")
-async def upscale_image(request: UpscaleRequest):
+def esrgan_tile_plan(width: int, height: int, half: bool) -> Optional[TilePlan]:
+    """Découpage à utiliser pour une image d'entrée, selon IMAGE_API_ESRGAN_TILE"""
+    return plan_tiles(
+        width, height, available_memory_bytes(device), half,
+        overlap=ESRGAN_TILE_OVERLAP, max_batch=ESRGAN_TILE_BATCH,
+        untiled_max_pixels=ESRGAN_UNTILED_MAX_PIXELS,
+        tile=None if ESRGAN_TILE == "auto" else int(ESRGAN_TILE)
+    )
+
+
+@dataclass
+class UpscaleItem:
+    """Un upscale tel que l'exécute le worker (seul ou dans un lot d'images du même modèle)"""
+    token: CancellationToken
+    request: UpscaleRequest
+    image_file: Optional[BinaryIO] = None
+    input_size: Optional[Tuple[int, int]] = None  # Image réduite à cette taille avant l'upscale (admission)
+
+
+def load_upscale_input(item: UpscaleItem) -> Image.Image:
+    """Décode l'image à upscaler (fichier uploadé ou base64) en RGB"""
+    input_image = open_input_image(item.request.image, item.image_file)
+    if input_image.mode != 'RGB':
+        logger.info(f"Converting image from {input_image.mode} to RGB")
+        input_image = input_image.convert('RGB')
+    if item.input_size is not None and input_image.size != tuple(item.input_size):
+        input_image = input_image.resize(item.input_size, Image.LANCZOS)
+    return input_image
+
+
+def run_upscale_batch(items: List[UpscaleItem]) -> Iterator[tuple]:
     """
-    Upscale une image avec Real-ESRGAN (general ou anime)
-    Retourne directement le résultat (comme /generate)
+    Exécute des upscales Real-ESRGAN du même modèle sur le thread worker
+    Les tuiles (ou images entières) de même taille des différentes images partagent les
+    passes du réseau; chaque image est produite dès qu'elle est terminée
+    Bloquant: ne jamais appeler depuis la boucle asyncio
+
+    Yields:
+        (index de l'item, (images, info) ou exception propre à cet item)
     """
-    # Mettre à jour le timestamp d'utilisation
-    update_last_usage()
+    model_type = items[0].request.model
+    logger.info(f"🔍 Upscaling {len(items)} image(s) ({', '.join(item.token.job_id for item in items)}) "
+                f"with Real-ESRGAN {model_type}")
 
-    # Créer un job ID pour cet upscaling
-    job_id = create_job_id()
-    active_jobs[job_id] = {"cancelled": False, "type": "upscale"}
+    # Une image illisible ne fait échouer que son job
+    inputs = {}
+    for index, item in enumerate(items):
+        try:
+            inputs[index] = load_upscale_input(item)
+        except Exception as e:
+            yield index, e
+    if not inputs:
+        return
+
+    # Upscale avec Real-ESRGAN (modèle sélectionné: general ou anime), épinglé pendant l'usage
+    with model_registry.pinned(esrgan_model_name(model_type)), cpu_backend.inference(esrgan_model_name(model_type)):
+        logger.info(f"Loading ESRGAN {model_type} model...")
+        esrgan = load_esrgan(model_type)
+        if esrgan is None:
+            raise HTTPException(status_code=503, detail=f"Real-ESRGAN ({model_type}) not available")
 
-    try:
-        logger.info(f"🔍 Upscaling image (job {job_id}) with Real-ESRGAN {request.model}")
+        # Vérifier si annulé avant de commencer (le chargement du modèle a pu prendre du temps)
+        started = []
+        for index in inputs:
+            try:
+                items[index].token.raise_if_cancelled("before ESRGAN processing")
+            except InterruptedError as e:
+                yield index, e
+                continue
+            progress_hub.publish(items[index].token.job_id, EVENT_STARTED)
+            started.append(index)
+
+        plans = []
+        for index in started:
+            input_image = inputs[index]
+            plan = esrgan_tile_plan(input_image.width, input_image.height, esrgan.half)
+            if plan is not None:
+                logger.info(f"🧩 Tiled upscale ({items[index].token.job_id}): {plan.tile}px tiles, "
+                            f"overlap {plan.overlap}px, batch {plan.batch_size}")
+            plans.append(plan)
+
+        start_time = time.monotonic()
+        outputs = upscale_arrays(
+            esrgan.model, [np.array(inputs[index]) for index in started], esrgan.scale, device, esrgan.half, plans,
+            available_bytes=available_memory_bytes(device), max_batch=ESRGAN_TILE_BATCH,
+            check_cancelled=[
+                lambda token=items[index].token: token.raise_if_cancelled("during ESRGAN processing")
+                for index in started
+            ]
+        )
+        for position, output_np in outputs:
+            index = started[position]
+            if isinstance(output_np, BaseException):
+                yield index, output_np
+                continue
+            # Avec un lot, le temps court depuis le début du lot (latence vue par le job)
+            upscale_time = time.monotonic() - start_time
+            ESRGAN_SECONDS.observe(upscale_time, model="anime" if model_type == "anime" else "general")
+            logger.info(f"ESRGAN upscale completed in {upscale_time:.1f}s, output shape: {output_np.shape}")
+            yield index, finish_upscale(items[index].request, inputs[index], output_np, esrgan.scale,
+                                        plans[position], upscale_time, len(started))
+
+
+def finish_upscale(request: UpscaleRequest, input_image: Image.Image, output_np: np.ndarray, native_scale: int,
+                   plan: Optional[TilePlan], upscale_time: float, batch_size: int):
+    """Image upscalée au facteur demandé, et son info"""
+    output_image = Image.fromarray(output_np, mode='RGB')
+    if request.scale != native_scale:
+        # Le modèle est x4: on redimensionne pour les autres facteurs (comme RealESRGANer)
+        output_image = output_image.resize(
+            (input_image.width * request.scale, input_image.height * request.scale), Image.LANCZOS
+        )
+
+    logger.info("✅ Image upscaled successfully")
+
+    info = {
+        "method": f"esrgan-x4plus-{request.model}",
+        "model": request.model,
+        "scale": request.scale,
+        "original_size": f"{input_image.width}x{input_image.height}",
+        "output_size": f"{output_image.width}x{output_image.height}",
+        "tiling": plan.as_dict() if plan is not None else None,
+        "batch_size": batch_size,
+        "upscale_time_s": round(upscale_time, 2)
+    }
+    return [output_image], info
 
-        # Décoder l'image
-        input_image = base64_to_image(request.image)
 
-        # Convertir en RGB si nécessaire
-        if input_image.mode != 'RGB':
-            logger.info(f"Converting image from {input_image.mode} to RGB")
-            input_image = input_image.convert('RGB')
+def worker_upscale_batch(requests: list) -> list:
+    """Processus worker: run_upscale_batch sur des (job_id, requête, image uploadée en octets, taille d'entrée)"""
+    items = [UpscaleItem(cancellation.get(job_id), request, io.BytesIO(image) if image is not None else None,
+                         input_size)
+             for job_id, request, image, input_size in requests]
+    outcomes = [None] * len(items)
+    for index, outcome in run_upscale_batch(items):
+        outcomes[index] = outcome
+    return portable_outcomes(outcomes)
 
-        # Upscale avec Real-ESRGAN (modèle sélectionné: general ou anime)
-        logger.info(f"Loading ESRGAN {request.model} model...")
-        esrgan = load_esrgan(request.model)
-        if esrgan is None:
-            raise HTTPException(status_code=503, detail=f"Real-ESRGAN ({request.model}) not available")
 
-        logger.info(f"Starting ESRGAN upscale (x{request.scale})...")
-        import numpy as np
+def dispatch_upscale_batch(items: List[UpscaleItem]):
+    """
+    Batcher des upscales: exécuté ici (résultats produits au fil de l'eau), ou sur le
+    processus worker de la voie (mode coordinateur: résultats du lot d'un coup)
+    """
+    if not worker_processes:
+        return run_upscale_batch(items)
+    requests = [(item.token.job_id, item.request, read_upload_bytes(item.image_file), item.input_size)
+                for item in items]
+    outcomes = run_on_lane("upscale_batch", requests, jobs=tuple(remote_job(item.token, "upscale") for item in items))
+    return rebuild_outcomes(outcomes)
+
+
+def run_upscale(item: UpscaleItem):
+    """Exécute un upscale seul (job non regroupé)"""
+    outcomes = dispatch_upscale_batch([item])
+    outcome = outcomes[0] if isinstance(outcomes, list) else dict(outcomes)[0]
+    if isinstance(outcome, BaseException):
+        raise outcome
+    return outcome
+
 
-        img_np = np.array(input_image)
-        logger.info(f"Input image shape: {img_np.shape}, dtype: {img_np.dtype}")
+inference_worker.register_batcher("upscale", dispatch_upscale_batch, UPSCALE_BATCH_IMAGES)
 
-        # Vérifier si annulé avant de commencer
-        if is_job_cancelled(job_id):
-            logger.info(f"Job {job_id} cancelled before ESRGAN processing")
-            raise HTTPException(status_code=499, detail=f"Job {job_id} was cancelled")
 
-        # Le traitement ESRGAN est bloquant, on doit l'exécuter dans un executor
-        loop = asyncio.get_event_loop()
-        output_np, _ = await loop.run_in_executor(
-            None,
-            lambda: esrgan.enhance(img_np, outscale=request.scale)
+async def enqueue_upscale(job_id: str, request: UpscaleRequest, image_file: Optional[BinaryIO],
+                          encoding: OutputEncoding, upload) -> asyncio.Future:
+    """
+    Place un upscale validé dans la file du worker (ou le sert depuis le cache disque)
+    Retourne un future résolu avec (images, info); upload est fermé à la fin du job
+
+    Raises:
+        QueueFullError: file pleine (upload reste ouvert, à fermer par l'appelant)
+        HTTPException: refus du contrôle d'admission (idem)
+    """
+    cache_key, cached = None, None
+    if result_cache.enabled:
+        cache_key, cached = await lookup_result_cache(upscale_cache_key, request, encoding, image_file)
+    if cached is not None:
+        if upload is not None:
+            upload.close()
+        return cached_result(job_id, cached)
+
+    # Coût prédit d'après la taille lue dans l'en-tête de l'image, avant de toucher au modèle
+    input_size, admission = admit_upscale(request, await asyncio.to_thread(input_image_size, request.image, image_file))
+    if input_size is not None:
+        cache_key = None  # Image réduite: pas le résultat que la requête désigne
+
+    model = esrgan_model_name(request.model)
+    token = cancellation.register(job_id, "upscale")
+    progress_hub.open(job_id, "upscale")
+    item = UpscaleItem(token, request, image_file, input_size)
+
+    try:
+        future = inference_worker.submit(
+            job_id, "upscale",
+            lambda: run_upscale(item),
+            priority=admission.priority,
+            batch_key=model, batch_item=item, model=model, cost_s=admission.queue_cost_s
         )
-        logger.info(f"ESRGAN upscale completed, output shape: {output_np.shape}")
+    except QueueFullError as e:
+        cancellation.release(job_id)
+        progress_hub.close(job_id, EVENT_ERROR, {"detail": str(e)})
+        raise
+    keep_alive_policy.record_request(model)
+    publish_queued(job_id)
+    return asyncio.ensure_future(finish_job(job_id, "upscale", future, encoding, cache_key, upload, admission))
 
-        # S'assurer que l'output est en uint8 pour une qualité optimale
-        if output_np.dtype != np.uint8:
-            output_np = np.clip(output_np, 0, 255).astype(np.uint8)
 
-        output_image = Image.fromarray(output_np, mode='RGB')
+async def submit_upscale(http_request: Request, job_id: str, image_format: str) -> asyncio.Future:
+    """
+    Lit et valide une requête d'upscale puis la place dans la file du worker
+    Retourne un future résolu avec (images, info), comme submit_generate
+    """
+    request, upload = await read_image_request(http_request, UpscaleRequest, "image")
+    image_file = upload.file if upload is not None else None
+    try:
+        if image_file is None and not request.image:
+            raise HTTPException(status_code=400, detail="No image provided")
+        # Défauts haute fidélité: WebP sans perte, PNG compressé rapidement
+        encoding = request_encoding(request, image_format, high_quality=True)
+    except HTTPException:
+        if upload is not None:
+            upload.close()
+        raise
+
+    try:
+        return await enqueue_upscale(job_id, request, image_file, encoding, upload)
+    except (QueueFullError, HTTPException) as e:
+        if upload is not None:
+            upload.close()
+        raise queue_full_exception(e) if isinstance(e, QueueFullError) else e
 
-        # Convertir en base64 avec haute qualité pour préserver les détails
-        output_base64 = image_to_base64(output_image, high_quality=True)
 
-        logger.info(f"✅ Image upscaled successfully (high quality PNG)")
+@app.post("/upscale")
+async def upscale_image(http_request: Request):
+    """
+    Upscale une image avec Real-ESRGAN (general ou anime)
+    Corps: JSON (UpscaleRequest avec l'image en base64), multipart/form-data (partie
+    fichier "image" + champs scale/model) ou image brute (scale/model en query string)
+    Retourne directement le résultat, négocié via Accept (comme /generate)
+    Un upscale déjà calculé (même image, modèle et facteur) est resservi depuis le cache disque
+    Plusieurs images: POST /upscale/batch
+    """
+    job_id = requested_job_id(http_request)
+    response_format = negotiate_response_format(http_request.headers.get("accept"))
+    job = await submit_upscale(http_request, job_id, response_format.image_format)
+    try:
+        images, info = await job
+    except Exception as e:
+        raise job_http_exception(job_id, "upscale", e)
+    return image_response(job_id, images, info, response_format)
 
-        # Nettoyer le job de la liste active
-        if job_id in active_jobs:
-            del active_jobs[job_id]
 
-        return {
-            "success": True,
-            "image": output_base64,
-            "job_id": job_id,
-            "info": {
-                "method": f"esrgan-x4plus-{request.model}",
-                "model": request.model,
-                "scale": request.scale,
-                "original_size": f"{input_image.width}x{input_image.height}",
-                "output_size": f"{output_image.width}x{output_image.height}"
-            }
-        }
+@dataclass
+class UpscaleBatch:
+    """Lot /upscale/batch en cours: IDs des jobs de ses images, annulables ensemble"""
+    job_ids: List[str]
+    cancelled: bool = False  # Plus aucune image n'est soumise
 
+
+upscale_batches: Dict[str, UpscaleBatch] = {}
+
+
+async def stream_upscale_batch(batch_id: str, sources: List[tuple], request: UpscaleBatchRequest,
+                               encoding: OutputEncoding, unsubmitted: Dict[str, Optional[BinaryIO]]):
+    """
+    Soumet les images d'un lot à la file du worker, au plus UPSCALE_BATCH_WINDOW à la fois,
+    et produit un BatchItemResult par image dans l'ordre où elles se terminent
+    unsubmitted: job_id -> fichier des images pas encore soumises (nettoyage en fin de réponse)
+    """
+    batch = upscale_batches[batch_id]
+    settings = request.model_dump(exclude={"images"})
+    running: Dict[asyncio.Future, tuple] = {}  # future -> (index, job_id)
+    next_index = 0
+    while next_index < len(sources) or running:
+        while next_index < len(sources) and len(running) < UPSCALE_BATCH_WINDOW:
+            image, image_file = sources[next_index]
+            job_id = batch.job_ids[next_index]
+            if batch.cancelled:
+                unsubmitted.pop(job_id, None)
+                if image_file is not None:
+                    image_file.close()
+                yield BatchItemResult(next_index, job_id, status_code=499, detail="Upscale cancelled: batch cancelled")
+                next_index += 1
+                continue
+            try:
+                future = await enqueue_upscale(job_id, UpscaleRequest(image=image, **settings), image_file,
+                                               encoding, image_file)
+            except (QueueFullError, HTTPException) as e:
+                if running and (isinstance(e, QueueFullError) or e.status_code == 429):
+                    break  # Une image du lot libérera une place (ou raccourcira l'attente prédite)
+                error = queue_full_exception(e) if isinstance(e, QueueFullError) else e
+                unsubmitted.pop(job_id, None)
+                if image_file is not None:
+                    image_file.close()
+                yield BatchItemResult(next_index, job_id, status_code=error.status_code, detail=str(error.detail))
+                next_index += 1
+                continue
+            unsubmitted.pop(job_id, None)
+            running[future] = (next_index, job_id)
+            next_index += 1
+        if not running:
+            continue
+
+        done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+        for future in sorted(done, key=lambda finished: running[finished][0]):
+            index, job_id = running.pop(future)
+            try:
+                images, info = future.result()
+            except Exception as e:
+                error = job_http_exception(job_id, "upscale", e)
+                yield BatchItemResult(index, job_id, status_code=error.status_code, detail=str(error.detail))
+            else:
+                yield BatchItemResult(index, job_id, images[0], info)
+
+
+@app.post("/upscale/batch")
+async def upscale_batch(http_request: Request):
+    """
+    Upscale plusieurs images (galerie, message à plusieurs pièces jointes) en une requête
+    Corps: JSON (UpscaleBatchRequest, images en base64) ou multipart/form-data (une partie
+    fichier "images" par image, réglages communs en champs texte)
+    Les images passent par la file du worker comme des /upscale (job {batch_id}_{index},
+    cache disque compris); celles du même modèle qui attendent ensemble partagent les passes
+    de Real-ESRGAN. Les résultats sont streamés dès que chaque image est prête: NDJSON par
+    défaut, multipart/mixed si Accept demande une image ou du multipart
+    /cancel/{batch_id} annule tout le lot; un client qui se déconnecte annule le reste du lot
+    """
+    batch_id = requested_job_id(http_request)
+    if batch_id in upscale_batches:
+        raise HTTPException(status_code=409, detail=f"Job {batch_id} already exists")
+    if upload_kind(http_request) == UPLOAD_RAW:
+        raise HTTPException(status_code=400, detail="Batch upscale expects JSON or multipart/form-data")
+    response_format = negotiate_response_format(http_request.headers.get("accept"))
+    request, upload = await read_image_request(http_request, UpscaleBatchRequest, "images",
+                                               max_files=UPSCALE_BATCH_MAX_IMAGES,
+                                               max_bytes=UPSCALE_BATCH_MAX_UPLOAD_BYTES)
+    files = upload.files if upload is not None else []
+    sources = [(image, None) for image in request.images] + [(None, image_file) for image_file in files]
+    try:
+        if not 1 <= len(sources) <= UPSCALE_BATCH_MAX_IMAGES:
+            raise HTTPException(status_code=400, detail=f"Batch upscale expects 1 to {UPSCALE_BATCH_MAX_IMAGES} "
+                                                        f"images (got {len(sources)})")
+        encoding = request_encoding(request, response_format.image_format, high_quality=True)
     except HTTPException:
-        if job_id in active_jobs:
-            del active_jobs[job_id]
+        if upload is not None:
+            upload.close()
         raise
+
+    job_ids = [f"{batch_id}_{index}" for index in range(len(sources))]
+    upscale_batches[batch_id] = UpscaleBatch(job_ids)
+    unsubmitted = {job_id: image_file for job_id, (_, image_file) in zip(job_ids, sources)}
+    logger.info(f"📚 Batch upscale {batch_id}: {len(sources)} image(s)")
+
+    def cleanup():
+        # Réponse terminée ou client parti: annuler ce qui reste, fermer les fichiers jamais soumis
+        del upscale_batches[batch_id]
+        for job_id in job_ids:
+            if job_id not in unsubmitted:
+                cancellation.cancel(job_id)
+        for image_file in unsubmitted.values():
+            if image_file is not None:
+                image_file.close()
+
+    return batch_stream_response(batch_id, stream_upscale_batch(batch_id, sources, request, encoding, unsubmitted),
+                                 response_format, background=BackgroundTask(cleanup))
+
+
+# ==================== JOBS ASYNCHRONES ====================
+
+JOB_SUBMITTERS = {"generate": submit_generate, "upscale": submit_upscale, "refine": submit_refine}
+collector_tasks = set()  # Références fortes: une tâche asyncio sans référence peut être ramassée
+
+
+async def collect_job_result(job_id: str, job_type: str, job: asyncio.Future):
+    """Attend la fin d'un job asynchrone et range son résultat (ou son erreur) dans job_results"""
+    try:
+        images, info = await job
     except Exception as e:
-        logger.error(f"❌ Error upscaling image: {e}")
-        if job_id in active_jobs:
-            del active_jobs[job_id]
-        raise HTTPException(status_code=500, detail=str(e))
+        error = job_http_exception(job_id, job_type, e)
+        status = STATUS_CANCELLED if error.status_code == 499 else STATUS_ERROR
+        job_results.fail(job_id, status, str(error.detail), error.status_code)
+    else:
+        # Un gros résultat est écrit sur disque: hors de la boucle
+        await asyncio.to_thread(job_results.complete, job_id, images, info)
+
+
+def job_status(record: JobRecord) -> dict:
+    """État d'un job asynchrone, avec sa position dans la file et sa dernière progression"""
+    status = record.as_dict()
+    if not record.finished:
+        position = inference_worker.queue_position(record.job_id)
+        status["status"] = STATUS_RUNNING if position == 0 else STATUS_QUEUED
+        status["position"] = position
+        eta_s = inference_worker.job_eta_s(record.job_id)
+        status["eta_s"] = round(eta_s, 1) if eta_s is not None else None
+        status["progress"] = progress_hub.last_event(record.job_id)
+    return status
+
+
+@app.post("/jobs", status_code=202)
+async def create_job(http_request: Request, job_type: str = Query("generate", alias="type"),
+                     image_format: Optional[str] = Query(None, alias="format")):
+    """
+    Soumet un job sans attendre son résultat (même corps que /generate, /upscale ou /refine)
+    Répond 202 tout de suite avec l'ID du job; suivre GET /jobs/{id} (ou /jobs/{id}/events)
+    puis récupérer l'image sur GET /jobs/{id}/result
+    format: png, webp ou jpeg (défaut: d'après Accept, sinon png); les champs output_format,
+    quality, lossless et png_compress_level du corps restent prioritaires
+    """
+    submitter = JOB_SUBMITTERS.get(job_type)
+    if submitter is None:
+        raise HTTPException(status_code=400,
+                            detail=f"Unknown job type: {job_type} (expected {', '.join(JOB_SUBMITTERS)})")
+    if image_format is None:
+        image_format = negotiate_response_format(http_request.headers.get("accept")).image_format
+    if image_format not in MEDIA_TYPE_BY_FORMAT:
+        raise HTTPException(status_code=400, detail=f"Unsupported image format: {image_format}")
+
+    job_id = requested_job_id(http_request)
+    if job_results.get(job_id) is not None:
+        raise HTTPException(status_code=409, detail=f"Job {job_id} already exists")
+    job = await submitter(http_request, job_id, image_format)
+    # Aucun await entre la soumission et l'enregistrement: le job ne peut pas finir avant
+    record = job_results.track(job_id, job_type, image_format)
+    task = asyncio.create_task(collect_job_result(job_id, job_type, job))
+    collector_tasks.add(task)
+    task.add_done_callback(collector_tasks.discard)
+
+    logger.info(f"📥 Job {job_id} accepted ({job_type}, {image_format})")
+    return {
+        **job_status(record),
+        "status_url": f"/jobs/{job_id}",
+        "result_url": f"/jobs/{job_id}/result",
+        "events_url": f"/jobs/{job_id}/events",
+    }
 
 
-@app.post("/unload")
-async def unload_models():
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """État d'un job asynchrone: queued (avec sa position), running (avec sa progression), done, error ou cancelled"""
+    record = job_results.get(job_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found or expired")
+    return job_status(record)
+
+
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str, http_request: Request):
     """
-    Décharge les modèles de la mémoire (libère la VRAM)
+    Résultat d'un job asynchrone, négocié via Accept comme /generate
+    202 tant que le job n'est pas terminé, le code d'erreur du job s'il a échoué (499 si annulé)
+    """
+    record = job_results.get(job_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found or expired")
+    if not record.finished:
+        return JSONResponse(status_code=202, content=job_status(record), headers={"Retry-After": "2"})
+    if record.status != STATUS_DONE:
+        raise HTTPException(status_code=record.error_status, detail=record.error)
+
+    result = await asyncio.to_thread(job_results.load_result, record)
+    if result is None:
+        raise HTTPException(status_code=410, detail=f"Result of job {job_id} is no longer available")
+    images, info = result
+    # Les images sont déjà encodées au format demandé à la soumission
+    response_format = negotiate_response_format(http_request.headers.get("accept"))
+    return image_response(job_id, images, info, response_format)
+
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
     """
-    global txt2img_pipeline, img2img_pipeline, esrgan_models
+    Progression d'un job en Server-Sent Events: queued, started, progress (à chaque step),
+    preview (aperçu JPEG basse résolution toutes les IMAGE_API_PREVIEW_EVERY steps),
+    puis done / cancelled / error. L'ID est celui passé en X-Job-Id à /generate ou /upscale.
+    """
+    queue = progress_hub.subscribe(job_id)
+    if queue is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return StreamingResponse(
+        progress_hub.sse_stream(job_id, queue),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
-    if txt2img_pipeline is not None:
-        del txt2img_pipeline
-        txt2img_pipeline = None
 
-    if img2img_pipeline is not None:
-        del img2img_pipeline
-        img2img_pipeline = None
+def prepare_done(pipeline: str, future: asyncio.Future):
+    pending_prepares.discard(pipeline)
+    if not future.cancelled() and future.exception() is not None:
+        logger.warning(f"⚠️ Prepare {pipeline} failed: {future.exception()}")
 
-    if esrgan_models:
-        esrgan_models.clear()
 
-    if device == "cuda":
-        torch.cuda.empty_cache()
+@app.post("/prepare", status_code=202)
+async def prepare_pipeline(pipeline: str = Query(..., description="txt2img, img2img, esrgan_general ou esrgan_anime")):
+    """
+    Annonce d'une commande à venir: le bot l'appelle dès qu'il la reçoit, avant sa propre file d'attente
+    Un modèle chargé voit son déchargement repoussé; sinon il est chargé quand le worker n'a rien d'autre à faire
+    """
+    if pipeline not in PRELOADERS:
+        raise HTTPException(status_code=400,
+                            detail=f"Unknown pipeline: {pipeline} (expected {', '.join(PRELOADERS)})")
+    model = PIPELINE_MODELS[pipeline]
+    if not worker_processes and model_registry.is_resident(model):
+        model_registry.touch(model)
+        return {"pipeline": pipeline, "status": "resident"}
+    # Mode coordinateur: le job part de préférence sur un worker qui a le modèle (qui repousse son déchargement)
+    resident = any(model in resident_models(status) for status in lane_statuses())
+
+    if pipeline not in pending_prepares:
+        try:
+            future = inference_worker.submit(f"prepare_{pipeline}", "maintenance",
+                                             lambda: run_on_lane("preload", pipeline),
+                                             priority=PRIORITY_PREPARE, model=model,
+                                             cost_s=0.0 if resident else model_reload_cost_s(model))
+        except QueueFullError as e:
+            raise queue_full_exception(e)
+        pending_prepares.add(pipeline)
+        future.add_done_callback(lambda done: prepare_done(pipeline, done))
+        if not resident:
+            logger.info(f"📣 Prepare {pipeline}: loading {model} in the background")
+    return {"pipeline": pipeline, "status": "resident" if resident else "loading"}
+
+
+@app.post("/unload")
+async def unload_models():
+    """
+    Décharge les modèles de la mémoire (libère la VRAM)
+    Passe par le worker pour attendre la fin du job en cours (sur chaque processus worker)
+    """
+    try:
+        await asyncio.gather(*submit_to_each_lane("unload", "unload_all"))
+    except QueueFullError as e:
+        raise queue_full_exception(e)
 
     logger.info("🗑️ Models unloaded, VRAM freed")
 
     return {"success": True, "message": "Models unloaded"}
 
 
+# Fonctions exécutables par run_on_lane (ici, ou dans un processus worker en mode coordinateur)
+WORKER_METHODS = {
+    "generate_batch": worker_generation_batch,
+    "upscale_batch": worker_upscale_batch,
+    "preload": preload_pipeline,
+    "startup_preload": preload_models,
+    "unload_all": unload_all_models,
+    "unload_idle": unload_idle_models,
+}
+
+
 # ==================== STARTUP ====================
 
 if __name__ == "__main__":
     import uvicorn
 
-    # Nettoyer les anciens fichiers de flag au démarrage
-    cleanup_cancel_flags()
-
-    # Pré-charger le pipeline txt2img au démarrage (le plus utilisé)
-    logger.info("🚀 Pre-loading txt2img pipeline...")
-    load_txt2img_pipeline()
-
-    # Démarrer le serveur
+    # Démarrer le serveur: le port s'ouvre tout de suite, le préchargement (IMAGE_API_PRELOAD)
+    # et le warmup tournent en tâche de fond (startup_event)
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,242 @@
+"""
+Réponses image négociées pour le microservice d'images
+Selon l'en-tête Accept, les images sont renvoyées:
+  - en binaire brut (image/png, image/webp, image/jpeg), métadonnées dans les en-têtes X-*
+  - en multipart/mixed pour les lots (une partie JSON puis une partie par image)
+  - en JSON avec l'image en base64 (format historique, utilisé par défaut)
+Les corps binaires sont streamés par morceaux, sans copie base64 intermédiaire.
+
+Les lots d'images indépendantes (/upscale/batch) sont streamés au fil des résultats:
+une ligne JSON par image (NDJSON, défaut) ou une partie par image en multipart/mixed.
+"""
+
+import base64
+import json
+import time
+import uuid
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict, Iterator, List, Optional
+
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+
+# Formats de sortie servis en binaire, par type MIME
+BINARY_MEDIA_TYPES = {
+    "image/png": "png",
+    "image/webp": "webp",
+    "image/jpeg": "jpeg",
+}
+MEDIA_TYPE_BY_FORMAT = {fmt: media_type for media_type, fmt in BINARY_MEDIA_TYPES.items()}
+
+RESPONSE_JSON = "json"
+RESPONSE_BINARY = "binary"
+RESPONSE_MULTIPART = "multipart"
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+STREAM_CHUNK_SIZE = 256 * 1024
+
+
+@dataclass
+class EncodedImage:
+    """Image déjà encodée, prête à être envoyée"""
+    data: bytes
+    format: str  # "png", "webp", ...
+    width: int
+    height: int
+
+    @property
+    def media_type(self) -> str:
+        return MEDIA_TYPE_BY_FORMAT.get(self.format, f"image/{self.format}")
+
+
+@dataclass
+class ResponseFormat:
+    """Résultat de la négociation: forme de la réponse et format d'encodage des images"""
+    kind: str = RESPONSE_JSON
+    image_format: str = "png"
+
+
+def _parse_accept(accept: str) -> List[str]:
+    """Types MIME de l'en-tête Accept triés par q décroissant (ordre d'origine à égalité)"""
+    entries = []
+    for index, part in enumerate(accept.split(",")):
+        fields = [f.strip() for f in part.split(";")]
+        media_type = fields[0].lower()
+        if not media_type:
+            continue
+        quality = 1.0
+        for param in fields[1:]:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            entries.append((-quality, index, media_type))
+    return [media_type for _, _, media_type in sorted(entries)]
+
+
+def negotiate_response_format(accept: Optional[str]) -> ResponseFormat:
+    """
+    Choisit la forme de la réponse d'après l'en-tête Accept
+    Sans préférence explicite pour un type image ou multipart, on garde le JSON base64
+    """
+    for media_type in _parse_accept(accept or ""):
+        if media_type in BINARY_MEDIA_TYPES:
+            return ResponseFormat(RESPONSE_BINARY, BINARY_MEDIA_TYPES[media_type])
+        if media_type == "image/*":
+            return ResponseFormat(RESPONSE_BINARY, "png")
+        if media_type == "multipart/mixed":
+            return ResponseFormat(RESPONSE_MULTIPART, "png")
+        if media_type in ("application/json", "*/*", "application/*"):
+            return ResponseFormat(RESPONSE_JSON, "png")
+    return ResponseFormat()
+
+
+def _iter_chunks(data: bytes) -> Iterator[bytes]:
+    # Starlette n'accepte que des bytes (pas de memoryview): chaque morceau est une petite copie
+    for offset in range(0, len(data), STREAM_CHUNK_SIZE):
+        yield data[offset:offset + STREAM_CHUNK_SIZE]
+
+
+def _metadata_headers(job_id: str, info: Dict) -> Dict[str, str]:
+    # json.dumps échappe le non-ASCII: l'en-tête reste en latin-1 valide
+    return {"X-Job-Id": job_id, "X-Image-Info": json.dumps(info)}
+
+
+def binary_response(job_id: str, image: EncodedImage, info: Dict) -> StreamingResponse:
+    """Corps image brut, métadonnées dans les en-têtes"""
+    headers = _metadata_headers(job_id, info)
+    headers.update({
+        "X-Image-Width": str(image.width),
+        "X-Image-Height": str(image.height),
+        "Content-Length": str(len(image.data)),
+    })
+    return StreamingResponse(_iter_chunks(image.data), media_type=image.media_type, headers=headers)
+
+
+def multipart_response(job_id: str, images: List[EncodedImage], info: Dict) -> StreamingResponse:
+    """multipart/mixed: une partie JSON (job_id + info) puis une partie binaire par image"""
+    boundary = f"netricsa-{uuid.uuid4().hex}"
+
+    def parts() -> Iterator[bytes]:
+        metadata = json.dumps({"success": True, "job_id": job_id, "count": len(images), "info": info})
+        yield (f"--{boundary}\r\nContent-Type: application/json\r\n\r\n{metadata}\r\n").encode()
+        for index, image in enumerate(images):
+            yield (f"--{boundary}\r\n"
+                   f"Content-Type: {image.media_type}\r\n"
+                   f"Content-Length: {len(image.data)}\r\n"
+                   f"Content-Disposition: attachment; filename=\"{job_id}_{index}.{image.format}\"\r\n"
+                   f"X-Image-Index: {index}\r\n"
+                   f"X-Image-Width: {image.width}\r\n"
+                   f"X-Image-Height: {image.height}\r\n\r\n").encode()
+            yield from _iter_chunks(image.data)
+            yield b"\r\n"
+        yield f"--{boundary}--\r\n".encode()
+
+    return StreamingResponse(parts(), media_type=f"multipart/mixed; boundary={boundary}",
+                             headers=_metadata_headers(job_id, info))
+
+
+def json_response(job_id: str, images: List[EncodedImage], info: Dict) -> Dict:
+    """Format historique: image(s) en base64 dans le JSON"""
+    payload = {
+        "success": True,
+        "image": base64.b64encode(images[0].data).decode(),
+        "job_id": job_id,
+        "info": info,
+    }
+    if len(images) > 1:
+        payload["images"] = [base64.b64encode(image.data).decode() for image in images]
+    return payload
+
+
+def image_response(job_id: str, images: List[EncodedImage], info: Dict, response_format: ResponseFormat):
+    """Construit la réponse négociée pour une ou plusieurs images"""
+    if response_format.kind == RESPONSE_BINARY and len(images) == 1:
+        return binary_response(job_id, images[0], info)
+    if response_format.kind in (RESPONSE_BINARY, RESPONSE_MULTIPART):
+        return multipart_response(job_id, images, info)
+    return json_response(job_id, images, info)
+
+
+@dataclass
+class BatchItemResult:
+    """Résultat d'une image d'un lot streamé: image encodée, ou erreur (statut HTTP et détail)"""
+    index: int
+    job_id: str
+    image: Optional[EncodedImage] = None
+    info: Optional[Dict] = None
+    status_code: int = 200
+    detail: Optional[str] = None
+
+    @property
+    def success(self) -> bool:
+        return self.image is not None
+
+    def metadata(self) -> Dict:
+        if self.success:
+            return {"index": self.index, "job_id": self.job_id, "success": True, "info": self.info}
+        return {"index": self.index, "job_id": self.job_id, "success": False,
+                "status": self.status_code, "detail": self.detail}
+
+
+def batch_stream_response(batch_id: str, results: AsyncIterator[BatchItemResult], response_format: ResponseFormat,
+                          background: Optional[BackgroundTask] = None) -> StreamingResponse:
+    """
+    Streame les résultats d'un lot dans l'ordre où ils arrivent, puis un résumé
+    JSON demandé (défaut): NDJSON, une ligne par image (image en base64), puis
+    {"done": true, ...}. Image ou multipart demandé: multipart/mixed, une partie binaire par
+    image réussie (métadonnées en en-têtes X-*), une partie JSON par échec, puis le résumé
+    background tourne à la fin de la réponse, y compris si le client s'est déconnecté
+    """
+    started_at = time.monotonic()
+    counts = {"count": 0, "succeeded": 0}
+
+    def summary() -> str:
+        return json.dumps({"done": True, "batch_id": batch_id, **counts,
+                           "total_time_s": round(time.monotonic() - started_at, 2)})
+
+    def count(result: BatchItemResult):
+        counts["count"] += 1
+        counts["succeeded"] += result.success
+
+    async def lines() -> AsyncIterator[bytes]:
+        async for result in results:
+            count(result)
+            line = result.metadata()
+            if result.success:
+                line["image"] = base64.b64encode(result.image.data).decode()
+            yield (json.dumps(line) + "\n").encode()
+        yield (summary() + "\n").encode()
+
+    boundary = f"netricsa-{uuid.uuid4().hex}"
+
+    async def parts() -> AsyncIterator[bytes]:
+        async for result in results:
+            count(result)
+            if not result.success:
+                yield (f"--{boundary}\r\nContent-Type: application/json\r\n\r\n"
+                       f"{json.dumps(result.metadata())}\r\n").encode()
+                continue
+            image = result.image
+            yield (f"--{boundary}\r\n"
+                   f"Content-Type: {image.media_type}\r\n"
+                   f"Content-Length: {len(image.data)}\r\n"
+                   f"Content-Disposition: attachment; filename=\"{result.job_id}.{image.format}\"\r\n"
+                   f"X-Image-Index: {result.index}\r\n"
+                   f"X-Job-Id: {result.job_id}\r\n"
+                   f"X-Image-Width: {image.width}\r\n"
+                   f"X-Image-Height: {image.height}\r\n"
+                   f"X-Image-Info: {json.dumps(result.info)}\r\n\r\n").encode()
+            for chunk in _iter_chunks(image.data):
+                yield chunk
+            yield b"\r\n"
+        yield f"--{boundary}\r\nContent-Type: application/json\r\n\r\n{summary()}\r\n--{boundary}--\r\n".encode()
+
+    headers = {"X-Job-Id": batch_id}
+    if response_format.kind == RESPONSE_JSON:
+        return StreamingResponse(lines(), media_type=NDJSON_MEDIA_TYPE, headers=headers, background=background)
+    return StreamingResponse(parts(), media_type=f"multipart/mixed; boundary={boundary}", headers=headers,
+                             background=background)
@@ -0,0 +1,513 @@
+"""
+Worker d'inférence dédié pour le microservice d'images
+Un seul thread possède le device (GPU/CPU) et exécute les jobs un par un,
+alimenté par une file de priorité bornée. Les handlers FastAPI attendent
+le résultat via un Future asyncio, la boucle d'événements reste donc libre
+pour le health check, /jobs et les annulations.
+
+Les jobs d'un même type qui déclarent la même clé de lot (ex: même taille, même
+nombre de steps) peuvent être regroupés: le worker prend le job en tête de file
+puis les jobs compatibles qui attendent, et les exécute en un seul appel au
+"batcher" enregistré pour ce type. Chaque handler reçoit son propre résultat.
+
+Avec plusieurs voies (lanes > 1, mode coordinateur), un thread par voie puise dans
+la même file; chaque voie pilote un processus worker qui a ses propres modèles
+résidents. Un job qui déclare son modèle va de préférence à une voie qui l'a déjà
+chargé: une voie libre ne prend pas un job dont le modèle est résident ailleurs,
+sauf s'il attend depuis plus de affinity_wait_s (la voie qui l'a est trop occupée).
+Une voie peut aussi être réservée à des modèles (set_lane_served: cœurs épinglés par modèle):
+elle ne prend alors que ceux-là, tant qu'une autre voie peut servir les autres.
+
+Chaque job peut déclarer sa durée prédite (cost_s): la file en déduit des ETA en simulant
+l'ordre d'exécution (chaque job part sur la première voie libérée; reste prédit des lots
+en cours compris).
+
+Une exception hors Exception (KeyboardInterrupt, SystemExit) arrête le thread de sa voie: le job
+en cours, les jobs en file que plus aucune voie ne peut prendre et les submit() suivants
+vers cette voie échouent avec WorkerStoppedError au lieu d'attendre indéfiniment.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional
+
+from model_registry import model_matches
+
+logger = logging.getLogger(__name__)
+
+# Une voie libre qui n'a rien pu prendre (affinité) revérifie la file à cet intervalle
+AFFINITY_RECHECK_S = 0.5
+
+_lane_local = threading.local()
+
+
+def current_lane() -> int:
+    """Voie qui exécute le job courant (à appeler depuis le job; 0 avec une seule voie)"""
+    return getattr(_lane_local, "index", 0)
+
+
+class QueueFullError(Exception):
+    """Levée quand la file d'attente a atteint sa profondeur maximale"""
+
+
+class WorkerStoppedError(RuntimeError):
+    """Transmise aux jobs qu'aucune voie ne pourra exécuter (thread arrêté par KeyboardInterrupt, SystemExit...)"""
+
+
+@dataclass(order=True)
+class QueuedJob:
+    """Job en attente dans la file (trié par priorité puis ordre d'arrivée)"""
+    priority: int
+    sequence: int
+    job_id: str = field(compare=False)
+    job_type: str = field(compare=False)
+    func: Callable[[], Any] = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    loop: asyncio.AbstractEventLoop = field(compare=False)
+    enqueued_at: float = field(compare=False, default_factory=time.monotonic)
+    batch_key: Optional[Hashable] = field(compare=False, default=None)
+    batch_item: Any = field(compare=False, default=None)
+    batch_weight: int = field(compare=False, default=1)
+    model: Optional[str] = field(compare=False, default=None)
+    lane: Optional[int] = field(compare=False, default=None)
+    cost_s: float = field(compare=False, default=0.0)
+
+
+def _resolve_future(future: asyncio.Future, result: Any = None, error: Optional[BaseException] = None):
+    """Résout un Future depuis la boucle asyncio (appelé via call_soon_threadsafe)"""
+    if future.done():
+        # Le handler a abandonné (client déconnecté), rien à faire
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+class InferenceWorker:
+    """
+    Thread propriétaire du device (un par voie), précédé d'une file de priorité bornée
+
+    Une priorité plus basse passe en premier; à priorité égale, l'ordre d'arrivée
+    est respecté. submit() ne bloque jamais: si la file est pleine, QueueFullError
+    est levée immédiatement pour que l'API puisse répondre 429.
+
+    on_job_start(job_type, attente_s) est appelé depuis le thread worker au démarrage
+    de chaque job (métriques de temps d'attente en file).
+
+    Args:
+        lanes: nombre de threads d'exécution (un par processus worker en mode coordinateur)
+        affinity_wait_s: attente au-delà de laquelle un job part sur une voie sans son modèle
+    """
+
+    def __init__(self, max_queue_depth: int = 8, name: str = "inference-worker",
+                 on_job_start: Optional[Callable[[str, float], None]] = None,
+                 lanes: int = 1, affinity_wait_s: float = 10.0):
+        self.max_queue_depth = max_queue_depth
+        self.name = name
+        self.on_job_start = on_job_start
+        self.lanes = max(1, lanes)
+        self.affinity_wait_s = affinity_wait_s
+        self._heap: List[QueuedJob] = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._threads: List[threading.Thread] = []
+        self._running = False
+        self._stopped_lanes = set()  # Voies dont le thread s'est arrêté sur une exception hors Exception
+        # voie -> lot en cours d'exécution, et modèles résidents sur chaque voie
+        self._running_batches: Dict[int, List[QueuedJob]] = {}
+        self._lane_started: Dict[int, float] = {}
+        self._lane_models: List[frozenset] = [frozenset()] * self.lanes
+        self._lane_served: List[tuple] = [()] * self.lanes  # Modèles réservés à chaque voie (vide = tous)
+        # job_type -> (batcher, poids maximal d'un lot)
+        self._batchers: Dict[str, tuple] = {}
+        self.batch_count = 0
+        self.batched_jobs_count = 0
+        self.completed_count = 0
+        self.failed_count = 0
+        self.rejected_count = 0
+
+    # ---------- Cycle de vie ----------
+
+    def start(self):
+        """Démarre le thread worker (idempotent)"""
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+        for lane in range(self.lanes):
+            name = self.name if self.lanes == 1 else f"{self.name}-{lane}"
+            thread = threading.Thread(target=self._run, args=(lane,), name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        lanes = f", {self.lanes} lanes" if self.lanes > 1 else ""
+        logger.info(f"✅ Inference worker started (max queue depth: {self.max_queue_depth}{lanes})")
+
+    def stop(self, timeout: Optional[float] = None):
+        """Arrête le worker après le job en cours; les jobs en attente sont annulés"""
+        with self._condition:
+            self._running = False
+            pending = self._heap
+            self._heap = []
+            self._condition.notify_all()
+        for job in pending:
+            job.loop.call_soon_threadsafe(job.future.cancel)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    # ---------- File d'attente ----------
+
+    def register_batcher(self, job_type: str, batcher: Callable[[List[Any]], List[Any]], max_batch_weight: int):
+        """
+        Autorise le regroupement des jobs d'un type
+
+        Args:
+            batcher: reçoit les batch_item des jobs regroupés et retourne un résultat par item,
+                dans le même ordre (une instance d'exception fait échouer ce seul job). Il peut aussi
+                produire des paires (index, résultat) au fil de l'eau (générateur): chaque job est
+                résolu dès que son résultat est produit, sans attendre la fin du lot
+            max_batch_weight: somme maximale des batch_weight d'un lot (ex: nombre d'images)
+        """
+        self._batchers[job_type] = (batcher, max_batch_weight)
+
+    def submit(self, job_id: str, job_type: str, func: Callable[[], Any], priority: int = 0,
+               batch_key: Optional[Hashable] = None, batch_item: Any = None,
+               batch_weight: int = 1, model: Optional[str] = None, lane: Optional[int] = None,
+               cost_s: float = 0.0) -> asyncio.Future:
+        """
+        Place un job dans la file et retourne un Future à attendre depuis la boucle asyncio
+
+        Args:
+            job_id: identifiant du job (pour /jobs et les annulations)
+            job_type: "generate", "upscale", ...
+            func: fonction bloquante exécutée sur le thread worker
+            priority: plus petit = plus prioritaire
+            batch_key: jobs regroupables entre eux s'ils ont la même clé (None = jamais regroupé)
+            batch_item: ce que reçoit le batcher du type quand le job fait partie d'un lot
+            batch_weight: poids du job dans le lot (ex: nombre d'images demandées)
+            model: modèle utilisé par le job (routage vers une voie qui l'a déjà chargé)
+            lane: voie imposée (maintenance propre à un processus worker: unload, préchargement)
+            cost_s: durée prédite (ETA des jobs suivants)
+
+        Raises:
+            QueueFullError: si la file a atteint max_queue_depth
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._condition:
+            if lane in self._stopped_lanes or len(self._stopped_lanes) == self.lanes:
+                # Plus aucune voie pour l'exécuter: échec immédiat plutôt qu'une attente sans fin
+                future.set_exception(WorkerStoppedError(f"Inference worker stopped, job {job_id} not run"))
+                return future
+            if len(self._heap) >= self.max_queue_depth:
+                self.rejected_count += 1
+                raise QueueFullError(f"Queue full ({len(self._heap)}/{self.max_queue_depth} jobs waiting)")
+            job = QueuedJob(priority, next(self._sequence), job_id, job_type, func, future, loop,
+                            batch_key=batch_key, batch_item=batch_item, batch_weight=batch_weight,
+                            model=model, lane=lane, cost_s=cost_s)
+            heapq.heappush(self._heap, job)
+            # Toutes les voies: celle qui se réveille n'est pas forcément celle qui doit le prendre
+            self._condition.notify_all()
+        return future
+
+    def discard(self, job_id: str, error: Optional[BaseException] = None) -> bool:
+        """
+        Retire un job encore en attente (ne touche pas au job en cours)
+
+        Args:
+            error: exception transmise au handler qui attend (sinon son Future est annulé)
+        """
+        with self._condition:
+            for index, job in enumerate(self._heap):
+                if job.job_id == job_id:
+                    self._heap.pop(index)
+                    heapq.heapify(self._heap)
+                    break
+            else:
+                return False
+        if error is not None:
+            job.loop.call_soon_threadsafe(_resolve_future, job.future, None, error)
+        else:
+            job.loop.call_soon_threadsafe(job.future.cancel)
+        return True
+
+    def queue_position(self, job_id: str) -> Optional[int]:
+        """Position dans la file (0 = en cours d'exécution), None si inconnu"""
+        with self._condition:
+            if any(job.job_id == job_id for batch in self._running_batches.values() for job in batch):
+                return 0
+            for position, job in enumerate(sorted(self._heap), start=1):
+                if job.job_id == job_id:
+                    return position
+        return None
+
+    def pending_jobs(self) -> List[Dict[str, Any]]:
+        """Jobs en attente, dans l'ordre où ils seront exécutés, avec leur durée prédite et leur ETA"""
+        now = time.monotonic()
+        with self._condition:
+            queued = sorted(self._heap)
+            finish_times, _ = self._simulate(queued, now)
+            return [
+                {"job_id": job.job_id, "type": job.job_type, "priority": job.priority,
+                 "waiting_s": round(now - job.enqueued_at, 2), "predicted_s": round(job.cost_s, 1),
+                 "eta_s": round(finish_times[job.job_id], 1)}
+                for job in queued
+            ]
+
+    def estimated_start_s(self, priority: int) -> float:
+        """Attente prédite d'un job soumis maintenant avec cette priorité (passe après ses égaux)"""
+        now = time.monotonic()
+        with self._condition:
+            ahead = [job for job in sorted(self._heap) if job.priority <= priority]
+            _, lane_free = self._simulate(ahead, now)
+        return min(lane_free)
+
+    def job_eta_s(self, job_id: str) -> Optional[float]:
+        """Temps prédit avant la fin d'un job en attente ou en cours (None si inconnu)"""
+        now = time.monotonic()
+        with self._condition:
+            for lane, batch in self._running_batches.items():
+                if any(job.job_id == job_id for job in batch):
+                    return self._lane_remaining(lane, now)
+            if not any(job.job_id == job_id for job in self._heap):
+                return None
+            finish_times, _ = self._simulate(sorted(self._heap), now)
+        return finish_times[job_id]
+
+    def _lane_remaining(self, lane: int, now: float) -> float:
+        """Reste prédit du lot en cours sur une voie (0 si libre ou si la prédiction est dépassée)"""
+        batch = self._running_batches.get(lane)
+        if not batch:
+            return 0.0
+        return max(0.0, sum(job.cost_s for job in batch) - (now - self._lane_started[lane]))
+
+    def _simulate(self, queued: List[QueuedJob], now: float) -> tuple:
+        """
+        Déroule la file dans l'ordre d'exécution: chaque job part sur la première voie libérée
+        (ou sa voie imposée). Appelé sous le verrou
+
+        Returns:
+            ({job_id: fin prédite dans N secondes}, [voie -> libre dans N secondes])
+        """
+        lane_free = [self._lane_remaining(lane, now) for lane in range(self.lanes)]
+        finish_times = {}
+        for job in queued:
+            lane = job.lane if job.lane is not None else min(self._serving_lanes(job.model), key=lane_free.__getitem__)
+            lane_free[lane] += job.cost_s
+            finish_times[job.job_id] = lane_free[lane]
+        return finish_times, lane_free
+
+    @property
+    def queue_depth(self) -> int:
+        with self._condition:
+            return len(self._heap)
+
+    @property
+    def current_batch(self) -> List[QueuedJob]:
+        """Jobs en cours d'exécution, toutes voies confondues"""
+        with self._condition:
+            return [job for lane in sorted(self._running_batches) for job in self._running_batches[lane]]
+
+    @property
+    def current_job(self) -> Optional[QueuedJob]:
+        """Premier job en cours d'exécution (None si toutes les voies sont libres)"""
+        batch = self.current_batch
+        return batch[0] if batch else None
+
+    def is_lane_idle(self, lane: int) -> bool:
+        """La voie n'exécute rien en ce moment"""
+        with self._condition:
+            return lane not in self._running_batches
+
+    def set_lane_models(self, lane: int, models):
+        """Modèles résidents sur une voie (rapportés par son processus worker après chaque job)"""
+        with self._condition:
+            models = frozenset(models)
+            if models != self._lane_models[lane]:
+                self._lane_models[lane] = models
+                self._condition.notify_all()
+
+    def set_lane_served(self, lane: int, models: Iterable[str]):
+        """Réserve une voie à des modèles (motifs de model_matches; vide = tous)"""
+        with self._condition:
+            self._lane_served[lane] = tuple(models)
+            self._condition.notify_all()
+
+    def _serves(self, lane: int, model: Optional[str]) -> bool:
+        served = self._lane_served[lane]
+        return not served or model is None or model_matches(model, served)
+
+    def _serving_lanes(self, model: Optional[str]) -> List[int]:
+        """Voies qui peuvent prendre un job de ce modèle (toutes si aucune voie ne le sert)"""
+        live = [lane for lane in range(self.lanes) if lane not in self._stopped_lanes]
+        return [lane for lane in live if self._serves(lane, model)] or live
+
+    def stats(self) -> Dict[str, Any]:
+        """Statistiques exposées sur le health check"""
+        current_batch = self.current_batch
+        with self._condition:
+            stats = {
+                "running": self._running,
+                "queue_depth": len(self._heap),
+                "max_queue_depth": self.max_queue_depth,
+                "current_job": current_batch[0].job_id if current_batch else None,
+                "current_batch": [job.job_id for job in current_batch],
+                "batches": self.batch_count,
+                "batched_jobs": self.batched_jobs_count,
+                "completed": self.completed_count,
+                "failed": self.failed_count,
+                "rejected": self.rejected_count,
+            }
+            if self.lanes > 1:
+                stats["lanes"] = [
+                    {"lane": lane,
+                     "current_batch": [job.job_id for job in self._running_batches.get(lane, [])],
+                     "models": sorted(self._lane_models[lane]),
+                     "serves": list(self._lane_served[lane]) or None}
+                    for lane in range(self.lanes)
+                ]
+            return stats
+
+    # ---------- Boucle des threads ----------
+
+    def _accepts(self, lane: int, job: QueuedJob, now: float) -> bool:
+        """La voie peut-elle prendre ce job maintenant (voie imposée, modèles réservés, puis affinité)"""
+        if job.lane is not None:
+            return job.lane == lane
+        if self.lanes == 1 or job.model is None:
+            return True
+        if lane not in self._serving_lanes(job.model):
+            return False
+        if job.model in self._lane_models[lane]:
+            return True
+        held_elsewhere = any(job.model in self._lane_models[other] for other in self._serving_lanes(job.model))
+        return not held_elsewhere or now - job.enqueued_at >= self.affinity_wait_s
+
+    def _next_job(self, lane: int) -> List[QueuedJob]:
+        """Premier job acceptable pour la voie, suivi des jobs en attente qui peuvent lui être regroupés"""
+        with self._condition:
+            while True:
+                if not self._running:
+                    return []
+                now = time.monotonic()
+                job = next((queued for queued in sorted(self._heap) if self._accepts(lane, queued, now)), None)
+                if job is not None:
+                    break
+                # File vide: attendre un submit(); jobs réservés à d'autres voies: revérifier l'affinité
+                self._condition.wait(AFFINITY_RECHECK_S if self._heap else None)
+            batch = [job]
+            batcher = self._batchers.get(job.job_type)
+            if batcher is not None and job.batch_key is not None:
+                _, max_weight = batcher
+                weight = job.batch_weight
+                for candidate in sorted(self._heap):
+                    if (candidate is not job and candidate.job_type == job.job_type
+                            and candidate.batch_key == job.batch_key and candidate.lane in (None, lane)
+                            and not candidate.future.done() and weight + candidate.batch_weight <= max_weight):
+                        batch.append(candidate)
+                        weight += candidate.batch_weight
+            self._heap = [queued for queued in self._heap if queued not in batch]
+            heapq.heapify(self._heap)
+            self._running_batches[lane] = batch
+            self._lane_started[lane] = time.monotonic()
+            return batch
+
+    def _run(self, lane: int):
+        try:
+            self._run_lane(lane)
+        except BaseException as e:
+            self._lane_stopped(lane, e)
+            raise
+
+    def _lane_stopped(self, lane: int, error: BaseException):
+        """Le thread d'une voie s'arrête: ses jobs en file (ou tous, si c'était la dernière) échouent"""
+        with self._condition:
+            self._stopped_lanes.add(lane)
+            last = len(self._stopped_lanes) == self.lanes
+            orphans = [job for job in self._heap if last or job.lane == lane]
+            self._heap = [job for job in self._heap if job not in orphans]
+            heapq.heapify(self._heap)
+            self._condition.notify_all()
+        logger.error(f"❌ Inference worker lane {lane} stopped ({type(error).__name__}), "
+                     f"failing {len(orphans)} queued jobs")
+        for job in orphans:
+            self._finish(job, error=WorkerStoppedError(f"Inference worker stopped, job {job.job_id} not run"))
+
+    def _run_lane(self, lane: int):
+        _lane_local.index = lane
+        while True:
+            batch = self._next_job(lane)
+            if not batch:
+                return
+
+            # Handlers déjà partis (client déconnecté ou job retiré): inutile de calculer
+            for job in batch:
+                if job.future.done():
+                    logger.info(f"⏭️ Skipping job {job.job_id}, nobody is waiting for it")
+            batch = [job for job in batch if not job.future.done()]
+            if self.on_job_start is not None:
+                now = time.monotonic()
+                for job in batch:
+                    self.on_job_start(job.job_type, now - job.enqueued_at)
+
+            try:
+                if len(batch) == 1:
+                    self._run_single(batch[0])
+                elif batch:
+                    self._run_batch(batch)
+            finally:
+                with self._condition:
+                    self._running_batches.pop(lane, None)
+
+    def _finish(self, job: QueuedJob, result: Any = None, error: Optional[BaseException] = None):
+        with self._condition:
+            if error is not None:
+                self.failed_count += 1
+            else:
+                self.completed_count += 1
+        job.loop.call_soon_threadsafe(_resolve_future, job.future, result, error)
+
+    def _run_single(self, job: QueuedJob):
+        try:
+            result = job.func()
+        except Exception as e:  # Remonte au handler (HTTPException comprise)
+            self._finish(job, error=e)
+        except BaseException as e:
+            # KeyboardInterrupt, SystemExit: le handler reçoit une erreur, puis le thread s'arrête
+            self._finish(job, error=WorkerStoppedError(f"Inference worker stopped ({type(e).__name__})"))
+            raise
+        else:
+            self._finish(job, result)
+
+    def _run_batch(self, batch: List[QueuedJob]):
+        batcher, _ = self._batchers[batch[0].job_type]
+        logger.info(f"📦 Running {len(batch)} {batch[0].job_type} jobs as one batch "
+                    f"({', '.join(job.job_id for job in batch)})")
+        with self._condition:
+            self.batch_count += 1
+            self.batched_jobs_count += len(batch)
+        pending = dict(enumerate(batch))
+        try:
+            outcomes = batcher([job.batch_item for job in batch])
+            for index, outcome in (enumerate(outcomes) if isinstance(outcomes, list) else outcomes):
+                job = pending.pop(index)
+                if isinstance(outcome, BaseException):
+                    self._finish(job, error=outcome)
+                else:
+                    self._finish(job, outcome)
+        except Exception as e:
+            for job in pending.values():
+                self._finish(job, error=e)
+            return
+        except BaseException as e:
+            for job in pending.values():
+                self._finish(job, error=WorkerStoppedError(f"Inference worker stopped ({type(e).__name__})"))
+            raise
+        for job in pending.values():
+            self._finish(job, error=RuntimeError(f"Batcher returned no result for job {job.job_id}"))
@@ -0,0 +1,160 @@
+"""
+Suivi de progression des jobs, diffusé en Server-Sent Events
+Le thread worker publie l'avancement (step courant, aperçus basse résolution) et
+chaque client abonné à un job reçoit ces événements dans sa propre file asyncio.
+La publication ne bloque jamais le worker: un client trop lent perd les
+événements les plus anciens, jamais l'événement final.
+
+Ce module n'importe pas torch: les aperçus sont calculés par l'appelant, et
+seulement si quelqu'un écoute (has_subscribers()).
+"""
+
+import asyncio
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+EVENT_QUEUED = "queued"
+EVENT_STARTED = "started"
+EVENT_PROGRESS = "progress"
+EVENT_PREVIEW = "preview"
+EVENT_DONE = "done"
+EVENT_ERROR = "error"
+EVENT_CANCELLED = "cancelled"
+FINAL_EVENTS = (EVENT_DONE, EVENT_ERROR, EVENT_CANCELLED)
+
+KEEPALIVE_INTERVAL_S = 15.0
+
+
+def _offer(queue: asyncio.Queue, event: Dict[str, Any]):
+    """Dépose un événement sans bloquer: si la file est pleine, le plus ancien est jeté"""
+    if queue.full():
+        try:
+            queue.get_nowait()
+        except asyncio.QueueEmpty:
+            pass
+    queue.put_nowait(event)
+
+
+class _Channel:
+    __slots__ = ("job_type", "started_at", "last_event", "final_event", "subscribers")
+
+    def __init__(self, job_type: str):
+        self.job_type = job_type
+        self.started_at = time.monotonic()
+        self.last_event: Optional[Dict[str, Any]] = None
+        self.final_event: Optional[Dict[str, Any]] = None
+        self.subscribers: List[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]] = []
+
+
+class ProgressHub:
+    """
+    Canaux de progression par job
+
+    Args:
+        finished_history: nombre de jobs terminés dont on garde l'événement final
+            (un client qui s'abonne juste après la fin le reçoit quand même)
+        queue_size: événements en attente par client avant de jeter les plus anciens
+    """
+
+    def __init__(self, finished_history: int = 256, queue_size: int = 32):
+        self.finished_history = finished_history
+        self.queue_size = queue_size
+        self._channels: Dict[str, _Channel] = {}
+        self._finished: "OrderedDict[str, _Channel]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    # ---------- Côté producteur (handlers et thread worker) ----------
+
+    def open(self, job_id: str, job_type: str):
+        with self._lock:
+            self._channels[job_id] = _Channel(job_type)
+
+    def has_subscribers(self, job_id: str) -> bool:
+        """Lecture sans verrou, appelée à chaque step: décide si un aperçu vaut la peine d'être calculé"""
+        channel = self._channels.get(job_id)
+        return channel is not None and bool(channel.subscribers)
+
+    def publish(self, job_id: str, event_type: str, data: Optional[Dict[str, Any]] = None):
+        """Publie un événement (depuis n'importe quel thread)"""
+        with self._lock:
+            channel = self._channels.get(job_id)
+            if channel is None:
+                return
+            event = self._event(channel, event_type, data)
+            if event_type != EVENT_PREVIEW:
+                # Les aperçus ne sont pas rejoués aux nouveaux abonnés (trop lourds)
+                channel.last_event = event
+            subscribers = list(channel.subscribers)
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(_offer, queue, event)
+
+    def close(self, job_id: str, event_type: str, data: Optional[Dict[str, Any]] = None):
+        """Publie l'événement final et archive le canal"""
+        with self._lock:
+            channel = self._channels.pop(job_id, None)
+            if channel is None:
+                return
+            event = self._event(channel, event_type, data)
+            channel.last_event = channel.final_event = event
+            subscribers = channel.subscribers
+            channel.subscribers = []
+            self._finished[job_id] = channel
+            while len(self._finished) > self.finished_history:
+                self._finished.popitem(last=False)
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(_offer, queue, event)
+
+    @staticmethod
+    def _event(channel: _Channel, event_type: str, data: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        event = {"event": event_type, "elapsed_s": round(time.monotonic() - channel.started_at, 2)}
+        if data:
+            event.update(data)
+        return event
+
+    # ---------- Côté client (boucle asyncio) ----------
+
+    def last_event(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            channel = self._channels.get(job_id) or self._finished.get(job_id)
+            return channel.last_event if channel is not None else None
+
+    def subscribe(self, job_id: str) -> Optional[asyncio.Queue]:
+        """Abonne la boucle courante à un job; None si le job est inconnu"""
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        with self._lock:
+            channel = self._channels.get(job_id)
+            if channel is None:
+                finished = self._finished.get(job_id)
+                if finished is None:
+                    return None
+                queue.put_nowait(finished.final_event)
+                return queue
+            if channel.last_event is not None:
+                queue.put_nowait(channel.last_event)
+            channel.subscribers.append((loop, queue))
+        return queue
+
+    def unsubscribe(self, job_id: str, queue: asyncio.Queue):
+        with self._lock:
+            channel = self._channels.get(job_id)
+            if channel is not None:
+                channel.subscribers = [(loop, q) for loop, q in channel.subscribers if q is not queue]
+
+    async def sse_stream(self, job_id: str, queue: asyncio.Queue) -> AsyncIterator[bytes]:
+        """Flux text/event-stream jusqu'à l'événement final (commentaire keep-alive toutes les 15 s)"""
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), KEEPALIVE_INTERVAL_S)
+                except asyncio.TimeoutError:
+                    yield b": keep-alive\n\n"
+                    continue
+                yield f"event: {event['event']}\ndata: {json.dumps(event)}\n\n".encode()
+                if event["event"] in FINAL_EVENTS:
+                    return
+        finally:
+            self.unsubscribe(job_id, queue)
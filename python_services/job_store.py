@@ -0,0 +1,281 @@
+"""
+Stockage des jobs asynchrones (POST /jobs) et de leurs résultats
+Un job soumis sans attendre la réponse est suivi ici jusqu'à ce que son résultat
+soit récupéré ou expire:
+  - les résultats restent TTL secondes après la fin du job
+  - la RAM occupée par les images est bornée: les gros résultats (et les plus anciens
+    quand la borne est atteinte) sont déversés sur disque
+  - le disque est borné aussi: au-delà, les résultats les plus anciens sont oubliés
+Les fichiers déversés utilisent le format de result_cache (écriture atomique). Les écritures et
+suppressions de fichiers se font hors du verrou, et jamais depuis la boucle asyncio: get() (appelé
+depuis la boucle pour GET /jobs/{id}) oublie les jobs expirés mais laisse leurs fichiers à supprimer
+par purge_expired(), appelé depuis un thread (complete(), tâche périodique de l'API).
+"""
+
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from image_responses import EncodedImage
+from result_cache import read_entry, write_entry
+
+logger = logging.getLogger(__name__)
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_ERROR = "error"
+STATUS_CANCELLED = "cancelled"
+FINISHED_STATUSES = (STATUS_DONE, STATUS_ERROR, STATUS_CANCELLED)
+
+
+@dataclass
+class JobRecord:
+    """État d'un job asynchrone"""
+    job_id: str
+    job_type: str
+    image_format: str = "png"
+    status: str = STATUS_QUEUED
+    created_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    info: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+    error_status: Optional[int] = None
+    images: Optional[List[EncodedImage]] = None  # En RAM
+    spill_path: Optional[Path] = None  # Ou sur disque
+    size_bytes: int = 0
+    spilling: bool = False  # Écriture sur disque en cours (hors verrou)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED_STATUSES
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.job_id,
+            "type": self.job_type,
+            "status": self.status,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "info": self.info,
+            "error": self.error,
+        }
+
+
+class JobStore:
+    """
+    Jobs asynchrones en cours et résultats en attente de récupération
+
+    Args:
+        directory: dossier des résultats déversés sur disque (vidé au démarrage)
+        ttl_s: durée de conservation d'un résultat après la fin du job
+        max_memory_bytes: images gardées en RAM, tous jobs confondus
+        spill_threshold_bytes: un résultat plus gros part directement sur disque
+        max_disk_bytes: taille maximale des résultats déversés
+        clock: horloge (time.time), injectable pour les tests
+    """
+
+    def __init__(self, directory: Path, ttl_s: float = 3600.0, max_memory_bytes: int = 256 * 1024 ** 2,
+                 spill_threshold_bytes: int = 4 * 1024 ** 2, max_disk_bytes: int = 2 * 1024 ** 3,
+                 clock: Callable[[], float] = time.time):
+        self.directory = Path(directory)
+        self.ttl_s = ttl_s
+        self.max_memory_bytes = max_memory_bytes
+        self.spill_threshold_bytes = spill_threshold_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.clock = clock
+        self._records: "OrderedDict[str, JobRecord]" = OrderedDict()  # Ordre de fin (les plus anciens d'abord)
+        self._lock = threading.Lock()
+        self._orphan_files: List[Path] = []  # Fichiers de jobs oubliés par get(), supprimés par purge_expired()
+        self.memory_bytes = 0
+        self.disk_bytes = 0
+        self.spilled_count = 0
+        self.expired_count = 0
+        self.dropped_count = 0
+
+    def reset_directory(self):
+        """Les enregistrements ne survivent pas au processus: on repart d'un dossier vide"""
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    # ---------- Cycle de vie d'un job ----------
+
+    def track(self, job_id: str, job_type: str, image_format: str = "png") -> JobRecord:
+        record = JobRecord(job_id, job_type, image_format, created_at=self.clock())
+        with self._lock:
+            self._records[job_id] = record
+        return record
+
+    def complete(self, job_id: str, images: List[EncodedImage], info: Dict[str, Any]):
+        """Enregistre le résultat d'un job terminé; les gros résultats partent sur disque"""
+        self.purge_expired()
+        size = sum(len(image.data) for image in images)
+        with self._lock:
+            record = self._records.get(job_id)
+            if record is None:
+                return
+            record.status = STATUS_DONE
+            record.finished_at = self.clock()
+            record.info = info
+            record.size_bytes = size
+            record.images = images
+            self.memory_bytes += size
+            self._records.move_to_end(job_id)
+            to_spill = self._choose_spills(record if size > self.spill_threshold_bytes else None)
+        for spilled in to_spill:
+            self._spill(spilled)
+        with self._lock:
+            to_delete = self._choose_drops()
+        self._delete_files(to_delete)
+
+    def fail(self, job_id: str, status: str, error: str, error_status: int):
+        """Termine un job en erreur ou annulé"""
+        with self._lock:
+            record = self._records.get(job_id)
+            if record is None:
+                return
+            record.status = status
+            record.finished_at = self.clock()
+            record.error = error
+            record.error_status = error_status
+            self._records.move_to_end(job_id)
+
+    # ---------- Lecture ----------
+
+    def get(self, job_id: str) -> Optional[JobRecord]:
+        """Enregistrement d'un job (None s'il a expiré); sans accès disque, appelable depuis la boucle asyncio"""
+        with self._lock:
+            self._orphan_files.extend(path for path in self._expire() if path is not None)
+            return self._records.get(job_id)
+
+    def load_result(self, record: JobRecord) -> Optional[Tuple[List[EncodedImage], Dict[str, Any]]]:
+        """Images et info d'un job terminé, relues sur disque si besoin; None si perdues"""
+        with self._lock:
+            images, spill_path = record.images, record.spill_path
+        if images is not None:
+            return images, record.info
+        if spill_path is None:
+            return None
+        try:
+            return read_entry(spill_path)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"⚠️ Spilled result of job {record.job_id} unreadable: {e}")
+            return None
+
+    # ---------- Bornes ----------
+
+    def purge_expired(self):
+        """Oublie les jobs terminés depuis plus de ttl_s et supprime leurs fichiers (depuis un thread)"""
+        with self._lock:
+            to_delete = self._expire() + self._orphan_files
+            self._orphan_files = []
+        self._delete_files(to_delete)
+
+    def _expire(self) -> List[Optional[Path]]:
+        """Oublie les jobs terminés depuis plus de ttl_s (sous self._lock); retourne leurs fichiers déversés"""
+        deadline = self.clock() - self.ttl_s
+        expired = [record for record in self._records.values() if record.finished and record.finished_at < deadline]
+        self.expired_count += len(expired)
+        return [self._forget(record) for record in expired]
+
+    def _choose_spills(self, record: Optional[JobRecord]) -> List[JobRecord]:
+        """
+        Résultats à déverser sur disque (sous self._lock): record s'il est trop gros, puis les plus anciens
+        tant que la RAM dépasse sa borne. Ils sont marqués spilling et gardent leurs images jusqu'à l'écriture
+        """
+        chosen = [record] if record is not None else []
+        leaving = sum(spilled.size_bytes for spilled in self._records.values() if spilled.spilling)
+        leaving += record.size_bytes if record is not None else 0
+        for candidate in self._records.values():
+            if self.memory_bytes - leaving <= self.max_memory_bytes:
+                break
+            if candidate.images is not None and not candidate.spilling and candidate is not record:
+                chosen.append(candidate)
+                leaving += candidate.size_bytes
+        for spilled in chosen:
+            spilled.spilling = True
+        return chosen
+
+    def _spill(self, record: JobRecord):
+        """Écrit les images d'un résultat sur disque (hors verrou), puis les retire de la RAM"""
+        with self._lock:
+            images, info = record.images, record.info
+        path = self.directory / f"{record.job_id}.bin"
+        try:
+            if images is None:
+                raise OSError("result already released")
+            self.directory.mkdir(parents=True, exist_ok=True)
+            file_size = write_entry(path, images, info)
+        except OSError as e:
+            logger.warning(f"⚠️ Could not spill result of job {record.job_id} to disk: {e}")
+            with self._lock:
+                record.spilling = False
+            return
+        with self._lock:
+            record.spilling = False
+            forgotten = self._records.get(record.job_id) is not record or record.images is not images
+            if not forgotten:
+                self.memory_bytes -= record.size_bytes
+                self.disk_bytes += file_size
+                record.images = None
+                record.spill_path = path
+                record.size_bytes = file_size
+                self.spilled_count += 1
+        if forgotten:  # Expiré pendant l'écriture
+            self._delete_files([path])
+
+    def _choose_drops(self) -> List[Optional[Path]]:
+        """Disque (sous self._lock): on oublie les résultats les plus anciens; fichiers à supprimer hors verrou"""
+        to_delete = []
+        for record in list(self._records.values()):
+            if self.disk_bytes <= self.max_disk_bytes:
+                break
+            if record.spill_path is not None:
+                logger.info(f"🗑️ Dropping result of job {record.job_id} (job store disk limit)")
+                to_delete.append(self._forget(record))
+                self.dropped_count += 1
+        return to_delete
+
+    def _forget(self, record: JobRecord) -> Optional[Path]:
+        """Retire un enregistrement (sous self._lock); retourne son fichier déversé, à supprimer hors verrou"""
+        self._records.pop(record.job_id, None)
+        if record.images is not None:
+            self.memory_bytes -= record.size_bytes
+            record.images = None
+        spill_path = record.spill_path
+        if spill_path is not None:
+            self.disk_bytes -= record.size_bytes
+            record.spill_path = None
+        return spill_path
+
+    @staticmethod
+    def _delete_files(paths: List[Optional[Path]]):
+        for path in paths:
+            if path is None:
+                continue
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        """Compteurs exposés sur le health check"""
+        with self._lock:
+            statuses: Dict[str, int] = {}
+            for record in self._records.values():
+                statuses[record.status] = statuses.get(record.status, 0) + 1
+            return {
+                "jobs": len(self._records),
+                "by_status": statuses,
+                "memory_mb": round(self.memory_bytes / 1024 ** 2, 2),
+                "disk_mb": round(self.disk_bytes / 1024 ** 2, 2),
+                "spilled": self.spilled_count,
+                "expired": self.expired_count,
+                "dropped": self.dropped_count,
+            }
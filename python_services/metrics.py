@@ -0,0 +1,227 @@
+"""
+Métriques au format texte Prometheus pour le microservice d'images (GET /metrics)
+Trois types, sans dépendance externe:
+  - Counter: total croissant (jobs annulés, OOM, ...)
+  - Gauge: valeur instantanée (modèles résidents, mémoire)
+  - Histogram: distribution de durées (attente en file, steps de débruitage, ...)
+Counter et Gauge acceptent un callback lu au moment du scrape, pour exposer des
+compteurs déjà tenus ailleurs (caches, registre des modèles) sans les dupliquer.
+
+observe() et inc() ne font qu'une recherche de bucket et quelques additions sous
+un verrou: appelables à chaque step depuis le thread worker. Dans un processus worker
+(mode coordinateur), redirect() envoie ces observations au processus principal, qui
+les rejoue avec replay(): /metrics reste exposé par un seul processus.
+Ce module n'importe pas torch.
+"""
+
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+# Starlette ajoute "; charset=utf-8" aux types text/*
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+# Durées de quelques ms (un step sur GPU) à plusieurs minutes (chargement à froid, génération CPU)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+LabelValues = Tuple[str, ...]
+CallbackValue = Union[float, Dict[LabelValues, float]]
+# (nom de la métrique, valeur, labels): observation redirigée vers un autre processus
+MetricSink = Callable[[str, float, Dict[str, Any]], None]
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.sink: Optional[MetricSink] = None
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class _ValueMetric(_Metric):
+    """Base de Counter et Gauge: une valeur par jeu de labels, ou un callback"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 callback: Optional[Callable[[], CallbackValue]] = None):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+        self._values: Dict[LabelValues, float] = {}
+
+    def _samples(self) -> Dict[LabelValues, float]:
+        if self.callback is None:
+            with self._lock:
+                return dict(self._values)
+        value = self.callback()
+        if isinstance(value, dict):
+            return value
+        return {(): value}
+
+    def value(self, **labels) -> float:
+        return self._samples().get(self._key(labels), 0.0)
+
+    def render(self) -> List[str]:
+        lines = self._header()
+        for key, value in sorted(self._samples().items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_ValueMetric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        if self.sink is not None:
+            self.sink(self.name, amount, labels)
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_ValueMetric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """Distribution d'une durée en secondes (buckets cumulés à l'export, comme Prometheus)"""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> (compte par bucket, +Inf compris, somme, nombre d'observations)
+        self._series: Dict[LabelValues, List] = {}
+
+    def observe(self, value: float, **labels):
+        if self.sink is not None:
+            self.sink(self.name, value, labels)
+            return
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """Mesure la durée du bloc (horloge monotone)"""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, **labels)
+
+    def snapshot(self, **labels) -> Tuple[int, float]:
+        """(nombre d'observations, somme) pour un jeu de labels"""
+        with self._lock:
+            series = self._series.get(self._key(labels))
+            return (series[2], series[1]) if series is not None else (0, 0.0)
+
+    def render(self) -> List[str]:
+        lines = self._header()
+        with self._lock:
+            series = {key: (list(counts), total, count) for key, (counts, total, count) in self._series.items()}
+        for key, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """Ensemble des métriques exposées, dans l'ordre de déclaration"""
+
+    def __init__(self, prefix: str = ""):
+        self.prefix = prefix
+        self._metrics: List[_Metric] = []
+
+    def _add(self, metric: _Metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                callback: Optional[Callable[[], CallbackValue]] = None) -> Counter:
+        return self._add(Counter(self.prefix + name, documentation, labelnames, callback))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+              callback: Optional[Callable[[], CallbackValue]] = None) -> Gauge:
+        return self._add(Gauge(self.prefix + name, documentation, labelnames, callback))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(self.prefix + name, documentation, labelnames, buckets))
+
+    def redirect(self, sink: MetricSink):
+        """Envoie les inc() et observe() à sink au lieu de les compter ici (processus worker)"""
+        for metric in self._metrics:
+            if isinstance(metric, Histogram) or (isinstance(metric, Counter) and metric.callback is None):
+                metric.sink = sink
+
+    def replay(self, name: str, value: float, labels: Dict[str, Any]):
+        """Compte une observation redirigée par un processus worker (noms inconnus ignorés)"""
+        for metric in self._metrics:
+            if metric.name != name:
+                continue
+            if isinstance(metric, Histogram):
+                metric.observe(value, **labels)
+            elif isinstance(metric, Counter):
+                metric.inc(value, **labels)
+            return
+
+    def render(self) -> str:
+        """Texte d'exposition Prometheus (version 0.0.4)"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,365 @@
+"""
+Exécution compilée (torch.compile) de l'UNet, du décodeur VAE et de RRDBNet, par buckets de formes
+Opt-in (IMAGE_API_COMPILE). Un bucket est une forme d'entrée exacte (taille du lot et résolution):
+chaque bucket a son graphe compilé (dynamic=False), au plus max_buckets par modèle; au-delà, les
+nouvelles formes restent en eager (pas de recompilation sans fin sur les tailles d'upscale arbitraires).
+
+Persistance: les noyaux générés par inductor (C++ compilé sur CPU, Triton sur GPU) sont gardés dans
+cache_dir (TORCHINDUCTOR_CACHE_DIR), et le graphe complet quand torch le permet (fx_graph_cache,
+torch >= 2.2). Un redémarrage ou un rechargement après unload retrace le modèle mais ne recompile
+pas ses noyaux. Sur CPU, les poids sont gelés dans le graphe (freezing: poids pré-empaquetés pour
+oneDNN): un modèle déplacé d'un device à l'autre doit être réenveloppé (wrap) par son chargeur.
+
+Déchargement: torch garde les poids d'un module compilé en vie après son déchargement (les guards de
+dynamo posent un weakref.finalize sur chaque objet gardé, qui référence le graphe tracé). release()
+détache ces finalizers et vide les caches de dynamo: les autres modèles compilés sont retracés à leur
+prochain appel, sans recompiler leurs noyaux (cache disque).
+
+Chaque bucket a ses mesures (durée de la compilation, latence moyenne d'un appel compilé et d'un
+appel eager), gardées dans cache_dir/buckets.json d'un démarrage à l'autre: pour l'UNet, un appel
+est un step de débruitage.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import torch
+
+from model_registry import model_matches
+
+logger = logging.getLogger(__name__)
+
+COMPILABLE_MODELS = ("unet", "vae", "esrgan")  # vae: le décodeur uniquement
+MANIFEST_NAME = "buckets.json"
+OTHER_BUCKET = "other"  # Formes au-delà de max_buckets, mesurées ensemble (eager)
+
+
+def first_input(args: tuple, kwargs: Dict[str, Any]) -> torch.Tensor:
+    return args[0] if args else next(iter(kwargs.values()))
+
+
+def shape_bucket(args: tuple, kwargs: Dict[str, Any]) -> str:
+    """Bucket d'un appel: forme du premier tenseur d'entrée, ex: "2x4x128x128" (lot x canaux x h x w)"""
+    return "x".join(str(size) for size in first_input(args, kwargs).shape)
+
+
+def compile_errors() -> Tuple[type, ...]:
+    """Erreurs de dynamo / inductor qui rendent un modèle incompilable ici (pas les erreurs d'exécution)"""
+    import torch._dynamo.exc
+
+    return torch._dynamo.exc.BackendCompilerFailed, torch._dynamo.exc.Unsupported
+
+
+@dataclass
+class BucketStats:
+    """Mesures d'un bucket (cumulées d'un démarrage à l'autre)"""
+    compiled: bool = False  # Graphe compilé au moins une fois: noyaux dans le cache disque
+    compile_s: Optional[float] = None  # Dernier premier appel compilé (compilation comprise)
+    compiles: int = 0
+    compiled_calls: int = 0  # Appels compilés hors compilation
+    compiled_total_s: float = 0.0
+    eager_calls: int = 0
+    eager_total_s: float = 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        compiled_call_s = self.compiled_total_s / self.compiled_calls if self.compiled_calls else None
+        eager_call_s = self.eager_total_s / self.eager_calls if self.eager_calls else None
+        return {
+            "compiled": self.compiled,
+            "compile_s": round(self.compile_s, 2) if self.compile_s is not None else None,
+            "compiles": self.compiles,
+            "compiled_calls": self.compiled_calls,
+            "compiled_call_s": round(compiled_call_s, 4) if compiled_call_s is not None else None,
+            "eager_calls": self.eager_calls,
+            "eager_call_s": round(eager_call_s, 4) if eager_call_s is not None else None,
+            "speedup": round(eager_call_s / compiled_call_s, 2) if compiled_call_s and eager_call_s else None,
+        }
+
+
+class BucketedModule:
+    """
+    Remplace forward d'un module: les buckets compilés passent par le graphe de torch.compile,
+    les autres par le forward d'origine. Le module garde sa classe (diffusers l'inspecte)
+    """
+
+    def __init__(self, compiler: "ModelCompiler", name: str, module: torch.nn.Module):
+        self.compiler = compiler
+        self.name = name
+        self.module = module
+        self.eager = module.forward
+        self.compiled = torch.compile(self.eager, mode=compiler.mode, dynamic=False)
+        self.buckets = set()  # Buckets déjà compilés (graphes en mémoire)
+        self.failed = False  # Erreur de compilation ou du backend (ex: sans compilateur C++ ni Triton): tout en eager
+        # Appels CUDA encore en vol: (bucket, compilé, événement de début, événement de fin)
+        self.pending_timings: List[Tuple[str, bool, torch.cuda.Event, torch.cuda.Event]] = []
+
+    def __call__(self, *args, **kwargs):
+        tensor = first_input(args, kwargs)
+        bucket = shape_bucket(args, kwargs)
+        compiled = not self.failed and not self.compiler.paused and (
+            bucket in self.buckets or self.compiler.admit(self.name, bucket))
+        first = compiled and bucket not in self.buckets
+        # Sur CUDA, les appels sont asynchrones: mesurés par une paire d'événements, lue plus tard
+        # sans bloquer le lancement des noyaux (la compilation, elle, se mesure à l'horloge)
+        timed_on_device = isinstance(tensor, torch.Tensor) and tensor.is_cuda and not first
+        if timed_on_device:
+            stream = torch.cuda.current_stream(tensor.device)
+            start_event = torch.cuda.Event(enable_timing=True)
+            start_event.record(stream)
+        start_time = time.perf_counter()
+        if not compiled:
+            output = self.eager(*args, **kwargs)
+        elif not first:
+            output = self.compiled(*args, **kwargs)
+        else:
+            try:
+                output = self.compiled(*args, **kwargs)
+            except compile_errors() as e:
+                # Un OOM pendant la compilation est passager: l'appelant le traite (nouvel essai plus petit)
+                if self.compiler.is_out_of_memory(e):
+                    raise
+                logger.warning(f"⚠️ Could not compile {self.name} for {bucket}, running it eager: {e}")
+                self.failed = True
+                return self.eager(*args, **kwargs)
+            self.buckets.add(bucket)
+        if timed_on_device:
+            end_event = torch.cuda.Event(enable_timing=True)
+            end_event.record(stream)
+            self.pending_timings.append((bucket, compiled, start_event, end_event))
+            self.collect_timings()
+            return output
+        if first and isinstance(tensor, torch.Tensor) and tensor.is_cuda:
+            torch.cuda.synchronize(tensor.device)  # Une seule fois par bucket
+        self.compiler.record(self.name, bucket, compiled, first, time.perf_counter() - start_time)
+        return output
+
+    def collect_timings(self):
+        """Enregistre les appels CUDA terminés (query() ne bloque pas; les autres attendent l'appel suivant)"""
+        while self.pending_timings and self.pending_timings[0][3].query():
+            bucket, compiled, start_event, end_event = self.pending_timings.pop(0)
+            self.compiler.record(self.name, bucket, compiled, False, start_event.elapsed_time(end_event) / 1000)
+
+
+class ModelCompiler:
+    """
+    Compilation par buckets des modèles désignés, et mesures par bucket
+
+    Args:
+        models: motifs des modèles à compiler ("unet", "vae", "esrgan"; vide = rien)
+        cache_dir: cache disque des noyaux et des mesures (None = cache temporaire de torch, sans mesures gardées)
+        mode: mode de torch.compile ("default", "reduce-overhead", "max-autotune", ...)
+        max_buckets: buckets compilés au plus par modèle et par processus
+        freezing: poids gelés dans le graphe (inférence CPU)
+        on_call: (modèle, bucket, "compile" | "compiled" | "eager", secondes) après chaque appel
+        is_out_of_memory: reconnaît un OOM (propagé, sans désactiver la compilation du modèle)
+    """
+
+    def __init__(self, models: Iterable[str], cache_dir: Optional[Path] = None, mode: str = "default",
+                 max_buckets: int = 8, freezing: bool = False,
+                 on_call: Optional[Callable[[str, str, str, float], None]] = None,
+                 is_out_of_memory: Optional[Callable[[BaseException], bool]] = None):
+        self.models = tuple(models)
+        self.is_out_of_memory = is_out_of_memory or (
+            lambda error: isinstance(error, (torch.cuda.OutOfMemoryError, MemoryError)))
+        self.cache_dir = cache_dir
+        self.mode = mode
+        self.max_buckets = max_buckets
+        self.on_call = on_call
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, BucketStats]] = {}
+        self._admitted: Dict[str, set] = {}
+        self._wrapped: Dict[str, "weakref.ref[BucketedModule]"] = {}
+        self.paused = False  # Tout en eager (mesure de référence du benchmark)
+        if not self.models:
+            return
+        unknown = [model for model in self.models if model not in COMPILABLE_MODELS]
+        if unknown:
+            raise ValueError(f"Invalid IMAGE_API_COMPILE entries: {', '.join(unknown)} "
+                             f"(expected {', '.join(COMPILABLE_MODELS)})")
+        self._configure(freezing)
+        self.load()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.models)
+
+    def _configure(self, freezing: bool):
+        import torch._dynamo
+        import torch._inductor.config as inductor_config
+
+        if self.cache_dir is not None:
+            # Lu une seule fois par inductor, à la première compilation
+            os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", str(self.cache_dir / "inductor"))
+        if hasattr(inductor_config, "fx_graph_cache"):
+            inductor_config.fx_graph_cache = True
+        inductor_config.freezing = freezing
+        torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, self.max_buckets)
+        logger.info(f"🛠️ torch.compile enabled for {', '.join(self.models)} (mode {self.mode}, "
+                    f"{self.max_buckets} shape buckets per model, freezing {'on' if freezing else 'off'}, "
+                    f"cache {os.environ.get('TORCHINDUCTOR_CACHE_DIR', 'temporary')})")
+
+    def wrap(self, name: str, module: torch.nn.Module) -> torch.nn.Module:
+        """
+        Compile module (par buckets) si son nom est désigné ("vae_decoder" par "vae", "esrgan_anime" par "esrgan")
+        À appeler par le chargeur, une fois le modèle sur son device et dans son format mémoire définitifs
+        """
+        if model_matches(name, self.models):
+            bucketed = BucketedModule(self, name, module)
+            module.forward = bucketed
+            with self._lock:
+                self._admitted[name] = set()
+                self._wrapped[name] = weakref.ref(bucketed)
+        return module
+
+    def release(self, *names: str):
+        """Libère les graphes compilés des modules déchargés (on_drop du registre) et les poids qu'ils retiennent"""
+        with self._lock:
+            released = [self._wrapped.pop(name)() for name in names if name in self._wrapped]
+            remaining = [ref() for ref in self._wrapped.values()]
+        released = [bucketed for bucketed in released if bucketed is not None]
+        if not released:
+            return
+        import torch._dynamo
+
+        detach_guard_finalizers([bucketed.module for bucketed in released])
+        torch._dynamo.reset()
+        with self._lock:
+            for bucketed in remaining:
+                if bucketed is not None:
+                    bucketed.buckets.clear()
+                    self._admitted[bucketed.name] = set()
+        logger.info(f"🛠️ Released compiled graphs of {', '.join(bucketed.name for bucketed in released)}")
+
+    @contextmanager
+    def eager(self) -> Iterator[None]:
+        """Appels en eager pendant le bloc, buckets compilés compris (mesure de référence)"""
+        self.paused = True
+        try:
+            yield
+        finally:
+            self.paused = False
+
+    def admit(self, name: str, bucket: str) -> bool:
+        """Le nouveau bucket d'un module fraîchement enveloppé peut-il être compilé (max_buckets)"""
+        with self._lock:
+            admitted = self._admitted.setdefault(name, set())
+            if bucket not in admitted and len(admitted) >= self.max_buckets:
+                return False
+            admitted.add(bucket)
+            return True
+
+    def record(self, name: str, bucket: str, compiled: bool, first: bool, seconds: float):
+        with self._lock:
+            buckets = self._stats.setdefault(name, {})
+            if bucket not in buckets and not compiled and len(buckets) >= self.max_buckets:
+                bucket = OTHER_BUCKET
+            stats = buckets.setdefault(bucket, BucketStats())
+            if first:
+                stats.compiled = True
+                stats.compile_s = seconds
+                stats.compiles += 1
+            elif compiled:
+                stats.compiled_calls += 1
+                stats.compiled_total_s += seconds
+            else:
+                stats.eager_calls += 1
+                stats.eager_total_s += seconds
+        if first:
+            logger.info(f"🛠️ Compiled {name} for {bucket} in {seconds:.1f}s")
+            self.save()
+        if self.on_call is not None:
+            self.on_call(name, bucket, "compile" if first else "compiled" if compiled else "eager", seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        """Mesures par modèle et par bucket, exposées sur le health check"""
+        with self._lock:
+            return {
+                "models": list(self.models),
+                "mode": self.mode,
+                "cache_dir": os.environ.get("TORCHINDUCTOR_CACHE_DIR"),
+                "buckets": {name: {bucket: stats.as_dict() for bucket, stats in buckets.items()}
+                            for name, buckets in self._stats.items()},
+            }
+
+    # ---------- Persistance des mesures ----------
+
+    @property
+    def manifest_path(self) -> Optional[Path]:
+        return self.cache_dir / MANIFEST_NAME if self.cache_dir is not None else None
+
+    def load(self):
+        path = self.manifest_path
+        if path is None or not path.exists():
+            return
+        try:
+            saved = json.loads(path.read_text(encoding="utf8"))
+            stats = {name: {bucket: BucketStats(**entry) for bucket, entry in buckets.items()}
+                     for name, buckets in saved.items()}
+        except (OSError, ValueError, TypeError) as e:
+            logger.warning(f"⚠️ Could not read compile buckets {path}: {e}")
+            return
+        with self._lock:
+            self._stats = stats
+        known = sum(1 for buckets in stats.values() for entry in buckets.values() if entry.compiled)
+        logger.info(f"🛠️ {known} compiled shape bucket(s) known from previous runs ({path})")
+
+    def save(self):
+        """Écrit les mesures (remplacement atomique): à chaque nouveau bucket compilé et à l'arrêt"""
+        path = self.manifest_path
+        if path is None or not self.enabled:
+            return
+        with self._lock:
+            saved = {name: {bucket: asdict(stats) for bucket, stats in buckets.items()}
+                     for name, buckets in self._stats.items()}
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            descriptor, temporary = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+            with os.fdopen(descriptor, "w", encoding="utf8") as file:
+                json.dump(saved, file, indent=2)
+            os.replace(temporary, path)
+        except OSError as e:
+            logger.warning(f"⚠️ Could not save compile buckets {path}: {e}")
+
+
+def detach_guard_finalizers(modules: Iterable[torch.nn.Module]):
+    """
+    Détache les weakref.finalize posés par les guards de dynamo sur ces modules (et leurs paramètres):
+    ils référencent le graphe tracé, qui garde les poids en vie tant que le finalizer existe
+    """
+    try:
+        from torch._dynamo.guards import CheckFunctionManager
+    except ImportError:
+        return
+    guarded = {id(item) for module in modules
+               for item in (module, *module.modules(), *module.parameters(), *module.buffers())}
+    # Un même CheckFunctionManager garde aussi d'autres objets (la classe du module, ...): tous ses finalizers
+    managers = []
+    for finalizer in list(weakref.finalize._registry):
+        info = finalizer.peek()
+        if info is not None and id(info[0]) in guarded and getattr(info[1], "__func__", None) is \
+                CheckFunctionManager.invalidate:
+            managers.append(info[1].__self__)
+    manager_ids = {id(manager) for manager in managers}
+    for finalizer in list(weakref.finalize._registry):
+        info = finalizer.peek()
+        if info is not None and id(getattr(info[1], "__self__", None)) in manager_ids:
+            finalizer.detach()
+
+
+def parse_compile_models(text: str) -> Tuple[str, ...]:
+    """ "unet,vae" -> ("unet", "vae"); "all" -> tous les modèles compilables; "" ou "0" -> ()"""
+    entries = tuple(entry.strip() for entry in text.split(",") if entry.strip())
+    if entries in (("0",), ("none",)):
+        return ()
+    if entries in (("1",), ("all",)):
+        return COMPILABLE_MODELS
+    return entries
@@ -0,0 +1,372 @@
+"""
+Registre de résidence des modèles pour le microservice d'images
+Suit l'empreinte mémoire estimée de chaque modèle face à un budget configurable
+et n'évince (LRU pondéré par le coût de rechargement) que lorsqu'un nouveau
+chargement dépasserait ce budget. La RAM CPU sert de palier intermédiaire:
+un modèle évincé du device y est d'abord déplacé avant d'être complètement libéré.
+Un modèle en cours d'utilisation (pinned) n'est jamais évincé ni déchargé.
+
+Ce module n'importe ni torch ni diffusers: les chargeurs et les callbacks de
+déplacement sont fournis par l'appelant, ce qui permet de le tester avec de
+faux modèles sur une machine sans GPU.
+"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+TIER_DEVICE = "device"
+TIER_OFFLOADED = "offloaded"
+TIER_UNLOADED = "unloaded"
+
+GB = 1024 ** 3
+
+
+def model_matches(name: str, patterns: Iterable[str]) -> bool:
+    """Le modèle name est-il désigné par l'un des motifs ("esrgan" couvre esrgan_general et esrgan_anime)"""
+    return any(name == pattern or name.startswith(f"{pattern}_") for pattern in patterns)
+
+
+@dataclass
+class ModelEntry:
+    """État de résidence d'un modèle enregistré"""
+    name: str
+    loader: Callable[[], Any]
+    size_bytes: int
+    offload: Optional[Callable[[Any], None]] = None
+    restore: Optional[Callable[[Any], None]] = None
+    on_drop: Optional[Callable[[], None]] = None
+    offload_size_bytes: Optional[int] = None  # Empreinte en RAM CPU une fois offloadé (poids seuls)
+    model: Any = None
+    tier: str = TIER_UNLOADED
+    last_used: float = 0.0
+    load_count: int = 0
+    total_load_time_s: float = 0.0
+    last_load_time_s: Optional[float] = None
+    last_restore_time_s: Optional[float] = None
+    offload_count: int = 0
+    drop_count: int = 0
+    pin_count: int = 0  # Utilisations en cours: ni éviction ni déchargement
+
+    @property
+    def offloaded_bytes(self) -> int:
+        """Place occupée dans le palier RAM CPU: les activations ne vivent que sur le device"""
+        return self.offload_size_bytes if self.offload_size_bytes is not None else self.size_bytes
+
+    @property
+    def reload_cost_s(self) -> float:
+        """Coût estimé pour ramener le modèle sur le device une fois évincé"""
+        if self.last_load_time_s is not None:
+            return self.last_load_time_s
+        return 1.0
+
+
+class ModelRegistry:
+    """
+    Gestionnaire unique de la résidence des modèles (device -> RAM CPU -> déchargé)
+
+    Args:
+        device_budget_bytes: mémoire du device que les modèles résidents peuvent occuper
+        offload_budget_bytes: RAM CPU utilisable comme palier intermédiaire (0 = désactivé)
+        on_release: appelé après chaque libération (ex: torch.cuda.empty_cache)
+        on_load: appelé avec (nom, durée en s, "load" ou "restore") après chaque chargement
+        clock: horloge monotone, injectable pour les tests
+    """
+
+    def __init__(self, device_budget_bytes: int, offload_budget_bytes: int = 0,
+                 on_release: Optional[Callable[[], None]] = None,
+                 on_load: Optional[Callable[[str, float, str], None]] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.device_budget_bytes = device_budget_bytes
+        self.offload_budget_bytes = offload_budget_bytes
+        self.on_release = on_release
+        self.on_load = on_load
+        self.clock = clock
+        self._entries: Dict[str, ModelEntry] = {}
+        # _lock protège la comptabilité (lectures rapides depuis la boucle asyncio),
+        # _load_lock sérialise les chargements, qui peuvent durer plusieurs secondes
+        self._lock = threading.RLock()
+        self._load_lock = threading.RLock()
+        self.eviction_count = 0
+
+    # ---------- Enregistrement ----------
+
+    def register(self, name: str, loader: Callable[[], Any], size_bytes: int,
+                 offload: Optional[Callable[[Any], None]] = None,
+                 restore: Optional[Callable[[Any], None]] = None,
+                 on_drop: Optional[Callable[[], None]] = None, offload_size_bytes: Optional[int] = None):
+        """
+        Déclare un modèle chargeable
+
+        Args:
+            name: identifiant du modèle ("sdxl", "esrgan_general", ...)
+            loader: charge le modèle sur le device et le retourne
+            size_bytes: empreinte estimée sur le device (poids + activations)
+            offload: déplace le modèle du device vers la RAM CPU (optionnel)
+            restore: ramène un modèle offloadé sur le device (requis si offload est fourni)
+            on_drop: appelé quand le modèle est complètement libéré
+            offload_size_bytes: empreinte en RAM CPU une fois offloadé (poids seuls; défaut: size_bytes)
+        """
+        with self._lock:
+            self._entries[name] = ModelEntry(name, loader, size_bytes, offload, restore, on_drop, offload_size_bytes)
+
+    # ---------- Accès ----------
+
+    def get(self, name: str) -> Any:
+        """
+        Retourne le modèle résident sur le device, en le chargeant ou en le
+        ramenant de la RAM CPU si nécessaire (évince d'autres modèles au besoin)
+        """
+        with self._load_lock:
+            entry = self._entry(name)
+
+            if entry.tier == TIER_DEVICE:
+                entry.last_used = self.clock()
+                return entry.model
+
+            self._make_room(entry.size_bytes, keep=name)
+
+            if entry.tier == TIER_OFFLOADED:
+                logger.info(f"⬆️ Restoring {name} from CPU RAM to device...")
+                start_time = time.monotonic()
+                entry.restore(entry.model)
+                restore_time = time.monotonic() - start_time
+                entry.last_restore_time_s = round(restore_time, 2)
+                if self.on_load is not None:
+                    self.on_load(name, restore_time, "restore")
+                with self._lock:
+                    entry.tier = TIER_DEVICE
+                    entry.last_used = self.clock()
+                logger.info(f"✅ {name} restored in {entry.last_restore_time_s:.1f}s")
+                return entry.model
+
+            start_time = time.monotonic()
+            model = entry.loader()
+            load_time = time.monotonic() - start_time
+            with self._lock:
+                entry.model = model
+                entry.tier = TIER_DEVICE
+                entry.last_used = self.clock()
+                entry.load_count += 1
+                entry.total_load_time_s = round(entry.total_load_time_s + load_time, 2)
+                entry.last_load_time_s = round(load_time, 2)
+            if self.on_load is not None:
+                self.on_load(name, load_time, "load")
+            logger.info(f"⏱️ {name} loaded in {load_time:.1f}s (load #{entry.load_count})")
+            return model
+
+    @contextmanager
+    def pinned(self, name: str) -> Iterator[None]:
+        """
+        Marque le modèle comme utilisé pendant le bloc: il n'est ni évincé ni déchargé,
+        et son inactivité ne compte qu'à partir de la fin du bloc (pas du début du job)
+        """
+        entry = self._entry(name)
+        with self._lock:
+            entry.pin_count += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                entry.pin_count -= 1
+                entry.last_used = self.clock()
+
+    def touch(self, name: str):
+        """Repousse le déchargement d'un modèle chargé (requête annoncée)"""
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and entry.tier != TIER_UNLOADED:
+                entry.last_used = self.clock()
+
+    def reload_cost_s(self, name: str) -> float:
+        """Dernier temps de chargement mesuré (estimation tant que le modèle n'a jamais été chargé)"""
+        return self._entry(name).reload_cost_s
+
+    def peek(self, name: str) -> Any:
+        """Retourne le modèle s'il est sur le device, sans le charger ni toucher à son LRU"""
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and entry.tier == TIER_DEVICE:
+                return entry.model
+        return None
+
+    def is_resident(self, name: str) -> bool:
+        with self._lock:
+            entry = self._entries.get(name)
+            return entry is not None and entry.tier == TIER_DEVICE
+
+    def is_loaded(self, name: str) -> bool:
+        """Vrai si le modèle est en mémoire (device ou RAM CPU)"""
+        with self._lock:
+            entry = self._entries.get(name)
+            return entry is not None and entry.tier != TIER_UNLOADED
+
+    # ---------- Libération ----------
+
+    def unload(self, name: str):
+        """Libère complètement un modèle (device et RAM CPU)"""
+        with self._load_lock:
+            entry = self._entry(name)
+            if entry.tier != TIER_UNLOADED:
+                self._drop(entry)
+                self._released()
+
+    def unload_all(self) -> List[str]:
+        """Libère tous les modèles, retourne les noms déchargés"""
+        with self._load_lock:
+            dropped = [entry.name for entry in self._entries.values() if entry.tier != TIER_UNLOADED]
+            for name in dropped:
+                self._drop(self._entries[name])
+            if dropped:
+                self._released()
+            return dropped
+
+    def unload_idle(self, max_idle_s: Union[float, Callable[[str, float], float]]) -> List[str]:
+        """
+        Libère les modèles inutilisés depuis plus de max_idle_s secondes (jamais un modèle en cours d'utilisation)
+
+        Args:
+            max_idle_s: délai commun, ou fonction (nom, coût de rechargement en s) -> délai du modèle
+        """
+        with self._load_lock:
+            now = self.clock()
+            with self._lock:
+                loaded = [entry for entry in self._entries.values()
+                          if entry.tier != TIER_UNLOADED and entry.pin_count == 0]
+            idle = []
+            for entry in loaded:
+                limit = max_idle_s(entry.name, entry.reload_cost_s) if callable(max_idle_s) else max_idle_s
+                if now - entry.last_used > limit:
+                    idle.append(entry.name)
+            for name in idle:
+                self._drop(self._entries[name])
+            if idle:
+                self._released()
+            return idle
+
+    # ---------- Comptabilité ----------
+
+    @property
+    def device_used_bytes(self) -> int:
+        with self._lock:
+            return sum(entry.size_bytes for entry in self._entries.values() if entry.tier == TIER_DEVICE)
+
+    @property
+    def offload_used_bytes(self) -> int:
+        with self._lock:
+            return sum(entry.offloaded_bytes for entry in self._entries.values() if entry.tier == TIER_OFFLOADED)
+
+    def status(self) -> Dict[str, Any]:
+        """Vue d'ensemble exposée sur le health check"""
+        now = self.clock()
+        with self._lock:
+            return {
+                "device_budget_gb": round(self.device_budget_bytes / GB, 2),
+                "device_used_gb": round(self.device_used_bytes / GB, 2),
+                "offload_budget_gb": round(self.offload_budget_bytes / GB, 2),
+                "offload_used_gb": round(self.offload_used_bytes / GB, 2),
+                "evictions": self.eviction_count,
+                "models": {
+                    entry.name: {
+                        "tier": entry.tier,
+                        "size_gb": round(entry.size_bytes / GB, 2),
+                        "offload_size_gb": round(entry.offloaded_bytes / GB, 2),
+                        "idle_s": round(now - entry.last_used, 1) if entry.tier != TIER_UNLOADED else None,
+                        "in_use": entry.pin_count > 0,
+                        "reload_cost_s": round(entry.reload_cost_s, 2),
+                    }
+                    for entry in self._entries.values()
+                },
+            }
+
+    def load_stats(self) -> Dict[str, Any]:
+        """Compteurs de chargements depuis le disque (un chargement = un cache miss complet)"""
+        with self._lock:
+            entries = list(self._entries.values())
+            last = max((e for e in entries if e.load_count), key=lambda e: e.last_used, default=None)
+            return {
+                "count": sum(e.load_count for e in entries),
+                "total_time_s": round(sum(e.total_load_time_s for e in entries), 2),
+                "last_time_s": last.last_load_time_s if last else None,
+                "by_model": {
+                    e.name: {"count": e.load_count, "total_time_s": e.total_load_time_s,
+                             "offloads": e.offload_count, "drops": e.drop_count}
+                    for e in entries if e.load_count
+                },
+            }
+
+    # ---------- Éviction ----------
+
+    def _entry(self, name: str) -> ModelEntry:
+        with self._lock:
+            entry = self._entries.get(name)
+        if entry is None:
+            raise KeyError(f"Unknown model: {name}")
+        return entry
+
+    def _keep_score(self, entry: ModelEntry, now: float) -> float:
+        """Valeur de garder un modèle: coût de rechargement / temps d'inactivité (plus bas = évincé d'abord)"""
+        idle_s = max(now - entry.last_used, 0.0)
+        return entry.reload_cost_s / (idle_s + 1.0)
+
+    def _make_room(self, needed_bytes: int, keep: str):
+        """Évince des modèles du device jusqu'à ce que needed_bytes tiennent dans le budget"""
+        now = self.clock()
+        evicted = False
+        while self.device_used_bytes + needed_bytes > self.device_budget_bytes:
+            with self._lock:
+                candidates = [entry for entry in self._entries.values()
+                              if entry.tier == TIER_DEVICE and entry.name != keep and entry.pin_count == 0]
+            if not candidates:
+                logger.warning(f"⚠️ {keep} ({needed_bytes / GB:.1f} GB) exceeds the device budget "
+                               f"({self.device_budget_bytes / GB:.1f} GB), loading anyway")
+                return
+            victim = min(candidates, key=lambda entry: self._keep_score(entry, now))
+            self._evict(victim, keep)
+            evicted = True
+        if evicted:
+            self._released()
+
+    def _evict(self, entry: ModelEntry, keep: str):
+        """Sort un modèle du device: vers la RAM CPU si possible, sinon libération complète"""
+        self.eviction_count += 1
+        if entry.offload is not None and self._make_offload_room(entry, keep):
+            logger.info(f"⬇️ Offloading {entry.name} to CPU RAM to make room on device")
+            entry.offload(entry.model)
+            with self._lock:
+                entry.tier = TIER_OFFLOADED
+                entry.offload_count += 1
+        else:
+            self._drop(entry)
+
+    def _make_offload_room(self, entry: ModelEntry, keep: str) -> bool:
+        """
+        Libère la RAM CPU (LRU) pour accueillir entry; False si impossible
+        keep, le modèle qui remonte sur le device, n'est pas libéré: sa place en RAM CPU se libère avec lui
+        """
+        if entry.offloaded_bytes > self.offload_budget_bytes:
+            return False
+        while True:
+            with self._lock:
+                offloaded = [e for e in self._entries.values() if e.tier == TIER_OFFLOADED and e.name != keep]
+            if sum(e.offloaded_bytes for e in offloaded) + entry.offloaded_bytes <= self.offload_budget_bytes:
+                return True
+            self._drop(min(offloaded, key=lambda e: e.last_used))
+
+    def _drop(self, entry: ModelEntry):
+        logger.info(f"🗑️ Unloading {entry.name} ({entry.tier})")
+        with self._lock:
+            entry.model = None
+            entry.tier = TIER_UNLOADED
+            entry.drop_count += 1
+        if entry.on_drop is not None:
+            entry.on_drop()
+
+    def _released(self):
+        if self.on_release is not None:
+            self.on_release()
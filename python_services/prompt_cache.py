@@ -0,0 +1,92 @@
+"""
+Cache LRU des embeddings de prompts pour le microservice d'images
+Les deux encodeurs de texte SDXL tournent à chaque génération sur le prompt et sur
+le negative prompt, alors que le negative prompt par défaut est quasiment toujours
+le même et que les rerolls d'un même prompt sont fréquents. Les embeddings sont
+mis en cache par (identité des encodeurs, texte), sous un plafond mémoire.
+
+Ce module n'importe pas torch: les valeurs sont des tuples de tenseurs dont on
+ne lit que la taille (element_size() * nelement()).
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def _tensors_nbytes(value: Tuple[Any, ...]) -> int:
+    return sum(tensor.element_size() * tensor.nelement() for tensor in value if tensor is not None)
+
+
+class PromptEmbeddingCache:
+    """
+    LRU borné en octets: (encoder_id, texte) -> tuple de tenseurs
+
+    Args:
+        max_bytes: taille maximale des tenseurs gardés (0 = cache désactivé)
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Tuple[Hashable, str], Tuple[Any, ...]]" = OrderedDict()
+        self._sizes: Dict[Tuple[Hashable, str], int] = {}
+        self._lock = threading.Lock()
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_compute(self, encoder_id: Hashable, text: str,
+                       compute: Callable[[], Tuple[Any, ...]]) -> Tuple[Any, ...]:
+        """Retourne les embeddings en cache, ou les calcule avec compute() et les garde"""
+        key = (encoder_id, text)
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+
+        # Encodage hors du verrou: seul le thread worker encode, les lectures de stats restent libres
+        value = compute()
+        self._put(key, value)
+        return value
+
+    def _put(self, key: Tuple[Hashable, str], value: Tuple[Any, ...]):
+        size = _tensors_nbytes(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            while self.used_bytes + size > self.max_bytes:
+                evicted_key, _ = self._entries.popitem(last=False)
+                self.used_bytes -= self._sizes.pop(evicted_key)
+                self.evictions += 1
+            self._entries[key] = value
+            self._sizes[key] = size
+            self.used_bytes += size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self.used_bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Compteurs exposés sur le health check"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "used_mb": round(self.used_bytes / 1024 ** 2, 2),
+                "max_mb": round(self.max_bytes / 1024 ** 2, 2),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "evictions": self.evictions,
+            }
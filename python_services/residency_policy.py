@@ -0,0 +1,125 @@
+"""
+Politique d'auto-unload des modèles, guidée par la demande
+Remplace le délai fixe de 120 s: chaque modèle reste chargé pendant un délai (keep-alive)
+calculé à partir de deux mesures:
+  - les écarts observés entre requêtes qui utilisent ce modèle: en session (soirée
+    chargée), le délai couvre la plupart des écarts, les requêtes suivantes trouvent
+    le modèle déjà chargé
+  - le coût de rechargement mesuré: un modèle long à recharger est gardé plus longtemps
+Le délai est borné par [min_s, max_s]. Les écarts plus longs que max_s (la nuit, entre
+deux sessions) ne comptent pas: après la dernière requête de la soirée, le modèle est
+libéré au bout de min_s, ou plus tard s'il est long à recharger.
+
+Ce module n'importe pas torch: l'horloge est injectable pour les tests.
+"""
+
+import math
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Optional
+
+# Écarts nécessaires avant de se fier aux mesures (sinon: min_s et coût de rechargement seuls)
+MIN_GAP_SAMPLES = 3
+
+
+def parse_keep_alive_overrides(text: str) -> Dict[str, float]:
+    """
+    Délais fixes par modèle, ex: "sdxl=900,esrgan_anime=60"
+
+    Raises:
+        ValueError: entrée mal formée
+    """
+    overrides = {}
+    for item in text.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, separator, seconds = item.partition("=")
+        if not separator or not name.strip():
+            raise ValueError(f"Invalid keep-alive override: {item!r} (expected model=seconds)")
+        overrides[name.strip()] = float(seconds)
+    return overrides
+
+
+def quantile(values, q: float) -> float:
+    """Quantile par rang le plus proche (pas d'interpolation: le délai retenu est un écart réellement observé)"""
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))
+    return ordered[index]
+
+
+class KeepAlivePolicy:
+    """
+    Délai d'inactivité avant déchargement, par modèle
+
+    Args:
+        min_s: délai minimal (et délai sans historique)
+        max_s: délai maximal; les écarts plus longs sont considérés comme des fins de session
+        coverage: part des écarts en session que le délai doit couvrir
+        reload_cost_factor: le modèle est gardé au moins reload_cost_factor x son temps de rechargement
+        history: nombre d'écarts gardés par modèle
+        overrides: délais fixes par modèle (remplacent le calcul)
+        clock: horloge monotone, injectable pour les tests
+    """
+
+    def __init__(self, min_s: float = 120.0, max_s: float = 1800.0, coverage: float = 0.9,
+                 reload_cost_factor: float = 4.0, history: int = 64, overrides: Optional[Dict[str, float]] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.min_s = min_s
+        self.max_s = max(max_s, min_s)
+        self.coverage = coverage
+        self.reload_cost_factor = reload_cost_factor
+        self.history = history
+        self.overrides = dict(overrides or {})
+        self.clock = clock
+        self._last_request: Dict[str, float] = {}
+        self._gaps: Dict[str, Deque[float]] = {}
+        self._requests: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def record_request(self, model: str):
+        """Une requête va utiliser ce modèle (appelé à la soumission, pas pour un hit du cache)"""
+        now = self.clock()
+        with self._lock:
+            last = self._last_request.get(model)
+            if last is not None:
+                self._gaps.setdefault(model, deque(maxlen=self.history)).append(now - last)
+            self._last_request[model] = now
+            self._requests[model] = self._requests.get(model, 0) + 1
+
+    def session_gap_s(self, model: str) -> Optional[float]:
+        """Écart couvrant `coverage` des écarts en session; None si le trafic est trop clairsemé"""
+        with self._lock:
+            gaps = list(self._gaps.get(model, ()))
+        in_session = [gap for gap in gaps if gap <= self.max_s]
+        # Moins de la moitié des écarts en session: requêtes isolées, rien à couvrir
+        if len(in_session) < MIN_GAP_SAMPLES or len(in_session) * 2 < len(gaps):
+            return None
+        return quantile(in_session, self.coverage)
+
+    def keep_alive_s(self, model: str, reload_cost_s: float) -> float:
+        """Délai d'inactivité après lequel le modèle peut être déchargé"""
+        if model in self.overrides:
+            return self.overrides[model]
+        keep_alive = reload_cost_s * self.reload_cost_factor
+        session_gap = self.session_gap_s(model)
+        if session_gap is not None:
+            keep_alive = max(keep_alive, session_gap)
+        return min(max(keep_alive, self.min_s), self.max_s)
+
+    def stats(self, reload_cost_s: Callable[[str], float]) -> Dict[str, Dict[str, Optional[float]]]:
+        """Demande observée et délai courant, par modèle ayant reçu des requêtes"""
+        with self._lock:
+            models = sorted(set(self._requests) | set(self.overrides))
+            requests = dict(self._requests)
+        stats = {}
+        for model in models:
+            session_gap = self.session_gap_s(model)
+            stats[model] = {
+                "requests": requests.get(model, 0),
+                "session_gap_s": round(session_gap, 1) if session_gap is not None else None,
+                "keep_alive_s": round(self.keep_alive_s(model, reload_cost_s(model)), 1),
+                "fixed": model in self.overrides,
+            }
+        return stats
@@ -0,0 +1,234 @@
+"""
+Cache disque des résultats, adressé par contenu
+Une génération avec seed fixé est entièrement déterminée par ses paramètres, et un
+upscale par (image, modèle, facteur): le résultat encodé est gardé sur disque sous le
+hash SHA-256 de la requête normalisée. Un hit est servi sans passer par le worker,
+donc sans toucher au GPU ni charger de modèle.
+
+Chaque entrée est un seul fichier <hash>.bin (en-tête JSON puis images concaténées),
+écrit dans un fichier temporaire puis renommé (os.replace): un lecteur ne voit jamais
+d'entrée à moitié écrite. La taille totale est bornée, les entrées les moins
+récemment servies sont supprimées en premier (date d'accès = mtime du fichier).
+"""
+
+import hashlib
+import json
+import logging
+import os
+import struct
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
+
+from image_responses import EncodedImage
+
+logger = logging.getLogger(__name__)
+
+ENTRY_SUFFIX = ".bin"
+HEADER_LENGTH = struct.Struct(">I")
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def request_key(parameters: Dict[str, Any]) -> str:
+    """Hash de la requête normalisée (clés triées, JSON compact)"""
+    canonical = json.dumps(parameters, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf8")).hexdigest()
+
+
+def file_digest(file: BinaryIO) -> str:
+    """SHA-256 d'un fichier uploadé, relu par morceaux puis rembobiné"""
+    digest = hashlib.sha256()
+    file.seek(0)
+    for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b""):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def bytes_digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def write_entry(path: Path, images: List[EncodedImage], info: Dict[str, Any]) -> int:
+    """
+    Écrit (images, info) dans un seul fichier, de façon atomique (temporaire + os.replace)
+
+    Returns:
+        Taille du fichier écrit
+    """
+    header = json.dumps({
+        "info": info,
+        "images": [{"format": image.format, "width": image.width, "height": image.height,
+                    "length": len(image.data)} for image in images],
+    }).encode("utf8")
+    fd, tmp_name = tempfile.mkstemp(prefix="tmp", dir=path.parent)
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.write(HEADER_LENGTH.pack(len(header)))
+            tmp_file.write(header)
+            for image in images:
+                tmp_file.write(image.data)
+        os.replace(tmp_name, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_name)
+        except OSError:
+            pass
+        raise
+    return HEADER_LENGTH.size + len(header) + sum(len(image.data) for image in images)
+
+
+def read_entry(path: Path) -> Tuple[List[EncodedImage], Dict[str, Any]]:
+    """Relit un fichier écrit par write_entry"""
+    with open(path, "rb") as entry_file:
+        (header_length,) = HEADER_LENGTH.unpack(entry_file.read(HEADER_LENGTH.size))
+        header = json.loads(entry_file.read(header_length))
+        images = [EncodedImage(entry_file.read(meta["length"]), meta["format"], meta["width"], meta["height"])
+                  for meta in header["images"]]
+    return images, header["info"]
+
+
+class ResultCache:
+    """
+    Cache LRU sur disque: hash de requête -> (images encodées, info)
+
+    Args:
+        directory: dossier des entrées (créé au besoin)
+        max_bytes: taille totale maximale sur disque (0 = cache désactivé)
+    """
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self._index: "OrderedDict[str, int]" = OrderedDict()  # clé -> taille, du plus ancien au plus récent
+        self._lock = threading.Lock()
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.bytes_saved = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def load_index(self):
+        """Reconstruit l'index LRU depuis le disque (au démarrage)"""
+        if not self.enabled:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(ENTRY_SUFFIX):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name[:-len(ENTRY_SUFFIX)], stat.st_size))
+            elif entry.name.startswith("tmp"):
+                # Écriture interrompue par un arrêt brutal
+                self._unlink(Path(entry.path))
+        with self._lock:
+            self._index.clear()
+            self.used_bytes = 0
+            for _, key, size in sorted(entries):
+                self._index[key] = size
+                self.used_bytes += size
+            self._evict_over_budget()
+        logger.info(f"💾 Result cache: {len(self._index)} entries, {self.used_bytes / 1024 ** 2:.1f} MB "
+                    f"in {self.directory.absolute()}")
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}{ENTRY_SUFFIX}"
+
+    @staticmethod
+    def _unlink(path: Path):
+        try:
+            path.unlink()
+        except OSError:
+            pass
+
+    # ---------- Lecture ----------
+
+    def get(self, key: str) -> Optional[Tuple[List[EncodedImage], Dict[str, Any]]]:
+        """Retourne (images, info) si la requête a déjà été calculée"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            known = key in self._index
+        if not known:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        path = self._path(key)
+        try:
+            images, info = read_entry(path)
+            os.utime(path)  # Persiste l'ordre LRU pour le prochain démarrage
+        except (OSError, ValueError, KeyError, struct.error) as e:
+            logger.warning(f"⚠️ Dropping unreadable cache entry {key}: {e}")
+            with self._lock:
+                self._forget(key)
+                self.misses += 1
+            self._unlink(path)
+            return None
+
+        served = sum(len(image.data) for image in images)
+        with self._lock:
+            if key in self._index:
+                self._index.move_to_end(key)
+            self.hits += 1
+            self.bytes_saved += served
+        return images, info
+
+    # ---------- Écriture ----------
+
+    def put(self, key: str, images: List[EncodedImage], info: Dict[str, Any]):
+        """Enregistre un résultat (écriture atomique); appelé hors du thread worker"""
+        if not self.enabled:
+            return
+        if sum(len(image.data) for image in images) > self.max_bytes:
+            return
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        try:
+            size = write_entry(self._path(key), images, info)
+        except OSError as e:
+            logger.warning(f"⚠️ Failed to store cache entry {key}: {e}")
+            return
+
+        with self._lock:
+            self._forget(key)
+            self._index[key] = size
+            self.used_bytes += size
+            self.stores += 1
+            self._evict_over_budget()
+
+    def _forget(self, key: str):
+        size = self._index.pop(key, None)
+        if size is not None:
+            self.used_bytes -= size
+
+    def _evict_over_budget(self):
+        while self.used_bytes > self.max_bytes and self._index:
+            key, size = self._index.popitem(last=False)
+            self.used_bytes -= size
+            self.evictions += 1
+            self._unlink(self._path(key))
+
+    def stats(self) -> Dict[str, Any]:
+        """Compteurs exposés sur le health check"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._index),
+                "used_mb": round(self.used_bytes / 1024 ** 2, 2),
+                "max_mb": round(self.max_bytes / 1024 ** 2, 2),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "bytes_saved": self.bytes_saved,
+            }
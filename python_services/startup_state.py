@@ -0,0 +1,89 @@
+"""
+Suivi du démarrage à froid du microservice d'images
+Le port est ouvert dès que l'application est importée: les poids se chargent ensuite
+en tâche de fond (sur le thread worker) puis une inférence de warmup initialise
+CUDA et les kernels. Pendant ce temps le service répond "warming" et les requêtes
+attendent dans la file derrière le préchargement.
+
+Chaque étape est datée depuis le début de l'import du service (imports lourds compris),
+ce qui donne le temps de démarrage jusqu'à "prêt". Ce module n'importe pas torch.
+"""
+
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+STATUS_STARTING = "starting"  # Import en cours, port pas encore ouvert
+STATUS_WARMING = "warming"  # Port ouvert, préchargement / warmup en cours
+STATUS_ONLINE = "online"  # Prêt (statut historique du health check)
+
+PHASE_IMPORTS = "imports"
+PHASE_SERVING = "serving"
+PHASE_WEIGHTS = "weights"
+PHASE_WARMUP = "warmup"
+PHASE_READY = "ready"
+
+
+class StartupState:
+    """
+    Étapes du démarrage et statut exposé sur le health check
+
+    Args:
+        started_at: instant de référence (clock()) pris avant les imports lourds
+        clock: horloge monotone, injectable pour les tests
+    """
+
+    def __init__(self, started_at: float, clock: Callable[[], float] = time.monotonic):
+        self.started_at = started_at
+        self.clock = clock
+        self.status = STATUS_STARTING
+        self.error: Optional[str] = None
+        self._phases: Dict[str, float] = {}  # étape -> secondes depuis started_at
+        self._lock = threading.Lock()
+
+    def mark(self, phase: str) -> float:
+        """Date la fin d'une étape (secondes depuis le début de l'import)"""
+        elapsed = self.clock() - self.started_at
+        with self._lock:
+            self._phases[phase] = elapsed
+        logger.info(f"⏱️ Startup: {phase} after {elapsed:.1f}s")
+        return elapsed
+
+    def warming(self):
+        """Le port va s'ouvrir: le service répond, les modèles se chargent en tâche de fond"""
+        self.status = STATUS_WARMING
+        self.mark(PHASE_SERVING)
+
+    def ready(self, error: Optional[str] = None):
+        """
+        Fin du préchargement (réussi ou non)
+        Un échec n'empêche pas de servir: le modèle sera rechargé à la première requête
+        """
+        self.error = error
+        elapsed = self.mark(PHASE_READY)
+        self.status = STATUS_ONLINE
+        if error:
+            logger.warning(f"⚠️ Startup preload failed after {elapsed:.1f}s: {error}")
+        else:
+            logger.info(f"✅ Ready {elapsed:.1f}s after startup")
+
+    @property
+    def is_ready(self) -> bool:
+        return self.status == STATUS_ONLINE
+
+    def phases(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._phases)
+
+    def as_dict(self) -> Dict[str, Any]:
+        phases = self.phases()
+        return {
+            "status": self.status,
+            "uptime_s": round(self.clock() - self.started_at, 2),
+            "phases_s": {phase: round(seconds, 2) for phase, seconds in phases.items()},
+            "startup_to_ready_s": round(phases[PHASE_READY], 2) if PHASE_READY in phases else None,
+            "error": self.error,
+        }
@@ -0,0 +1,74 @@
+"""
+Tests de l'upscale par tuiles (esrgan_tiling.py): sortie par tuiles contre sortie en un seul passage,
+sur un petit RRDBNet aux poids aléatoires
+Lancer depuis python_services: python -m pytest
+"""
+
+import numpy as np
+import pytest
+import torch
+
+from esrgan_tiling import TilePlan, plan_tiles, psnr, upscale_arrays
+
+rrdbnet_arch = pytest.importorskip("basicsr.archs.rrdbnet_arch")
+
+SCALE = 4
+MIN_PSNR_DB = 50.0
+MAX_ABS_DIFF = 4
+
+
+@pytest.fixture(scope="module")
+def model() -> torch.nn.Module:
+    torch.manual_seed(0)
+    return rrdbnet_arch.RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=16, num_block=1, num_grow_ch=8,
+                                scale=SCALE).eval()
+
+
+def random_image(height: int, width: int, seed: int) -> np.ndarray:
+    return np.random.default_rng(seed).integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+
+def upscale_all(model: torch.nn.Module, images, plans):
+    results = dict(upscale_arrays(model, images, SCALE, "cpu", False, plans, max_batch=4))
+    return [results[index] for index in range(len(images))]
+
+
+def assert_close(reference: np.ndarray, tiled: np.ndarray):
+    assert tiled.shape == reference.shape
+    diff = np.abs(reference.astype(np.int16) - tiled.astype(np.int16))
+    assert int(diff.max()) <= MAX_ABS_DIFF
+    assert psnr(reference, tiled) >= MIN_PSNR_DB
+
+
+@pytest.mark.parametrize("height, width", [(64, 64), (90, 77)])  # 90x77: pas un multiple de la tuile
+def test_tiled_matches_untiled(model, height, width):
+    image = random_image(height, width, seed=height)
+    reference, = upscale_all(model, [image], [None])
+    tiled, = upscale_all(model, [image], [TilePlan(tile=48, overlap=12, batch_size=2)])
+    assert reference.shape == (height * SCALE, width * SCALE, 3)
+    assert_close(reference, tiled)
+
+
+def test_fixed_tile_smaller_than_overlap(model):
+    # IMAGE_API_ESRGAN_TILE=32 avec le chevauchement par défaut (32): ramené au quart de la tuile
+    plan = plan_tiles(77, 90, available_bytes=1 << 30, half=False, overlap=32, tile=32)
+    assert plan.tile == 32 and plan.overlap == 8
+    image = random_image(90, 77, seed=3)
+    reference, = upscale_all(model, [image], [None])
+    tiled, = upscale_all(model, [image], [plan])
+    assert_close(reference, tiled)
+
+
+def test_fixed_tile_zero_or_covering_image_is_untiled():
+    assert plan_tiles(77, 90, available_bytes=1 << 30, half=False, tile=0) is None
+    assert plan_tiles(77, 90, available_bytes=1 << 30, half=False, tile=512) is None
+
+
+def test_images_batched_together_match_single_runs(model):
+    # Tuiles de plusieurs images (tailles différentes) dans les mêmes appels au modèle
+    images = [random_image(90, 77, seed=1), random_image(70, 61, seed=2)]
+    plan = TilePlan(tile=48, overlap=12, batch_size=4)
+    batched = upscale_all(model, images, [plan, plan])
+    for image, output in zip(images, batched):
+        reference, = upscale_all(model, [image], [None])
+        assert_close(reference, output)
@@ -0,0 +1,96 @@
+"""
+Tests du stockage des jobs asynchrones (job_store.py): déversement sur disque et bornes
+Lancer depuis python_services: python -m pytest
+"""
+
+import pytest
+
+import job_store
+from image_responses import EncodedImage
+from job_store import JobStore, STATUS_DONE
+
+
+def image(size: int) -> EncodedImage:
+    return EncodedImage(b"x" * size, "png", 8, 8)
+
+
+def complete(store: JobStore, job_id: str, size: int):
+    store.track(job_id, "generate")
+    store.complete(job_id, [image(size)], {"seed": 1})
+
+
+def test_large_result_spilled_and_readable(tmp_path):
+    store = JobStore(tmp_path, spill_threshold_bytes=100)
+    complete(store, "big", 1000)
+    record = store.get("big")
+    assert record.status == STATUS_DONE
+    assert record.images is None and record.spill_path.exists()
+    images, info = store.load_result(record)
+    assert images[0].data == b"x" * 1000 and info == {"seed": 1}
+    assert store.memory_bytes == 0 and store.disk_bytes == record.size_bytes
+
+
+def test_oldest_results_spilled_past_memory_bound(tmp_path):
+    store = JobStore(tmp_path, max_memory_bytes=250, spill_threshold_bytes=1000)
+    for job_id in ("a", "b", "c"):
+        complete(store, job_id, 100)
+    assert store.get("a").spill_path is not None
+    assert store.get("b").images is not None and store.get("c").images is not None
+    assert store.memory_bytes == 200
+
+
+def test_oldest_results_dropped_past_disk_bound(tmp_path):
+    store = JobStore(tmp_path, spill_threshold_bytes=10, max_disk_bytes=1500)
+    complete(store, "a", 1000)
+    path = store.get("a").spill_path
+    complete(store, "b", 1000)
+    assert store.get("a") is None and not path.exists()
+    assert store.get("b").spill_path.exists()
+    assert store.dropped_count == 1
+
+
+def test_spill_written_outside_lock(tmp_path, monkeypatch):
+    store = JobStore(tmp_path, spill_threshold_bytes=10)
+    write_entry = job_store.write_entry
+    locked_during_write = []
+
+    def checked_write(*args):
+        locked_during_write.append(store._lock.locked())
+        return write_entry(*args)
+
+    monkeypatch.setattr(job_store, "write_entry", checked_write)
+    complete(store, "a", 100)
+    assert locked_during_write == [False]
+    assert store.get("a").spill_path is not None
+
+
+def test_result_expired_during_spill_is_deleted(tmp_path, monkeypatch):
+    now = [0.0]
+    store = JobStore(tmp_path, ttl_s=10, spill_threshold_bytes=10, clock=lambda: now[0])
+    write_entry = job_store.write_entry
+
+    def slow_write(path, images, info):
+        size = write_entry(path, images, info)
+        now[0] += 60
+        store.purge_expired()  # Le job expire pendant l'écriture
+        return size
+
+    monkeypatch.setattr(job_store, "write_entry", slow_write)
+    complete(store, "a", 100)
+    assert store.get("a") is None
+    assert list(tmp_path.glob("*.bin")) == []
+    assert store.memory_bytes == 0 and store.disk_bytes == 0
+
+
+def test_get_forgets_expired_job_without_touching_disk(tmp_path, monkeypatch):
+    now = [0.0]
+    store = JobStore(tmp_path, ttl_s=10, spill_threshold_bytes=10, clock=lambda: now[0])
+    complete(store, "a", 100)
+    path = store.get("a").spill_path
+    now[0] += 60
+    monkeypatch.setattr(job_store.os, "unlink", lambda path: pytest.fail("get() deleted a file"))
+    assert store.get("a") is None
+    assert path.exists() and store.disk_bytes == 0
+    monkeypatch.undo()
+    store.purge_expired()  # Depuis un thread dans l'API (complete(), tâche périodique)
+    assert not path.exists()
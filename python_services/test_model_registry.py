@@ -0,0 +1,187 @@
+"""
+Tests du registre de résidence (model_registry.py), avec de faux modèles et une horloge injectée
+Lancer depuis python_services: python -m pytest
+"""
+
+import pytest
+
+from model_registry import GB, TIER_DEVICE, TIER_OFFLOADED, TIER_UNLOADED, ModelRegistry
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+class FakeModels:
+    """Chargeurs et callbacks de déplacement qui notent chaque appel"""
+
+    def __init__(self):
+        self.events = []
+
+    def loader(self, name: str):
+        def load():
+            self.events.append(("load", name))
+            return {"name": name, "device": "cuda"}
+        return load
+
+    def offload(self, model):
+        self.events.append(("offload", model["name"]))
+        model["device"] = "cpu"
+
+    def restore(self, model):
+        self.events.append(("restore", model["name"]))
+        model["device"] = "cuda"
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def models():
+    return FakeModels()
+
+
+def register(registry: ModelRegistry, models: FakeModels, name: str, size_gb: float, offload_gb: float = None,
+             offloadable: bool = True):
+    registry.register(
+        name, models.loader(name), int(size_gb * GB),
+        offload=models.offload if offloadable else None,
+        restore=models.restore if offloadable else None,
+        offload_size_bytes=int(offload_gb * GB) if offload_gb is not None else None
+    )
+
+
+def test_no_eviction_within_budget(clock, models):
+    registry = ModelRegistry(int(10 * GB), clock=clock)
+    register(registry, models, "a", 4, offloadable=False)
+    register(registry, models, "b", 4, offloadable=False)
+    registry.get("a")
+    registry.get("b")
+    assert registry.is_resident("a") and registry.is_resident("b")
+    assert registry.eviction_count == 0
+
+
+def test_lru_eviction_when_budget_exceeded(clock, models):
+    registry = ModelRegistry(int(10 * GB), clock=clock)
+    for name in ("a", "b", "c"):
+        register(registry, models, name, 4, offloadable=False)
+    registry.get("a")
+    clock.advance(10)
+    registry.get("b")
+    clock.advance(10)
+    registry.get("c")
+    # Même coût de rechargement: le moins récemment utilisé part
+    assert not registry.is_loaded("a")
+    assert registry.is_resident("b") and registry.is_resident("c")
+    assert registry.eviction_count == 1
+
+
+def test_eviction_weighted_by_reload_cost(clock, models):
+    registry = ModelRegistry(int(10 * GB), clock=clock)
+    for name in ("slow", "fast", "new"):
+        register(registry, models, name, 4, offloadable=False)
+    registry.get("slow")
+    registry.get("fast")
+    registry._entries["slow"].last_load_time_s = 60.0
+    registry._entries["fast"].last_load_time_s = 0.5
+    clock.advance(1)
+    registry.get("fast")  # fast plus récent, mais bien moins cher à recharger
+    clock.advance(10)
+    registry.get("new")
+    assert registry.is_resident("slow")
+    assert not registry.is_loaded("fast")
+
+
+def test_offload_before_drop(clock, models):
+    registry = ModelRegistry(int(10 * GB), offload_budget_bytes=int(8 * GB), clock=clock)
+    register(registry, models, "a", 6)
+    register(registry, models, "b", 6)
+    registry.get("a")
+    clock.advance(1)
+    registry.get("b")
+    assert registry.status()["models"]["a"]["tier"] == TIER_OFFLOADED
+    assert ("offload", "a") in models.events
+
+    clock.advance(1)
+    model = registry.get("a")  # Ramené de la RAM CPU, sans rechargement depuis le disque
+    assert model["device"] == "cuda"
+    assert models.events.count(("load", "a")) == 1
+    assert ("restore", "a") in models.events
+    assert registry.status()["models"]["b"]["tier"] == TIER_OFFLOADED
+
+
+def test_offload_uses_weights_only_size(clock, models):
+    # SDXL en float16: 8,5 Go sur le device (activations comprises), 7 Go de poids en RAM CPU
+    registry = ModelRegistry(int(10 * GB), offload_budget_bytes=int(8 * GB), clock=clock)
+    register(registry, models, "sdxl", 8.5, offload_gb=7)
+    register(registry, models, "big_esrgan", 4, offload_gb=0.1)
+    registry.get("sdxl")
+    clock.advance(1)
+    registry.get("big_esrgan")
+    assert registry.status()["models"]["sdxl"]["tier"] == TIER_OFFLOADED
+    assert registry.offload_used_bytes == int(7 * GB)
+
+
+def test_offload_drops_oldest_when_offload_budget_full(clock, models):
+    registry = ModelRegistry(int(5 * GB), offload_budget_bytes=int(5 * GB), clock=clock)
+    for name in ("a", "b", "c"):
+        register(registry, models, name, 4)
+    registry.get("a")
+    clock.advance(1)
+    registry.get("b")  # a -> RAM CPU
+    clock.advance(1)
+    registry.get("c")  # b -> RAM CPU, a n'y tient plus avec b: libéré
+    status = registry.status()["models"]
+    assert status["a"]["tier"] == TIER_UNLOADED
+    assert status["b"]["tier"] == TIER_OFFLOADED
+    assert status["c"]["tier"] == TIER_DEVICE
+
+
+def test_sdxl_and_esrgan_both_fit(clock, models):
+    registry = ModelRegistry(int(11 * GB), offload_budget_bytes=int(8 * GB), clock=clock)
+    register(registry, models, "sdxl", 8.5, offload_gb=7)
+    register(registry, models, "esrgan_general", 1.5, offload_gb=0.1)
+    registry.get("sdxl")
+    clock.advance(1)
+    registry.get("esrgan_general")
+    clock.advance(1)
+    registry.get("sdxl")
+    assert registry.is_resident("sdxl") and registry.is_resident("esrgan_general")
+    assert registry.eviction_count == 0
+    assert not any(event[0] in ("offload", "restore") for event in models.events)
+
+
+def test_pinned_model_never_evicted(clock, models):
+    registry = ModelRegistry(int(10 * GB), clock=clock)
+    register(registry, models, "a", 6, offloadable=False)
+    register(registry, models, "b", 6, offloadable=False)
+    registry.get("a")
+    clock.advance(100)
+    with registry.pinned("a"):
+        registry.get("b")  # Dépasse le budget, mais a est en cours d'utilisation
+        assert registry.is_resident("a")
+        assert registry.is_resident("b")
+        assert registry.eviction_count == 0
+
+
+def test_pinned_model_not_unloaded_when_idle(clock, models):
+    registry = ModelRegistry(int(10 * GB), clock=clock)
+    register(registry, models, "a", 2, offloadable=False)
+    registry.get("a")
+    with registry.pinned("a"):
+        clock.advance(1000)
+        assert registry.unload_idle(60) == []
+    # L'inactivité compte depuis la fin de l'utilisation
+    clock.advance(30)
+    assert registry.unload_idle(60) == []
+    clock.advance(31)
+    assert registry.unload_idle(60) == ["a"]
@@ -0,0 +1,138 @@
+"""
+Lecture des images envoyées au microservice sans passer par le base64
+Accepte, en plus du JSON historique:
+  - multipart/form-data: paramètres en champs texte, image en partie fichier
+  - corps brut (image/* ou application/octet-stream): paramètres dans la query string
+La taille est vérifiée pendant la réception: une requête trop grosse est coupée
+en 413 dès que la limite est franchie, sans jamais être entièrement en mémoire.
+Les fichiers passent par un SpooledTemporaryFile (débordement sur disque au-delà de 1 Mo).
+Un envoi multipart peut porter plusieurs fichiers sous le même nom (lots, ex: /upscale/batch).
+"""
+
+import tempfile
+from dataclasses import dataclass, field
+from typing import AsyncIterator, BinaryIO, Dict, List, Optional
+
+from fastapi import HTTPException, Request
+from starlette.datastructures import UploadFile
+from starlette.formparsers import MultiPartException, MultiPartParser
+
+SPOOL_MAX_MEMORY_BYTES = 1024 * 1024  # Au-delà, le corps déborde sur disque
+
+UPLOAD_MULTIPART = "multipart"
+UPLOAD_RAW = "raw"
+UPLOAD_JSON = "json"
+
+
+@dataclass
+class ParsedUpload:
+    """Corps de requête décodé: champs texte et éventuel(s) fichier(s) image"""
+    kind: str
+    fields: Dict[str, str] = field(default_factory=dict)
+    file: Optional[BinaryIO] = None  # Premier fichier
+    size: int = 0
+    files: List[BinaryIO] = field(default_factory=list)  # Tous les fichiers, dans l'ordre d'envoi
+
+    def close(self):
+        for file in self.files:
+            file.close()
+        self.file = None
+        self.files = []
+
+
+def upload_kind(request: Request) -> str:
+    content_type = request.headers.get("content-type", "").lower()
+    if content_type.startswith("multipart/form-data"):
+        return UPLOAD_MULTIPART
+    if content_type.startswith("image/") or content_type.startswith("application/octet-stream"):
+        return UPLOAD_RAW
+    return UPLOAD_JSON
+
+
+def check_declared_size(request: Request, max_bytes: int):
+    """Refuse immédiatement si Content-Length annonce déjà trop"""
+    declared = request.headers.get("content-length")
+    if declared is not None and declared.isdigit() and int(declared) > max_bytes:
+        raise HTTPException(status_code=413, detail=f"Request body too large ({int(declared)} > {max_bytes} bytes)")
+
+
+async def limited_stream(request: Request, max_bytes: int) -> AsyncIterator[bytes]:
+    """Relaie le corps de la requête en coupant dès que max_bytes est dépassé"""
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        if received > max_bytes:
+            raise HTTPException(status_code=413, detail=f"Request body too large (> {max_bytes} bytes)")
+        yield chunk
+
+
+async def read_limited_body(request: Request, max_bytes: int) -> bytes:
+    """Corps complet (pour le JSON), borné à max_bytes"""
+    check_declared_size(request, max_bytes)
+    chunks = []
+    async for chunk in limited_stream(request, max_bytes):
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def _close_parts(parser: MultiPartParser):
+    """Ferme tous les fichiers temporaires créés par le parser, y compris la partie interrompue"""
+    files = [value.file for _, value in parser.items if isinstance(value, UploadFile)]
+    files.extend(getattr(parser, "_files_to_close_on_error", []))
+    for file in files:
+        file.close()
+
+
+async def parse_image_upload(request: Request, file_field: str, max_bytes: int, max_files: int = 1) -> ParsedUpload:
+    """
+    Lit un envoi multipart ou brut
+
+    Args:
+        file_field: nom de la partie fichier en multipart ("image", "reference_image", "images")
+        max_bytes: taille maximale du corps, vérifiée au fil de l'eau
+        max_files: nombre maximal de parties fichier en multipart (400 au-delà)
+    """
+    kind = upload_kind(request)
+    check_declared_size(request, max_bytes)
+
+    if kind == UPLOAD_MULTIPART:
+        parser = MultiPartParser(request.headers, limited_stream(request, max_bytes),
+                                 max_files=max_files, max_fields=32)
+        upload = ParsedUpload(kind)
+        try:
+            try:
+                form = await parser.parse()
+            except MultiPartException as e:
+                raise HTTPException(status_code=400, detail=e.message)
+            for key, value in form.multi_items():
+                if isinstance(value, UploadFile):
+                    if key == file_field:
+                        value.file.seek(0)
+                        upload.files.append(value.file)
+                        upload.size += value.size or 0
+                    else:
+                        await value.close()
+                else:
+                    upload.fields[key] = value
+        except BaseException:
+            # 413 en cours de lecture, annulation...: parties déjà écrites et partie en cours
+            _close_parts(parser)
+            raise
+        if upload.files:
+            upload.file = upload.files[0]
+        return upload
+
+    if kind == UPLOAD_RAW:
+        spooled = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY_BYTES)
+        size = 0
+        try:
+            async for chunk in limited_stream(request, max_bytes):
+                spooled.write(chunk)
+                size += len(chunk)
+        except BaseException:
+            spooled.close()
+            raise
+        spooled.seek(0)
+        return ParsedUpload(kind, dict(request.query_params), spooled, size, [spooled])
+
+    raise ValueError("JSON bodies are handled by the caller")
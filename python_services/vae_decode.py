@@ -0,0 +1,203 @@
+"""
+Décodage VAE des latents SDXL, à mémoire bornée
+Le pipeline s'arrête aux latents (output_type="latent"); le décodage est une étape séparée:
+  - par tranches: plusieurs images (ou tuiles) par appel au VAE, autant que la mémoire libre le permet
+  - par tuiles au-delà d'un seuil de résolution, ou dès qu'une image entière ne tiendrait pas
+    en mémoire: les tuiles de latents se chevauchent et les coutures sont fondues (pondération
+    linéaire, comme esrgan_tiling)
+  - durée et pic mémoire de chaque décodage (mesuré en CUDA, estimé sur CPU)
+Le pic ne dépend plus que de la taille de tuile: une grande toile n'oblige pas à décharger
+les autres modèles.
+
+La conversion reste celle de diffusers: VAE passé en fp32 s'il déborde en fp16 (force_upcast),
+division par scaling_factor, filigrane éventuel, puis [-1, 1] -> [0, 1].
+"""
+
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import torch
+
+from esrgan_tiling import blend_ramp, tile_starts
+
+logger = logging.getLogger(__name__)
+
+LATENT_SCALE = 8  # Un pixel de latent donne 8x8 pixels d'image
+# Activations du décodeur par pixel de sortie au pic (fp32, mesurées sur CPU avec le VAE SDXL);
+# la matrice d'attention du bloc central (quadratique en pixels de latent) est comptée à part
+BYTES_PER_OUTPUT_PIXEL_FP32 = 5 * 1024
+# Part de la mémoire libre qu'on s'autorise à utiliser (fragmentation, autres allocations)
+MEMORY_SAFETY_FACTOR = 0.75
+TILE_ALIGN = 8  # Pixels de latent (64 px)
+MIN_TILE = 32  # Pixels de latent (256 px)
+
+
+@dataclass
+class DecodePlan:
+    """Découpage retenu pour un décodage (tile et overlap en pixels de latent; tile None = images entières)"""
+    tile: Optional[int]
+    overlap: int
+    slice_size: int  # Images (ou tuiles) par appel au VAE
+
+    @property
+    def tiled(self) -> bool:
+        return self.tile is not None
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "mode": "tiled" if self.tiled else "full",
+            "tile": self.tile * LATENT_SCALE if self.tiled else None,
+            "overlap": self.overlap * LATENT_SCALE if self.tiled else None,
+            "slice_size": self.slice_size,
+        }
+
+
+def decode_bytes(latent_height: int, latent_width: int, element_size: int) -> int:
+    """Pic estimé du décodage d'un morceau: activations du décodeur et attention du bloc central"""
+    tokens = latent_height * latent_width
+    pixels = tokens * LATENT_SCALE ** 2
+    return pixels * BYTES_PER_OUTPUT_PIXEL_FP32 * element_size // 4 + tokens * tokens * element_size
+
+
+def plan_decode(latent_height: int, latent_width: int, count: int, available_bytes: int, element_size: int,
+                tiled_min_pixels: int, tile: Optional[int] = None, max_tile: int = 128, overlap: int = 16,
+                max_slice: int = 4) -> DecodePlan:
+    """
+    Choisit le découpage pour décoder count latents latent_height x latent_width
+
+    Args:
+        available_bytes: mémoire libre sur le device
+        element_size: octets par valeur pendant le décodage (4 si le VAE est passé en fp32)
+        tiled_min_pixels: au-delà (pixels d'une image), découpage en tuiles même si l'image tiendrait
+        tile: taille de tuile imposée (pixels de latent; 0 = jamais de tuiles), sinon d'après la mémoire
+        max_tile: côté maximal d'une tuile choisie d'après la mémoire (pixels de latent)
+        overlap: chevauchement entre tuiles voisines (pixels de latent)
+        max_slice: nombre maximal d'images (ou de tuiles) par appel au VAE
+    """
+    usable = available_bytes * MEMORY_SAFETY_FACTOR
+    whole = decode_bytes(latent_height, latent_width, element_size)
+    pixels = latent_height * latent_width * LATENT_SCALE ** 2
+    if tile == 0 or (tile is None and pixels <= tiled_min_pixels and whole <= usable):
+        return DecodePlan(None, 0, max(1, min(max_slice, count, int(usable // whole))))
+
+    if tile is None:
+        tile = max_tile
+        while tile > MIN_TILE and decode_bytes(tile, tile, element_size) > usable:
+            tile -= TILE_ALIGN
+    if tile >= max(latent_height, latent_width):
+        # Une seule tuile couvrirait toute l'image
+        return DecodePlan(None, 0, 1)
+    overlap = min(overlap, tile // 4)
+    per_call = decode_bytes(min(tile, latent_height), min(tile, latent_width), element_size)
+    return DecodePlan(tile, overlap, max(1, min(max_slice, int(usable // per_call))))
+
+
+def needs_upcasting(vae) -> bool:
+    """Le VAE SDXL déborde en fp16: diffusers le passe en fp32 pour décoder"""
+    return vae.dtype == torch.float16 and vae.config.force_upcast
+
+
+def _decode_tiled(vae, latents: torch.Tensor, plan: DecodePlan,
+                  check_cancelled: Optional[Callable[[], None]]) -> torch.Tensor:
+    count, _, height, width = latents.shape
+    tile_h, tile_w = min(plan.tile, height), min(plan.tile, width)
+    starts = [(y, x) for y in tile_starts(height, tile_h, plan.overlap)
+              for x in tile_starts(width, tile_w, plan.overlap)]
+
+    pieces = [(index, y, x) for index in range(count) for y, x in starts]
+    output = weights = None
+    tile_weights = {}
+    for offset in range(0, len(pieces), plan.slice_size):
+        if check_cancelled is not None:
+            check_cancelled()
+        chunk = pieces[offset:offset + plan.slice_size]
+        batch = torch.cat([latents[index:index + 1, :, y:y + tile_h, x:x + tile_w] for index, y, x in chunk])
+        decoded = vae.decode(batch, return_dict=False)[0].float()
+        if output is None:
+            # Facteur d'agrandissement lu sur la sortie (8 pour SDXL); même géométrie pour toutes
+            # les images: une seule carte de poids
+            scale = decoded.shape[-1] // tile_w
+            output = torch.zeros(count, decoded.shape[1], height * scale, width * scale, device=decoded.device)
+            weights = torch.zeros(height * scale, width * scale, device=decoded.device)
+            for y, x in starts:
+                weight_y = blend_ramp(tile_h * scale, plan.overlap * scale, y > 0, y + tile_h < height)
+                weight_x = blend_ramp(tile_w * scale, plan.overlap * scale, x > 0, x + tile_w < width)
+                tile_weights[y, x] = (weight_y[:, None] * weight_x[None, :]).to(decoded.device)
+                weights[y * scale:(y + tile_h) * scale, x * scale:(x + tile_w) * scale] += tile_weights[y, x]
+        for (index, y, x), result in zip(chunk, decoded):
+            region = (index, slice(None), slice(y * scale, (y + tile_h) * scale),
+                      slice(x * scale, (x + tile_w) * scale))
+            output[region] += result * tile_weights[y, x]
+    return output.div_(weights)
+
+
+def _decode_slices(vae, latents: torch.Tensor, plan: DecodePlan,
+                   check_cancelled: Optional[Callable[[], None]]) -> torch.Tensor:
+    slices = []
+    for offset in range(0, latents.shape[0], plan.slice_size):
+        if check_cancelled is not None:
+            check_cancelled()
+        slices.append(vae.decode(latents[offset:offset + plan.slice_size], return_dict=False)[0].float())
+    return torch.cat(slices)
+
+
+def decode_latents(pipeline, latents: torch.Tensor, plan_for: Callable[[torch.Tensor, int], DecodePlan],
+                   check_cancelled: Optional[Callable[[], None]] = None) -> Tuple[torch.Tensor, Dict[str, Any]]:
+    """
+    Décode la sortie latente d'un pipeline SDXL (N x 4 x h x w) en images N x 3 x H x W dans [0, 1]
+
+    Args:
+        plan_for: (latents, octets par valeur) -> DecodePlan
+        check_cancelled: appelé avant chaque appel au VAE (lève pour interrompre)
+
+    Returns:
+        (images sur le device du VAE, info: découpage, durée, pic mémoire)
+    """
+    vae = pipeline.vae
+    start_time = time.perf_counter()
+    measure = latents.device.type == "cuda"
+    if measure:
+        torch.cuda.synchronize(latents.device)
+        baseline = torch.cuda.memory_allocated(latents.device)
+        torch.cuda.reset_peak_memory_stats(latents.device)
+
+    upcast = needs_upcasting(vae)
+    plan = plan_for(latents, 4 if upcast or vae.dtype == torch.float32 else 2)
+    if upcast:
+        pipeline.upcast_vae()
+    try:
+        # upcast_vae garde l'entrée du décodeur en fp16 quand l'attention le permet
+        latents = latents.to(next(iter(vae.post_quant_conv.parameters())).dtype) / vae.config.scaling_factor
+        with torch.inference_mode():
+            if plan.tiled:
+                images = _decode_tiled(vae, latents, plan, check_cancelled)
+            else:
+                images = _decode_slices(vae, latents, plan, check_cancelled)
+    finally:
+        if upcast:
+            vae.to(dtype=torch.float16)
+
+    watermark = getattr(pipeline, "watermark", None)
+    if watermark is not None:
+        images = watermark.apply_watermark(images)
+    images = (images / 2 + 0.5).clamp_(0, 1)
+
+    if measure:
+        torch.cuda.synchronize(latents.device)
+        peak_bytes = torch.cuda.max_memory_allocated(latents.device) - baseline
+    else:
+        _, _, height, width = latents.shape
+        piece = (min(plan.tile, height), min(plan.tile, width)) if plan.tiled else (height, width)
+        element_size = 4 if upcast or vae.dtype == torch.float32 else 2
+        peak_bytes = decode_bytes(*piece, element_size) * plan.slice_size
+    info = {
+        **plan.as_dict(),
+        "decode_time_s": round(time.perf_counter() - start_time, 3),
+        "peak_memory_mb": round(peak_bytes / 1024 ** 2, 1),
+        "peak_memory_measured": measure,
+    }
+    logger.info(f"🖼️ VAE decode ({info['mode']}, {len(images)} image(s)) in {info['decode_time_s']:.2f}s, "
+                f"peak {info['peak_memory_mb']:.0f} MB{'' if measure else ' (estimated)'}")
+    return images, info
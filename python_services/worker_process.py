@@ -0,0 +1,381 @@
+"""
+Processus workers du mode coordinateur (IMAGE_API_WORKER_PROCESSES > 0)
+Le processus principal (FastAPI) garde la file, le registre des jobs, les caches et
+l'encodage des sorties; chaque processus worker possède un device (ou un ensemble de
+cœurs CPU) et ses propres modèles résidents. L'InferenceWorker du processus principal
+a une voie par processus worker: le thread de la voie lui envoie ses jobs un par un
+et attend le résultat, ce qui garde la priorité, les lots et l'affinité de modèle dans
+une seule file.
+
+Messages échangés sur le Pipe (pickle):
+  principal -> worker: ("call", call_id, méthode, args, jobs), ("cancel", job_id), ("stop",)
+  worker -> principal: ("event", job_id, événement, data)      progression SSE relayée
+                       ("metric", nom, valeur, labels)          métrique rejouée par le principal
+                       ("result", call_id, ok, payload, statut) fin de l'appel + résidence des modèles
+jobs liste les (job_id, job_type, aperçus demandés, déjà annulé) de l'appel: le worker crée
+leurs jetons d'annulation avant de l'exécuter. Les exceptions traversent sous forme de
+RemoteError et sont reconstruites côté principal (HTTPException, InterruptedError, OOM).
+
+Ce module n'importe pas torch: le processus worker l'importe (via le service) après avoir
+fixé son affinité CPU et CUDA_VISIBLE_DEVICES.
+"""
+
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Annulations reçues avant le job qu'elles visent (course entre la file et l'envoi), gardées pour lui
+EARLY_CANCELS_KEPT = 256
+
+
+@dataclass(frozen=True)
+class WorkerSpec:
+    """Ressources d'un processus worker"""
+    index: int
+    device: str = "cpu"  # "cpu" ou "cuda:N"
+    cpus: Tuple[int, ...] = ()  # Cœurs CPU réservés (vide = pas d'affinité)
+    memory_share: int = 1  # Nombre de workers qui se partagent la mémoire de ce device
+    process_count: int = 1  # Nombre total de workers (qui se partagent la RAM)
+    models: Tuple[str, ...] = ()  # Modèles servis (vide = tous), ex: ("sdxl",) ou ("esrgan",)
+
+    @property
+    def gpu(self) -> Optional[str]:
+        """Index CUDA à exposer au processus (CUDA_VISIBLE_DEVICES), None pour un worker CPU"""
+        kind, _, index = self.device.partition(":")
+        return (index or "0") if kind == "cuda" else None
+
+    def describe(self) -> str:
+        description = self.device
+        if self.cpus:
+            description += f" (cpus {min(self.cpus)}-{max(self.cpus)})"
+        if self.models:
+            description += f" for {'+'.join(self.models)}"
+        return description
+
+
+def parse_cpu_range(text: str) -> Tuple[int, ...]:
+    """ "0-3" -> (0, 1, 2, 3), "5" -> (5,)"""
+    first, separator, last = text.partition("-")
+    if not separator:
+        return (int(first),)
+    return tuple(range(int(first), int(last) + 1))
+
+
+def worker_specs(count: int, devices: str = "", cuda_count: int = 0,
+                 cpus: Sequence[int] = ()) -> List[WorkerSpec]:
+    """
+    Répartit les ressources entre count workers
+
+    Args:
+        devices: un device par worker, ex: "cuda:0,cuda:1" ou "cpu:0-7,cpu:8-15" (vide = automatique);
+            "=modèles" réserve le worker à des modèles, ex: "cpu:0-11=sdxl,cpu:12-15=esrgan"
+        cuda_count: GPU visibles; en automatique, le worker i prend le GPU i modulo cuda_count
+        cpus: cœurs disponibles; en automatique sans GPU, découpés en blocs contigus égaux
+
+    Raises:
+        ValueError: liste de devices mal formée ou de mauvaise longueur
+    """
+    entries = [entry.strip() for entry in devices.split(",") if entry.strip()]
+    if entries and len(entries) != count:
+        raise ValueError(f"IMAGE_API_WORKER_DEVICES lists {len(entries)} devices for {count} worker processes")
+    placements = []
+    for index in range(count):
+        if entries:
+            placement, _, served = entries[index].partition("=")
+            models = tuple(model.strip() for model in served.split("+") if model.strip())
+            kind, _, detail = placement.partition(":")
+            if kind == "cuda":
+                placements.append((f"cuda:{int(detail or 0)}", (), models))
+            elif kind == "cpu":
+                placements.append(("cpu", parse_cpu_range(detail) if detail else (), models))
+            else:
+                raise ValueError(f"Invalid worker device: {entries[index]!r} (expected cuda:N or cpu:A-B)")
+        elif cuda_count > 0:
+            placements.append((f"cuda:{index % cuda_count}", (), ()))
+        else:
+            chunk = len(cpus) // count
+            placements.append(("cpu", tuple(cpus[index * chunk:(index + 1) * chunk]) if chunk else (), ()))
+    return [WorkerSpec(index, device, cpu_set, sum(1 for other, *_ in placements if other == device), count, models)
+            for index, (device, cpu_set, models) in enumerate(placements)]
+
+
+class RemoteError(Exception):
+    """Exception levée dans un processus worker, sous une forme qui traverse le Pipe"""
+
+    def __init__(self, kind: str, message: str, status_code: Optional[int] = None):
+        super().__init__(kind, message, status_code)
+        self.kind = kind
+        self.message = message
+        self.status_code = status_code
+
+    @classmethod
+    def wrap(cls, error: BaseException) -> "RemoteError":
+        if isinstance(error, InterruptedError):
+            return cls("cancelled", str(error))
+        if isinstance(error, MemoryError):
+            return cls("memory", str(error) or "out of memory")
+        status_code = getattr(error, "status_code", None)
+        if status_code is not None:
+            return cls("http", str(getattr(error, "detail", error)), status_code)
+        return cls("error", str(error) or type(error).__name__)
+
+    def rebuild(self) -> BaseException:
+        """Exception équivalente côté processus principal (mêmes réponses HTTP que sans workers)"""
+        if self.kind == "cancelled":
+            return InterruptedError(self.message)
+        if self.kind == "memory":
+            return MemoryError(self.message)
+        if self.kind == "http":
+            from fastapi import HTTPException
+            return HTTPException(status_code=self.status_code, detail=self.message)
+        # Le message d'un OOM torch ("CUDA out of memory...") est gardé: is_out_of_memory le reconnaît
+        return RuntimeError(self.message)
+
+
+def rebuild_outcomes(outcomes: List[Any]) -> List[Any]:
+    """Résultats d'un lot: les RemoteError redeviennent les exceptions d'origine"""
+    return [outcome.rebuild() if isinstance(outcome, RemoteError) else outcome for outcome in outcomes]
+
+
+def portable_outcomes(outcomes: List[Any]) -> List[Any]:
+    """Résultats d'un lot côté worker: les exceptions deviennent des RemoteError"""
+    return [RemoteError.wrap(outcome) if isinstance(outcome, BaseException) else outcome for outcome in outcomes]
+
+
+# ==================== CÔTÉ PROCESSUS PRINCIPAL ====================
+
+class WorkerProcess:
+    """
+    Processus worker vu du processus principal
+    call() est appelé par le thread de la voie correspondante (un appel à la fois);
+    cancel() peut l'être depuis n'importe quel thread.
+
+    Args:
+        spec: ressources du worker
+        initializer: appelé avec le module du service dans le worker, après son import
+            (doit être picklable: fonction de module ou functools.partial)
+        on_event: (job_id, événement, data) pour chaque événement de progression du worker
+        on_metric: (nom, valeur, labels) pour chaque observation du worker
+    """
+
+    def __init__(self, spec: WorkerSpec, initializer: Optional[Callable[[Any], None]] = None,
+                 on_event: Optional[Callable[[str, str, Any], None]] = None,
+                 on_metric: Optional[Callable[[str, float, Dict[str, Any]], None]] = None):
+        self.spec = spec
+        self.initializer = initializer
+        self.on_event = on_event
+        self.on_metric = on_metric
+        self.process: Optional[multiprocessing.Process] = None
+        self.status: Dict[str, Any] = {}  # Dernière résidence rapportée (ModelRegistry.status())
+        self.restarts = 0
+        self._conn = None
+        self._send_lock = threading.Lock()
+        self._call_ids = itertools.count()
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def start(self):
+        """Lance le processus (spawn: le worker réimporte le service, sans hériter de l'état CUDA)"""
+        context = multiprocessing.get_context("spawn")
+        parent_conn, child_conn = context.Pipe()
+        self.process = context.Process(target=run_worker, args=(self.spec, child_conn, self.initializer),
+                                       name=f"image-worker-{self.spec.index}", daemon=True)
+        self.process.start()
+        child_conn.close()
+        self._conn = parent_conn
+        self.status = {}
+        logger.info(f"🧵 Worker process {self.spec.index} started on {self.spec.describe()} (pid {self.process.pid})")
+
+    def stop(self, timeout: float = 5.0):
+        if self.process is None:
+            return
+        try:
+            with self._send_lock:
+                self._conn.send(("stop",))
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+        self._conn.close()
+        self.process = None
+
+    def _send(self, message: tuple):
+        with self._send_lock:
+            self._conn.send(message)
+
+    def call(self, method: str, args: tuple = (), jobs: Iterable[tuple] = ()) -> Any:
+        """
+        Exécute une méthode du service dans le worker et retourne son résultat (bloquant)
+        Le worker est relancé s'il s'est arrêté (crash, OOM du système) depuis l'appel précédent.
+
+        Raises:
+            l'exception levée dans le worker (reconstruite), ou RuntimeError si le worker meurt pendant l'appel
+        """
+        if not self.alive:
+            if self.process is not None:
+                self.restarts += 1
+                logger.warning(f"⚠️ Worker process {self.spec.index} exited, restarting it")
+                self._conn.close()
+            self.start()
+        call_id = next(self._call_ids)
+        try:
+            self._send(("call", call_id, method, args, list(jobs)))
+            while True:
+                message = self._conn.recv()
+                kind = message[0]
+                if kind == "event":
+                    if self.on_event is not None:
+                        self.on_event(*message[1:])
+                elif kind == "metric":
+                    if self.on_metric is not None:
+                        self.on_metric(*message[1:])
+                elif kind == "result" and message[1] == call_id:
+                    break
+        except (EOFError, OSError) as e:
+            self.status = {}
+            raise RuntimeError(f"Worker process {self.spec.index} exited during {method}") from e
+        _, _, ok, payload, status = message
+        self.status = status
+        if ok:
+            return payload
+        # Hors du try: InterruptedError (job annulé) est une OSError
+        raise payload.rebuild()
+
+    def cancel(self, job_id: str):
+        """Transmet une annulation (sans effet si le worker n'a pas ce job)"""
+        if not self.alive:
+            return
+        try:
+            self._send(("cancel", job_id))
+        except (OSError, ValueError):
+            pass
+
+
+# ==================== CÔTÉ PROCESSUS WORKER ====================
+
+class ForwardingProgressHub:
+    """
+    Remplace le ProgressHub du service dans un worker: les événements partent vers le
+    processus principal, qui a les abonnés SSE. has_subscribers() répond d'après les
+    aperçus demandés à l'envoi du job (pas de décodage d'aperçu inutile).
+    """
+
+    def __init__(self, send: Callable[[tuple], None]):
+        self._send = send
+        self.preview_jobs = set()
+
+    def has_subscribers(self, job_id: str) -> bool:
+        return job_id in self.preview_jobs
+
+    def publish(self, job_id: str, event_type: str, data: Optional[dict] = None):
+        self._send(("event", job_id, event_type, data))
+
+
+def apply_placement(spec: WorkerSpec):
+    """Affinité CPU et GPU visible, à fixer avant d'importer torch"""
+    os.environ["CUDA_VISIBLE_DEVICES"] = spec.gpu if spec.gpu is not None else ""
+    if spec.cpus:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, spec.cpus)
+        # Un thread de calcul par cœur réservé (torch, OpenMP, MKL)
+        os.environ["OMP_NUM_THREADS"] = str(len(spec.cpus))
+        os.environ["MKL_NUM_THREADS"] = str(len(spec.cpus))
+
+
+def run_worker(spec: WorkerSpec, conn, initializer: Optional[Callable[[Any], None]] = None):
+    """Point d'entrée du processus worker"""
+    apply_placement(spec)
+    # Le worker exécute les jobs lui-même: pas de sous-workers, annulations reçues par le Pipe
+    os.environ["IMAGE_API_WORKER_PROCESSES"] = "0"
+    os.environ["IMAGE_API_CANCEL_BACKEND"] = "memory"
+    import image_generation_api as api
+
+    if spec.cpus and not os.environ.get("IMAGE_API_CPU_THREADS"):
+        # Sinon IMAGE_API_CPU_THREADS, borné aux cœurs réservés, a été appliqué à l'import (cpu_backend)
+        import torch
+        torch.set_num_threads(len(spec.cpus))
+    if initializer is not None:
+        initializer(api)
+    serve(api, conn, spec)
+
+
+def serve(api, conn, spec: WorkerSpec):
+    """
+    Boucle du worker: un thread lit le Pipe (jobs et annulations), le thread principal
+    exécute les appels dans l'ordre reçu, comme le thread worker en mode un seul processus
+    """
+    send_lock = threading.Lock()
+
+    def send(message: tuple):
+        with send_lock:
+            conn.send(message)
+
+    hub = ForwardingProgressHub(send)
+    api.progress_hub = hub
+    api.metrics.redirect(lambda name, value, labels: send(("metric", name, value, labels)))
+    api.share_device_memory(spec.memory_share, spec.process_count)
+    api.serve_models(spec.models)
+
+    calls: "queue.Queue[Optional[tuple]]" = queue.Queue()
+    early_cancels: "OrderedDict[str, None]" = OrderedDict()
+
+    def read():
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                calls.put(None)
+                return
+            if message[0] == "call":
+                # Jetons créés à la lecture: une annulation qui suit le job dans le Pipe le trouve
+                for job_id, job_type, previews, cancelled in message[4]:
+                    token = api.cancellation.register(job_id, job_type)
+                    if cancelled or job_id in early_cancels:
+                        early_cancels.pop(job_id, None)
+                        token.cancel()
+                    if previews:
+                        hub.preview_jobs.add(job_id)
+                calls.put(message)
+            elif message[0] == "cancel":
+                if not api.cancellation.cancel(message[1]):
+                    early_cancels[message[1]] = None
+                    while len(early_cancels) > EARLY_CANCELS_KEPT:
+                        early_cancels.popitem(last=False)
+            elif message[0] == "stop":
+                calls.put(None)
+                return
+
+    threading.Thread(target=read, name="worker-pipe-reader", daemon=True).start()
+    logger.info(f"✅ Worker process {spec.index} ready on {spec.describe()}")
+
+    while True:
+        message = calls.get()
+        if message is None:
+            return
+        _, call_id, method, args, jobs = message
+        try:
+            payload, ok = api.WORKER_METHODS[method](*args), True
+        except Exception as e:  # Remonte au processus principal, comme sur le thread worker (pas SystemExit)
+            payload, ok = RemoteError.wrap(e), False
+        finally:
+            for job_id, *_ in jobs:
+                api.cancellation.release(job_id)
+                hub.preview_jobs.discard(job_id)
+        try:
+            send(("result", call_id, ok, payload, api.model_registry.status()))
+        except (OSError, ValueError):
+            return  # Processus principal parti
+        except Exception as e:  # Résultat non picklable: l'appel échoue, le worker continue
+            logger.error(f"❌ Worker process {spec.index} could not send the result of {method}: {e}")
+            send(("result", call_id, False, RemoteError.wrap(e), api.model_registry.status()))
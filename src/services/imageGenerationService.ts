@@ -43,10 +43,84 @@ export interface UpscaleOptions {
     model?: "general" | "anime"; // Modèle à utiliser (general = photos, anime = illustrations)
 }
 
+interface ImageUpload {
+    field: string;
+    buffer: Buffer;
+    filename: string;
+}
+
+/**
+ * Construit le corps de la requête: JSON sans image, multipart/form-data avec l'image en fichier brut
+ */
+function buildImageRequestBody(fields: Record<string, any>, upload?: ImageUpload): { body: string | FormData; headers: Record<string, string> } {
+    if (!upload) {
+        return {body: JSON.stringify(fields), headers: {"Content-Type": "application/json"}};
+    }
+
+    const form = new FormData();
+    for (const [key, value] of Object.entries(fields)) {
+        if (value !== undefined && value !== null) {
+            form.append(key, String(value));
+        }
+    }
+    form.append(upload.field, new Blob([upload.buffer]), upload.filename);
+
+    // Le Content-Type (avec boundary) est positionné par fetch
+    return {body: form, headers: {}};
+}
+
+interface ImageApiResult {
+    success: boolean;
+    image: Buffer;
+    job_id?: string;
+    info: any;
+}
+
+/**
+ * Lit la réponse image de l'API: corps binaire (métadonnées dans les en-têtes X-*)
+ * ou ancien format JSON avec l'image en base64
+ */
+async function readImageResponse(response: Response): Promise<ImageApiResult> {
+    const contentType = response.headers.get("content-type") || "";
+
+    if (contentType.startsWith("image/")) {
+        const image = Buffer.from(await response.arrayBuffer());
+        const infoHeader = response.headers.get("x-image-info");
+        return {
+            success: true,
+            image,
+            job_id: response.headers.get("x-job-id") || undefined,
+            info: infoHeader ? JSON.parse(infoHeader) : {}
+        };
+    }
+
+    const data = await response.json();
+    return {
+        success: Boolean(data.success),
+        image: data.image ? Buffer.from(data.image, "base64") : Buffer.alloc(0),
+        job_id: data.job_id,
+        info: data.info || {}
+    };
+}
+
+/**
+ * Annonce une commande à venir au microservice: le modèle se charge pendant que la commande
+ * attend dans la queue globale (sans effet s'il est déjà en mémoire). Jamais bloquant.
+ */
+function prepareImagePipeline(pipeline: "txt2img" | "img2img" | "esrgan_general" | "esrgan_anime"): void {
+    const controller = new AbortController();
+    const timeoutId = setTimeout(() => controller.abort(), 5000);
+    fetch(`${IMAGE_API_URL}/prepare?pipeline=${pipeline}`, {method: "POST", signal: controller.signal})
+        .catch(error => logger.debug(`Prepare ${pipeline} failed: ${error}`))
+        .finally(() => clearTimeout(timeoutId));
+}
+
 /**
  * Génère une image avec Stable Diffusion via le microservice Python
  */
 export async function generateImage(options: GenerationOptions): Promise<{ path: string; attachment: AttachmentBuilder; jobId?: string }> {
+    prepareImagePipeline(options.referenceImagePath ? "img2img" : "txt2img");
+
     // Mettre la génération d'image dans la queue globale pour éviter les surcharges
     return enqueueGlobally(async () => {
         const mode = options.referenceImagePath ? "img2img" : "txt2img";
@@ -63,11 +137,14 @@ export async function generateImage(options: GenerationOptions): Promise<{ path:
             sampler: options.sampler || "DPM++ 2M Karras",
         };
 
-        // Si image de référence fournie, l'ajouter au payload
+        // Si image de référence fournie, l'envoyer en fichier brut (multipart, pas de base64)
+        let referenceImage: ImageUpload | undefined;
         if (options.referenceImagePath) {
-            const imageBuffer = fs.readFileSync(options.referenceImagePath);
-            const imageBase64 = imageBuffer.toString("base64");
-            payload.reference_image = imageBase64;
+            referenceImage = {
+                field: "reference_image",
+                buffer: fs.readFileSync(options.referenceImagePath),
+                filename: path.basename(options.referenceImagePath)
+            };
             payload.strength = options.strength || 0.75;
         }
 
@@ -93,14 +170,16 @@ export async function generateImage(options: GenerationOptions): Promise<{ path:
                 const controller = new AbortController();
                 const timeoutId = setTimeout(() => controller.abort(), 600000); // 10 minutes
 
+                const request = buildImageRequestBody(payload, referenceImage);
                 const response = await fetch(`${IMAGE_API_URL}/generate`, {
                     method: "POST",
                     headers: {
-                        "Content-Type": "application/json",
+                        ...request.headers,
+                        "Accept": "image/png, application/json;q=0.5", // PNG brut, métadonnées dans les en-têtes
                         "Connection": "close", // Désactiver keep-alive pour éviter les connexions stales
                         "User-Agent": "Netricsa-Bot/1.0"
                     },
-                    body: JSON.stringify(payload),
+                    body: request.body,
                     signal: controller.signal,
                     // @ts-ignore - undici-specific options
                     headersTimeout: 600000, // 10 minutes pour les headers (undici timeout)
@@ -123,19 +202,16 @@ export async function generateImage(options: GenerationOptions): Promise<{ path:
                     throw new Error(`Image API error: ${response.status} - ${error}`);
                 }
 
-                // Parser la réponse JSON
-                logger.info("Parsing response JSON...");
-                const data = await response.json();
-                logger.info("Response parsed successfully");
+                const data = await readImageResponse(response);
 
-                if (!data.success || !data.image) {
+                if (!data.success || data.image.length === 0) {
                     throw new Error("No image generated");
                 }
 
-                logger.info(`Image base64 size: ${data.image.length} chars`);
+                logger.info(`Image size: ${data.image.length} bytes`);
 
-                // Décoder le base64 et sauvegarder
-                const imageBuffer = Buffer.from(data.image, "base64");
+                // Sauvegarder
+                const imageBuffer = data.image;
                 const outputFilename = `gen_${mode}_${Date.now()}.png`;
                 const outputPath = path.join(OUTPUT_DIR, outputFilename);
                 fs.writeFileSync(outputPath, imageBuffer);
@@ -223,16 +299,20 @@ export async function generateImage(options: GenerationOptions): Promise<{ path:
  * Upscale une image
  */
 export async function upscaleImage(options: UpscaleOptions): Promise<{ path: string; attachment: AttachmentBuilder; jobId?: string }> {
+    prepareImagePipeline(options.model === "anime" ? "esrgan_anime" : "esrgan_general");
+
     // Mettre l'upscaling dans la queue globale pour éviter les surcharges
     return enqueueGlobally(async () => {
         const modelType = options.model || "general";
         logger.info(`Upscaling image with Real-ESRGAN ${modelType}: ${path.basename(options.imagePath)}`);
 
-        const imageBuffer = fs.readFileSync(options.imagePath);
-        const imageBase64 = imageBuffer.toString("base64");
+        const imageUpload: ImageUpload = {
+            field: "image",
+            buffer: fs.readFileSync(options.imagePath),
+            filename: path.basename(options.imagePath)
+        };
 
         const payload = {
-            image: imageBase64,
             scale: options.scale || 4,
             model: modelType
         };
@@ -260,14 +340,16 @@ export async function upscaleImage(options: UpscaleOptions): Promise<{ path: str
                 const controller = new AbortController();
                 const timeoutId = setTimeout(() => controller.abort(), 900000); // 15 minutes
 
+                const request = buildImageRequestBody(payload, imageUpload);
                 const response = await fetch(`${IMAGE_API_URL}/upscale`, {
                     method: "POST",
                     headers: {
-                        "Content-Type": "application/json",
+                        ...request.headers,
+                        "Accept": "image/png, application/json;q=0.5", // PNG brut, métadonnées dans les en-têtes
                         "Connection": "close", // Désactiver keep-alive pour éviter les connexions stales
                         "User-Agent": "Netricsa-Bot/1.0"
                     },
-                    body: JSON.stringify(payload),
+                    body: request.body,
                     signal: controller.signal,
                     // @ts-ignore - undici-specific options
                     timeout: 900000,
@@ -289,14 +371,14 @@ export async function upscaleImage(options: UpscaleOptions): Promise<{ path: str
                     throw new Error(`Upscale API error: ${response.status} - ${error}`);
                 }
 
-                const data = await response.json();
+                const data = await readImageResponse(response);
 
-                if (!data.success || !data.image) {
+                if (!data.success || data.image.length === 0) {
                     throw new Error("No upscaled image returned");
                 }
 
                 // Sauvegarder l'image upscalée
-                const upscaledBuffer = Buffer.from(data.image, "base64");
+                const upscaledBuffer = data.image;
                 const filename = `upscaled_x${options.scale || 4}_${Date.now()}.png`;
                 const filepath = path.join(OUTPUT_DIR, filename);
 
@@ -94,7 +94,13 @@ async function checkPythonAPIConnection(): Promise<boolean> {
         clearTimeout(timeoutId);
 
         if (response.ok) {
-            logger.info(`✅ Python API connection successful (${response.status})`);
+            // "warming": port ouvert, modèles en préchargement (les requêtes attendent dans la file)
+            const data = await response.json().catch(() => null);
+            if (data?.status === "warming") {
+                logger.info(`🔥 Python API reachable, models still warming up (${response.status})`);
+            } else {
+                logger.info(`✅ Python API connection successful (${response.status})`);
+            }
             return true;
         } else {
             logger.warn(`⚠️ Python API responded with status ${response.status}`);